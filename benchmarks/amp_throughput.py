@@ -0,0 +1,84 @@
+"""Measure the throughput of AMP method calls over a Unix socket.
+
+An object is published with a L{MethodCallServerFactory} on a Unix
+socket, like the broker does, and a remote object connected to it is
+called with arguments of growing sizes. Arguments bigger than an AMP
+value are sent in chunks, either pipelined like L{MethodCallSender} does
+or one at a time, waiting for each chunk to be acknowledged.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/amp_throughput.py [--megabytes N]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from landscape.lib.amp import (
+    MethodCallClientFactory, MethodCallSender, MethodCallServerFactory)
+
+
+class Sink(object):
+
+    def consume(self, data):
+        return len(data)
+
+
+@inlineCallbacks
+def measure(remote, size, total):
+    data = b"x" * size
+    calls = max(1, total // size)
+    start = timeit.default_timer()
+    for i in range(calls):
+        yield remote.consume(data)
+    returnValue((calls, timeit.default_timer() - start))
+
+
+@inlineCallbacks
+def main(options):
+    directory = tempfile.mkdtemp()
+    try:
+        socket = os.path.join(directory, "sink.sock")
+        port = reactor.listenUNIX(
+            socket, MethodCallServerFactory(Sink(), ["consume"]))
+        factory = MethodCallClientFactory(reactor)
+        connector = reactor.connectUNIX(socket, factory)
+        remote = yield factory.getRemoteObject()
+
+        total = options.megabytes * 1024 * 1024
+        print("%dMB sent with each argument size" % options.megabytes)
+        print("%-10s %8s %8s %10s %10s" % ("size", "window", "calls",
+                                           "calls/s", "MB/s"))
+        window = MethodCallSender._chunk_window
+        for size, windows in ((1024, [window]), (60 * 1024, [window]),
+                              (1024 * 1024, [1, window]),
+                              (8 * 1024 * 1024, [1, window])):
+            for chunk_window in windows:
+                MethodCallSender._chunk_window = chunk_window
+                calls, elapsed = yield measure(remote, size, total)
+                print("%-10s %8d %8d %10.0f %10.1f" % (
+                    "%dK" % (size // 1024), chunk_window, calls,
+                    calls / elapsed, calls * size / elapsed / 2 ** 20))
+        MethodCallSender._chunk_window = window
+
+        factory.stopTrying()
+        connector.disconnect()
+        yield port.stopListening()
+    finally:
+        shutil.rmtree(directory)
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=int, default=64)
+    options = parser.parse_args()
+    reactor.callWhenRunning(main, options)
+    reactor.run()
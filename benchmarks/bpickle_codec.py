@@ -0,0 +1,70 @@
+"""Compare the pure Python and compiled bpickle codecs.
+
+A few typical messages are encoded and decoded with each implementation.
+The compiled one needs to be built first, with C{make build3}.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/bpickle_codec.py [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from landscape.lib import bpickle
+
+
+MESSAGES = [
+    ("packages", {
+        "type": "packages", "api": b"3.2", "timestamp": 1234567890,
+        "installed": list(range(0, 20000, 2)),
+        "available": [(i, i + 100) for i in range(0, 20000, 200)],
+        "not-installed": list(range(1, 2000, 2))}),
+    ("processes", {
+        "type": "active-process-info", "api": b"3.2", "timestamp": 0,
+        "add-processes": [
+            {"pid": i, "name": u"process-%d" % i, "state": b"R",
+             "uid": 0, "gid": 0, "vm-size": 12345, "start-time": 1234,
+             "percent-cpu": 0.5}
+            for i in range(500)]}),
+    ("text", {
+        "type": "operation-result", "api": b"3.2", "operation-id": 1,
+        "status": 6,
+        "result-lines": [u"\N{SNOWMAN} output line %d" % i
+                         for i in range(10000)]}),
+]
+
+
+def get_codecs():
+    codecs = [("python", bpickle._py_dumps,
+               lambda data: bpickle._py_decode(data, 0, False))]
+    if bpickle._bpickle is not None:
+        decode = bpickle._bpickle.decode
+        codecs.append(("compiled", bpickle._bpickle.dumps,
+                       lambda data: decode(data, 0, False)))
+    return codecs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20,
+                        help="How many times each message is processed.")
+    args = parser.parse_args()
+    codecs = get_codecs()
+    if len(codecs) == 1:
+        print("The compiled codec isn't built, only timing the Python one.")
+    print("%-10s %-10s %8s %8s" % ("message", "codec", "dumps", "loads"))
+    for name, message in MESSAGES:
+        data = bpickle.dumps(message)
+        for codec, dumps, decode in codecs:
+            dumps_time = timeit.timeit(lambda: dumps(message),
+                                       number=args.number)
+            decode_time = timeit.timeit(lambda: decode(data),
+                                        number=args.number)
+            print("%-10s %-10s %7.3fs %7.3fs" % (
+                name, codec, dumps_time, decode_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Time decoding typical message payloads with bpickle.
+
+Each payload is decoded from C{bytes}, from a C{memoryview} of a
+C{bytearray}, like the data handed over by a socket, and with
+L{bpickle.load_stream} from a file holding it several times in a row.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/bpickle_decoder.py [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import timeit
+
+from landscape.lib import bpickle
+
+
+PAYLOADS = [
+    ("active-process-info", {
+        "type": "active-process-info", "timestamp": 1234567890,
+        "kill-all-processes": True,
+        "add-processes": [
+            {"pid": i, "name": u"process-%d" % i, "state": b"S",
+             "sleep-average": 0, "uid": 1000, "gid": 1000,
+             "vm-size": 123456, "start-time": 1234567, "percent-cpu": 0.5}
+            for i in range(1000)]}),
+    ("packages", {
+        "type": "packages", "timestamp": 1234567890,
+        "installed": [(i, i + 3) for i in range(0, 40000, 8)],
+        "available": list(range(1, 40000, 3)),
+        "not-installed": list(range(40000, 42000, 2))}),
+    ("add-packages", {
+        "type": "add-packages", "request-id": 1,
+        "packages": [
+            {"type": 65537, "name": u"package%d" % i,
+             "version": u"1.%d-0ubuntu1" % i, "section": u"misc",
+             "summary": u"Summary of package%d" % i,
+             "description": u"Long description of package%d\n" % i * 5,
+             "size": 123456, "installed-size": 654321,
+             "relations": [(131074, u"package%d = 1.%d" % (i, i)),
+                           (262148, u"libc6 >= 2.27"),
+                           (458768, u"package%d < 1.%d" % (i, i))]}
+            for i in range(500)]}),
+    ("network-activity", {
+        "type": "network-activity", "timestamp": 1234567890,
+        "activities": dict(
+            (b"eth%d" % i,
+             [(step, step * 1000, step * 2000)
+              for step in range(1234567890, 1234567890 + 300 * 120, 30)])
+            for i in range(4))}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20,
+                        help="How many times each payload is decoded.")
+    args = parser.parse_args()
+    print("%-20s %8s %8s %11s %8s" % ("payload", "size", "bytes",
+                                      "memoryview", "stream"))
+    for name, payload in PAYLOADS:
+        data = bpickle.dumps(payload)
+        view = memoryview(bytearray(data))
+        stream = data * args.number
+        bpickle.loads(data)  # Warm up.
+        bytes_time = timeit.timeit(lambda: bpickle.loads(data),
+                                   number=args.number)
+        view_time = timeit.timeit(lambda: bpickle.loads(view),
+                                  number=args.number)
+        stream_time = timeit.timeit(
+            lambda: list(bpickle.load_stream(io.BytesIO(stream))), number=1)
+        print("%-20s %7dK %7.3fs %10.3fs %7.3fs" % (
+            name, len(data) // 1024, bytes_time, view_time, stream_time))
+
+
+if __name__ == "__main__":
+    main()
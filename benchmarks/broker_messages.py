@@ -0,0 +1,109 @@
+"""Compare sending messages to the broker one by one and in batches.
+
+A L{BrokerServer} is published on a Unix socket, like the broker does, and
+a L{RemoteBroker} connected to it sends bursts of messages, like monitor
+plugins do when they run, with and without C{batch_messages}. Messages
+are queued in a real message store.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/broker_messages.py [--messages N]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from twisted.internet.defer import gatherResults, inlineCallbacks
+
+from landscape.client.amp import ComponentPublisher
+from landscape.client.broker.amp import RemoteBrokerConnector
+from landscape.client.broker.config import BrokerConfiguration
+from landscape.client.broker.server import BrokerServer
+from landscape.client.broker.store import get_default_message_store
+from landscape.client.reactor import LandscapeReactor
+from landscape.lib.persist import Persist
+
+
+class QueueingExchange(object):
+    """Queue messages in the store, like L{MessageExchange.send} does."""
+
+    def __init__(self, store):
+        self._store = store
+
+    def send(self, message, urgent=False):
+        message["timestamp"] = 0
+        return self._store.add(message)
+
+
+def make_broker(directory, reactor):
+    config_filename = os.path.join(directory, "client.conf")
+    with open(config_filename, "w") as config_file:
+        config_file.write("[client]\ndata_path = %s\nlog_dir = %s\n"
+                          % (directory, directory))
+    config = BrokerConfiguration()
+    config.load(["-c", config_filename])
+    os.mkdir(config.sockets_path)
+    store = get_default_message_store(
+        Persist(filename=os.path.join(directory, "broker.bpickle")),
+        config.message_store_path)
+    store.set_accepted_types(["memory-info"])
+    broker = BrokerServer(config, reactor, QueueingExchange(store), None,
+                          store, None)
+    return config, broker, store.get_session_id()
+
+
+@inlineCallbacks
+def send_messages(remote, session_id, messages, burst):
+    for i in range(0, messages, burst):
+        sent = [remote.send_message(
+            {"type": "memory-info",
+             "memory-info": [(j, 1024, 2048)]}, session_id)
+            for j in range(i, min(i + burst, messages))]
+        yield gatherResults(sent)
+
+
+@inlineCallbacks
+def run(reactor, options, results):
+    directory = tempfile.mkdtemp()
+    try:
+        config, broker, session_id = make_broker(directory, reactor)
+        publisher = ComponentPublisher(broker, reactor, config)
+        publisher.start()
+        connector = RemoteBrokerConnector(reactor, config)
+        remote = yield connector.connect()
+        for batch_messages in (False, True):
+            remote.batch_messages = batch_messages
+            start = timeit.default_timer()
+            yield send_messages(remote, session_id, options.messages,
+                                options.burst)
+            results.append(
+                (batch_messages, timeit.default_timer() - start))
+        connector.disconnect()
+        yield publisher.stop()
+    finally:
+        shutil.rmtree(directory)
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--burst", type=int, default=20,
+                        help="How many messages are sent at a time.")
+    options = parser.parse_args()
+    reactor = LandscapeReactor()
+    results = []
+    reactor.call_later(0, run, reactor, options, results)
+    reactor.run()
+    print("%d messages, %d at a time" % (options.messages, options.burst))
+    print("%-15s %8s" % ("batch_messages", "time"))
+    for batch_messages, elapsed in results:
+        print("%-15s %7.3fs" % (batch_messages, elapsed))
+
+
+if __name__ == "__main__":
+    main()
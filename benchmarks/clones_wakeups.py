@@ -0,0 +1,75 @@
+"""Count the reactor wake-ups of clients sharing a process, see --clones.
+
+Each clone schedules calls with the intervals used by the monitor and
+manager plugins, a fraction of a second after the previous clone, either
+with a C{LoopingCall} each, like before the periodic scheduler, or with a
+L{PeriodicScheduler}. A simulated hour is then run, and the distinct
+times at which calls were performed are counted as wake-ups. Wall-clock
+time isn't reported, since it would mostly measure the simulated clock.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/clones_wakeups.py [--clones N]
+"""
+from __future__ import print_function
+
+import argparse
+import random
+
+from twisted.internet.task import Clock, LoopingCall
+
+from landscape.lib.reactor import PeriodicScheduler
+
+
+INTERVALS = [5, 20, 30, 60, 300, 900]
+
+
+def looping_calls(clock):
+
+    def call_every(interval, f):
+        call = LoopingCall(f)
+        call.clock = clock
+        call.start(interval, now=False)
+
+    return call_every
+
+
+def periodic_scheduler(clock):
+    return PeriodicScheduler(clock).call_every
+
+
+def run(scheduler_factory, clones, duration):
+    clock = Clock()
+    call_every = scheduler_factory(clock)
+    times = []
+
+    def called():
+        times.append(clock.seconds())
+
+    for i in range(clones):
+        clock.advance(random.random())
+        for interval in INTERVALS:
+            call_every(interval, called)
+    for i in range(duration):
+        clock.advance(1)
+    return len(times), len(set(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clones", type=int, default=100)
+    parser.add_argument("--duration", type=int, default=3600,
+                        help="How many simulated seconds are run.")
+    args = parser.parse_args()
+    print("%d clones, %d calls each, %ds" % (args.clones, len(INTERVALS),
+                                             args.duration))
+    print("%-12s %8s %8s" % ("calls", "runs", "wakeups"))
+    random.seed(0)
+    for name, scheduler_factory in (("looping", looping_calls),
+                                    ("scheduler", periodic_scheduler)):
+        runs, wakeups = run(scheduler_factory, args.clones, args.duration)
+        print("%-12s %8d %8d" % (name, runs, wakeups))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Time firing events and registering and cancelling their handlers.
+
+Only the public reactor API is used, so the script can also be run on
+earlier revisions of the tree to compare them.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/event_handlers.py
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from landscape.lib.reactor import EventHandlingReactorMixin
+
+
+def handler(*args, **kwargs):
+    pass
+
+
+def time_fire(handlers, fires):
+    reactor = EventHandlingReactorMixin()
+    for i in range(handlers):
+        reactor.call_on("event", handler, priority=i % 5)
+    return timeit.timeit(lambda: reactor.fire("event", 1, key=2),
+                         number=fires)
+
+
+def time_register_cancel(handlers, pairs):
+    reactor = EventHandlingReactorMixin()
+    ids = [reactor.call_on("event", handler, priority=i % 5)
+           for i in range(handlers)]
+
+    def register_cancel():
+        for i in range(pairs):
+            ids.append(reactor.call_on("event", handler, priority=i % 5))
+            reactor.cancel_call(ids.pop(len(ids) // 2))
+
+    return timeit.timeit(register_cancel, number=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fires", type=int, default=10000)
+    parser.add_argument("--pairs", type=int, default=1000)
+    args = parser.parse_args()
+    print("%d fires with 50 handlers: %.3fs" % (
+        args.fires, time_fire(50, args.fires)))
+    print("%d register/cancel pairs among 200 handlers: %.3fs" % (
+        args.pairs, time_register_cancel(200, args.pairs)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Compare exchanges with and without keeping the connection alive.
+
+A local HTTPS server, with a throwaway self-signed certificate made with
+the openssl command, answers the exchanges of an L{HTTPTransport}. The
+server counts the TLS handshakes, telling full ones from resumed
+sessions.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/exchange_keep_alive.py [--exchanges N]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import timeit
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from landscape.client.broker.transport import HTTPTransport
+from landscape.lib import bpickle
+
+
+class ExchangeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = bpickle.dumps({"next-expected-sequence": 0, "messages": []})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingHTTPSServer(HTTPServer):
+    """Serve one connection at a time, counting the TLS handshakes."""
+
+    def __init__(self, certificate, key):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ExchangeHandler)
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certificate, key)
+        self.handshakes = 0
+        self.resumed = 0
+
+    def get_request(self):
+        sock, address = HTTPServer.get_request(self)
+        sock = self.context.wrap_socket(sock, server_side=True)
+        self.handshakes += 1
+        if sock.session_reused:
+            self.resumed += 1
+        return sock, address
+
+
+def make_certificate(directory):
+    certificate = os.path.join(directory, "cert.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-days", "1", "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1",
+         "-keyout", key, "-out", certificate],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate, key
+
+
+def run(certificate, key, keep_alive, exchanges):
+    server = CountingHTTPSServer(certificate, key)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "https://localhost:%d/message-system" % server.server_port
+        transport = HTTPTransport(None, url, certificate,
+                                  keep_alive=keep_alive)
+        start = timeit.default_timer()
+        for i in range(exchanges):
+            transport.exchange({"messages": []})
+        elapsed = timeit.default_timer() - start
+        transport.set_url(None)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    return elapsed, server.handshakes, server.resumed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--exchanges", type=int, default=50)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        certificate, key = make_certificate(directory)
+        print("%d exchanges" % args.exchanges)
+        print("%-12s %8s %12s %10s" % ("keep_alive", "time", "handshakes",
+                                       "resumed"))
+        for keep_alive in (False, True):
+            elapsed, handshakes, resumed = run(
+                certificate, key, keep_alive, args.exchanges)
+            print("%-12s %7.3fs %12d %10d" % (keep_alive, elapsed,
+                                              handshakes, resumed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Profile the memory used to serialize and send a 500-message exchange.
+
+The peak of the memory allocated by Python, as traced by C{tracemalloc},
+is reported for serializing the payload with L{bpickle.dumps}, for
+dumping it into a L{PayloadBuffer} like the transport does, compressed or
+not, and for a whole exchange of an L{HTTPTransport} with a local HTTP
+server. Memory allocated by curl itself isn't traced.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/exchange_memory.py [--messages N]
+"""
+from __future__ import print_function
+
+import argparse
+import threading
+import timeit
+import tracemalloc
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from landscape.client.broker.transport import (
+    REQUEST_ENCODINGS, HTTPTransport, dump_payload)
+from landscape.lib import bpickle
+
+
+class ExchangeHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        remaining = int(self.headers["Content-Length"])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        body = bpickle.dumps({"next-expected-sequence": 0, "messages": []})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_payload(messages):
+    payload = {"server-api": b"3.2", "client-api": b"3.8",
+               "sequence": 0, "accepted-types": b"",
+               "next-expected-sequence": 0, "total-messages": messages,
+               "messages": []}
+    for i in range(messages):
+        if i % 2:
+            message = {
+                "type": "active-process-info", "api": b"3.2",
+                "timestamp": 1234567890 + i,
+                "add-processes": [
+                    {"pid": pid, "name": u"process-%d" % pid, "state": b"S",
+                     "uid": 1000, "gid": 1000, "vm-size": 123456,
+                     "start-time": 1234567, "percent-cpu": 0.5}
+                    for pid in range(250)]}
+        else:
+            message = {
+                "type": "packages", "api": b"3.2",
+                "timestamp": 1234567890 + i,
+                "available": list(range(i, i + 6000, 3))}
+        payload["messages"].append(message)
+    return payload
+
+
+def profile(f):
+    tracemalloc.start()
+    try:
+        start = timeit.default_timer()
+        result = f()
+        elapsed = timeit.default_timer() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak, elapsed
+
+
+def exchange(payload):
+    server = HTTPServer(("127.0.0.1", 0), ExchangeHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:%d/message-system" % server.server_port
+        transport = HTTPTransport(None, url)
+        return profile(lambda: transport.exchange(payload))
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500)
+    args = parser.parse_args()
+    payload = make_payload(args.messages)
+    size = len(bpickle.dumps(payload))
+    codec = "compiled" if bpickle._bpickle is not None else "python"
+    print("%d messages, %.1fMB serialized, %s codec" % (
+        args.messages, size / 2.0 ** 20, codec))
+    print("%-18s %8s %8s" % ("step", "peak", "time"))
+    results = [("dumps", profile(lambda: bpickle.dumps(payload))),
+               ("dump_payload", profile(lambda: dump_payload(payload)))]
+    for encoding in REQUEST_ENCODINGS:
+        results.append(("dump_payload " + encoding,
+                        profile(lambda: dump_payload(payload, encoding))))
+    results.append(("exchange", exchange(payload)))
+    for name, (peak, elapsed) in results:
+        print("%-18s %6.1fMB %7.3fs" % (name, peak / 2.0 ** 20, elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Compare the message store backends.
+
+For each backend, a store is filled with messages, which are then walked,
+sent in batches and deleted like the exchange does, after reopening the
+store to account for loading its index. Then L{MessageStore.is_pending}
+is timed against a larger backlog, like the package reporter checks
+whether its requests were delivered.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/message_store.py [--messages N]
+        [--backlog N]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from landscape.client.broker.store import (
+    FileSystemBackend, MessageStore, SegmentBackend)
+from landscape.lib.persist import Persist
+from landscape.lib.schema import Bytes
+from landscape.message_schemas.message import Message
+
+
+BACKENDS = [
+    ("directory", FileSystemBackend),
+    ("segment", SegmentBackend),
+]
+
+
+def make_store(directory, backend_factory):
+    persist = Persist(filename=os.path.join(directory, "persist"))
+    store = MessageStore(persist, directory,
+                         backend=backend_factory(directory))
+    store.set_accepted_types(["data"])
+    store.add_schema(Message("data", {"data": Bytes()}))
+    return store
+
+
+def run(backend_factory, messages, batch):
+    directory = tempfile.mkdtemp()
+    try:
+        timings = []
+        store = make_store(directory, backend_factory)
+        start = timeit.default_timer()
+        for i in range(messages):
+            store.add({"type": "data", "data": b"x" * 512})
+        timings.append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        store = make_store(directory, backend_factory)
+        timings.append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        store.get_pending_messages()
+        timings.append(timeit.default_timer() - start)
+
+        start = timeit.default_timer()
+        while store.count_pending_messages():
+            sent = len(store.get_pending_messages(batch))
+            store.add_pending_offset(sent)
+            store.delete_old_messages()
+        timings.append(timeit.default_timer() - start)
+        return timings
+    finally:
+        shutil.rmtree(directory)
+
+
+def time_is_pending(backend_factory, messages, lookups):
+    directory = tempfile.mkdtemp()
+    try:
+        store = make_store(directory, backend_factory)
+        message_ids = [store.add({"type": "data", "data": b"x" * 64})
+                       for i in range(messages)]
+        store.set_pending_offset(messages // 2)
+        step = max(1, messages // lookups)
+        checked = message_ids[::step][:lookups]
+        return timeit.timeit(
+            lambda: [store.is_pending(message_id) for message_id in checked],
+            number=1)
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--batch", type=int, default=100,
+                        help="How many messages are sent per exchange.")
+    parser.add_argument("--backlog", type=int, default=50000,
+                        help="How many messages are pending for is_pending.")
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+    print("%d messages, %d per exchange" % (args.messages, args.batch))
+    print("%-10s %8s %8s %8s %8s" % ("backend", "add", "open", "walk",
+                                     "send"))
+    for name, backend_factory in BACKENDS:
+        timings = run(backend_factory, args.messages, args.batch)
+        print("%-10s" % name + "".join("%8.3fs" % t for t in timings))
+    print()
+    print("%d is_pending calls against %d messages" % (args.lookups,
+                                                       args.backlog))
+    for name, backend_factory in BACKENDS:
+        print("%-10s %8.3fs" % (name, time_is_pending(
+            backend_factory, args.backlog, args.lookups)))
+
+
+if __name__ == "__main__":
+    main()
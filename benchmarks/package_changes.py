@@ -0,0 +1,152 @@
+"""Time the package change detection of the reporter on many packages.
+
+A synthetic Packages index is added as a channel of an L{AptFacade} in a
+temporary Apt root, with a tenth of its packages installed, and the ids of
+all their hashes are put in a lookaside hash=>id database. The changes are
+then detected twice, once with everything to report and once with nothing,
+looking the ids up in the database itself or in a L{HashIdIndex} copy.
+
+The memory taken by a L{HashIdIndex} of the database is compared with the
+one of a C{dict} holding the same mappings.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/package_changes.py [--packages N]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+import tracemalloc
+
+from twisted.internet.defer import succeed
+
+from landscape.client.package import reporter
+from landscape.client.package.reporter import (
+    PackageReporter, PackageReporterConfiguration)
+from landscape.lib.apt.package.facade import AptFacade
+from landscape.lib.apt.package.store import (
+    HashIdIndex, HashIdStore, PackageStore)
+from landscape.lib.testing import FakeReactor
+
+
+STANZA = """\
+Package: package%(index)d
+Priority: optional
+Section: misc
+Installed-Size: 1234
+Maintainer: Someone
+Architecture: all
+Version: 1.0
+Depends: package%(depend)d
+%(status)sDescription: short description
+ long description
+
+"""
+
+
+def write_stanzas(filename, indexes, packages, status=""):
+    with open(filename, "w") as index_file:
+        for index in indexes:
+            index_file.write(STANZA % {"index": index, "status": status,
+                                       "depend": (index * 7) % packages})
+
+
+class FakeBroker(object):
+
+    def send_message(self, message, session_id, urgent=False):
+        return succeed(None)
+
+
+def make_facade(root, packages):
+    deb_dir = os.path.join(root, "repository")
+    os.mkdir(deb_dir)
+    write_stanzas(os.path.join(deb_dir, "Packages"), range(packages),
+                  packages)
+    facade = AptFacade(root=root)
+    write_stanzas(os.path.join(root, "var", "lib", "dpkg", "status"),
+                  range(0, packages, 10), packages,
+                  status="Status: install ok installed\n")
+    facade.add_channel_apt_deb("file://%s" % deb_dir, "./", trusted=True)
+    facade.refetch_package_index = True
+    facade.reload_channels()
+    return facade
+
+
+def make_hash_id_db(filename, facade):
+    hash_id_db = HashIdStore(filename)
+    hash_id_db.set_hash_ids(dict(
+        (hash, id) for id, hash in enumerate(facade.get_package_hashes(), 1)))
+    return hash_id_db
+
+
+def detect_changes(root, facade, hash_id_db_filename, in_memory):
+    data_path = tempfile.mkdtemp(dir=root)
+    store = PackageStore(os.path.join(data_path, "package.database"))
+    store.add_hash_id_db(hash_id_db_filename, in_memory=in_memory)
+    config = PackageReporterConfiguration()
+    config.data_path = data_path
+    package_reporter = PackageReporter(store, facade, FakeBroker(), config,
+                                       FakeReactor())
+    timings = []
+    for i in range(2):
+        start = timeit.default_timer()
+        package_reporter._compute_packages_changes()
+        timings.append(timeit.default_timer() - start)
+    return timings
+
+
+def measure_memory(hash_id_db):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        index = HashIdIndex(hash_id_db)
+        index_size = tracemalloc.get_traced_memory()[0] - before
+        before = tracemalloc.get_traced_memory()[0]
+        mappings = dict(hash_id_db.get_sorted_hash_ids())
+        dict_size = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del index, mappings
+    return index_size, dict_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=100000)
+    args = parser.parse_args()
+    root = tempfile.mkdtemp()
+    try:
+        lsb_release = os.path.join(root, "lsb-release")
+        with open(lsb_release, "w") as lsb_file:
+            lsb_file.write("DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=18.04\n"
+                           "DISTRIB_CODENAME=bionic\n"
+                           "DISTRIB_DESCRIPTION=\"Ubuntu 18.04\"\n")
+        reporter.LSB_RELEASE_FILENAME = lsb_release
+        facade = make_facade(root, args.packages)
+        hash_id_db_filename = os.path.join(root, "hash-id-db")
+        hash_id_db = make_hash_id_db(hash_id_db_filename, facade)
+
+        installed = len(range(0, args.packages, 10))
+        print("%d packages, %d installed" % (args.packages, installed))
+        print("%-10s %8s %10s" % ("lookups", "changes", "no changes"))
+        for name, in_memory in (("database", False), ("in memory", True)):
+            timings = detect_changes(root, facade, hash_id_db_filename,
+                                     in_memory)
+            print("%-10s %7.3fs %9.3fs" % (name, timings[0], timings[1]))
+
+        index_size, dict_size = measure_memory(hash_id_db)
+        print()
+        print("%-10s %8s %10s" % ("memory", "total", "per hash"))
+        for name, size in (("index", index_size), ("dict", dict_size)):
+            print("%-10s %6.1fMB %9.1fB" % (name, size / 2.0 ** 20,
+                                            float(size) / args.packages))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
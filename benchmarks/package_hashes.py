@@ -0,0 +1,110 @@
+"""Time reloading the channels with and without the package hash cache.
+
+A synthetic Packages index, with relations between its packages, is added
+as a channel of an L{AptFacade} in a temporary Apt root, like in the
+facade tests. The channels are then reloaded by new facades, computing the
+hashes of all the packages, or finding them in the hash cache written by
+the previous reload, or computing them in worker processes. The time it
+takes to read all the package records is given for comparison, since the
+hash cache keys are built without reading them.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/package_hashes.py [--packages N]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+
+from landscape.lib.apt.package.facade import AptFacade
+
+
+STANZA = """\
+Package: package%(index)d
+Priority: optional
+Section: misc
+Installed-Size: 1234
+Maintainer: Someone
+Architecture: all
+Source: source
+Version: 1.%(index)d
+Provides: virtual%(virtual)d
+Depends: package%(depend1)d (>= 1.0), package%(depend2)d | virtual%(virtual)d
+Conflicts: package%(conflict)d (<< 1.0)
+Filename: pool/package%(index)d.deb
+Size: 1000
+Description: short description
+ long description
+
+"""
+
+
+def create_packages_file(deb_dir, packages):
+    with open(os.path.join(deb_dir, "Packages"), "w") as packages_file:
+        for index in range(packages):
+            packages_file.write(STANZA % {
+                "index": index, "virtual": index % 100,
+                "depend1": (index * 7) % packages,
+                "depend2": (index * 13) % packages,
+                "conflict": (index + 1) % packages})
+
+
+def reload_channels(root, refetch=False, hash_cache_filename=None,
+                    hash_workers=0):
+    facade = AptFacade(root=root)
+    facade.refetch_package_index = refetch
+    facade.hash_cache_filename = hash_cache_filename
+    facade.hash_workers = hash_workers
+    start = timeit.default_timer()
+    facade.reload_channels()
+    return facade, timeit.default_timer() - start
+
+
+def read_records(facade):
+    start = timeit.default_timer()
+    for version in facade.get_packages():
+        version.record
+    return timeit.default_timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packages", type=int, default=50000)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    root = tempfile.mkdtemp()
+    try:
+        deb_dir = os.path.join(root, "repository")
+        os.mkdir(deb_dir)
+        create_packages_file(deb_dir, args.packages)
+        facade = AptFacade(root=root)
+        facade.add_channel_apt_deb("file://%s" % deb_dir, "./", trusted=True)
+        reload_channels(root, refetch=True)
+        hash_cache_filename = os.path.join(root, "hash-cache")
+
+        print("%d packages" % args.packages)
+        print("%-22s %8s" % ("reload", "time"))
+        facade, elapsed = reload_channels(root)
+        print("%-22s %7.3fs" % ("no cache", elapsed))
+        print("%-22s %7.3fs" % ("(reading the records)",
+                                read_records(facade)))
+        for name, cold, hash_workers in (
+                ("cold cache", True, 0),
+                ("warm cache", False, 0),
+                ("cold cache, workers", True, args.workers)):
+            if cold and os.path.exists(hash_cache_filename):
+                os.unlink(hash_cache_filename)
+            facade, elapsed = reload_channels(
+                root, hash_cache_filename=hash_cache_filename,
+                hash_workers=hash_workers)
+            print("%-22s %7.3fs" % (name, elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
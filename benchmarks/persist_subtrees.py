@@ -0,0 +1,59 @@
+"""Time setting and getting large subtrees of a Persist.
+
+A subtree of 10k user-like dicts, like the ones the users plugin keeps,
+is set and got back, and a value deep in a small subtree is got by its
+path string. The time of a C{copy.deepcopy} of the subtree, which Persist
+used to make for each set and get, is given for comparison.
+
+Only the public Persist API is used, so the script can also be run on
+earlier revisions of the tree to compare them.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/persist_subtrees.py [--entries N]
+"""
+from __future__ import print_function
+
+import argparse
+import copy
+import timeit
+
+from landscape.lib.persist import Persist
+
+
+def make_subtree(entries):
+    return dict(
+        (u"user%d" % i,
+         {"uid": 1000 + i, "username": u"user%d" % i,
+          "name": u"User %d" % i, "enabled": True,
+          "location": None, "home-phone": None, "work-phone": None,
+          "primary-gid": 1000 + i, "groups": [u"users", u"adm"]})
+        for i in range(entries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=10000)
+    parser.add_argument("--number", type=int, default=10)
+    args = parser.parse_args()
+    subtree = make_subtree(args.entries)
+    persist = Persist()
+    persist.set("users", subtree)
+    persist.set("a.b", [{"c": 1}])
+    timings = [
+        ("set", timeit.timeit(lambda: persist.set("users", subtree),
+                              number=args.number)),
+        ("get", timeit.timeit(lambda: persist.get("users"),
+                              number=args.number)),
+        ("(deepcopy)", timeit.timeit(lambda: copy.deepcopy(subtree),
+                                     number=args.number)),
+    ]
+    print("%d entries, %d times each" % (args.entries, args.number))
+    for name, elapsed in timings:
+        print("%-16s %8.1fms" % (name, elapsed * 1000 / args.number))
+    path_time = timeit.timeit(lambda: persist.get("a.b[0].c"), number=100000)
+    print("%-16s %8.2fus" % ('get("a.b[0].c")', path_time * 10))
+
+
+if __name__ == "__main__":
+    main()
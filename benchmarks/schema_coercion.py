@@ -0,0 +1,70 @@
+"""Compare coercing messages with compiled schemas and with schema.coerce.
+
+Large messages of a few server-bound types are coerced by their schema,
+interpreting it with C{coerce}, and by the function built for it by
+L{compile_schema}, like L{MessageStore.add} does.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/schema_coercion.py [--number N]
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from landscape.lib.schema import compile_schema
+from landscape.message_schemas.server_bound import (
+    ACTIVE_PROCESS_INFO, ADD_PACKAGES, NETWORK_ACTIVITY, PACKAGES)
+
+
+MESSAGES = [
+    ("packages", PACKAGES, {
+        "type": "packages", "timestamp": 1234567890,
+        "installed": [(i, i + 3) for i in range(0, 200000, 8)],
+        "available": list(range(1, 200000, 3))}),
+    ("add-packages", ADD_PACKAGES, {
+        "type": "add-packages", "request-id": 1,
+        "packages": [
+            {"type": 65537, "name": u"package%d" % i,
+             "version": u"1.%d-0ubuntu1" % i, "section": u"misc",
+             "summary": u"Summary of package%d" % i,
+             "description": u"Long description of package%d" % i,
+             "size": 123456, "installed-size": None,
+             "relations": [(131074, u"package%d = 1.%d" % (i, i)),
+                           (262148, u"libc6 >= 2.27")]}
+            for i in range(10000)]}),
+    ("active-process-info", ACTIVE_PROCESS_INFO, {
+        "type": "active-process-info", "timestamp": 1234567890,
+        "add-processes": [
+            {"pid": i, "name": u"process-%d" % i, "state": b"S",
+             "sleep-average": 0, "uid": 1000, "gid": 1000,
+             "vm-size": 123456, "start-time": 1234567, "percent-cpu": 0.5}
+            for i in range(20000)]}),
+    ("network-activity", NETWORK_ACTIVITY, {
+        "type": "network-activity", "timestamp": 1234567890,
+        "activities": dict(
+            (b"eth%d" % i, [(step, step * 10, step * 20)
+                            for step in range(0, 30 * 5000, 30)])
+            for i in range(4))}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=5,
+                        help="How many times each message is coerced.")
+    args = parser.parse_args()
+    print("%-20s %8s %9s" % ("message", "coerce", "compiled"))
+    for name, schema, message in MESSAGES:
+        compiled = compile_schema(schema)
+        assert compiled(message) == schema.coerce(message)
+        coerce_time = timeit.timeit(lambda: schema.coerce(message),
+                                    number=args.number)
+        compiled_time = timeit.timeit(lambda: compiled(message),
+                                      number=args.number)
+        print("%-20s %7.3fs %8.3fs" % (name, coerce_time, compiled_time))
+
+
+if __name__ == "__main__":
+    main()
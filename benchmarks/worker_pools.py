@@ -0,0 +1,75 @@
+"""Time exchanges running alongside hanging pings and a burst of downloads.
+
+The blocking calls are simulated with sleeps. They either all share the
+reactor thread pool, like they did before the worker pools, or run in
+their worker pool, see L{landscape.lib.workers}. The latency of each
+exchange, from its call to its result, is reported.
+
+Run it from the top of the tree with::
+
+    PYTHONPATH=. python3 benchmarks/worker_pools.py [--fetches N]
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    gatherResults, inlineCallbacks, returnValue)
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
+
+from landscape.lib.workers import get_pool
+
+
+def run_shared(name, f, *args):
+    return deferToThread(f, *args)
+
+
+def run_pooled(name, f, *args):
+    return get_pool(name).run(f, *args)
+
+
+@inlineCallbacks
+def measure(run, options):
+    others = [run("ping", time.sleep, options.ping_time) for i in range(2)]
+    others.extend(run("fetch", time.sleep, options.fetch_time)
+                  for i in range(options.fetches))
+    # Let the other calls start first.
+    yield deferLater(reactor, 0.05, lambda: None)
+    latencies = []
+    for i in range(options.exchanges):
+        start = time.time()
+        yield run("exchange", time.sleep, options.exchange_time)
+        latencies.append(time.time() - start)
+    yield gatherResults(others)
+    returnValue(latencies)
+
+
+@inlineCallbacks
+def main(options):
+    try:
+        print("%d exchanges of %.2fs, with 2 pings of %.2fs and %d fetches "
+              "of %.2fs" % (options.exchanges, options.exchange_time,
+                            options.ping_time, options.fetches,
+                            options.fetch_time))
+        print("%-8s %8s %8s" % ("threads", "first", "max"))
+        for name, run in (("shared", run_shared), ("pools", run_pooled)):
+            latencies = yield measure(run, options)
+            print("%-8s %7.3fs %7.3fs" % (name, latencies[0],
+                                          max(latencies)))
+    finally:
+        reactor.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--exchanges", type=int, default=5)
+    parser.add_argument("--exchange-time", type=float, default=0.05)
+    parser.add_argument("--ping-time", type=float, default=2.0)
+    parser.add_argument("--fetches", type=int, default=20)
+    parser.add_argument("--fetch-time", type=float, default=0.5)
+    options = parser.parse_args()
+    reactor.callWhenRunning(main, options)
+    reactor.run()
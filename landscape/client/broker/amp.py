@@ -1,7 +1,7 @@
-from twisted.internet.defer import maybeDeferred, execute, succeed
+from twisted.internet.defer import Deferred, maybeDeferred, execute, succeed
 from twisted.python.compat import iteritems
 
-from landscape.lib.amp import RemoteObject, MethodCallArgument
+from landscape.lib.amp import RemoteObject, MethodCallArgument, MethodCallError
 from landscape.client.amp import ComponentConnector, get_remote_methods
 from landscape.client.broker.server import BrokerServer
 from landscape.client.broker.client import BrokerClient
@@ -10,10 +10,191 @@ from landscape.client.manager.manager import Manager
 
 
 class RemoteBroker(RemoteObject):
+    """A L{RemoteObject} for performing method calls on a L{BrokerServer}.
+
+    @ivar batch_messages: Whether messages sent with L{send_message} during
+        the same reactor iteration should be queued with a single
+        L{BrokerServer.send_messages} call, and whether the accepted message
+        types used by L{call_if_accepted} should be cached, see
+        L{fetch_accepted_types}. It must only be set by L{BrokerClient}s,
+        which get notified when the accepted types change, see
+        L{BrokerClient.fire_event}.
+    """
+
+    batch_messages = False
+
+    def __init__(self, factory):
+        super(RemoteBroker, self).__init__(factory)
+        self._accepted_types = None
+        self._accepted_types_generation = None
+        self._accepted_types_changes = {}
+        self._accepted_types_waiters = []
+        self._accepted_types_stale = False
+        self._queued_messages = []
+        self._send_messages_call = None
+        self._send_messages_supported = True
+
+    def send_message(self, message, session_id, urgent=False):
+        """Queue C{message} for delivery, see L{BrokerServer.send_message}.
+
+        If L{batch_messages} is set, the message is queued along with the
+        other ones sent during the current reactor iteration.
+        """
+        send_message = RemoteObject.__getattr__(self, "send_message")
+        if not (self.batch_messages and self._send_messages_supported):
+            return send_message(message, session_id, urgent=urgent)
+        deferred = Deferred()
+        self._queued_messages.append((message, session_id, urgent, deferred))
+        if self._send_messages_call is None:
+            self._send_messages_call = self._factory.clock.callLater(
+                0, self._send_queued_messages)
+        return deferred
+
+    def _send_queued_messages(self):
+        """Send all the messages queued by L{send_message} at once."""
+        self._send_messages_call = None
+        queued = self._queued_messages
+        self._queued_messages = []
+        if len(queued) == 1 or not self._send_messages_supported:
+            self._send_each(queued)
+            return
+        messages = [(message, session_id, urgent)
+                    for message, session_id, urgent, _ in queued]
+        result = RemoteObject.__getattr__(self, "send_messages")(messages)
+
+        def got_results(results):
+            for (_, _, _, deferred), (ok, value) in zip(queued, results):
+                if ok:
+                    deferred.callback(value)
+                else:
+                    deferred.errback(MethodCallError(value))
+
+        def got_failure(failure):
+            if (failure.check(MethodCallError) and
+                    str(failure.value).startswith("Forbidden method")):
+                # The broker is older than us and can't queue several
+                # messages at once, fall back to sending them one by one.
+                self._send_messages_supported = False
+                self._send_each(queued)
+                return
+            for _, _, _, deferred in queued:
+                deferred.errback(failure)
+
+        result.addCallbacks(got_results, got_failure)
+
+    def _send_each(self, queued):
+        """Send the given queued messages with individual calls."""
+        send_message = RemoteObject.__getattr__(self, "send_message")
+        for message, session_id, urgent, deferred in queued:
+            result = send_message(message, session_id, urgent=urgent)
+            result.chainDeferred(deferred)
+
+    def fetch_accepted_types(self):
+        """Fetch the accepted message types from the broker and cache them.
+
+        The cache is then kept up to date by L{accepted_types_changed}.
+
+        @return: A L{Deferred} resulting in the C{set} of accepted types.
+        """
+        deferred = Deferred()
+        self._accepted_types_waiters.append(deferred)
+        if len(self._accepted_types_waiters) == 1:
+            self._request_accepted_types()
+        return deferred
+
+    def _request_accepted_types(self):
+        self._accepted_types_stale = False
+        result = self.get_accepted_message_types_snapshot()
+        result.addErrback(self._request_accepted_types_failed)
+        result.addCallbacks(self._got_accepted_types,
+                            self._accepted_types_failed)
+
+    def _request_accepted_types_failed(self, failure):
+        failure.trap(MethodCallError)
+        if not str(failure.value).startswith("Forbidden method"):
+            return failure
+        # The broker is older than us and doesn't number the changes to the
+        # accepted types, they'll only invalidate our cache.
+        result = self.get_accepted_message_types()
+        return result.addCallback(lambda types: (None, types))
+
+    def _got_accepted_types(self, snapshot):
+        if self._accepted_types_stale:
+            # The accepted types changed while we were waiting for them.
+            self._request_accepted_types()
+            return
+        generation, types = snapshot
+        self._accepted_types = set(types)
+        self._accepted_types_generation = generation
+        if not self._apply_accepted_types_changes():
+            self._request_accepted_types()
+            return
+        waiters = self._accepted_types_waiters
+        self._accepted_types_waiters = []
+        for deferred in waiters:
+            deferred.callback(self._accepted_types)
+
+    def _accepted_types_failed(self, failure):
+        waiters = self._accepted_types_waiters
+        self._accepted_types_waiters = []
+        for deferred in waiters:
+            deferred.errback(failure)
+
+    def accepted_types_changed(self, type=None, accepted=None,
+                               generation=None):
+        """Update the cached accepted message types.
+
+        @param type: The message type whose acceptance changed.
+        @param accepted: Whether C{type} is now accepted.
+        @param generation: The number of the change, as counted by the
+            broker. If C{None}, which is the case of older brokers and of
+            reconnections, the cache is dropped altogether.
+        """
+        if generation is None:
+            self._accepted_types = None
+            self._accepted_types_changes = {}
+            self._accepted_types_stale = True
+            return
+        self._accepted_types_changes[generation] = (type, accepted)
+        if (self._accepted_types is not None and
+                not self._apply_accepted_types_changes()):
+            self._accepted_types = None
+
+    def _apply_accepted_types_changes(self):
+        """Apply the pending changes newer than our cached accepted types.
+
+        @return: C{False} if some change got lost along the way, in which
+            case the cache can't be trusted anymore.
+        """
+        changes = self._accepted_types_changes
+        if self._accepted_types_generation is None:
+            return not changes
+        for generation in list(changes):
+            if generation <= self._accepted_types_generation:
+                del changes[generation]
+        while self._accepted_types_generation + 1 in changes:
+            self._accepted_types_generation += 1
+            type, accepted = changes.pop(self._accepted_types_generation)
+            if accepted:
+                self._accepted_types.add(type)
+            else:
+                self._accepted_types.discard(type)
+        return not changes
 
     def call_if_accepted(self, type, callable, *args):
-        """Call C{callable} if C{type} is an accepted message type."""
-        deferred_types = self.get_accepted_message_types()
+        """Call C{callable} if C{type} is an accepted message type.
+
+        If L{batch_messages} is set and the accepted types are cached, the
+        call is performed synchronously.
+        """
+        if not self.batch_messages:
+            deferred_types = self.get_accepted_message_types()
+        elif self._accepted_types is not None:
+            if type in self._accepted_types:
+                return maybeDeferred(callable, *args)
+            return succeed(None)
+        else:
+            deferred_types = self.fetch_accepted_types()
 
         def got_accepted_types(result):
             if type in result:
@@ -67,6 +248,13 @@ class FakeRemoteBroker(object):
             return maybeDeferred(callable, *args)
         return succeed(None)
 
+    def fetch_accepted_types(self):
+        return succeed(set(self.message_store.get_accepted_types()))
+
+    def accepted_types_changed(self, type=None, accepted=None,
+                               generation=None):
+        pass
+
     def call_on_event(self, handlers):
         """Call a given handler as soon as a certain event occurs.
 
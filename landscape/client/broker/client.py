@@ -243,6 +243,8 @@ class BrokerClient(object):
             the fired event handlers, in the order they were fired.
         """
         if event_type == "message-type-acceptance-changed":
+            if self.broker is not None:
+                self.broker.accepted_types_changed(*args)
             message_type = args[0]
             acceptance = args[1]
             results = self.reactor.fire((event_type, message_type), acceptance)
@@ -261,7 +263,11 @@ class BrokerClient(object):
 
           - Re-register ourselves as client, so the broker knows we exist and
             will talk to us firing events and dispatching messages.
+
+          - Forget about the accepted message types we know of, since they
+            might have changed while we were disconnected.
         """
+        self.broker.accepted_types_changed()
         for type in self._registered_messages:
             self.broker.register_client_accepted_message_type(type)
         self.broker.register_client(self.name)
@@ -32,6 +32,9 @@ class BrokerConfiguration(Configuration):
               - C{urgent_exchange_interval} (C{1*60})
               - C{http_proxy}
               - C{https_proxy}
+              - C{message_store_backend} (C{"directory"})
+              - C{message_passthrough} (C{False})
+              - C{exchange_keep_alive} (C{False})
         """
         parser = super(BrokerConfiguration, self).make_parser()
 
@@ -62,6 +65,22 @@ class BrokerConfiguration(Configuration):
         parser.add_option("--tags",
                           help="Comma separated list of tag names to be sent "
                                "to the server.")
+        parser.add_option("--message-store-backend", default="directory",
+                          choices=["directory", "segment"],
+                          help="How queued messages are stored on disk: "
+                               "'directory' keeps a file per message, "
+                               "'segment' appends them to segment files "
+                               "(default: 'directory').")
+        parser.add_option("--message-passthrough", action="store_true",
+                          default=False,
+                          help="Send queued messages to the server as they "
+                               "are stored, without decoding and encoding "
+                               "them again.")
+        parser.add_option("--exchange-keep-alive", action="store_true",
+                          default=False,
+                          help="Keep the connection to the server open "
+                               "between exchanges, instead of connecting "
+                               "again for each of them.")
 
         return parser
 
@@ -397,6 +397,7 @@ class MessageExchange(object):
         self._exchange_interval = config.exchange_interval
         self._urgent_exchange_interval = config.urgent_exchange_interval
         self._max_messages = max_messages
+        self._message_passthrough = config.message_passthrough
         self._notification_id = None
         self._exchange_id = None
         self._exchanging = False
@@ -406,6 +407,7 @@ class MessageExchange(object):
         self._message_handlers = {}
         self._exchange_store = exchange_store
         self._stopped = False
+        self._reprocessing = None
 
         self.register_message("accepted-types", self._handle_accepted_types)
         self.register_message("resynchronize", self._handle_resynchronize)
@@ -480,7 +482,8 @@ class MessageExchange(object):
         accepts, update our message store.
 
         If this makes existing held messages available for sending,
-        urgently exchange messages.
+        urgently exchange messages. Held messages are reprocessed in
+        batches across reactor iterations, see L{_reprocess_holding}.
 
         If new types are made available or old types are dropped a
         C{("message-type-acceptance-changed", type, bool)} reactor
@@ -489,15 +492,33 @@ class MessageExchange(object):
         old_types = set(self._message_store.get_accepted_types())
         new_types = set(message["types"])
         diff = get_accepted_types_diff(old_types, new_types)
-        self._message_store.set_accepted_types(new_types)
+        self._message_store.set_accepted_types(new_types, reprocess=False)
         logging.info("Accepted types changed: %s", diff)
-        if self._message_store.get_pending_messages(1):
-            self.schedule_exchange(urgent=True)
+        # Any reprocessing still in progress is superseded by this one.
+        self._reprocessing = self._message_store.reprocess_holding()
+        self._reprocess_holding(self._reprocessing)
         for type in old_types - new_types:
             self._reactor.fire("message-type-acceptance-changed", type, False)
         for type in new_types - old_types:
             self._reactor.fire("message-type-acceptance-changed", type, True)
 
+    def _reprocess_holding(self, reprocessing):
+        """Run a batch of C{reprocessing} and schedule the next one.
+
+        Once done, urgently exchange messages if there are any pending.
+        """
+        if reprocessing is not self._reprocessing:
+            return
+        try:
+            next(reprocessing)
+        except StopIteration:
+            self._reprocessing = None
+            if self._message_store.get_pending_messages(1):
+                self.schedule_exchange(urgent=True)
+        else:
+            self._reactor.call_later(
+                0, self._reprocess_holding, reprocessing)
+
     def _handle_resynchronize(self, message):
         opid = message["operation-id"]
         scopes = message.get("scopes")
@@ -684,7 +705,15 @@ class MessageExchange(object):
         """
         store = self._message_store
         accepted_types_digest = self._hash_types(store.get_accepted_types())
-        messages = store.get_pending_messages(self._max_messages)
+        if self._message_passthrough:
+            # Stored messages are spliced into the payload as they are.
+            apis_and_messages = store.get_pending_serialized_messages(
+                self._max_messages)
+            apis = [api for api, message in apis_and_messages]
+            messages = [message for api, message in apis_and_messages]
+        else:
+            messages = store.get_pending_messages(self._max_messages)
+            apis = [message.get("api") for message in messages]
         total_messages = store.count_pending_messages()
         if messages:
             # Each message is tagged with the API that the client was
@@ -692,9 +721,9 @@ class MessageExchange(object):
             # logic below will make sure that all messages which are added
             # to the payload being built will have the same api, and any
             # other messages will be postponed to the next exchange.
-            server_api = messages[0].get("api")
-            for i, message in enumerate(messages):
-                if message.get("api") != server_api:
+            server_api = apis[0]
+            for i, api in enumerate(apis):
+                if api != server_api:
                     break
             else:
                 i = None
@@ -794,7 +823,8 @@ class MessageExchange(object):
 
         message_store.commit()
 
-        sequence = message_store.get_server_sequence()
+        sequence = initial_sequence = (
+            message_store.get_server_sequence())
         for message in result.get("messages", ()):
             # The wire format of the 'type' field is bytes, but our handlers
             # actually expect it to be a string. Some unit tests set it to
@@ -804,7 +834,11 @@ class MessageExchange(object):
                 message["type"] = message["type"].decode("ascii")
             self.handle_message(message)
             sequence += 1
-            message_store.set_server_sequence(sequence)
+            message_store.record_server_sequence(sequence)
+        if sequence != initial_sequence:
+            # Commit once for the whole batch, the progress through it is
+            # recorded cheaply by the message store in the meantime, unless
+            # handling a message changed the persist too.
             message_store.commit()
 
         if message_store.get_pending_messages(1):
@@ -74,10 +74,11 @@ class PingClient(object):
 
             def errback(type, value, tb):
                 page_deferred.errback(Failure(value, type, tb))
-            self._reactor.call_in_thread(page_deferred.callback, errback,
-                                         self.get_page, url,
-                                         post=True, data=data,
-                                         headers=headers)
+            # Pings have their own pool, so that a ping server which doesn't
+            # answer doesn't hold back the exchanges.
+            self._reactor.call_in_pool("ping", page_deferred.callback,
+                                       errback, self.get_page, url,
+                                       post=True, data=data, headers=headers)
             page_deferred.addCallback(self._got_result)
             return page_deferred
         return defer.succeed(False)
@@ -95,11 +95,12 @@ class BrokerServer(object):
         self._registered_clients = {}
         self._connectors = {}
         self._pinger = pinger
+        self._accepted_types_generation = 0
 
         reactor.call_on("message", self.broadcast_message)
         reactor.call_on("impending-exchange", self.impending_exchange)
         reactor.call_on("message-type-acceptance-changed",
-                        self.message_type_acceptance_changed)
+                        self._accepted_types_changed)
         reactor.call_on("server-uuid-changed", self.server_uuid_changed)
         reactor.call_on("package-data-changed", self.package_data_changed)
         reactor.call_on("resynchronize-clients", self.resynchronize)
@@ -213,6 +214,30 @@ class BrokerServer(object):
         if self._message_store.is_valid_session_id(session_id):
             return self._exchanger.send(message, urgent=urgent)
 
+    @remote
+    def send_messages(self, messages):
+        """Queue several messages at once, see L{send_message}.
+
+        This lets clients queue all the messages they generated in a single
+        round trip instead of one per message.
+
+        @param messages: A list of C{(message, session_id, urgent)} items.
+        @return: A list with an C{(ok, value)} tuple for each message, in the
+            same order: C{ok} is C{True} and C{value} the message identifier
+            if the message was queued, or C{ok} is C{False} and C{value} a
+            description of the error preventing it from being queued.
+        """
+        results = []
+        for message, session_id, urgent in messages:
+            try:
+                message_id = self.send_message(message, session_id, urgent)
+            except Exception as error:
+                results.append((False, "%s: %s" % (
+                    error.__class__.__name__, error)))
+            else:
+                results.append((True, message_id))
+        return results
+
     @remote
     def is_message_pending(self, message_id):
         """Indicate if a message with given C{message_id} is pending."""
@@ -249,6 +274,18 @@ class BrokerServer(object):
         """Return the message types accepted by the Landscape server."""
         return self._message_store.get_accepted_types()
 
+    @remote
+    def get_accepted_message_types_snapshot(self):
+        """Return the accepted message types along with their generation.
+
+        @return: A C{(generation, types)} tuple, where C{generation} is the
+            number of the last C{message-type-acceptance-changed} event
+            broadcast to the clients. Clients can use it to keep a copy of
+            the accepted types up to date and to detect missed events.
+        """
+        return (self._accepted_types_generation,
+                self._message_store.get_accepted_types())
+
     @remote
     def get_server_uuid(self):
         """Return the uuid of the Landscape server we're pointing at."""
@@ -332,9 +369,14 @@ class BrokerServer(object):
     def server_uuid_changed(self, old_uuid, new_uuid):
         """Broadcast a C{server-uuid-changed} event to the clients."""
 
+    def _accepted_types_changed(self, type, accepted):
+        self._accepted_types_generation += 1
+        return self.message_type_acceptance_changed(
+            type, accepted, self._accepted_types_generation)
+
     @event
-    def message_type_acceptance_changed(self, type, accepted):
-        pass
+    def message_type_acceptance_changed(self, type, accepted, generation):
+        """Broadcast a C{message-type-acceptance-changed} event."""
 
     @event
     def package_data_changed(self):
@@ -10,7 +10,8 @@ from landscape.client.broker.transport import HTTPTransport
 from landscape.client.broker.exchange import MessageExchange
 from landscape.client.broker.exchangestore import ExchangeStore
 from landscape.client.broker.ping import Pinger
-from landscape.client.broker.store import get_default_message_store
+from landscape.client.broker.store import (
+    get_default_message_store, get_message_store_backend)
 from landscape.client.broker.server import BrokerServer
 
 
@@ -49,9 +50,12 @@ class BrokerService(LandscapeService):
         super(BrokerService, self).__init__(config)
 
         self.transport = self.transport_factory(
-            self.reactor, config.url, config.ssl_public_key)
+            self.reactor, config.url, config.ssl_public_key,
+            keep_alive=config.exchange_keep_alive)
+        backend = get_message_store_backend(
+            config.message_store_backend, config.message_store_path)
         self.message_store = get_default_message_store(
-            self.persist, config.message_store_path)
+            self.persist, config.message_store_path, backend=backend)
         self.identity = Identity(self.config, self.persist)
         exchange_store = ExchangeStore(self.config.exchange_store_path)
         self.exchanger = MessageExchange(
@@ -87,9 +87,10 @@ a next-expected-sequence value which is so old to be outside our buffer
 of already-sent messages. In that case there is now way we can recover the
 lost messages, and we'll just send the oldest one that we have.
 
-See L{MessageStore} for details about how messages are stored on the file
-system and L{landscape.lib.message.got_next_expected} to check how the
-strategy for updating the pending offset and the sequence is implemented.
+See L{FileSystemBackend} and L{SegmentBackend} for details about how messages
+are stored on the file system and L{landscape.lib.message.got_next_expected}
+to check how the strategy for updating the pending offset and the sequence is
+implemented.
 """
 
 import itertools
@@ -97,21 +98,32 @@ import logging
 import os
 import uuid
 
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
 from twisted.python.compat import iteritems
 
 from landscape import DEFAULT_SERVER_API
 from landscape.lib import bpickle
 from landscape.lib.fs import create_binary_file, read_binary_file
+from landscape.lib.schema import compile_schema
 from landscape.lib.versioning import sort_versions, is_version_higher
 
 
 HELD = "h"
 BROKEN = "b"
 
+# How many messages L{MessageStore.reprocess_holding} goes through before
+# giving control back to its caller.
+REPROCESS_BATCH_SIZE = 500
+
 
 class MessageStore(object):
     """A message store which stores its messages in a file system hierarchy.
 
+    The actual layout of messages on disk is delegated to a backend, see
+    L{FileSystemBackend} and L{SegmentBackend}.
+
     Beside the "sequence" and the "pending offset" values described in the
     module docstring above, the L{MessageStore} also stores what we call
     "server sequence", which is the next message number expected by the
@@ -120,11 +132,17 @@ class MessageStore(object):
 
     The server sequence is entirely unrelated to the stored messages, but is
     incremented when successfully receiving messages from the server, in the
-    very same way described above but with the roles inverted.
+    very same way described above but with the roles inverted. Progress
+    through a batch of messages from the server can be recorded with
+    L{record_server_sequence}, which is cheaper than a L{commit} per message.
 
     @param persist: a L{Persist} used to save state parameters like the
         accepted message types, sequence, server uuid etc.
     @param directory: base of the file system hierarchy
+    @param directory_size: the maximum number of messages kept in a single
+        directory (or segment, see L{SegmentBackend}).
+    @param backend: the storage backend holding the actual messages, by
+        default a L{FileSystemBackend} rooted at C{directory}.
     """
 
     # The initial message API version that we use to communicate with the
@@ -134,30 +152,49 @@ class MessageStore(object):
     # in case the server supports it.
     _api = DEFAULT_SERVER_API
 
-    def __init__(self, persist, directory, directory_size=1000):
-        self._directory = directory
-        self._directory_size = directory_size
+    def __init__(self, persist, directory, directory_size=1000, backend=None):
+        if backend is None:
+            backend = FileSystemBackend(directory, directory_size)
+        self._backend = backend
+        self._index = MessageIndex(backend)
         self._schemas = {}
         self._original_persist = persist
         self._persist = persist.root_at("message-store")
-        message_dir = self._message_dir()
-        if not os.path.isdir(message_dir):
-            os.makedirs(message_dir)
+        # The records are kept next to the persist they extend, rather than
+        # among the messages, where older clients don't expect them.
+        self._server_sequence_filename = None
+        if persist.filename is not None:
+            self._server_sequence_filename = (
+                persist.filename + ".server-sequence")
+        self._server_sequence_recorded = False
+        # How many writes the persist had right after the last record.
+        self._recorded_write_count = None
+        self._recover_server_sequence()
 
     def commit(self):
-        """Persist metadata to disk."""
-        self._original_persist.save()
-
-    def set_accepted_types(self, types):
+        """Persist metadata to disk, if it changed since the last commit."""
+        self._original_persist.flush()
+        if self._server_sequence_recorded:
+            # The saved persist is now at least as recent as the records.
+            os.unlink(self._server_sequence_filename)
+            self._server_sequence_recorded = False
+
+    def set_accepted_types(self, types, reprocess=True):
         """Specify the types of messages that the server will expect from us.
 
         If messages are added to the store which are not currently
         accepted, they will be saved but ignored until their type is
         accepted.
+
+        @param reprocess: Whether to immediately hold or unhold the stored
+            messages according to the new accepted types. If C{False}, the
+            caller is expected to go through L{reprocess_holding} itself.
         """
         assert type(types) in (tuple, list, set)
         self._persist.set("accepted-types", sorted(set(types)))
-        self._reprocess_holding()
+        if reprocess:
+            for _ in self.reprocess_holding():
+                pass
 
     def get_accepted_types(self):
         """Get a list of all accepted message types."""
@@ -199,6 +236,68 @@ class MessageStore(object):
         """
         self._persist.set("server_sequence", number)
 
+    def record_server_sequence(self, number):
+        """Set the current server sequence, and record it without a commit.
+
+        The new value is appended to a small journal file next to the
+        persist, which is replayed if the store gets loaded again before
+        being committed. This makes it cheap to record the progress after
+        each message received from the server, and commit only once the
+        whole batch is handled.
+
+        Records are flushed to disk before returning, along with the
+        directory entry of the file when it gets created.
+
+        If anything else changed in the persist since the last record or
+        commit, like the effects of handling a message, the store is
+        committed instead. The recorded progress can't get ahead of those
+        changes then.
+        """
+        persist = self._original_persist
+        changed = (persist.modified and
+                   self._get_write_count() != self._recorded_write_count)
+        self.set_server_sequence(number)
+        if self._server_sequence_filename is None:
+            return
+        if changed:
+            self.commit()
+            return
+        with open(self._server_sequence_filename, "ab") as fd:
+            fd.write(("%d\n" % number).encode("ascii"))
+            fd.flush()
+            os.fsync(fd.fileno())
+        if not self._server_sequence_recorded:
+            dir_fd = os.open(
+                os.path.dirname(self._server_sequence_filename) or os.curdir,
+                os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self._server_sequence_recorded = True
+        self._recorded_write_count = self._get_write_count()
+
+    def _get_write_count(self):
+        return sum(self._original_persist.write_counts.values())
+
+    def _recover_server_sequence(self):
+        """Replay the server sequence records not committed yet, if any."""
+        if (self._server_sequence_filename is None or
+                not os.path.exists(self._server_sequence_filename)):
+            return
+        self._server_sequence_recorded = True
+        # The last item is either empty or a partially written record.
+        records = read_binary_file(self._server_sequence_filename).split(
+            b"\n")[:-1]
+        if records:
+            try:
+                number = int(records[-1])
+            except ValueError:
+                logging.warning("Ignoring invalid server sequence record %r",
+                                records[-1])
+            else:
+                self.set_server_sequence(number)
+
     def get_server_uuid(self):
         """Return the currently set server UUID."""
         uuid = self._persist.get("server_uuid")
@@ -255,23 +354,23 @@ class MessageStore(object):
 
     def count_pending_messages(self):
         """Return the number of pending messages."""
-        return sum(1 for x in self._walk_pending_messages())
+        return max(0, self._index.count_ready() - self.get_pending_offset())
 
     def get_pending_messages(self, max=None):
         """Get any pending messages that aren't being held, up to max."""
         accepted_types = self.get_accepted_types()
         server_api = self.get_server_api()
         messages = []
-        for filename in self._walk_pending_messages():
+        for message_id in self._walk_pending_messages():
             if max is not None and len(messages) >= max:
                 break
-            data = read_binary_file(self._message_dir(filename))
+            data = self._backend.read(self._index.get_key(message_id))
             try:
                 # don't reinterpret messages that are meant to be sent out
                 message = bpickle.loads(data, as_is=True)
             except ValueError as e:
                 logging.exception(e)
-                self._add_flags(filename, BROKEN)
+                self._add_flags(message_id, BROKEN)
             else:
                 if u"type" not in message:
                     # Special case to decode keys for messages which were
@@ -284,55 +383,97 @@ class MessageStore(object):
                         for k, v in message.items()}
                     message[u"type"] = message[u"type"].decode("ascii")
 
-                unknown_type = message["type"] not in accepted_types
-                unknown_api = not is_version_higher(server_api, message["api"])
-                if unknown_type or unknown_api:
-                    self._add_flags(filename, HELD)
-                else:
+                if self._is_deliverable(
+                        message_id, message["type"], message["api"],
+                        accepted_types, server_api):
                     messages.append(message)
         return messages
 
+    def get_pending_serialized_messages(self, max=None):
+        """Get pending messages like L{get_pending_messages}, but serialized.
+
+        Messages are returned as they are stored, so that they can be sent
+        without being decoded and encoded again. Only their C{api} is
+        decoded, their type being kept in the index.
+
+        @return: A list of C{(api, message)} tuples, with C{message} being a
+            L{bpickle.Serialized}.
+        """
+        accepted_types = self.get_accepted_types()
+        server_api = self.get_server_api()
+        messages = []
+        for message_id in self._walk_pending_messages():
+            if max is not None and len(messages) >= max:
+                break
+            data = self._backend.read(self._index.get_key(message_id))
+            try:
+                # A full check would mean decoding the message, so just
+                # catch messages that were cut short, which is how they
+                # usually get broken.
+                if data[-1:] != b";":
+                    raise ValueError("Truncated message")
+                api = bpickle.peek(data, "api")
+            except ValueError as e:
+                logging.exception(e)
+                self._add_flags(message_id, BROKEN)
+                continue
+            message_type = self._get_type(message_id)
+            if message_type is None:
+                self._add_flags(message_id, BROKEN)
+            elif self._is_deliverable(message_id, message_type, api,
+                                      accepted_types, server_api):
+                messages.append((api, bpickle.Serialized(data)))
+        return messages
+
+    def _is_deliverable(self, message_id, message_type, api, accepted_types,
+                        server_api):
+        """Check that a message can be sent, or hold it if not."""
+        unknown_type = message_type not in accepted_types
+        unknown_api = not is_version_higher(server_api, api)
+        if unknown_type or unknown_api:
+            self._add_flags(message_id, HELD)
+            return False
+        return True
+
     def delete_old_messages(self):
         """Delete messages which are unlikely to be needed in the future."""
-        for fn in itertools.islice(self._walk_messages(exclude=HELD + BROKEN),
-                                   self.get_pending_offset()):
-            os.unlink(fn)
-            containing_dir = os.path.split(fn)[0]
-            if not os.listdir(containing_dir):
-                os.rmdir(containing_dir)
+        message_ids = list(itertools.islice(
+            self._walk_messages(exclude=HELD + BROKEN),
+            self.get_pending_offset()))
+        for message_id in message_ids:
+            self._backend.delete(self._index.get_key(message_id))
+            self._index.remove(message_id)
 
     def delete_all_messages(self):
         """Remove ALL stored messages."""
         self.set_pending_offset(0)
-        for filename in self._walk_messages():
-            os.unlink(filename)
+        self._backend.delete_all()
+        self._index.clear()
 
     def add_schema(self, schema):
         """Add a schema to be applied to messages of the given type.
 
         The schema must be an instance of
-        landscape.message_schemas.message.Message.
+        landscape.message_schemas.message.Message. It's compiled with
+        L{compile_schema}, since it's applied to every message added.
         """
         api = schema.api if schema.api else self._api
         schemas = self._schemas.setdefault(schema.type, {})
-        schemas[api] = schema
+        schemas[api] = compile_schema(schema)
 
     def is_pending(self, message_id):
         """Return bool indicating if C{message_id} still hasn't been delivered.
 
         @param message_id: Identifier returned by the L{add()} method.
         """
-        i = 0
-        pending_offset = self.get_pending_offset()
-        for filename in self._walk_messages(exclude=BROKEN):
-            flags = self._get_flags(filename)
-            if ((HELD in flags or i >= pending_offset) and
-                os.stat(filename).st_ino == message_id
-                ):
-                return True
-            if BROKEN not in flags and HELD not in flags:
-                i += 1
-        return False
+        if message_id not in self._index:
+            return False
+        flags = self._get_flags(message_id)
+        if BROKEN in flags:
+            return False
+        if HELD in flags:
+            return True
+        return self._index.get_rank(message_id) >= self.get_pending_offset()
 
     def record_success(self, timestamp):
         """Record a successful exchange."""
@@ -383,122 +524,122 @@ class MessageStore(object):
         schemas = self._schemas[message["type"]]
         for api in sort_versions(schemas.keys()):
             if is_version_higher(server_api, api):
-                schema = schemas[api]
+                coerce = schemas[api]
                 break
-        message = schema.coerce(message)
+        message = coerce(message)
 
         message_data = bpickle.dumps(message)
 
-        filename = self._get_next_message_filename()
-        temp_path = filename + ".tmp"
-        create_binary_file(temp_path, message_data)
-        os.rename(temp_path, filename)
+        key = self._backend.add(message_data, type=message["type"])
+        message_id = self._backend.get_message_id(key)
+        self._index.append(message_id, key, "", message["type"])
 
         if not self.accepts(message["type"]):
-            filename = self._set_flags(filename, HELD)
-
-        # For now we use the inode as the message id, as it will work
-        # correctly even faced with holding/unholding.  It will break
-        # if the store is copied over for some reason, but this shouldn't
-        # present an issue given the current uses.  In the future we
-        # should have a nice transactional storage (e.g. sqlite) which
-        # will offer a more strong primary key.
-        message_id = os.stat(filename).st_ino
+            self._set_flags(message_id, HELD)
 
         return message_id
 
-    def _get_next_message_filename(self):
-        message_dirs = self._get_sorted_filenames()
-        if message_dirs:
-            newest_dir = message_dirs[-1]
-        else:
-            os.makedirs(self._message_dir("0"))
-            newest_dir = "0"
-
-        message_filenames = self._get_sorted_filenames(newest_dir)
-        if not message_filenames:
-            filename = self._message_dir(newest_dir, "0")
-        elif len(message_filenames) < self._directory_size:
-            filename = str(int(message_filenames[-1].split("_")[0]) + 1)
-            filename = self._message_dir(newest_dir, filename)
-        else:
-            newest_dir = self._message_dir(str(int(newest_dir) + 1))
-            os.makedirs(newest_dir)
-            filename = os.path.join(newest_dir, "0")
-
-        return filename
-
     def _walk_pending_messages(self):
-        """Walk the files which are definitely pending."""
+        """Walk the messages which are definitely pending."""
         pending_offset = self.get_pending_offset()
-        for i, filename in enumerate(
+        for i, message_id in enumerate(
                 self._walk_messages(exclude=HELD + BROKEN)):
             if i >= pending_offset:
-                yield filename
+                yield message_id
 
     def _walk_messages(self, exclude=None):
-        if exclude:
-            exclude = set(exclude)
-        message_dirs = self._get_sorted_filenames()
-        for message_dir in message_dirs:
-            for filename in self._get_sorted_filenames(message_dir):
-                flags = set(self._get_flags(filename))
-                if (not exclude or not exclude & flags):
-                    yield self._message_dir(message_dir, filename)
-
-    def _get_sorted_filenames(self, dir=""):
-        message_files = [x for x in os.listdir(self._message_dir(dir))
-                         if not x.endswith(".tmp")]
-        message_files.sort(key=lambda x: int(x.split("_")[0]))
-        return message_files
-
-    def _message_dir(self, *args):
-        return os.path.join(self._directory, *args)
+        return self._index.walk(exclude=exclude)
 
-    def _reprocess_holding(self):
+    def reprocess_holding(self, batch_size=REPROCESS_BATCH_SIZE):
         """
         Unhold accepted messages left behind, and hold unaccepted
         pending messages.
+
+        All the changes are computed in a first pass over the messages and
+        then applied in a second one. The type of each message is looked
+        up in the index, so messages only need to be decoded the first
+        time their type is needed.
+
+        This is a generator, yielding every C{batch_size} messages, so that
+        callers can spread the work across several reactor iterations.
+        Messages which are deleted or re-flagged by someone else in the
+        meantime are left alone.
         """
         offset = 0
         pending_offset = self.get_pending_offset()
         accepted_types = self.get_accepted_types()
-        for old_filename in self._walk_messages():
-            flags = self._get_flags(old_filename)
-            try:
-                message = bpickle.loads(read_binary_file(old_filename))
-            except ValueError as e:
-                logging.exception(e)
+        hold = []
+        unhold = []
+        message_ids = list(self._walk_messages())
+        for i, message_id in enumerate(message_ids):
+            if i and not i % batch_size:
+                yield
+            if message_id not in self._index:
+                continue
+            flags = self._get_flags(message_id)
+            message_type = self._get_type(message_id)
+            if message_type is None:
                 if HELD not in flags:
                     offset += 1
             else:
-                accepted = message["type"] in accepted_types
+                accepted = message_type in accepted_types
                 if HELD in flags:
                     if accepted:
-                        new_filename = self._get_next_message_filename()
-                        os.rename(old_filename, new_filename)
-                        self._set_flags(new_filename, set(flags) - set(HELD))
+                        unhold.append(message_id)
                 else:
                     if not accepted and offset >= pending_offset:
-                        self._set_flags(old_filename, set(flags) | set(HELD))
+                        hold.append(message_id)
                     offset += 1
 
-    def _get_flags(self, path):
-        basename = os.path.basename(path)
-        if "_" in basename:
-            return basename.split("_")[1]
-        return ""
-
-    def _set_flags(self, path, flags):
-        dirname, basename = os.path.split(path)
-        new_path = os.path.join(dirname, basename.split("_")[0])
-        if flags:
-            new_path += "_" + "".join(sorted(set(flags)))
-        os.rename(path, new_path)
-        return new_path
-
-    def _add_flags(self, path, flags):
-        self._set_flags(path, self._get_flags(path) + flags)
+        changes = [(message_id, True) for message_id in hold]
+        changes.extend((message_id, False) for message_id in unhold)
+        for i, (message_id, held) in enumerate(changes):
+            if i and not i % batch_size:
+                yield
+            if message_id not in self._index:
+                continue
+            flags = self._get_flags(message_id)
+            if held and HELD not in flags:
+                self._set_flags(message_id, set(flags) | set(HELD))
+            elif not held and HELD in flags:
+                flags = _join_flags(set(flags) - set(HELD))
+                key = self._backend.move_to_end(
+                    self._index.get_key(message_id), flags)
+                self._index.move_to_end(message_id, key, flags)
+
+    def _get_type(self, message_id):
+        """Return the type of a message, or C{None} if it can't be decoded.
+
+        The type is cached in the index, and in the backend if it supports
+        it, so that the message doesn't need to be decoded again.
+        """
+        message_type = self._index.get_type(message_id)
+        if message_type is not None:
+            return message_type
+        key = self._index.get_key(message_id)
+        try:
+            message = bpickle.loads(self._backend.read(key))
+        except ValueError as e:
+            logging.exception(e)
+            return None
+        message_type = message["type"]
+        if isinstance(message_type, bytes):
+            # Messages serialized by py27 have a byte string type.
+            message_type = message_type.decode("ascii")
+        self._backend.set_type(key, message_type)
+        self._index.set_type(message_id, message_type)
+        return message_type
+
+    def _get_flags(self, message_id):
+        return self._index.get_flags(message_id)
+
+    def _set_flags(self, message_id, flags):
+        flags = _join_flags(flags)
+        key = self._backend.set_flags(self._index.get_key(message_id), flags)
+        self._index.update(message_id, key, flags)
+
+    def _add_flags(self, message_id, flags):
+        self._set_flags(message_id, self._get_flags(message_id) + flags)
 
     def get_session_id(self, scope=None):
         """Generate a unique session identifier, persist it and return it.
@@ -544,6 +685,686 @@ class MessageStore(object):
         self._persist.set("session-ids", new_session_ids)
 
 
+class MessageIndex(object):
+    """In-memory index of the messages kept by a L{MessageStore} backend.
+
+    The index is built by walking the backend once, and is then kept up to
+    date by the L{MessageStore} as messages get added, flagged, moved or
+    deleted, so that looking up and counting messages never needs to touch
+    the backend.
+
+    Messages are indexed by message id, each entry recording the backend key
+    of the message, its flags, its position in the queue and its type, when
+    known. The positions
+    of messages without flags, i.e. which are neither held nor broken, are
+    also kept in a sorted list, telling how many of them come before any
+    given message.
+
+    @param backend: The backend holding the messages to index.
+    """
+
+    def __init__(self, backend):
+        self._entries = OrderedDict()
+        self._ready = []
+        self._next_position = 0
+        for key in backend.walk():
+            self.append(backend.get_message_id(key), key,
+                        backend.get_flags(key), backend.get_type(key))
+
+    def __contains__(self, message_id):
+        return message_id in self._entries
+
+    def walk(self, exclude=None):
+        """Yield the ids of all indexed messages, in order.
+
+        @param exclude: Optionally, a string of flags. Messages with any of
+            these flags set are skipped.
+        """
+        if exclude:
+            exclude = set(exclude)
+        for message_id, entry in list(self._entries.items()):
+            if message_id not in self._entries:
+                continue
+            if not exclude or not exclude & set(entry[1]):
+                yield message_id
+
+    def get_key(self, message_id):
+        """Return the backend key of the given message."""
+        return self._entries[message_id][0]
+
+    def get_flags(self, message_id):
+        """Return the flags of the given message."""
+        return self._entries[message_id][1]
+
+    def get_type(self, message_id):
+        """Return the type of the given message, or C{None} if unknown."""
+        return self._entries[message_id][3]
+
+    def set_type(self, message_id, type):
+        """Remember the type of the given message."""
+        self._entries[message_id][3] = type
+
+    def count_ready(self):
+        """Return the number of messages which are neither held nor broken."""
+        return len(self._ready)
+
+    def get_rank(self, message_id):
+        """
+        Return the number of messages which are neither held nor broken and
+        come before the given message in the queue.
+        """
+        return bisect_left(self._ready, self._entries[message_id][2])
+
+    def append(self, message_id, key, flags, type=None):
+        """Index a message at the end of the queue."""
+        self._entries[message_id] = [key, flags, self._next_position, type]
+        self._next_position += 1
+        self._add(message_id)
+
+    def update(self, message_id, key, flags):
+        """Update the key and flags of a message, keeping its position."""
+        self._remove(message_id)
+        entry = self._entries[message_id]
+        entry[0] = key
+        entry[1] = flags
+        self._add(message_id)
+
+    def move_to_end(self, message_id, key, flags):
+        """Move a message to the end of the queue."""
+        type = self.get_type(message_id)
+        self.remove(message_id)
+        self.append(message_id, key, flags, type)
+
+    def remove(self, message_id):
+        """Drop a message from the index."""
+        self._remove(message_id)
+        del self._entries[message_id]
+
+    def clear(self):
+        """Drop all messages from the index."""
+        self._entries.clear()
+        del self._ready[:]
+
+    def _add(self, message_id):
+        key, flags, position, type = self._entries[message_id]
+        if not flags:
+            insort(self._ready, position)
+
+    def _remove(self, message_id):
+        key, flags, position, type = self._entries[message_id]
+        if not flags:
+            del self._ready[bisect_left(self._ready, position)]
+
+
+def _join_flags(flags):
+    """Return the canonical string representation of a set of flags."""
+    return "".join(sorted(set(flags)))
+
+
+class FileSystemBackend(object):
+    """Store each message in its own file, in a hierarchy of directories.
+
+    Messages are kept in numbered directories holding up to
+    C{directory_size} numbered files each, and their order is given by the
+    directory and file numbers. Flags and message ids are encoded in the
+    file name, after an underscore each (e.g. C{0/12_h_345} for a held
+    message with id 345, or C{0/13__346} for a message without flags).
+
+    Message ids are handed out in increasing order, and reserved a block at
+    a time in the C{<directory>.next-id} file, so that they're never reused
+    even after the messages carrying them are gone. The file is kept out of
+    the message directory, where older versions expect numbered entries
+    only. Files without an id, stored by older versions, are given one when
+    the backend is created.
+
+    Keys identifying messages are the paths of their files. Message types
+    are not stored separately from the messages themselves.
+
+    @param directory: base of the file system hierarchy.
+    @param directory_size: the maximum number of files in a directory.
+    """
+
+    # How many message ids get reserved each time the next-id file is
+    # written.
+    id_block_size = 1000
+
+    def __init__(self, directory, directory_size=1000):
+        self._directory = directory
+        self._directory_size = directory_size
+        # The newest directory, the next file number in it and how many
+        # files it has, so that adding messages doesn't need to list the
+        # directories each time.
+        self._next = None
+        self._next_id_filename = os.path.normpath(directory) + ".next-id"
+        self._next_id = 0
+        self._reserved_id = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load_ids()
+
+    def walk(self, exclude=None):
+        """Yield the keys of all messages, in order.
+
+        @param exclude: Optionally, a string of flags. Messages with any of
+            these flags set are skipped.
+        """
+        if exclude:
+            exclude = set(exclude)
+        message_dirs = self._get_sorted_filenames()
+        for message_dir in message_dirs:
+            for filename in self._get_sorted_filenames(message_dir):
+                flags = set(self.get_flags(filename))
+                if (not exclude or not exclude & flags):
+                    yield self._message_dir(message_dir, filename)
+
+    def read(self, key):
+        """Return the raw data of the message identified by C{key}."""
+        return read_binary_file(key)
+
+    def add(self, data, type=None):
+        """Append a new message with the given raw C{data}.
+
+        @return: The key of the new message.
+        """
+        filename = self._get_next_message_filename()
+        temp_path = filename + ".tmp"
+        create_binary_file(temp_path, data)
+        key = self._make_key(filename, "", self._allocate_id())
+        os.rename(temp_path, key)
+        return key
+
+    def move_to_end(self, key, flags):
+        """Move a message to the end of the queue, setting its C{flags}.
+
+        @return: The new key of the message.
+        """
+        new_key = self._make_key(self._get_next_message_filename(), flags,
+                                 self.get_message_id(key))
+        os.rename(key, new_key)
+        return new_key
+
+    def delete(self, key):
+        """Delete a message, and its directory if it gets empty."""
+        os.unlink(key)
+        self._next = None
+        containing_dir = os.path.split(key)[0]
+        if not os.listdir(containing_dir):
+            os.rmdir(containing_dir)
+
+    def delete_all(self):
+        """Delete all messages."""
+        for filename in list(self.walk()):
+            os.unlink(filename)
+        self._next = None
+
+    def remove(self):
+        """Remove the reserved message ids, once all messages are gone."""
+        if os.path.exists(self._next_id_filename):
+            os.unlink(self._next_id_filename)
+
+    def get_flags(self, key):
+        basename = os.path.basename(key)
+        if "_" in basename:
+            return basename.split("_")[1]
+        return ""
+
+    def set_flags(self, key, flags):
+        """Set the flags of a message.
+
+        @return: The new key of the message.
+        """
+        dirname, basename = os.path.split(key)
+        new_key = self._make_key(os.path.join(dirname, basename.split("_")[0]),
+                                 flags, self.get_message_id(key))
+        os.rename(key, new_key)
+        return new_key
+
+    def get_type(self, key):
+        """Message types are unknown until messages are decoded."""
+        return None
+
+    def set_type(self, key, type):
+        """Message types are not stored."""
+
+    def get_message_id(self, key):
+        """Return the identifier of the message with the given C{key}.
+
+        It's kept in the file name, so it doesn't change when holding and
+        unholding the message.
+        """
+        return int(os.path.basename(key).split("_")[2])
+
+    def get_next_message_id(self):
+        """Return the lowest message id which was never handed out."""
+        return self._next_id
+
+    def reserve_message_ids(self, next_id):
+        """Never hand out ids below C{next_id}, used by another backend."""
+        if next_id > self._next_id:
+            self._next_id = next_id
+            self._reserve_ids(next_id)
+
+    def _make_key(self, filename, flags, message_id):
+        return "%s_%s_%d" % (filename, flags, message_id)
+
+    def _allocate_id(self):
+        """Return a new message id, reserving more of them if needed."""
+        message_id = self._next_id
+        if message_id >= self._reserved_id:
+            self._reserve_ids(message_id + self.id_block_size)
+        self._next_id = message_id + 1
+        return message_id
+
+    def _reserve_ids(self, reserved_id):
+        """Reserve the message ids below C{reserved_id}."""
+        self._reserved_id = reserved_id
+        temp_path = self._next_id_filename + ".tmp"
+        create_binary_file(temp_path, ("%d\n" % reserved_id).encode("ascii"))
+        os.rename(temp_path, self._next_id_filename)
+
+    def _load_ids(self):
+        """Find out the next message id, and give one to messages without."""
+        if os.path.exists(self._next_id_filename):
+            try:
+                self._next_id = int(read_binary_file(self._next_id_filename))
+            except ValueError:
+                logging.warning("Ignoring invalid message id file %s",
+                                self._next_id_filename)
+        missing = []
+        for key in self.walk():
+            if os.path.basename(key).count("_") < 2:
+                missing.append(key)
+            else:
+                self._next_id = max(self._next_id,
+                                    self.get_message_id(key) + 1)
+        # Make sure that the ids given by a previous run are never handed
+        # out again, even if they were lost.
+        self._reserved_id = self._next_id
+        for key in missing:
+            dirname, basename = os.path.split(key)
+            number, _, flags = basename.partition("_")
+            os.rename(key, self._make_key(os.path.join(dirname, number),
+                                          flags, self._allocate_id()))
+
+    def _get_next_message_filename(self):
+        if self._next is None:
+            message_dirs = self._get_sorted_filenames()
+            if message_dirs:
+                newest_dir = message_dirs[-1]
+                message_filenames = self._get_sorted_filenames(newest_dir)
+            else:
+                os.makedirs(self._message_dir("0"))
+                newest_dir = "0"
+                message_filenames = []
+            if message_filenames:
+                number = int(message_filenames[-1].split("_")[0]) + 1
+            else:
+                number = 0
+            self._next = [int(newest_dir), number, len(message_filenames)]
+
+        newest_dir, number, count = self._next
+        if count >= self._directory_size:
+            newest_dir, number, count = newest_dir + 1, 0, 0
+            os.makedirs(self._message_dir(str(newest_dir)))
+        self._next = [newest_dir, number + 1, count + 1]
+        return self._message_dir(str(newest_dir), str(number))
+
+    def _get_sorted_filenames(self, dir=""):
+        # Only consider numbered entries, skipping temporary files as well
+        # as anything else that might live in the store directory.
+        message_files = [x for x in os.listdir(self._message_dir(dir))
+                         if x.split("_")[0].isdigit()]
+        message_files.sort(key=lambda x: int(x.split("_")[0]))
+        return message_files
+
+    def _message_dir(self, *args):
+        return os.path.join(self._directory, *args)
+
+
+class SegmentBackend(object):
+    """Store messages in append-only segment files.
+
+    The raw data of messages is appended to numbered segment files in the
+    C{segments} sub-directory, each segment holding the data of at most
+    C{segment_size} messages. The order, flags and location of every message
+    are kept in an in-memory index, so walking the store never touches the
+    file system.
+
+    The index is persisted in an append-only C{index} journal file, where
+    each change is recorded by a single line:
+
+      - C{n <next-id>}: the next message id to use.
+      - C{a <id> <segment> <offset> <length> <flags> <type> [<file>]}: a
+        message was added, possibly migrated from the given C{file} of a
+        L{FileSystemBackend}.
+      - C{f <id> <flags>}: the flags of a message were changed.
+      - C{m <id> <flags>}: a message was moved to the end of the queue.
+      - C{t <id> <type>}: the type of a message was found out.
+      - C{d <id>}: a message was deleted.
+
+    Empty flags and unknown types are written as C{-}. A trailing line which
+    was only partially written (e.g. due to a power failure) is ignored when
+    loading, and the journal is compacted to one line per message when it
+    grows too long.
+    The data of a message is flushed to disk before the journal line adding
+    it is written, and journal lines are flushed to disk as well. Messages
+    whose data is missing from their segment anyway are dropped when
+    loading.
+    Segments are removed as soon as no message references them anymore.
+
+    Keys identifying messages are integer ids, which are also used as
+    message ids and are stable across holding and unholding.
+
+    If C{directory} contains messages stored by a L{FileSystemBackend},
+    they get migrated into segments when the backend is created, keeping
+    their ids. New ids are handed out above the ones the L{FileSystemBackend}
+    reserved. Each file is deleted right after its message is added, and
+    the journal records which file each message came from until the
+    migration is over, so that a file left behind by a crash isn't
+    migrated twice.
+
+    @param directory: the directory holding segments and index.
+    @param segment_size: the maximum number of messages in a segment.
+    """
+
+    def __init__(self, directory, segment_size=1000):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._segments_dir = os.path.join(directory, "segments")
+        self._index_filename = os.path.join(directory, "index")
+        self._entries = OrderedDict()
+        self._segment_counts = {}
+        self._next_id = 0
+        self._journal_length = 0
+        # The files of a FileSystemBackend which were migrated already.
+        self._migrated = set()
+        if not os.path.isdir(self._segments_dir):
+            os.makedirs(self._segments_dir)
+        self._load_index()
+        self._drop_truncated_entries()
+        # Never append to a segment written by a previous process, since
+        # it might have a torn tail.
+        segments = [int(x) for x in os.listdir(self._segments_dir)
+                    if x.isdigit()]
+        self._segment = max(segments) + 1 if segments else 0
+        self._segment_messages = 0
+        self._remove_unused_segments(segments)
+        self._migrate_file_system_messages()
+
+    def walk(self, exclude=None):
+        """Yield the keys of all messages, in order.
+
+        @param exclude: Optionally, a string of flags. Messages with any of
+            these flags set are skipped.
+        """
+        if exclude:
+            exclude = set(exclude)
+        for key, entry in list(self._entries.items()):
+            if key not in self._entries:
+                continue
+            if not exclude or not exclude & set(entry[3]):
+                yield key
+
+    def read(self, key):
+        """Return the raw data of the message identified by C{key}."""
+        segment, offset, length = self._entries[key][:3]
+        with open(self._segment_filename(segment), "rb") as fd:
+            fd.seek(offset)
+            return fd.read(length)
+
+    def add(self, data, flags="", type=None):
+        """Append a new message with the given raw C{data}.
+
+        @param flags: The initial flags of the message.
+        @param type: The message type, if known.
+        @return: The key of the new message.
+        """
+        return self._add(data, flags, type)
+
+    def _add(self, data, flags, type, migrated=None, key=None):
+        if self._segment_messages >= self._segment_size:
+            self._segment += 1
+            self._segment_messages = 0
+        with open(self._segment_filename(self._segment), "ab") as fd:
+            fd.seek(0, os.SEEK_END)
+            offset = fd.tell()
+            fd.write(data)
+            # The journal line must never refer to data that could be lost.
+            fd.flush()
+            os.fsync(fd.fileno())
+        self._segment_messages += 1
+        if key is None:
+            key = self._next_id
+        line = "a %d %d %d %d %s %s" % (
+            key, self._segment, offset, len(data), flags or "-", type or "-")
+        if migrated is not None:
+            line += " " + migrated
+        self._write_journal(line)
+        self._apply_add(key, self._segment, offset, len(data), flags, type)
+        return key
+
+    def move_to_end(self, key, flags):
+        """Move a message to the end of the queue, setting its C{flags}.
+
+        @return: The key of the message, which doesn't change.
+        """
+        self._write_journal("m %d %s" % (key, flags or "-"))
+        self._apply_move(key, flags)
+        return key
+
+    def delete(self, key):
+        """Delete a message, and its segment if it's not used anymore."""
+        self._write_journal("d %d" % key)
+        segment = self._apply_delete(key)
+        if segment != self._segment and segment not in self._segment_counts:
+            os.unlink(self._segment_filename(segment))
+
+    def delete_all(self):
+        """Delete all messages."""
+        self._entries.clear()
+        self._segment_counts.clear()
+        self._compact()
+        self._remove_unused_segments(
+            int(x) for x in os.listdir(self._segments_dir) if x.isdigit())
+        self._segment += 1
+        self._segment_messages = 0
+
+    def get_flags(self, key):
+        return self._entries[key][3]
+
+    def set_flags(self, key, flags):
+        """Set the flags of a message.
+
+        @return: The key of the message, which doesn't change.
+        """
+        self._write_journal("f %d %s" % (key, flags or "-"))
+        self._entries[key][3] = flags
+        return key
+
+    def get_type(self, key):
+        """Return the type of a message, or C{None} if unknown."""
+        return self._entries[key][4]
+
+    def set_type(self, key, type):
+        """Remember the type of a message."""
+        self._write_journal("t %d %s" % (key, type))
+        self._entries[key][4] = type
+
+    def get_message_id(self, key):
+        """Return the identifier of the message with the given C{key}."""
+        return key
+
+    def get_next_message_id(self):
+        """Return the lowest message id which was never handed out."""
+        return self._next_id
+
+    def _segment_filename(self, segment):
+        return os.path.join(self._segments_dir, str(segment))
+
+    def _apply_add(self, key, segment, offset, length, flags, type):
+        self._entries[key] = [segment, offset, length, flags, type]
+        self._segment_counts[segment] = (
+            self._segment_counts.get(segment, 0) + 1)
+        self._next_id = max(self._next_id, key + 1)
+
+    def _apply_move(self, key, flags):
+        entry = self._entries.pop(key)
+        entry[3] = flags
+        self._entries[key] = entry
+
+    def _apply_delete(self, key):
+        segment = self._entries.pop(key)[0]
+        self._segment_counts[segment] -= 1
+        if not self._segment_counts[segment]:
+            del self._segment_counts[segment]
+        return segment
+
+    def _write_journal(self, line):
+        if self._journal_length > 2 * len(self._entries) + 1000:
+            self._compact()
+        with open(self._index_filename, "ab") as fd:
+            fd.write(line.encode("ascii") + b"\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+        self._journal_length += 1
+
+    def _load_index(self):
+        if not os.path.exists(self._index_filename):
+            return
+        lines = read_binary_file(self._index_filename).split(b"\n")
+        # The last item is either empty or a partially written line.
+        for line in lines[:-1]:
+            try:
+                fields = [field if field != "-" else ""
+                          for field in line.decode("ascii").split(" ")]
+                if fields[0] == "n":
+                    self._next_id = max(self._next_id, int(fields[1]))
+                elif fields[0] == "a":
+                    self._apply_add(int(fields[1]), int(fields[2]),
+                                    int(fields[3]), int(fields[4]), fields[5],
+                                    fields[6] or None)
+                    if len(fields) > 7:
+                        self._migrated.add(fields[7])
+                elif fields[0] == "f":
+                    self._entries[int(fields[1])][3] = fields[2]
+                elif fields[0] == "m":
+                    self._apply_move(int(fields[1]), fields[2])
+                elif fields[0] == "t":
+                    self._entries[int(fields[1])][4] = fields[2]
+                elif fields[0] == "d":
+                    self._apply_delete(int(fields[1]))
+            except (IndexError, KeyError, ValueError):
+                logging.warning("Ignoring invalid message store index "
+                                "record %r", line)
+        self._journal_length = len(lines) - 1
+        if lines[-1]:
+            # Get rid of the torn line, so that new records are appended
+            # to a well formed journal.
+            self._compact()
+
+    def _drop_truncated_entries(self):
+        """Drop the messages whose data lies past the end of their segment."""
+        sizes = {}
+        truncated = []
+        for key, entry in self._entries.items():
+            segment, offset, length = entry[:3]
+            if segment not in sizes:
+                filename = self._segment_filename(segment)
+                sizes[segment] = (os.path.getsize(filename)
+                                  if os.path.exists(filename) else 0)
+            if offset + length > sizes[segment]:
+                truncated.append(key)
+        for key in truncated:
+            logging.warning("Dropping message %d, whose data is missing from "
+                            "the message store.", key)
+            self._apply_delete(key)
+        if truncated:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the index journal with a single line per message."""
+        lines = ["n %d" % self._next_id]
+        for key, entry in self._entries.items():
+            segment, offset, length, flags, type = entry
+            lines.append("a %d %d %d %d %s %s" % (
+                key, segment, offset, length, flags or "-", type or "-"))
+        data = "".join(line + "\n" for line in lines).encode("ascii")
+        temp_path = self._index_filename + ".tmp"
+        with open(temp_path, "wb") as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(temp_path, self._index_filename)
+        self._journal_length = len(lines)
+
+    def _remove_unused_segments(self, segments):
+        for segment in segments:
+            if segment not in self._segment_counts:
+                os.unlink(self._segment_filename(segment))
+
+    def _migrate_file_system_messages(self):
+        """Move messages stored by a L{FileSystemBackend} into segments."""
+        legacy = FileSystemBackend(self._directory)
+        next_id = legacy.get_next_message_id()
+        if next_id > self._next_id:
+            # Ids handed out by the legacy store may still be referenced,
+            # for instance by the package reporter, so they aren't reused.
+            self._write_journal("n %d" % next_id)
+            self._next_id = next_id
+        filenames = list(legacy.walk())
+        if filenames:
+            logging.info(
+                "Migrating %d messages to the segmented message store.",
+                len(filenames))
+        for filename in filenames:
+            name = os.path.relpath(filename, self._directory)
+            if name not in self._migrated:
+                self._add(legacy.read(filename), legacy.get_flags(filename),
+                          None, migrated=name,
+                          key=legacy.get_message_id(filename))
+            legacy.delete(filename)
+        legacy.remove()
+        if filenames:
+            # The names of the migrated files aren't needed anymore.
+            self._migrated.clear()
+            self._compact()
+
+    def has_messages(self):
+        """Return whether any message is stored."""
+        return bool(self._entries)
+
+    def remove(self):
+        """Remove the segments and the index, which must hold no message."""
+        self._remove_unused_segments(
+            int(x) for x in os.listdir(self._segments_dir) if x.isdigit())
+        os.rmdir(self._segments_dir)
+        if os.path.exists(self._index_filename):
+            os.unlink(self._index_filename)
+
+
+def get_message_store_backend(name, directory):
+    """Return the backend with the given C{name} storing messages in
+    C{directory}, or C{None} for the default L{FileSystemBackend}.
+
+    Messages stored a file each are migrated when switching to the
+    C{"segment"} backend, but they are never moved back. So when switching
+    to the C{"directory"} backend, a L{SegmentBackend} is still used until
+    all its messages are gone. Message ids keep increasing across switches.
+    """
+    if name == "segment":
+        return SegmentBackend(directory)
+    if os.path.isdir(os.path.join(directory, "segments")):
+        backend = SegmentBackend(directory)
+        if backend.has_messages():
+            logging.warning("Keeping the segmented message store in %s until "
+                            "its messages are sent.", directory)
+            return backend
+        FileSystemBackend(directory).reserve_message_ids(
+            backend.get_next_message_id())
+        backend.remove()
+    return None
+
+
 def get_default_message_store(*args, **kwargs):
     """
     Get a L{MessageStore} object with all Landscape message schemas added.
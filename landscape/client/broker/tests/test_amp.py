@@ -1,5 +1,7 @@
 import mock
 
+from twisted.internet.task import Clock
+
 from landscape.lib.amp import MethodCallError
 from landscape.client.tests.helpers import (
         LandscapeTest, DEFAULT_ACCEPTED_TYPES)
@@ -61,6 +63,73 @@ class RemoteBrokerTest(LandscapeTest):
         self.assertTrue(isinstance(message_id, int))
         self.assertTrue(self.exchanger.is_urgent())
 
+    def test_send_message_batched(self):
+        """
+        If L{RemoteBroker.batch_messages} is set, the messages sent during
+        the same reactor iteration are queued with a single call to the
+        remote L{BrokerServer.send_messages} method.
+        """
+        self.remote.batch_messages = True
+        self.remote._factory.clock = clock = Clock()
+        self.broker.send_messages = mock.Mock(
+            wraps=self.broker.send_messages)
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.successResultOf(self.remote.get_session_id())
+        message1 = {"type": "test", "echo": b"1"}
+        message2 = {"type": "test", "echo": b"2"}
+        result1 = self.remote.send_message(message1, session_id)
+        result2 = self.remote.send_message(message2, session_id, urgent=True)
+        self.assertFalse(result1.called)
+        self.assertFalse(result2.called)
+
+        clock.advance(0)
+        message_id1 = self.successResultOf(result1)
+        message_id2 = self.successResultOf(result2)
+        self.assertTrue(self.mstore.is_pending(message_id1))
+        self.assertTrue(self.mstore.is_pending(message_id2))
+        self.assertMessages(self.mstore.get_pending_messages(),
+                            [message1, message2])
+        self.assertTrue(self.exchanger.is_urgent())
+        self.assertEqual(1, self.broker.send_messages.call_count)
+
+    def test_send_message_batched_with_error(self):
+        """
+        If a batched message can't be queued, only the L{Deferred} associated
+        with it fails.
+        """
+        self.remote.batch_messages = True
+        self.remote._factory.clock = clock = Clock()
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.successResultOf(self.remote.get_session_id())
+        result1 = self.remote.send_message({"type": "test"}, None)
+        result2 = self.remote.send_message({"type": "test"}, session_id)
+        clock.advance(0)
+        failure = self.failureResultOf(result1)
+        self.assertTrue(failure.check(MethodCallError))
+        self.assertTrue(self.mstore.is_pending(self.successResultOf(result2)))
+
+    def test_send_message_batched_with_old_broker(self):
+        """
+        If the remote broker doesn't support L{BrokerServer.send_messages},
+        batched messages are sent one by one.
+        """
+        self.remote.batch_messages = True
+        self.remote._factory.clock = clock = Clock()
+        self.broker.send_messages = mock.Mock(
+            side_effect=MethodCallError("Forbidden method 'send_messages'"))
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.successResultOf(self.remote.get_session_id())
+        result1 = self.remote.send_message({"type": "test"}, session_id)
+        result2 = self.remote.send_message({"type": "test"}, session_id)
+        clock.advance(0)
+        self.assertTrue(self.mstore.is_pending(self.successResultOf(result1)))
+        self.assertTrue(self.mstore.is_pending(self.successResultOf(result2)))
+
+        # Further messages are not batched anymore
+        result3 = self.remote.send_message({"type": "test"}, session_id)
+        self.assertTrue(self.mstore.is_pending(self.successResultOf(result3)))
+        self.assertEqual(1, self.broker.send_messages.call_count)
+
     def test_is_message_pending(self):
         """
         The L{RemoteBroker.is_message_pending} method calls the
@@ -163,6 +232,108 @@ class RemoteBrokerTest(LandscapeTest):
         result = self.remote.call_if_accepted("test", function)
         return self.assertSuccess(result, None)
 
+    def test_call_if_accepted_cached(self):
+        """
+        If L{RemoteBroker.batch_messages} is set, the accepted message types
+        are fetched only once, until L{RemoteBroker.accepted_types_changed}
+        gets called.
+        """
+        self.remote.batch_messages = True
+        self.broker.get_accepted_message_types_snapshot = mock.Mock(
+            wraps=self.broker.get_accepted_message_types_snapshot)
+        self.mstore.set_accepted_types(["test"])
+        function = mock.Mock(return_value="cool")
+        self.successResultOf(self.remote.call_if_accepted("test", function))
+        self.successResultOf(self.remote.call_if_accepted("test", function))
+        self.assertEqual(2, function.call_count)
+        self.assertEqual(
+            1, self.broker.get_accepted_message_types_snapshot.call_count)
+
+        self.mstore.set_accepted_types([])
+        self.remote.accepted_types_changed()
+        self.successResultOf(self.remote.call_if_accepted("test", function))
+        self.assertEqual(2, function.call_count)
+        self.assertEqual(
+            2, self.broker.get_accepted_message_types_snapshot.call_count)
+
+    def test_call_if_accepted_synchronous(self):
+        """
+        Once the accepted types are fetched, L{RemoteBroker.call_if_accepted}
+        calls the given function synchronously, without asking the broker.
+        """
+        self.remote.batch_messages = True
+        self.mstore.set_accepted_types(["test"])
+        self.assertEqual(
+            set(["test"]),
+            self.successResultOf(self.remote.fetch_accepted_types()))
+        self.broker.get_accepted_message_types_snapshot = mock.Mock()
+        function = mock.Mock(return_value="cool")
+        result = self.remote.call_if_accepted("test", function, 123)
+        self.assertEqual("cool", self.successResultOf(result))
+        function.assert_called_once_with(123)
+        result = self.remote.call_if_accepted("other", function)
+        self.assertIs(None, self.successResultOf(result))
+        snapshot = self.broker.get_accepted_message_types_snapshot
+        self.assertFalse(snapshot.called)
+
+    def test_accepted_types_changed(self):
+        """
+        The cached accepted types are updated by the changes notified by the
+        broker, in order.
+        """
+        self.remote.batch_messages = True
+        self.mstore.set_accepted_types(["test", "foo"])
+        self.successResultOf(self.remote.fetch_accepted_types())
+        self.remote.accepted_types_changed("bar", True, 1)
+        self.remote.accepted_types_changed("foo", False, 2)
+        self.assertEqual(set(["test", "bar"]), self.remote._accepted_types)
+
+    def test_accepted_types_changed_with_missed_change(self):
+        """
+        If a change to the accepted types got lost, the cache is dropped and
+        the accepted types are fetched again when needed.
+        """
+        self.remote.batch_messages = True
+        self.mstore.set_accepted_types(["test"])
+        self.successResultOf(self.remote.fetch_accepted_types())
+        self.remote.accepted_types_changed("foo", True, 2)
+        self.assertIs(None, self.remote._accepted_types)
+        self.broker._accepted_types_generation = 2
+        self.mstore.set_accepted_types(["test", "foo", "bar"])
+        function = mock.Mock()
+        self.successResultOf(self.remote.call_if_accepted("bar", function))
+        function.assert_called_once_with()
+        self.assertEqual(2, self.remote._accepted_types_generation)
+
+    def test_accepted_types_changed_while_fetching(self):
+        """
+        Changes notified while the accepted types are being fetched are
+        applied to the fetched types if they're newer.
+        """
+        self.remote.batch_messages = True
+        self.mstore.set_accepted_types(["test"])
+        self.remote.accepted_types_changed("test", True, 1)
+        self.remote.accepted_types_changed("foo", True, 2)
+        self.broker._accepted_types_generation = 1
+        types = self.successResultOf(self.remote.fetch_accepted_types())
+        self.assertEqual(set(["test", "foo"]), types)
+        self.assertEqual(2, self.remote._accepted_types_generation)
+
+    def test_fetch_accepted_types_with_old_broker(self):
+        """
+        If the broker can't number the changes to the accepted types, the
+        cached types are just dropped when they change.
+        """
+        self.remote.batch_messages = True
+        self.broker.get_accepted_message_types_snapshot = mock.Mock(
+            side_effect=MethodCallError(
+                "Forbidden method 'get_accepted_message_types_snapshot'"))
+        self.mstore.set_accepted_types(["test"])
+        types = self.successResultOf(self.remote.fetch_accepted_types())
+        self.assertEqual(set(["test"]), types)
+        self.remote.accepted_types_changed("foo", True)
+        self.assertIs(None, self.remote._accepted_types)
+
     def test_listen_events(self):
         """
         L{RemoteBroker.listen_events} returns a deferred which fires when
@@ -378,6 +378,18 @@ class BrokerClientTest(LandscapeTest):
         self.client.fire_event(event_type, "test", False)
         callback.assert_called_once_with(False)
 
+    def test_fire_event_with_acceptance_changed_resets_accepted_types(self):
+        """
+        When the given event type is C{message-type-acceptance-changed}, the
+        change is also passed to the broker, to update its cached accepted
+        types.
+        """
+        self.client.broker = mock.Mock()
+        self.client.fire_event(
+            "message-type-acceptance-changed", "test", True, 3)
+        self.client.broker.accepted_types_changed.assert_called_once_with(
+            "test", True, 3)
+
     def test_handle_reconnect(self):
         """
         The L{BrokerClient.handle_reconnect} method is triggered by a
@@ -397,6 +409,7 @@ class BrokerClientTest(LandscapeTest):
             broker.register_client_accepted_message_type.assert_has_calls(
                 calls, any_order=True)
             broker.register_client.assert_called_once_with("client")
+            broker.accepted_types_changed.assert_called_once_with()
 
         return gather_results([result1, result2]).addCallback(got_result)
 
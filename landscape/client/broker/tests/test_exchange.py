@@ -1,6 +1,7 @@
 import mock
 
 from landscape import CLIENT_API
+from landscape.lib import bpickle
 from landscape.lib.persist import Persist
 from landscape.lib.fetch import HTTPCodeError, PyCurlError
 from landscape.lib.hashlib import md5
@@ -109,6 +110,35 @@ class MessageExchangeTest(LandscapeTest):
                                      "timestamp": 0,
                                      "api": b"3.2"}])
 
+    def test_send_with_request_encoding(self):
+        """
+        Messages go through unchanged when payloads are compressed, with or
+        without being passed through as they are stored.
+        """
+        self.transport.request_encoding = "gzip"
+        self.mstore.set_accepted_types(["empty"])
+        self.exchanger.send({"type": "empty"})
+        self.exchanger.exchange()
+        self.exchanger._message_passthrough = True
+        self.exchanger.send({"type": "empty"})
+        self.exchanger.exchange()
+        for payload in self.transport.payloads:
+            self.assertEqual(payload["messages"], [{"type": "empty",
+                                                    "timestamp": 0,
+                                                    "api": b"3.2"}])
+
+    def test_passthrough_messages_decoded_as_is(self):
+        """
+        L{FakeTransport} decodes passed-through messages as they are, with
+        or without compressing the payload.
+        """
+        message = bpickle.Serialized(bpickle.dumps({b"key": b"value"}))
+        self.transport.exchange({"messages": [message]})
+        self.transport.request_encoding = "gzip"
+        self.transport.exchange({"messages": [message]})
+        for payload in self.transport.payloads:
+            self.assertEqual([{b"key": b"value"}], payload["messages"])
+
     def test_send_urgent(self):
         """
         Sending a message with the urgent flag should schedule an
@@ -202,6 +232,26 @@ class MessageExchangeTest(LandscapeTest):
         self.assertMessages(self.transport.payloads[0]["messages"],
                             [{"type": "holdme"}])
 
+    def test_accepted_types_reprocessing_spans_reactor_iterations(self):
+        """
+        Held messages are reprocessed in batches across reactor iterations,
+        and the urgent exchange is scheduled once all of them are done.
+        """
+        for i in range(3):
+            self.exchanger.send({"type": "holdme"})
+        reprocess_holding = self.mstore.reprocess_holding
+        with mock.patch.object(self.mstore, "reprocess_holding",
+                               lambda: reprocess_holding(batch_size=2)):
+            self.exchanger.handle_message(
+                {"type": "accepted-types", "types": ["holdme"]})
+        self.assertEqual(0, self.mstore.count_pending_messages())
+        self.reactor.advance(0)
+        self.assertEqual(3, self.mstore.count_pending_messages())
+        self.wait_for_exchange(urgent=True)
+        self.assertEqual(len(self.transport.payloads), 1)
+        self.assertMessages(self.transport.payloads[0]["messages"],
+                            [{"type": "holdme"}] * 3)
+
     def test_accepted_types_no_urgent_without_held(self):
         """
         If an accepted-types message does *not* "unhold" any exist messages,
@@ -240,8 +290,8 @@ class MessageExchangeTest(LandscapeTest):
 
     def test_messages_from_server_commit(self):
         """
-        The Exchange should commit the message store after processing each
-        message.
+        The Exchange should record the server sequence in the message store
+        after processing each message.
         """
         self.transport.responses.append([{"type": "inbound"}] * 3)
         handled = []
@@ -259,6 +309,56 @@ class MessageExchangeTest(LandscapeTest):
         self.exchanger.exchange()
         self.assertEqual(handled, [True] * 3, self.logfile.getvalue())
 
+    def test_messages_from_server_single_commit(self):
+        """
+        The message store is committed only once for a whole batch of
+        messages from the server, the progress through the batch survives
+        a restart anyway.
+        """
+        self.transport.responses.append([{"type": "inbound"}] * 3)
+        recovered = []
+        commits = []
+
+        def handler(message):
+            persist = Persist(filename=self.persist_filename)
+            store = MessageStore(persist, self.config.message_store_path)
+            recovered.append(store.get_server_sequence())
+            commits.append(commit.call_count)
+
+        self.exchanger.register_message("inbound", handler)
+        with mock.patch.object(self.mstore, "commit",
+                               wraps=self.mstore.commit) as commit:
+            self.exchanger.exchange()
+        self.assertEqual([0, 1, 2], recovered)
+        self.assertEqual([commits[0]] * 3, commits)
+        self.assertEqual(commits[0] + 1, commit.call_count)
+        self.assertEqual(3, self.mstore.get_server_sequence())
+
+    def test_messages_from_server_changing_persist(self):
+        """
+        The recorded progress through a batch of messages from the server
+        never gets ahead of the persist changes made by their handlers, so
+        these changes survive a crash in the middle of the batch.
+        """
+        self.transport.responses.append(
+            [{"type": "inbound", "value": value} for value in (1, 2, 3)])
+        recovered = []
+
+        def handler(message):
+            persist = Persist(filename=self.persist_filename)
+            store = MessageStore(persist, self.config.message_store_path)
+            recovered.append(
+                (store.get_server_sequence(), persist.get("handled")))
+            self.persist.set("handled", message["value"])
+
+        self.exchanger.register_message("inbound", handler)
+        self.exchanger.exchange()
+        self.assertEqual([(0, None), (1, 1), (2, 2)], recovered)
+        persist = Persist(filename=self.persist_filename)
+        store = MessageStore(persist, self.config.message_store_path)
+        self.assertEqual((3, 3),
+                         (store.get_server_sequence(), persist.get("handled")))
+
     def test_messages_from_server_causing_urgent_exchanges(self):
         """
         If a message from the server causes an urgent message to be
@@ -554,6 +654,32 @@ class MessageExchangeTest(LandscapeTest):
         self.assertEqual(payload.get("server-api"), b"1.1")
         self.assertEqual(self.transport.message_api, b"1.1")
 
+    def test_per_api_payloads_with_message_passthrough(self):
+        """
+        Messages with different APIs are split in different payloads when
+        they are passed through as they are stored too.
+        """
+        self.exchanger._message_passthrough = True
+        self.mstore.set_accepted_types(["a", "b"])
+        self.mstore.add_schema(Message("a", {}))
+        self.mstore.add_schema(Message("b", {}))
+        self.mstore.add({"type": "a", "api": b"1.0"})
+        self.mstore.add({"type": "b", "api": b"1.1"})
+
+        payload = self.exchanger._make_payload()
+        self.assertEqual(b"1.0", payload["server-api"])
+        self.assertEqual(
+            [bpickle.dumps({"type": "a", "api": b"1.0"})], payload["messages"])
+        self.assertIsInstance(payload["messages"][0], bpickle.Serialized)
+
+        self.exchanger.exchange()
+        self.exchanger.exchange()
+        self.assertMessages(self.transport.payloads[-2]["messages"],
+                            [{"type": "a", "api": b"1.0"}])
+        self.assertMessages(self.transport.payloads[-1]["messages"],
+                            [{"type": "b", "api": b"1.1"}])
+        self.assertEqual(b"1.1", self.transport.message_api)
+
     def test_exchange_token(self):
         """
         When sending messages to the server, the exchanger provides the
@@ -1,3 +1,5 @@
+import mock
+
 from landscape.client.tests.helpers import LandscapeTest
 
 from twisted.internet.defer import fail
@@ -67,6 +69,19 @@ class PingClientTest(LandscapeTest):
             [(url, True, {"Content-Type": "application/x-www-form-urlencoded"},
               "insecure_id=10")])
 
+    def test_ping_in_ping_pool(self):
+        """
+        Pings run in their own pool of threads, separately from the message
+        exchanges.
+        """
+        client = FakePageGetter(None)
+        pinger = PingClient(self.reactor, get_page=client.get_page)
+        with mock.patch.object(self.reactor, "call_in_pool",
+                               wraps=self.reactor.call_in_pool) as call:
+            pinger.ping("http://localhost/ping", 10)
+        self.assertEqual("ping", call.call_args[0][0])
+        self.assertEqual(1, len(client.fetches))
+
     def test_ping_no_insecure_id(self):
         """
         If a L{PingClient} does not have an insecure-id yet, then the ping
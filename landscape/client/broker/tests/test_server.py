@@ -84,6 +84,42 @@ class BrokerServerTest(LandscapeTest):
         self.assertMessages(self.mstore.get_pending_messages(), [message])
         self.assertTrue(self.exchanger.is_urgent())
 
+    def test_send_messages(self):
+        """
+        The L{BrokerServer.send_messages} method queues several messages at
+        once, returning a result for each of them.
+        """
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        message1 = {"type": "test", "echo": b"1"}
+        message2 = {"type": "test", "echo": b"2"}
+        results = self.broker.send_messages(
+            [(message1, session_id, False), (message2, session_id, True)])
+        self.assertEqual([True, True], [ok for ok, _ in results])
+        self.assertTrue(self.mstore.is_pending(results[0][1]))
+        self.assertTrue(self.mstore.is_pending(results[1][1]))
+        self.assertMessages(self.mstore.get_pending_messages(),
+                            [message1, message2])
+        self.assertTrue(self.exchanger.is_urgent())
+
+    def test_send_messages_with_error(self):
+        """
+        If a message passed to L{BrokerServer.send_messages} can't be queued,
+        the other messages are queued anyway and the error is reported in the
+        results.
+        """
+        self.mstore.set_accepted_types(["test"])
+        session_id = self.broker.get_session_id()
+        message1 = {"type": "test", "echo": b"1"}
+        message2 = {"type": "test", "echo": b"2"}
+        results = self.broker.send_messages(
+            [(message1, None, False), (message2, session_id, False)])
+        self.assertEqual(
+            (False, "RuntimeError: Session ID must be set before attempting "
+                    "to send a message"), results[0])
+        self.assertTrue(results[1][0])
+        self.assertMessages(self.mstore.get_pending_messages(), [message2])
+
     def test_send_message_wont_send_with_invalid_session_id(self):
         """
         The L{BrokerServer.send_message} call will silently drop messages
@@ -563,7 +599,24 @@ class HandlersTest(LandscapeTest):
         self.client.fire_event = Mock(return_value=succeed(None))
         self.reactor.fire("message-type-acceptance-changed", "test", True)
         self.client.fire_event.assert_called_once_with(
-            "message-type-acceptance-changed", "test", True)
+            "message-type-acceptance-changed", "test", True, 1)
+
+    def test_message_type_acceptance_changed_generation(self):
+        """
+        Each C{message-type-acceptance-changed} event broadcast to clients
+        gets a new generation number, which is also returned along with the
+        accepted types by L{BrokerServer.get_accepted_message_types_snapshot}.
+        """
+        self.client.fire_event = Mock(return_value=succeed(None))
+        self.mstore.set_accepted_types(["test"])
+        self.assertEqual(
+            (0, ["test"]), self.broker.get_accepted_message_types_snapshot())
+        self.reactor.fire("message-type-acceptance-changed", "foo", False)
+        self.reactor.fire("message-type-acceptance-changed", "test", True)
+        self.client.fire_event.assert_called_with(
+            "message-type-acceptance-changed", "test", True, 2)
+        self.assertEqual(
+            (2, ["test"]), self.broker.get_accepted_message_types_snapshot())
 
     def test_server_uuid_changed(self):
         """
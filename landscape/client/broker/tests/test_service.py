@@ -7,6 +7,7 @@ from landscape.client.broker.tests.helpers import BrokerConfigurationHelper
 from landscape.client.broker.service import BrokerService
 from landscape.client.broker.transport import HTTPTransport
 from landscape.client.broker.amp import RemoteBrokerConnector
+from landscape.client.broker.store import SegmentBackend
 from landscape.lib.testing import FakeReactor
 
 
@@ -37,12 +38,31 @@ class BrokerServiceTest(LandscapeTest):
         self.assertTrue(isinstance(self.service.transport, HTTPTransport))
         self.assertEqual(self.service.transport.get_url(), self.config.url)
 
+    def test_transport_keep_alive(self):
+        """
+        The C{exchange_keep_alive} option makes the transport keep its
+        connection open.
+        """
+        self.config.exchange_keep_alive = True
+        service = BrokerService(self.config)
+        self.assertTrue(service.transport._keep_alive)
+        self.assertFalse(self.service.transport._keep_alive)
+
     def test_message_store(self):
         """
         A L{BrokerService} instance has a proper C{message_store} attribute.
         """
         self.assertEqual(self.service.message_store.get_accepted_types(), ())
 
+    def test_message_store_segment_backend(self):
+        """
+        The C{message_store_backend} option selects the backend used by the
+        message store.
+        """
+        self.config.message_store_backend = "segment"
+        service = BrokerService(self.config)
+        self.assertIsInstance(service.message_store._backend, SegmentBackend)
+
     def test_identity(self):
         """
         A L{BrokerService} instance has a proper C{identity} attribute.
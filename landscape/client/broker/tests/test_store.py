@@ -4,11 +4,14 @@ import mock
 
 from twisted.python.compat import intToBytes
 
+from landscape.lib import bpickle
 from landscape.lib.bpickle import dumps
+from landscape.lib.fs import read_binary_file
 from landscape.lib.persist import Persist
 from landscape.lib.schema import InvalidError, Int, Bytes, Unicode
 from landscape.message_schemas.message import Message
-from landscape.client.broker.store import MessageStore
+from landscape.client.broker.store import (
+    MessageStore, FileSystemBackend, SegmentBackend, get_message_store_backend)
 
 from landscape.client.tests.helpers import LandscapeTest
 
@@ -52,6 +55,85 @@ class MessageStoreTest(LandscapeTest):
         store = self.create_store()
         self.assertEqual(store.get_server_sequence(), 3)
 
+    def test_commit_unmodified(self):
+        """The persist isn't saved again if nothing changed."""
+        self.store.set_sequence(3)
+        self.store.commit()
+        with mock.patch.object(Persist, "save") as save:
+            self.store.commit()
+        self.assertFalse(save.called)
+
+    def test_record_server_sequence(self):
+        """
+        A recorded server sequence is set right away, and survives a restart
+        without a commit.
+        """
+        self.store.commit()
+        self.store.record_server_sequence(3)
+        self.store.record_server_sequence(4)
+        self.assertEqual(self.store.get_server_sequence(), 4)
+        store = self.create_store()
+        self.assertEqual(store.get_server_sequence(), 4)
+
+    def test_record_server_sequence_fsync(self):
+        """
+        Records are flushed to disk, and so is the directory holding them
+        when the file gets created.
+        """
+        self.store.commit()
+        with mock.patch("os.fsync") as fsync:
+            self.store.record_server_sequence(3)
+            self.assertEqual(2, fsync.call_count)
+            self.store.record_server_sequence(4)
+            self.assertEqual(3, fsync.call_count)
+            self.store.commit()
+            self.store.record_server_sequence(5)
+            self.assertEqual(5, fsync.call_count)
+
+    def test_record_server_sequence_commit(self):
+        """The records are dropped once the store is committed."""
+        self.store.commit()
+        self.store.record_server_sequence(3)
+        self.assertTrue(
+            os.path.exists(self.persist_filename + ".server-sequence"))
+        self.assertEqual([], os.listdir(self.temp_dir))
+        self.store.commit()
+        self.assertFalse(
+            os.path.exists(self.persist_filename + ".server-sequence"))
+        self.store.set_server_sequence(2)
+        self.store.commit()
+        store = self.create_store()
+        self.assertEqual(store.get_server_sequence(), 2)
+
+    def test_record_server_sequence_torn(self):
+        """A partially written record is ignored."""
+        self.store.commit()
+        self.store.record_server_sequence(3)
+        with open(self.persist_filename + ".server-sequence", "ab") as fd:
+            fd.write(b"4")
+        store = self.create_store()
+        self.assertEqual(store.get_server_sequence(), 3)
+        store.commit()
+        self.assertEqual(self.create_store().get_server_sequence(), 3)
+
+    def test_record_server_sequence_after_other_changes(self):
+        """
+        If something else changed in the persist since the last record, the
+        store is committed instead, so the recorded sequence never gets
+        ahead of the saved changes.
+        """
+        self.store.commit()
+        self.store.record_server_sequence(3)
+        self.store.set_exchange_token("abcd")
+        with mock.patch.object(self.store, "commit") as commit:
+            self.store.record_server_sequence(4)
+        commit.assert_called_once_with()
+        self.store.commit()
+        self.store.record_server_sequence(5)
+        store = self.create_store()
+        self.assertEqual(5, store.get_server_sequence())
+        self.assertEqual("abcd", store.get_exchange_token())
+
     def test_get_set_server_uuid(self):
         self.assertEqual(self.store.get_server_uuid(), None)
         self.store.set_server_uuid("abcd-efgh")
@@ -169,7 +251,8 @@ class MessageStoreTest(LandscapeTest):
             self.store.add(dict(type="data", data=intToBytes(i)))
         il = [m["data"] for m in self.store.get_pending_messages(60)]
         self.assertEqual(il, [intToBytes(i) for i in range(60)])
-        self.assertEqual(set(os.listdir(self.temp_dir)), set(["0", "1", "2"]))
+        self.assertEqual(set(os.listdir(self.temp_dir)),
+                         set(["0", "1", "2"]))
 
         self.store.set_pending_offset(60)
         self.store.delete_old_messages()
@@ -182,6 +265,45 @@ class MessageStoreTest(LandscapeTest):
         il = [m["data"] for m in self.store.get_pending_messages(20)]
         self.assertEqual(il, [intToBytes(i) for i in [0, 2, 4, 6, 8]])
 
+    def test_get_pending_serialized_messages(self):
+        """
+        Pending messages can be got as they are stored, along with their
+        API, holding the ones which aren't accepted.
+        """
+        for i in range(4):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        messages = self.store.get_pending_serialized_messages()
+        self.assertEqual(
+            [(b"3.2", bpickle.dumps({"type": "data", "api": b"3.2",
+                                     "data": intToBytes(i)}))
+             for i in [0, 2]],
+            messages)
+        self.assertIsInstance(messages[0][1], bpickle.Serialized)
+        self.assertEqual(1, len(self.store.get_pending_serialized_messages(1)))
+        self.store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(
+            [intToBytes(i) for i in [0, 2, 1, 3]],
+            [bpickle.loads(message)["data"]
+             for api, message in self.store.get_pending_serialized_messages()])
+
+    def test_get_pending_serialized_messages_truncated(self):
+        """Truncated messages are flagged as broken."""
+        self.log_helper.ignore_errors(ValueError)
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "data", "data": b"2"})
+        filename = os.path.join(self.temp_dir, "0", "0__0")
+        with open(filename, "rb") as fh:
+            data = fh.read()
+        with open(filename, "wb") as fh:
+            fh.write(data[:-3])
+        messages = self.store.get_pending_serialized_messages()
+        self.assertEqual(
+            [b"2"],
+            [bpickle.loads(message)["data"] for api, message in messages])
+        self.assertIn("Truncated message", self.logfile.getvalue())
+        self.assertEqual(1, len(self.store.get_pending_messages()))
+
     def test_unaccepted_with_offset(self):
         for i in range(10):
             self.store.add(dict(type=["data", "unaccepted"][i % 2],
@@ -236,12 +358,50 @@ class MessageStoreTest(LandscapeTest):
         self.assertEqual(il, [intToBytes(i)
                               for i in [1, 3, 5, 7, 9, 0, 2, 4, 6, 8]])
 
+    def test_reprocess_holding_in_batches(self):
+        """
+        C{reprocess_holding} yields control back to its caller every
+        C{batch_size} messages, and only applies changes once all messages
+        have been looked at.
+        """
+        for i in range(4):
+            self.store.add(dict(type="unaccepted", data=intToBytes(i)))
+        self.store.set_accepted_types(["unaccepted"], reprocess=False)
+        reprocessing = self.store.reprocess_holding(batch_size=3)
+        next(reprocessing)
+        self.assertEqual([], self.store.get_pending_messages())
+        next(reprocessing)
+        self.assertEqual(3, len(self.store.get_pending_messages()))
+        self.assertRaises(StopIteration, next, reprocessing)
+        self.assertEqual(4, len(self.store.get_pending_messages()))
+
+    def test_reprocess_holding_skips_deleted_messages(self):
+        """
+        Messages deleted while reprocessing is in progress are left alone.
+        """
+        self.store.add(dict(type="unaccepted", data=b"1"))
+        self.store.set_accepted_types(["unaccepted"], reprocess=False)
+        reprocessing = self.store.reprocess_holding(batch_size=1)
+        self.store.delete_all_messages()
+        list(reprocessing)
+        self.assertEqual([], self.store.get_pending_messages())
+
+    def test_wb_reprocess_holding_uses_known_types(self):
+        """
+        Messages are not decoded again when reprocessing, since their type
+        is remembered when they're added.
+        """
+        self.store.add(dict(type="unaccepted", data=b"1"))
+        with mock.patch("landscape.lib.bpickle.loads") as loads:
+            self.store.set_accepted_types(["unaccepted"])
+        loads.assert_not_called()
+
     def test_wb_handle_broken_messages(self):
         self.log_helper.ignore_errors(ValueError)
         self.store.add({"type": "empty"})
         self.store.add({"type": "empty2"})
 
-        filename = os.path.join(self.temp_dir, "0", "0")
+        filename = os.path.join(self.temp_dir, "0", "0__0")
         self.assertTrue(os.path.isfile(filename))
 
         with open(filename, "w") as fh:
@@ -262,10 +422,15 @@ class MessageStoreTest(LandscapeTest):
         self.logfile.seek(0)
         self.logfile.truncate()
 
-        # Unholding will also load the message.
+        # Unholding doesn't load the message again, since its type is known
+        # already.
         self.store.set_accepted_types([])
         self.store.set_accepted_types(["empty", "empty2"])
 
+        self.assertEqual("", self.logfile.getvalue())
+
+        # A new store doesn't know the type of messages, so it will load it.
+        self.store = self.create_store()
         self.assertIn("invalid literal for int()", self.logfile.getvalue())
 
     def test_wb_delete_messages_with_broken(self):
@@ -273,7 +438,7 @@ class MessageStoreTest(LandscapeTest):
         self.store.add({"type": "data", "data": b"1"})
         self.store.add({"type": "data", "data": b"2"})
 
-        filename = os.path.join(self.temp_dir, "0", "0")
+        filename = os.path.join(self.temp_dir, "0", "0__0")
         self.assertTrue(os.path.isfile(filename))
 
         with open(filename, "w") as fh:
@@ -418,6 +583,49 @@ class MessageStoreTest(LandscapeTest):
         self.store.add({"type": "data", "data": b"yay"})
         self.assertEqual(self.store.count_pending_messages(), 2)
 
+    def test_count_pending_messages_with_held_and_offset(self):
+        """
+        Held messages and messages before the pending offset are not
+        counted as pending.
+        """
+        for i in range(6):
+            self.store.add(dict(type=["data", "unaccepted"][i % 2],
+                                data=intToBytes(i)))
+        self.assertEqual(3, self.store.count_pending_messages())
+        self.store.set_pending_offset(2)
+        self.assertEqual(1, self.store.count_pending_messages())
+        self.store.set_pending_offset(5)
+        self.assertEqual(0, self.store.count_pending_messages())
+        self.store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual(1, self.store.count_pending_messages())
+
+    def test_count_pending_messages_of_existing_store(self):
+        """
+        A new store indexes the messages already on disk, and counts the
+        pending ones.
+        """
+        self.store.add({"type": "empty"})
+        self.store.add({"type": "data", "data": b"A thing"})
+        self.store.add({"type": "unaccepted", "data": b"A thing"})
+        self.store.commit()
+        self.assertEqual(2, self.create_store().count_pending_messages())
+
+    def test_wb_is_pending_uses_index(self):
+        """
+        Neither C{is_pending} nor C{count_pending_messages} go through the
+        messages on disk, they only look at the in-memory index.
+        """
+        message_id = self.store.add({"type": "empty"})
+        held_id = self.store.add({"type": "unaccepted", "data": b"blah"})
+        with mock.patch("os.listdir") as listdir:
+            with mock.patch("os.stat") as stat:
+                self.assertTrue(self.store.is_pending(message_id))
+                self.assertTrue(self.store.is_pending(held_id))
+                self.assertFalse(self.store.is_pending(message_id + 1234))
+                self.assertEqual(1, self.store.count_pending_messages())
+        listdir.assert_not_called()
+        stat.assert_not_called()
+
     def test_commit(self):
         """
         The Message Store can be told to save its persistent data to disk on
@@ -446,7 +654,7 @@ class MessageStoreTest(LandscapeTest):
         # For the same reason we break the first message.
         self.store.add({"type": "empty"})
 
-        filename = os.path.join(self.temp_dir, "0", "0")
+        filename = os.path.join(self.temp_dir, "0", "0__0")
         self.assertTrue(os.path.isfile(filename))
 
         with open(filename, "w") as fh:
@@ -488,7 +696,7 @@ class MessageStoreTest(LandscapeTest):
 
         id = self.store.add({"type": "empty"})
 
-        filename = os.path.join(self.temp_dir, "0", "0")
+        filename = os.path.join(self.temp_dir, "0", "0__0")
         self.assertTrue(os.path.isfile(filename))
 
         with open(filename, "w") as fh:
@@ -639,6 +847,55 @@ class MessageStoreTest(LandscapeTest):
         [empty, message] = self.store.get_pending_messages()
         self.assertEqual("resynchronize", message["type"])
 
+    def test_message_ids(self):
+        """
+        Message ids are handed out in increasing order, don't change when
+        messages are held and unheld, and aren't reused by a new store
+        after the messages are gone.
+        """
+        id1 = self.store.add({"type": "data", "data": b"1"})
+        id2 = self.store.add({"type": "data", "data": b"2"})
+        self.assertTrue(id1 < id2)
+        self.store.set_accepted_types([])
+        self.store.set_accepted_types(["data"])
+        self.assertTrue(self.store.is_pending(id1))
+        self.assertTrue(self.store.is_pending(id2))
+        self.store.set_pending_offset(2)
+        self.store.delete_old_messages()
+
+        self.store = self.create_store()
+        id3 = self.store.add({"type": "data", "data": b"3"})
+        self.assertTrue(id3 > id2)
+        self.assertFalse(self.store.is_pending(id1))
+        self.assertFalse(self.store.is_pending(id2))
+
+    def test_wb_next_message_id_file(self):
+        """
+        The reserved message ids are kept out of the message directory,
+        where older versions expect numbered entries only.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        self.assertEqual(["0"], os.listdir(self.temp_dir))
+        with open(self.temp_dir + ".next-id") as fd:
+            self.assertEqual("1000\n", fd.read())
+
+    def test_wb_message_ids_of_legacy_messages(self):
+        """
+        Messages stored without an id get one when the store is created,
+        keeping their order and flags.
+        """
+        os.makedirs(os.path.join(self.temp_dir, "0"))
+        for name, data in [("0", b"1"), ("1_b", b"2"), ("2", b"3")]:
+            with open(os.path.join(self.temp_dir, "0", name), "wb") as fh:
+                fh.write(dumps({"type": "data", "data": data, "api": b"3.2"}))
+        self.store = self.create_store()
+        self.assertEqual(
+            ["0__0", "1_b_1", "2__2"],
+            sorted(os.listdir(os.path.join(self.temp_dir, "0"))))
+        messages = self.store.get_pending_messages()
+        self.assertEqual([b"1", b"3"], [m["data"] for m in messages])
+        self.assertEqual(3, self.store.add({"type": "data", "data": b"4"}))
+
     def test_wb_get_pending_legacy_messages(self):
         """Pending messages queued by legacy py27 are converted."""
         filename = os.path.join(self.temp_dir, "0", "0")
@@ -647,6 +904,7 @@ class MessageStoreTest(LandscapeTest):
             fh.write(dumps({b"type": b"data",
                             b"data": b"A thing",
                             b"api": b"3.2"}))
+        self.store = self.create_store()
         [message] = self.store.get_pending_messages()
         # message keys are decoded
         self.assertIn(u"type", message)
@@ -654,3 +912,307 @@ class MessageStoreTest(LandscapeTest):
         self.assertIsInstance(message[u"api"], bytes)  # api is bytes
         self.assertEqual(u"data", message[u"type"])  # message type is decoded
         self.assertEqual(b"A thing", message[u"data"])  # other are kept as-is
+
+
+class SegmentMessageStoreTest(LandscapeTest):
+
+    def setUp(self):
+        super(SegmentMessageStoreTest, self).setUp()
+        self.temp_dir = self.makeDir()
+        self.persist = Persist(filename=self.makeFile())
+        self.store = self.create_store()
+
+    def create_store(self, segment_size=20):
+        store = MessageStore(
+            self.persist, self.temp_dir,
+            backend=SegmentBackend(self.temp_dir, segment_size))
+        store.set_accepted_types(["data"])
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.add_schema(Message("unaccepted", {"data": Bytes()}))
+        return store
+
+    def test_get_pending_messages(self):
+        """Messages are read back from segments in the order they were added.
+        """
+        for i in range(35):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.assertEqual(
+            [m["data"] for m in self.store.get_pending_messages()],
+            [intToBytes(i) for i in range(35)])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.temp_dir, "segments"))),
+            ["0", "1"])
+
+    def test_index_is_persisted(self):
+        """
+        The index is saved to disk, so a new store sees the same messages
+        with the same flags and ids.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        held_id = self.store.add({"type": "unaccepted", "data": b"2"})
+        self.store.add({"type": "data", "data": b"3"})
+        self.store.set_pending_offset(1)
+        self.store.delete_old_messages()
+
+        store = self.create_store()
+        store.set_pending_offset(0)
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"3"])
+        self.assertTrue(store.is_pending(held_id))
+        store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"3", b"2"])
+
+    def test_message_ids_are_stable(self):
+        """
+        Message ids are integers which don't change when a message gets
+        held and unheld.
+        """
+        first_id = self.store.add({"type": "unaccepted", "data": b"1"})
+        second_id = self.store.add({"type": "data", "data": b"2"})
+        self.assertEqual((0, 1), (first_id, second_id))
+        self.store.set_accepted_types(["data", "unaccepted"])
+        self.store.set_pending_offset(1)
+        self.assertTrue(self.store.is_pending(first_id))
+        self.assertFalse(self.store.is_pending(second_id))
+
+    def test_delete_old_messages_removes_unused_segments(self):
+        """Segments are removed once none of their messages is left."""
+        for i in range(45):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.set_pending_offset(40)
+        self.store.delete_old_messages()
+        self.assertEqual(
+            os.listdir(os.path.join(self.temp_dir, "segments")), ["2"])
+        self.store.set_pending_offset(0)
+        self.assertEqual(
+            [m["data"] for m in self.store.get_pending_messages()],
+            [intToBytes(i) for i in range(40, 45)])
+
+    def test_delete_all_messages(self):
+        """All messages and segments can be removed at once."""
+        for i in range(25):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+        self.store.delete_all_messages()
+        self.assertEqual(
+            os.listdir(os.path.join(self.temp_dir, "segments")), [])
+        self.assertEqual(self.store.get_pending_messages(), [])
+        message_id = self.store.add({"type": "data", "data": b"new"})
+        self.assertEqual(25, message_id)
+        self.assertEqual(self.create_store().get_pending_messages(),
+                         [{"type": "data", "data": b"new", "api": b"3.2"}])
+
+    def test_types_are_persisted(self):
+        """
+        Message types are saved in the index, so a new store doesn't need
+        to decode messages to reprocess them.
+        """
+        self.store.add({"type": "unaccepted", "data": b"1"})
+        store = self.create_store()
+        with mock.patch("landscape.lib.bpickle.loads") as loads:
+            store.set_accepted_types(["data", "unaccepted"])
+        loads.assert_not_called()
+        self.assertEqual(1, store.count_pending_messages())
+
+    def test_torn_index_record_is_ignored(self):
+        """
+        A partially written record at the end of the index journal, e.g.
+        due to a power failure, is discarded when loading the index.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        with open(os.path.join(self.temp_dir, "index"), "ab") as fd:
+            fd.write(b"a 1 0 1")
+        store = self.create_store()
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"1"])
+        store.add({"type": "data", "data": b"2"})
+        self.assertEqual(
+            [m["data"] for m in self.create_store().get_pending_messages()],
+            [b"1", b"2"])
+
+    def test_truncated_segment(self):
+        """
+        Messages whose data is missing from a truncated segment are dropped
+        when loading the index, while the other messages are kept.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "data", "data": b"2"})
+        filename = os.path.join(self.temp_dir, "segments", "0")
+        with open(filename, "r+b") as fd:
+            fd.truncate(os.path.getsize(filename) - 3)
+        store = self.create_store()
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"1"])
+        self.assertIn("Dropping message 1", self.logfile.getvalue())
+        self.assertEqual(
+            [m["data"] for m in self.create_store().get_pending_messages()],
+            [b"1"])
+
+    def test_add_syncs_segment_before_index(self):
+        """
+        The data of a message is flushed to disk before the index journal
+        records it.
+        """
+        index = os.path.join(self.temp_dir, "index")
+        recorded = []
+
+        def fsync(fd):
+            recorded.append(os.path.exists(index) and
+                            b"a 0 " in read_binary_file(index))
+
+        with mock.patch("os.fsync", side_effect=fsync):
+            self.store.add({"type": "data", "data": b"1"})
+        self.assertEqual([False, True], recorded)
+
+    def test_index_is_compacted(self):
+        """The index journal is rewritten once it grows too long."""
+        self.store.add({"type": "data", "data": b"0"})
+        for i in range(1, 600):
+            self.store.add({"type": "data", "data": intToBytes(i)})
+            self.store.set_pending_offset(1)
+            self.store.delete_old_messages()
+        with open(os.path.join(self.temp_dir, "index"), "rb") as fd:
+            self.assertTrue(len(fd.readlines()) < 1100)
+        store = self.create_store()
+        store.set_pending_offset(0)
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"599"])
+
+    def test_broken_message(self):
+        """Messages which can't be decoded are flagged as broken."""
+        self.log_helper.ignore_errors(ValueError)
+        message_id = self.store.add({"type": "data", "data": b"1"})
+        self.store.add({"type": "data", "data": b"2"})
+        with open(os.path.join(self.temp_dir, "segments", "0"), "r+b") as fd:
+            fd.write(b"bpickle will break reading this")
+        messages = self.store.get_pending_messages()
+        self.assertEqual([m["data"] for m in messages], [b"2"])
+        self.assertFalse(self.store.is_pending(message_id))
+        self.assertIn("ValueError", self.logfile.getvalue())
+
+    def test_migrate_file_system_messages(self):
+        """
+        Messages stored one per file by a L{FileSystemBackend} are moved to
+        segments, keeping their order and flags.
+        """
+        temp_dir = self.makeDir()
+        store = MessageStore(self.persist, temp_dir, 2)
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.add_schema(Message("unaccepted", {"data": Bytes()}))
+        store.add({"type": "data", "data": b"1"})
+        store.add({"type": "unaccepted", "data": b"2"})
+        store.add({"type": "data", "data": b"3"})
+
+        store = MessageStore(self.persist, temp_dir,
+                             backend=SegmentBackend(temp_dir))
+        self.assertEqual(sorted(os.listdir(temp_dir)), ["index", "segments"])
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"1", b"3"])
+        store.set_accepted_types(["data", "unaccepted"])
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"1", b"3", b"2"])
+
+    def test_migrate_file_system_messages_keeps_ids(self):
+        """
+        Migrated messages keep their ids, and new messages get ids never
+        handed out by the L{FileSystemBackend}.
+        """
+        temp_dir = self.makeDir()
+        store = MessageStore(self.persist, temp_dir, 2)
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.set_accepted_types(["data"])
+        ids = [store.add({"type": "data", "data": b"1"}),
+               store.add({"type": "data", "data": b"2"}),
+               store.add({"type": "data", "data": b"3"})]
+        store.add_pending_offset(1)
+        store.delete_old_messages()
+        store.set_pending_offset(0)
+
+        store = MessageStore(self.persist, temp_dir,
+                             backend=SegmentBackend(temp_dir))
+        store.add_schema(Message("data", {"data": Bytes()}))
+        self.assertEqual([False, True, True],
+                         [store.is_pending(message_id) for message_id in ids])
+        self.assertEqual(FileSystemBackend.id_block_size,
+                         store.add({"type": "data", "data": b"3"}))
+        self.assertFalse(os.path.exists(temp_dir + ".next-id"))
+
+    def test_migrate_without_file_system_messages(self):
+        """
+        The message ids reserved by a L{FileSystemBackend} aren't reused
+        when switching to segments, even if no message is left.
+        """
+        temp_dir = self.makeDir()
+        store = MessageStore(self.persist, temp_dir, 2)
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.add({"type": "data", "data": b"1"})
+        store.add_pending_offset(1)
+        store.delete_old_messages()
+
+        backend = SegmentBackend(temp_dir)
+        self.assertEqual(FileSystemBackend.id_block_size,
+                         backend.add(b"data"))
+        self.assertEqual(FileSystemBackend.id_block_size + 1,
+                         SegmentBackend(temp_dir).add(b"data"))
+
+    def test_migrate_file_system_messages_interrupted(self):
+        """
+        If the migration is interrupted, the messages which were added to
+        segments already aren't added again when it's resumed, even if
+        their files were left behind.
+        """
+        temp_dir = self.makeDir()
+        store = MessageStore(self.persist, temp_dir, 2)
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.set_accepted_types(["data"])
+        store.add({"type": "data", "data": b"1"})
+        store.add({"type": "data", "data": b"2"})
+        store.add({"type": "data", "data": b"3"})
+
+        with mock.patch.object(FileSystemBackend, "delete",
+                               side_effect=OSError("crash")):
+            self.assertRaises(OSError, SegmentBackend, temp_dir)
+
+        store = MessageStore(self.persist, temp_dir,
+                             backend=SegmentBackend(temp_dir))
+        store.add_schema(Message("data", {"data": Bytes()}))
+        store.set_accepted_types(["data"])
+        self.assertEqual(sorted(os.listdir(temp_dir)), ["index", "segments"])
+        self.assertEqual([m["data"] for m in store.get_pending_messages()],
+                         [b"1", b"2", b"3"])
+        with open(os.path.join(temp_dir, "index"), "rb") as fd:
+            self.assertNotIn(b"0/0", fd.read())
+
+    def test_get_message_store_backend(self):
+        """
+        L{get_message_store_backend} returns the L{SegmentBackend} if asked
+        for, and C{None} for the default backend.
+        """
+        self.assertIsInstance(
+            get_message_store_backend("segment", self.makeDir()),
+            SegmentBackend)
+        self.assertIs(
+            None, get_message_store_backend("directory", self.makeDir()))
+
+    def test_get_message_store_backend_switch_back(self):
+        """
+        When switching back to the C{"directory"} backend, the segments are
+        kept until all their messages are gone, since they aren't migrated
+        back to a file each.
+        """
+        self.store.add({"type": "data", "data": b"1"})
+        with mock.patch("logging.warning") as warning:
+            backend = get_message_store_backend("directory", self.temp_dir)
+        self.assertIsInstance(backend, SegmentBackend)
+        warning.assert_called_once_with(
+            "Keeping the segmented message store in %s until its messages "
+            "are sent.", self.temp_dir)
+
+        self.store.add_pending_offset(1)
+        self.store.delete_old_messages()
+        self.assertIs(
+            None, get_message_store_backend("directory", self.temp_dir))
+        self.assertEqual([], os.listdir(self.temp_dir))
+        # The ids handed out by the segments aren't used again.
+        backend = FileSystemBackend(self.temp_dir)
+        self.assertEqual(1, backend.get_message_id(backend.add(b"data")))
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
+import zlib
+
+import mock
 
 from landscape import VERSION
-from landscape.client.broker.transport import HTTPTransport
+from landscape.client.broker.transport import (
+    HTTPTransport, PayloadBuffer, dump_payload, load_payload, zstandard)
 from landscape.lib import bpickle
-from landscape.lib.fetch import PyCurlError
+from landscape.lib.fetch import HTTPCodeError, PyCurlError
 from landscape.lib.testing import LogKeeperHelper
 
 from landscape.client.tests.helpers import LandscapeTest
@@ -28,6 +32,8 @@ BADPUBKEY = sibpath("badpublic.ssl")
 class DataCollectingResource(resource.Resource):
 
     request = content = None
+    accept_encoding = None
+    content_encoding = None
 
     def getChild(self, request, name):
         return self
@@ -35,9 +41,71 @@ class DataCollectingResource(resource.Resource):
     def render(self, request):
         self.request = request
         self.content = request.content.read()
+        if self.accept_encoding:
+            request.setHeader("Accept-Encoding", self.accept_encoding)
+        if self.content_encoding:
+            request.setHeader("Content-Encoding", self.content_encoding)
+            return dump_payload("Great.", self.content_encoding).read()
         return bpickle.dumps("Great.")
 
 
+class PayloadBufferTest(LandscapeTest):
+
+    def test_read(self):
+        """Data can be read across the chunks written."""
+        buffer = PayloadBuffer()
+        buffer.write(b"abc")
+        buffer.write(b"")
+        buffer.write(b"defg")
+        self.assertEqual(7, buffer.tell())
+        buffer.seek(0)
+        self.assertEqual(b"ab", buffer.read(2))
+        self.assertEqual(b"cdef", buffer.read(4))
+        self.assertEqual(b"g", buffer.read(10))
+        self.assertEqual(b"", buffer.read(10))
+
+    def test_read_all(self):
+        buffer = PayloadBuffer()
+        buffer.write(b"abc")
+        buffer.write(b"def")
+        buffer.seek(1)
+        self.assertEqual(b"bcdef", buffer.read())
+
+    def test_seek(self):
+        buffer = PayloadBuffer()
+        buffer.write(b"abcdef")
+        self.assertEqual(6, buffer.seek(0, os.SEEK_END))
+        self.assertEqual(4, buffer.seek(-2, os.SEEK_CUR))
+        self.assertEqual(b"ef", buffer.read())
+        self.assertEqual(0, buffer.seek(-10))
+
+
+class PayloadEncodingTest(LandscapeTest):
+
+    payload = {"messages": [{"type": "test", "data": b"x" * 100000}]}
+
+    def test_dump_payload(self):
+        buffer = dump_payload(self.payload)
+        self.assertEqual(0, buffer.tell())
+        self.assertEqual(bpickle.dumps(self.payload), buffer.read())
+
+    def test_gzip(self):
+        """Payloads can be compressed with gzip."""
+        data = dump_payload(self.payload, "gzip").read()
+        self.assertEqual(
+            bpickle.dumps(self.payload), zlib.decompress(data, 31))
+        self.assertEqual(self.payload, load_payload(data, "gzip"))
+
+    def test_zstd(self):
+        """Payloads can be compressed with zstd."""
+        data = dump_payload(self.payload, "zstd").read()
+        self.assertTrue(len(data) < 1000)
+        self.assertEqual(self.payload, load_payload(data, "zstd"))
+
+    if zstandard is None:
+        test_zstd.skip = "zstandard is not available"
+
+
 class HTTPTransportTest(LandscapeTest):
 
     helpers = [LogKeeperHelper]
@@ -51,6 +119,31 @@ class HTTPTransportTest(LandscapeTest):
         for port in self.ports:
             port.stopListening()
 
+    def exchange_twice(self, transport):
+        """
+        Make two exchanges one after the other with C{transport}, and return
+        a deferred firing with the client address of both.
+        """
+        resource = DataCollectingResource()
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport.set_url("http://localhost:%d/" % (port.getHost().port,))
+        addresses = []
+
+        def exchange(ignored=None):
+            return deferToThread(transport.exchange, "HI")
+
+        def got_result(ignored):
+            addresses.append(resource.request.getClientAddress())
+
+        result = exchange()
+        result.addCallback(got_result)
+        result.addCallback(exchange)
+        result.addCallback(got_result)
+        result.addCallback(lambda ignored: addresses)
+        return result
+
     def request_with_payload(self, payload):
         resource = DataCollectingResource()
         port = reactor.listenTCP(
@@ -105,6 +198,186 @@ class HTTPTransportTest(LandscapeTest):
         """
         return self.request_with_payload(payload=u"проба")
 
+    def test_keep_alive(self):
+        """
+        With C{keep_alive}, the same connection is used for subsequent
+        exchanges.
+        """
+        transport = HTTPTransport(None, None, keep_alive=True)
+        self.addCleanup(transport.set_url, None)
+        result = self.exchange_twice(transport)
+
+        def check(addresses):
+            self.assertEqual(addresses[0], addresses[1])
+        return result.addCallback(check)
+
+    def test_no_keep_alive(self):
+        """By default, each exchange uses a new connection."""
+        result = self.exchange_twice(HTTPTransport(None, None))
+
+        def check(addresses):
+            self.assertNotEqual(addresses[0], addresses[1])
+        return result.addCallback(check)
+
+    def test_keep_alive_set_url(self):
+        """The kept curl handle is dropped when the URL changes."""
+        transport = HTTPTransport(None, "http://localhost/", keep_alive=True)
+        curl = mock.Mock()
+        transport._kept_curl = curl
+        transport.set_url("http://localhost/")
+        self.assertIs(curl, transport._kept_curl)
+        transport.set_url("http://example.com/")
+        self.assertIsNone(transport._kept_curl)
+        curl.close.assert_called_once_with()
+
+    def test_keep_alive_error(self):
+        """The kept curl handle is dropped when an exchange fails."""
+        self.log_helper.ignore_errors(PyCurlError)
+        transport = HTTPTransport(None, "http://localhost/", keep_alive=True)
+        curl = mock.Mock()
+        transport._kept_curl = curl
+        with mock.patch("landscape.client.broker.transport.fetch") as fetch:
+            fetch.side_effect = PyCurlError(7, "Failed to connect")
+            self.assertRaises(PyCurlError, transport.exchange, "HI")
+        self.assertIs(curl, fetch.call_args[1]["curl"])
+        self.assertIsNone(transport._kept_curl)
+        curl.close.assert_called_once_with()
+
+    def test_request_encoding(self):
+        """
+        Once the server advertises that it accepts gzip compressed request
+        bodies, the following requests are compressed.
+        """
+        resource = DataCollectingResource()
+        resource.accept_encoding = "gzip;q=0.5, identity"
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        transport = HTTPTransport(
+            None, "http://localhost:%d/" % (port.getHost().port,))
+        encodings = []
+
+        def exchange(ignored=None):
+            return deferToThread(transport.exchange, "HI")
+
+        def got_result(ignored):
+            headers = resource.request.requestHeaders
+            encodings.append(headers.getRawHeaders("content-encoding"))
+            encoding = encodings[-1] and encodings[-1][0]
+            self.assertEqual("HI", load_payload(resource.content, encoding))
+
+        result = exchange()
+        result.addCallback(got_result)
+        result.addCallback(exchange)
+        result.addCallback(got_result)
+
+        def check(ignored):
+            self.assertEqual([None, ["gzip"]], encodings)
+        return result.addCallback(check)
+
+    def test_negotiate_request_encoding(self):
+        """The preferred of the encodings accepted by the server is used."""
+        transport = HTTPTransport(None, "http://localhost/")
+        transport._negotiate_request_encoding(
+            {"accept-encoding": "identity, GZIP"})
+        self.assertEqual("gzip", transport._request_encoding)
+        transport._negotiate_request_encoding({"accept-encoding": "br"})
+        self.assertIsNone(transport._request_encoding)
+        transport._negotiate_request_encoding({})
+        self.assertIsNone(transport._request_encoding)
+
+    def test_request_encoding_set_url(self):
+        """The negotiated encoding is forgotten when the URL changes."""
+        transport = HTTPTransport(None, "http://localhost/")
+        transport._request_encoding = "gzip"
+        transport.set_url("http://localhost/")
+        self.assertEqual("gzip", transport._request_encoding)
+        transport.set_url("http://example.com/")
+        self.assertIsNone(transport._request_encoding)
+
+    def test_request_encoding_after_set_url(self):
+        """
+        The first exchange after the URL changes goes out uncompressed, and
+        the following ones are compressed if the new server accepts it.
+        """
+        transport = HTTPTransport(None, "http://localhost/")
+        transport._request_encoding = "gzip"
+        transport.set_url("http://example.com/")
+
+        def fetch(url, **kwargs):
+            kwargs["response_headers"]["accept-encoding"] = "gzip"
+            return bpickle.dumps("OK")
+
+        with mock.patch("landscape.client.broker.transport.fetch") as fetch_:
+            fetch_.side_effect = fetch
+            transport.exchange("HI")
+            transport.exchange("HI")
+        [first, second] = fetch_.call_args_list
+        self.assertNotIn("Content-Encoding", first[1]["headers"])
+        first[1]["data"].seek(0)
+        self.assertEqual(bpickle.dumps("HI"), first[1]["data"].read())
+        self.assertEqual("gzip", second[1]["headers"]["Content-Encoding"])
+
+    def test_accept_encoding(self):
+        """
+        Requests advertise the encodings the client supports, and responses
+        compressed with them are decompressed.
+        """
+        transport = HTTPTransport(None, "http://localhost/")
+
+        def fetch(url, **kwargs):
+            kwargs["response_headers"]["content-encoding"] = "gzip"
+            return dump_payload("OK", "gzip").read()
+
+        with mock.patch("landscape.client.broker.transport.fetch") as fetch_:
+            fetch_.side_effect = fetch
+            self.assertEqual("OK", transport.exchange("HI"))
+        self.assertIn("gzip",
+                      fetch_.call_args[1]["headers"]["Accept-Encoding"])
+
+    def test_compressed_response(self):
+        """
+        Responses compressed by the server are decompressed once, whether
+        the same curl handle is kept or not.
+        """
+        resource = DataCollectingResource()
+        resource.content_encoding = "gzip"
+        port = reactor.listenTCP(
+            0, server.Site(resource), interface="127.0.0.1")
+        self.ports.append(port)
+        url = "http://localhost:%d/" % (port.getHost().port,)
+        transports = [HTTPTransport(None, url),
+                      HTTPTransport(None, url, keep_alive=True)]
+        self.addCleanup(transports[1].set_url, None)
+
+        def exchange():
+            return [transport.exchange("HI") for transport in transports]
+
+        def check(responses):
+            self.assertEqual(["Great.", "Great."], responses)
+            [accept_encoding] = resource.request.requestHeaders.getRawHeaders(
+                "accept-encoding")
+            self.assertIn("gzip", accept_encoding)
+        return deferToThread(exchange).addCallback(check)
+
+    def test_request_encoding_refused(self):
+        """
+        If the server refuses a compressed request with a 415 error, the
+        request is sent again uncompressed, and compression is turned off.
+        """
+        transport = HTTPTransport(None, "http://localhost/")
+        transport._request_encoding = "gzip"
+        with mock.patch("landscape.client.broker.transport.fetch") as fetch:
+            fetch.side_effect = [HTTPCodeError(415, b""), bpickle.dumps("OK")]
+            self.assertEqual("OK", transport.exchange("HI"))
+        [compressed, uncompressed] = fetch.call_args_list
+        self.assertEqual("gzip", compressed[1]["headers"]["Content-Encoding"])
+        self.assertNotIn("Content-Encoding", uncompressed[1]["headers"])
+        uncompressed[1]["data"].seek(0)
+        self.assertEqual(bpickle.dumps("HI"), uncompressed[1]["data"].read())
+        transport._negotiate_request_encoding({"accept-encoding": "gzip"})
+        self.assertIsNone(transport._request_encoding)
+
     def test_ssl_verification_positive(self):
         """
         The client transport should complete an upload of messages to
@@ -1,30 +1,168 @@
 """Low-level server communication."""
+import os
 import time
 import logging
 import pprint
 import uuid
+import zlib
+
+from bisect import bisect_right
 
 import pycurl
 
 from twisted.python.compat import unicode, _PY3
 
 from landscape.lib import bpickle
-from landscape.lib.fetch import fetch
+from landscape.lib.fetch import fetch, HTTPCodeError
 from landscape.lib.format import format_delta
 from landscape import SERVER_API, VERSION
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Compressors and decompressors of request bodies, by content coding.
+_compressors = {"gzip": lambda: zlib.compressobj(6, zlib.DEFLATED, 31)}
+_decompressors = {"gzip": lambda: zlib.decompressobj(31)}
+if zstandard is not None:
+    _compressors["zstd"] = lambda: zstandard.ZstdCompressor().compressobj()
+    _decompressors["zstd"] = (
+        lambda: zstandard.ZstdDecompressor().decompressobj())
+
+# The content codings that requests can be compressed with, by preference.
+REQUEST_ENCODINGS = [encoding for encoding in ("zstd", "gzip")
+                     if encoding in _compressors]
+
+
+class PayloadBuffer(object):
+    """File-like buffer for serialized payloads.
+
+    The data written to it is kept as a list of the chunks written rather
+    than in a contiguous buffer, so it doesn't have to be copied around as
+    it grows.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._starts = []
+        self._size = 0
+        self._position = 0
+
+    def write(self, data):
+        """Append C{data} to the buffer, regardless of the position."""
+        if data:
+            self._chunks.append(data)
+            self._starts.append(self._size)
+            self._size += len(data)
+            self._position = self._size
+
+    def read(self, size=-1):
+        """Read at most C{size} bytes from the current position."""
+        if size < 0:
+            size = self._size - self._position
+        parts = []
+        while size > 0 and self._position < self._size:
+            index = bisect_right(self._starts, self._position) - 1
+            offset = self._position - self._starts[index]
+            part = self._chunks[index][offset:offset + size]
+            parts.append(part)
+            self._position += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = max(0, min(offset, self._size))
+        return self._position
+
+
+class _CompressingWriter(object):
+    """Compress the data written to it into another file-like object."""
+
+    def __init__(self, fd, encoding):
+        self._fd = fd
+        self._compressor = _compressors[encoding]()
+
+    def write(self, data):
+        self._fd.write(self._compressor.compress(data))
+
+    def close(self):
+        self._fd.write(self._compressor.flush())
+
+
+def dump_payload(payload, encoding=None):
+    """Serialize C{payload} into a L{PayloadBuffer}.
+
+    @param encoding: Optionally, one of L{REQUEST_ENCODINGS} to compress
+        the payload with, as it's being serialized.
+    @return: The buffer, positioned at its start.
+    """
+    buffer = PayloadBuffer()
+    if encoding is None:
+        bpickle.dump(payload, buffer)
+    else:
+        writer = _CompressingWriter(buffer, encoding)
+        bpickle.dump(payload, writer)
+        writer.close()
+    buffer.seek(0)
+    return buffer
+
+
+def load_payload(data, encoding=None, as_is=False):
+    """Load a payload serialized by L{dump_payload}.
+
+    @param as_is: Don't reinterpret dict keys as str, see L{bpickle.loads}.
+    """
+    if encoding is not None:
+        data = _decompressors[encoding]().decompress(data)
+    return bpickle.loads(data, as_is=as_is)
+
+
+# How many seconds host names are cached for by kept-alive curl handles.
+KEEP_ALIVE_DNS_CACHE_TIMEOUT = 60
+
 
 class HTTPTransport(object):
     """Transport makes a request to exchange message data over HTTP.
 
     @param url: URL of the remote Landscape server message system.
     @param pubkey: SSH public key used for secure communication.
+    @param keep_alive: Whether to keep using the same curl handle for all
+        the exchanges with the server, rather than a new one for each of
+        them. This lets curl keep the connection open between exchanges,
+        resume TLS sessions when it has to reconnect, and cache DNS lookups
+        for L{KEEP_ALIVE_DNS_CACHE_TIMEOUT} seconds. The handle is dropped
+        when the URL changes or an exchange fails.
+
+    Requests list the L{REQUEST_ENCODINGS} in their C{Accept-Encoding}
+    header, so the server knows it can compress its responses with them,
+    and that the client supports compression at all. Responses are then
+    decompressed here rather than by curl, which only knows some of them.
+
+    Request bodies are compressed when the server lists one of the
+    L{REQUEST_ENCODINGS} in the C{Accept-Encoding} header of its responses
+    (as in RFC 7694). Until the first response from a server, and so after
+    the URL changes, requests are sent uncompressed. If the server rejects
+    a compressed request with a 415 error, the request is sent again
+    uncompressed and compression is turned off until the URL changes.
     """
 
-    def __init__(self, reactor, url, pubkey=None):
+    def __init__(self, reactor, url, pubkey=None, keep_alive=False):
         self._reactor = reactor
         self._url = url
         self._pubkey = pubkey
+        self._keep_alive = keep_alive
+        self._kept_curl = None
+        self._request_encoding = None
+        self._request_encoding_refused = False
 
     def get_url(self):
         """Get the URL of the remote message system."""
@@ -32,9 +170,32 @@ class HTTPTransport(object):
 
     def set_url(self, url):
         """Set the URL of the remote message system."""
+        if url != self._url:
+            self._drop_kept_curl()
+            self._request_encoding = None
+            self._request_encoding_refused = False
         self._url = url
 
-    def _curl(self, payload, computer_id, exchange_token, message_api):
+    def _drop_kept_curl(self):
+        curl, self._kept_curl = self._kept_curl, None
+        if curl is not None:
+            curl.close()
+
+    def _negotiate_request_encoding(self, response_headers):
+        """Pick the request encoding accepted by the server, if any."""
+        self._request_encoding = None
+        if self._request_encoding_refused:
+            return
+        accepted = set(
+            coding.split(";")[0].strip().lower() for coding in
+            response_headers.get("accept-encoding", "").split(","))
+        for encoding in REQUEST_ENCODINGS:
+            if encoding in accepted:
+                self._request_encoding = encoding
+                return
+
+    def _curl(self, payload, computer_id, exchange_token, message_api,
+              content_encoding=None, response_headers=None):
         # There are a few "if _PY3" checks below, because for Python 3 we
         # want to convert a number of values from bytes to string, before
         # assigning them to the headers.
@@ -42,7 +203,8 @@ class HTTPTransport(object):
             message_api = message_api.decode("ascii")
         headers = {"X-Message-API": message_api,
                    "User-Agent": "landscape-client/%s" % VERSION,
-                   "Content-Type": "application/octet-stream"}
+                   "Content-Type": "application/octet-stream",
+                   "Accept-Encoding": ", ".join(REQUEST_ENCODINGS)}
         if computer_id:
             if _PY3 and isinstance(computer_id, bytes):
                 computer_id = computer_id.decode("ascii")
@@ -51,9 +213,36 @@ class HTTPTransport(object):
             if _PY3 and isinstance(exchange_token, bytes):
                 exchange_token = exchange_token.decode("ascii")
             headers["X-Exchange-Token"] = str(exchange_token)
-        curl = pycurl.Curl()
-        return (curl, fetch(self._url, post=True, data=payload,
-                            headers=headers, cainfo=self._pubkey, curl=curl))
+        if content_encoding:
+            headers["Content-Encoding"] = content_encoding
+        if not self._keep_alive:
+            curl = pycurl.Curl()
+            return (curl, fetch(self._url, post=True, data=payload,
+                                headers=headers, cainfo=self._pubkey,
+                                curl=curl, response_headers=response_headers,
+                                decode_content=False))
+
+        # The kept handle is taken while it's being used, exchanges run in
+        # threads and the URL can change meanwhile.
+        url = self._url
+        curl, self._kept_curl = self._kept_curl, None
+        if curl is None:
+            curl = pycurl.Curl()
+        try:
+            data = fetch(url, post=True, data=payload, headers=headers,
+                         cainfo=self._pubkey, curl=curl,
+                         dns_cache_timeout=KEEP_ALIVE_DNS_CACHE_TIMEOUT,
+                         response_headers=response_headers,
+                         decode_content=False)
+        except Exception:
+            curl.close()
+            raise
+        if url == self._url:
+            self._drop_kept_curl()
+            self._kept_curl = curl
+        else:
+            curl.close()
+        return (curl, data)
 
     def exchange(self, payload, computer_id=None, exchange_token=None,
                  message_api=SERVER_API):
@@ -73,23 +262,46 @@ class HTTPTransport(object):
         @note: This code is thread safe (HOPEFULLY).
 
         """
-        spayload = bpickle.dumps(payload)
+        # The payload is serialized straight into the buffer which curl
+        # reads the request body from, rather than into a byte string.
+        encoding = self._request_encoding
+        spayload = dump_payload(payload, encoding)
         start_time = time.time()
         if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
             logging.debug("Sending payload:\n%s", pprint.pformat(payload))
+        response_headers = {}
         try:
-            curly, data = self._curl(spayload, computer_id, exchange_token,
-                                     message_api)
+            try:
+                curly, data = self._curl(
+                    spayload, computer_id, exchange_token, message_api,
+                    encoding, response_headers)
+            except HTTPCodeError as error:
+                if encoding is None or error.http_code != 415:
+                    raise
+                logging.info("Server refused a %s compressed request, "
+                             "sending it uncompressed.", encoding)
+                self._request_encoding_refused = True
+                encoding = None
+                spayload = dump_payload(payload)
+                curly, data = self._curl(
+                    spayload, computer_id, exchange_token, message_api,
+                    response_headers=response_headers)
         except Exception:
             logging.exception("Error contacting the server at %s." % self._url)
             raise
         else:
+            spayload.seek(0, os.SEEK_END)
             logging.info("Sent %d bytes and received %d bytes in %s.",
-                         len(spayload), len(data),
+                         spayload.tell(), len(data),
                          format_delta(time.time() - start_time))
+        self._negotiate_request_encoding(response_headers)
 
         try:
-            response = bpickle.loads(data)
+            response_encoding = response_headers.get(
+                "content-encoding", "").strip().lower()
+            if response_encoding not in _decompressors:
+                response_encoding = None
+            response = load_payload(data, response_encoding)
         except Exception:
             logging.exception("Server returned invalid data: %r" % data)
             return None
@@ -104,8 +316,11 @@ class HTTPTransport(object):
 class FakeTransport(object):
     """Fake transport for testing purposes."""
 
-    def __init__(self, reactor=None, url=None, pubkey=None):
+    def __init__(self, reactor=None, url=None, pubkey=None, keep_alive=False):
         self._pubkey = pubkey
+        # If set, payloads are compressed and decompressed with this
+        # encoding, like they would be by HTTPTransport.
+        self.request_encoding = None
         self.payloads = []
         self.responses = []
         self._current_response = 0
@@ -125,6 +340,18 @@ class FakeTransport(object):
 
     def exchange(self, payload, computer_id=None, exchange_token=None,
                  message_api=SERVER_API):
+        # Passed-through messages are decoded as they are, like the server
+        # would, whether they go through compression or not.
+        if self.request_encoding is not None:
+            payload = load_payload(
+                dump_payload(payload, self.request_encoding).read(),
+                self.request_encoding, as_is=True)
+        elif "messages" in payload:
+            payload = dict(payload)
+            payload["messages"] = [
+                bpickle.loads(message, as_is=True)
+                if isinstance(message, bpickle.Serialized) else message
+                for message in payload["messages"]]
         self.payloads.append(payload)
         self.computer_id = computer_id
         self.exchange_token = exchange_token
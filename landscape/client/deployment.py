@@ -7,7 +7,7 @@ from twisted.logger import globalLogBeginner
 from landscape import VERSION
 from landscape.lib import logging
 from landscape.lib.config import BaseConfiguration as _BaseConfiguration
-from landscape.lib.persist import Persist
+from landscape.lib.persist import JournaledBPickleBackend, Persist
 
 from landscape.client.upgraders import UPGRADE_MANAGERS
 
@@ -82,6 +82,7 @@ class Configuration(BaseConfiguration):
               - C{ping_url} (C{"http://landscape.canonical.com/ping"})
               - C{ssl_public_key}
               - C{ignore_sigint} (C{False})
+              - C{persist_journal} (C{False})
         """
         parser = super(Configuration, self).make_parser()
         logging.add_cli_options(parser, logdir="/var/log/landscape")
@@ -111,6 +112,11 @@ class Configuration(BaseConfiguration):
                           metavar="INTERVAL",
                           help="The number of seconds between flushes to disk "
                                "for persistent data.")
+        parser.add_option("--persist-journal", action="store_true",
+                          default=False,
+                          help="Append the changes to persistent data to a "
+                               "journal when flushing, rather than writing "
+                               "all of it every time.")
 
         # Hidden options, used for load-testing to run in-process clones
         parser.add_option("--clones", default=0, type=int, help=SUPPRESS_HELP)
@@ -145,7 +151,10 @@ def get_versioned_persist(service):
     Load a L{Persist} database for the given C{service} and upgrade or
     mark as current, as necessary.
     """
-    persist = Persist(filename=service.persist_filename)
+    backend = None
+    if getattr(getattr(service, "config", None), "persist_journal", False):
+        backend = JournaledBPickleBackend()
+    persist = Persist(backend, filename=service.persist_filename)
     upgrade_manager = UPGRADE_MANAGERS[service.service_name]
     if os.path.exists(service.persist_filename):
         upgrade_manager.apply(persist)
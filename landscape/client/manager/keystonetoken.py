@@ -40,7 +40,7 @@ class KeystoneToken(DataWatcher):
         self._persist.remove("data")
 
     def flush(self):
-        self._persist.save(self._persist_filename)
+        self._persist.flush(self._persist_filename)
 
     def get_data(self):
         """
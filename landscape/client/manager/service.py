@@ -41,11 +41,16 @@ class ManagerService(LandscapeService):
         self.publisher.start()
 
         def start_plugins(broker):
+            broker.batch_messages = True
             self.broker = broker
             self.manager.broker = broker
             for plugin in self.plugins:
                 self.manager.add(plugin)
-            return self.broker.register_client(self.service_name)
+            registered = self.broker.register_client(self.service_name)
+            # Seed the accepted message types, we'll then get notified of
+            # their changes as registered client.
+            return registered.addCallback(
+                lambda ignored: broker.fetch_accepted_types())
 
         self.connector = RemoteBrokerConnector(self.reactor, self.config)
         connected = self.connector.connect()
@@ -2,11 +2,11 @@ import logging
 import time
 import os
 
-from twisted.internet import threads
 from twisted.python.compat import unicode
 
 from landscape.client.accumulate import Accumulator
 from landscape.lib.monitor import CoverageMonitor
+from landscape.lib.workers import get_pool
 from landscape.client.monitor.plugin import MonitorPlugin
 
 
@@ -97,7 +97,7 @@ class CephUsage(MonitorPlugin):
             return
 
         self._monitor.ping()
-        deferred = threads.deferToThread(self._perform_rados_call)
+        deferred = get_pool("process").run(self._perform_rados_call)
         deferred.addCallback(self._handle_usage)
         return deferred
 
@@ -1,12 +1,18 @@
 """The Landscape monitor plugin system."""
 
+import logging
 import os
 
 from landscape.client.broker.client import BrokerClient
 
 
 class Monitor(BrokerClient):
-    """The central point of integration in the Landscape monitor."""
+    """The central point of integration in the Landscape monitor.
+
+    @ivar saved_flushes: How many flushes saved the persist to disk.
+    @ivar skipped_flushes: How many flushes were skipped, because the
+        persist wasn't modified since the last one.
+    """
 
     name = "monitor"
 
@@ -21,12 +27,22 @@ class Monitor(BrokerClient):
             self.persist.load(persist_filename)
         self._plugins = []
         self.step_size = step_size
+        self.saved_flushes = 0
+        self.skipped_flushes = 0
         self.reactor.call_every(self.config.flush_interval, self.flush)
 
     def flush(self):
-        """Flush data to disk."""
+        """Flush data to disk, if it changed since the last flush."""
         if self.persist_filename:
-            self.persist.save(self.persist_filename)
+            if self.persist.flush(self.persist_filename):
+                self.saved_flushes += 1
+            else:
+                self.skipped_flushes += 1
+            logging.debug(
+                "Monitor flushes: %d saved, %d skipped. Persist writes: %s",
+                self.saved_flushes, self.skipped_flushes,
+                ", ".join("%s=%d" % item for item in
+                          sorted(self.persist.write_counts.items())))
 
     def exchange(self):
         """Call C{exchange} on all plugins."""
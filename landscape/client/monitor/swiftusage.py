@@ -2,11 +2,10 @@ import logging
 import time
 import os
 
-from twisted.internet import threads
-
 from landscape.client.accumulate import Accumulator
 from landscape.lib.monitor import CoverageMonitor
 from landscape.lib.network import get_active_device_info
+from landscape.lib.workers import get_pool
 from landscape.client.monitor.plugin import MonitorPlugin
 
 try:
@@ -75,7 +74,7 @@ class SwiftUsage(MonitorPlugin):
         self._monitor.ping()
 
         host = self._get_recon_host()
-        deferred = threads.deferToThread(self._perform_recon_call, host)
+        deferred = get_pool("process").run(self._perform_recon_call, host)
         deferred.addCallback(self._handle_usage)
         return deferred
 
@@ -43,6 +43,20 @@ class MonitorTest(LandscapeTest):
         persist.load(self.monitor.persist_filename)
         self.assertEqual(persist.get("a"), 1)
 
+    def test_flush_skips_unmodified_persist(self):
+        """
+        The L{Monitor.flush} method doesn't save the persist if it didn't
+        change since the last flush, and counts saved and skipped flushes.
+        """
+        self.monitor.persist.set("a", 1)
+        self.monitor.flush()
+        self.monitor.persist.save = Mock()
+        self.monitor.flush()
+        self.monitor.flush()
+        self.assertFalse(self.monitor.persist.save.called)
+        self.assertEqual(1, self.monitor.saved_flushes)
+        self.assertEqual(2, self.monitor.skipped_flushes)
+
     def test_flush_every_flush_interval(self):
         """
         The L{Monitor.flush} method gets called every C{flush_interval}
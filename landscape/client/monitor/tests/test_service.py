@@ -58,6 +58,8 @@ class MonitorServiceTest(LandscapeTest):
         def assert_broker_connection(ignored):
             self.assertEqual(len(self.broker_service.broker.get_clients()), 1)
             self.assertIs(self.service.broker, self.service.monitor.broker)
+            self.assertTrue(self.service.broker.batch_messages)
+            self.assertIsNot(None, self.service.broker._accepted_types)
             result = self.service.broker.ping()
             return result.addCallback(stop_service)
 
@@ -115,9 +115,11 @@ class ReleaseUpgrader(PackageTaskHandler):
         if not os.path.exists(self._config.upgrade_tool_directory):
             os.mkdir(self._config.upgrade_tool_directory)
 
+        # Fetch the files one after the other, leaving a worker of the
+        # fetch pool free for other downloads.
         result = fetch_to_files([tarball_url, signature_url],
                                 self._config.upgrade_tool_directory,
-                                logger=logging.warning)
+                                logger=logging.warning, concurrency=1)
 
         def log_success(ignored):
             logging.info("Successfully fetched upgrade-tool files")
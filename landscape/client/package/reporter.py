@@ -12,12 +12,15 @@ import re
 
 from twisted.internet.defer import (
     Deferred, succeed, inlineCallbacks, returnValue)
+from twisted.python.compat import iteritems
 
 from landscape.lib import bpickle
 from landscape.lib.apt.package.store import (
         UnknownHashIDRequest, FakePackageStore)
 from landscape.lib.config import get_bindir
-from landscape.lib.sequenceranges import sequence_to_ranges
+from landscape.lib.sequenceranges import (
+    bitmap_to_ranges, count_bitmap, sequence_to_bitmap)
+from landscape.lib.store import transaction
 from landscape.lib.twisted_util import gather_results, spawn_process
 from landscape.lib.fetch import fetch_async
 from landscape.lib.fs import touch_file, create_binary_file
@@ -50,6 +53,12 @@ class PackageReporterConfiguration(PackageTaskHandlerConfiguration):
                           help="The URL of the HTTP proxy, if one is needed.")
         parser.add_option("--https-proxy", metavar="URL",
                           help="The URL of the HTTPS proxy, if one is needed.")
+        parser.add_option("--hash-workers", default=0, type="int",
+                          metavar="COUNT",
+                          help="The number of processes computing the "
+                               "hashes of the available packages, or 0 to "
+                               "compute them in the reporter process "
+                               "(default: 0).")
         return parser
 
 
@@ -69,6 +78,7 @@ class PackageReporter(PackageTaskHandler):
 
     def run(self):
         self._got_task = False
+        self._facade.hash_workers = self._config.hash_workers or 0
 
         result = Deferred()
         # Set us up to communicate properly
@@ -148,9 +158,11 @@ class PackageReporter(PackageTaskHandler):
             else:
                 proxy = self._config.get("http_proxy")
 
+            # The database is big and nothing waits for it, so let other
+            # downloads in the pool go first.
             result = fetch_async(url,
                                  cainfo=self._config.get("ssl_public_key"),
-                                 proxy=proxy)
+                                 proxy=proxy, priority=-1)
             result.addCallback(fetch_ok)
             result.addErrback(fetch_error)
 
@@ -497,12 +509,9 @@ class PackageReporter(PackageTaskHandler):
         """
         self._facade.ensure_channels_reloaded()
 
-        unknown_hashes = set()
-
-        for package in self._facade.get_packages():
-            hash = self._facade.get_package_hash(package)
-            if self._store.get_hash_id(hash) is None:
-                unknown_hashes.add(self._facade.get_package_hash(package))
+        hashes = set(self._facade.get_package_hash(package)
+                     for package in self._facade.get_packages())
+        unknown_hashes = hashes.difference(self._store.lookup_hash_ids(hashes))
 
         # Discard unknown hashes in existent requests.
         for request in self._store.iter_hash_id_requests():
@@ -620,12 +629,7 @@ class PackageReporter(PackageTaskHandler):
         """
         self._facade.ensure_channels_reloaded()
 
-        old_installed = set(self._store.get_installed())
-        old_available = set(self._store.get_available())
-        old_upgrades = set(self._store.get_available_upgrades())
-        old_locked = set(self._store.get_locked())
-        old_autoremovable = set(self._store.get_autoremovable())
-        old_security = set(self._store.get_security())
+        old_states = self._store.get_package_states()
 
         current_installed = set()
         current_available = set()
@@ -637,6 +641,7 @@ class PackageReporter(PackageTaskHandler):
         backports_archive = "{}-backports".format(lsb["code-name"])
         security_archive = "{}-security".format(lsb["code-name"])
 
+        packages = []
         for package in self._facade.get_packages():
             # Don't include package versions from the official backports
             # archive. The backports archive is enabled by default since
@@ -654,8 +659,15 @@ class PackageReporter(PackageTaskHandler):
                 # e.g. a PPA, we assume it was added manually and the
                 # user wants to get updates from it.
                 continue
-            hash = self._facade.get_package_hash(package)
-            id = self._store.get_hash_id(hash)
+            packages.append((package, self._facade.get_package_hash(package)))
+        locked_hashes = [self._facade.get_package_hash(package)
+                         for package in self._facade.get_locked_packages()]
+
+        hash_ids = self._store.lookup_hash_ids(
+            [hash for _, hash in packages] + locked_hashes)
+
+        for package, hash in packages:
+            id = hash_ids.get(hash)
             if id is not None:
                 if self._facade.is_package_installed(package):
                     current_installed.add(id)
@@ -677,66 +689,73 @@ class PackageReporter(PackageTaskHandler):
                 if security_origins:
                     current_security.add(id)
 
-        for package in self._facade.get_locked_packages():
-            hash = self._facade.get_package_hash(package)
-            id = self._store.get_hash_id(hash)
+        for hash in locked_hashes:
+            id = hash_ids.get(hash)
             if id is not None:
                 current_locked.add(id)
 
-        new_installed = current_installed - old_installed
-        new_available = current_available - old_available
-        new_upgrades = current_upgrades - old_upgrades
-        new_locked = current_locked - old_locked
-        new_autoremovable = current_autoremovable - old_autoremovable
-        new_security = current_security - old_security
-
-        not_installed = old_installed - current_installed
-        not_available = old_available - current_available
-        not_upgrades = old_upgrades - current_upgrades
-        not_locked = old_locked - current_locked
-        not_autoremovable = old_autoremovable - current_autoremovable
-        not_security = old_security - current_security
+        # From here on, the package ids are handled as bitmaps, see
+        # sequence_to_bitmap.
+        current_states = {
+            "installed": sequence_to_bitmap(current_installed),
+            "available": sequence_to_bitmap(current_available),
+            "available_upgrade": sequence_to_bitmap(current_upgrades),
+            "locked": sequence_to_bitmap(current_locked),
+            "autoremovable": sequence_to_bitmap(current_autoremovable),
+            "security": sequence_to_bitmap(current_security)}
+        new_states = dict(
+            (state, bitmap & ~old_states[state])
+            for state, bitmap in iteritems(current_states))
+        not_states = dict(
+            (state, old_states[state] & ~bitmap)
+            for state, bitmap in iteritems(current_states))
+
+        new_installed = new_states["installed"]
+        new_available = new_states["available"]
+        new_upgrades = new_states["available_upgrade"]
+        new_locked = new_states["locked"]
+        new_autoremovable = new_states["autoremovable"]
+        new_security = new_states["security"]
+
+        not_installed = not_states["installed"]
+        not_available = not_states["available"]
+        not_upgrades = not_states["available_upgrade"]
+        not_locked = not_states["locked"]
+        not_autoremovable = not_states["autoremovable"]
+        not_security = not_states["security"]
 
         message = {}
         if new_installed:
-            message["installed"] = \
-                list(sequence_to_ranges(sorted(new_installed)))
+            message["installed"] = list(bitmap_to_ranges(new_installed))
         if new_available:
-            message["available"] = \
-                list(sequence_to_ranges(sorted(new_available)))
+            message["available"] = list(bitmap_to_ranges(new_available))
         if new_upgrades:
-            message["available-upgrades"] = \
-                list(sequence_to_ranges(sorted(new_upgrades)))
+            message["available-upgrades"] = list(
+                bitmap_to_ranges(new_upgrades))
         if new_locked:
-            message["locked"] = \
-                list(sequence_to_ranges(sorted(new_locked)))
+            message["locked"] = list(bitmap_to_ranges(new_locked))
 
         if new_autoremovable:
             message["autoremovable"] = list(
-                sequence_to_ranges(sorted(new_autoremovable)))
+                bitmap_to_ranges(new_autoremovable))
         if not_autoremovable:
             message["not-autoremovable"] = list(
-                sequence_to_ranges(sorted(not_autoremovable)))
+                bitmap_to_ranges(not_autoremovable))
 
         if new_security:
-            message["security"] = list(
-                sequence_to_ranges(sorted(new_security)))
+            message["security"] = list(bitmap_to_ranges(new_security))
         if not_security:
-            message["not-security"] = list(
-                sequence_to_ranges(sorted(not_security)))
+            message["not-security"] = list(bitmap_to_ranges(not_security))
 
         if not_installed:
-            message["not-installed"] = \
-                list(sequence_to_ranges(sorted(not_installed)))
+            message["not-installed"] = list(bitmap_to_ranges(not_installed))
         if not_available:
-            message["not-available"] = \
-                list(sequence_to_ranges(sorted(not_available)))
+            message["not-available"] = list(bitmap_to_ranges(not_available))
         if not_upgrades:
-            message["not-available-upgrades"] = \
-                list(sequence_to_ranges(sorted(not_upgrades)))
+            message["not-available-upgrades"] = list(
+                bitmap_to_ranges(not_upgrades))
         if not_locked:
-            message["not-locked"] = \
-                list(sequence_to_ranges(sorted(not_locked)))
+            message["not-locked"] = list(bitmap_to_ranges(not_locked))
 
         if not message:
             return succeed(False)
@@ -756,43 +775,28 @@ class PackageReporter(PackageTaskHandler):
             "%(not_auto)d not autoremovable, "
             "%(not_security)d not security.",
             extra=dict(
-                installed=len(new_installed), available=len(new_available),
-                upgrades=len(new_upgrades), locked=len(new_locked),
-                auto=len(new_autoremovable), not_installed=len(not_installed),
-                not_available=len(not_available),
-                not_upgrades=len(not_upgrades), not_locked=len(not_locked),
-                not_auto=len(not_autoremovable), security=len(new_security),
-                not_security=len(not_security)))
+                installed=count_bitmap(new_installed),
+                available=count_bitmap(new_available),
+                upgrades=count_bitmap(new_upgrades),
+                locked=count_bitmap(new_locked),
+                auto=count_bitmap(new_autoremovable),
+                not_installed=count_bitmap(not_installed),
+                not_available=count_bitmap(not_available),
+                not_upgrades=count_bitmap(not_upgrades),
+                not_locked=count_bitmap(not_locked),
+                not_auto=count_bitmap(not_autoremovable),
+                security=count_bitmap(new_security),
+                not_security=count_bitmap(not_security)))
 
         def update_currently_known(result):
-            if new_installed:
-                self._store.add_installed(new_installed)
-            if not_installed:
-                self._store.remove_installed(not_installed)
-            if new_available:
-                self._store.add_available(new_available)
-            if new_locked:
-                self._store.add_locked(new_locked)
-            if new_autoremovable:
-                self._store.add_autoremovable(new_autoremovable)
-            if not_available:
-                self._store.remove_available(not_available)
-            if new_upgrades:
-                self._store.add_available_upgrades(new_upgrades)
-            if not_upgrades:
-                self._store.remove_available_upgrades(not_upgrades)
-            if not_locked:
-                self._store.remove_locked(not_locked)
-            if not_autoremovable:
-                self._store.remove_autoremovable(not_autoremovable)
-            if new_security:
-                self._store.add_security(new_security)
-            if not_security:
-                self._store.remove_security(not_security)
-            # Something has changed wrt the former run, let's update the
-            # timestamp and return True.
-            stamp_file = self._config.detect_package_changes_stamp
-            touch_file(stamp_file)
+            # The new states are only kept if the timestamp gets updated
+            # too, so that the changes are detected again otherwise.
+            with transaction(self._store):
+                self._store.set_package_states(current_states)
+                # Something has changed wrt the former run, let's update the
+                # timestamp and return True.
+                stamp_file = self._config.detect_package_changes_stamp
+                touch_file(stamp_file)
             return True
 
         result.addCallback(update_currently_known)
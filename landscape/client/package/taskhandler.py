@@ -20,6 +20,19 @@ class PackageTaskError(Exception):
 class PackageTaskHandlerConfiguration(Configuration):
     """Specialized configuration for L{PackageTaskHandler}s."""
 
+    def make_parser(self):
+        """
+        Specialize L{Configuration.make_parser}, adding options for the
+        package store.
+        """
+        parser = super(PackageTaskHandlerConfiguration, self).make_parser()
+        parser.add_option("--package-store-wal", action="store_true",
+                          default=False,
+                          help="Switch the package database to write-ahead "
+                               "logging, so that reading it doesn't block "
+                               "the package tasks writing to it.")
+        return parser
+
     @property
     def package_directory(self):
         """Get the path to the package directory."""
@@ -40,6 +53,11 @@ class PackageTaskHandlerConfiguration(Configuration):
         """Get the path to the update-stamp file."""
         return os.path.join(self.package_directory, "update-stamp")
 
+    @property
+    def package_hash_cache_filename(self):
+        """Get the path to the file caching the hashes of the packages."""
+        return os.path.join(self.package_directory, "hash-cache")
+
     @property
     def detect_package_changes_stamp(self):
         """Get the path to the stamp marking when the last time we checked for
@@ -185,7 +203,10 @@ class PackageTaskHandler(object):
                 return
 
             try:
-                self._store.add_hash_id_db(hash_id_db_filename)
+                # The stock databases are only replaced between runs, so
+                # they can be searched in memory.
+                self._store.add_hash_id_db(hash_id_db_filename,
+                                           in_memory=True)
             except InvalidHashIdDb:
                 # The appropriate database is there but broken,
                 # let's remove it and go on
@@ -291,11 +312,13 @@ def run_task_handler(cls, args, reactor=None):
     # 0o644 so...
     os.umask(0o022)
 
-    package_store = cls.package_store_class(config.store_filename)
+    package_store = cls.package_store_class(
+        config.store_filename, wal=config.package_store_wal)
     # Delay importing of the facades so that we don't
     # import Apt unless we need to.
     from landscape.lib.apt.package.facade import AptFacade
     package_facade = AptFacade()
+    package_facade.hash_cache_filename = config.package_hash_cache_filename
 
     def finish():
         connector.disconnect()
@@ -86,6 +86,36 @@ class ReleaseUpgraderTest(LandscapeTest):
         result.addCallback(check_result)
         return result
 
+    @mock.patch("landscape.lib.fetch.fetch_async")
+    def test_fetch_one_at_a_time(self, fetch_mock):
+        """
+        L{ReleaseUpgrader.fetch} fetches the signature only once the tarball
+        has been fetched, to leave room in the fetch pool.
+        """
+        tarball_url = "http://some/where/karmic.tar.gz"
+        signature_url = "http://some/where/karmic.tar.gz.gpg"
+
+        method_returns = {
+            tarball_url: Deferred(),
+            signature_url: succeed(b"signature")}
+
+        def side_effect(param):
+            return method_returns[param]
+
+        fetch_mock.side_effect = side_effect
+
+        result = self.upgrader.fetch(tarball_url,
+                                     signature_url)
+        fetch_mock.assert_called_once_with(tarball_url)
+        method_returns[tarball_url].callback(b"tarball")
+
+        def check_result(ignored):
+            calls = [mock.call(tarball_url), mock.call(signature_url)]
+            self.assertEqual(calls, fetch_mock.mock_calls)
+
+        result.addCallback(check_result)
+        return result
+
     @mock.patch("landscape.lib.fetch.fetch_async")
     def test_fetch_with_errors(self, fetch_mock):
         """
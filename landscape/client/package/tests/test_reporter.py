@@ -44,6 +44,18 @@ class PackageReporterConfigurationTest(LandscapeTest):
         config.load(["--force-apt-update"])
         self.assertTrue(config.force_apt_update)
 
+    def test_hash_workers_option(self):
+        """
+        The L{PackageReporterConfiguration} supports a '--hash-workers'
+        command line option, which defaults to 0.
+        """
+        config = PackageReporterConfiguration()
+        config.default_config_filenames = (self.makeFile(""), )
+        config.load([])
+        self.assertEqual(0, config.hash_workers)
+        config.load(["--hash-workers", "4"])
+        self.assertEqual(4, config.hash_workers)
+
 
 class PackageReporterAptTest(LandscapeTest):
 
@@ -330,7 +342,7 @@ class PackageReporterAptTest(LandscapeTest):
         logging_mock.assert_called_once_with(
             "Downloaded hash=>id database from %s" % hash_id_db_url)
         mock_fetch_async.assert_called_once_with(
-            hash_id_db_url, cainfo=None, proxy=None)
+            hash_id_db_url, cainfo=None, proxy=None, priority=-1)
         return result
 
     @mock.patch("landscape.client.package.reporter.fetch_async",
@@ -357,7 +369,8 @@ class PackageReporterAptTest(LandscapeTest):
 
         result = self.reporter.fetch_hash_id_db()
         mock_fetch_async.assert_called_once_with(
-            hash_id_db_url, cainfo=None, proxy="http://helloproxy:8000")
+            hash_id_db_url, cainfo=None, proxy="http://helloproxy:8000",
+            priority=-1)
         return result
 
     @mock.patch("landscape.client.package.reporter.fetch_async")
@@ -467,7 +480,7 @@ class PackageReporterAptTest(LandscapeTest):
             self.assertEqual(open(hash_id_db_filename).read(), "hash-ids")
         result.addCallback(callback)
         mock_fetch_async.assert_called_once_with(
-            hash_id_db_url, cainfo=None, proxy=None)
+            hash_id_db_url, cainfo=None, proxy=None, priority=-1)
         return result
 
     @mock.patch("landscape.client.package.reporter.fetch_async",
@@ -502,7 +515,7 @@ class PackageReporterAptTest(LandscapeTest):
         logging_mock.assert_called_once_with(
             "Couldn't download hash=>id database: fetch error")
         mock_fetch_async.assert_called_once_with(
-            hash_id_db_url, cainfo=None, proxy=None)
+            hash_id_db_url, cainfo=None, proxy=None, priority=-1)
         return result
 
     @mock.patch("logging.warning", return_value=None)
@@ -556,7 +569,8 @@ class PackageReporterAptTest(LandscapeTest):
         # Now go!
         result = self.reporter.fetch_hash_id_db()
         mock_fetch_async.assert_called_once_with(
-            hash_id_db_url, cainfo=self.config.ssl_public_key, proxy=None)
+            hash_id_db_url, cainfo=self.config.ssl_public_key, proxy=None,
+            priority=-1)
 
         return result
 
@@ -862,6 +876,33 @@ class PackageReporterAptTest(LandscapeTest):
         result = self.reporter.detect_packages_changes()
         return result.addCallback(got_result)
 
+    def test_detect_packages_changes_with_stamp_error(self):
+        """
+        If the timestamp of the changes can't be updated, the new package
+        states aren't stored either, so that the changes are detected
+        again on the next run.
+        """
+        message_store = self.broker_service.message_store
+        message_store.set_accepted_types(["packages"])
+
+        self.store.set_hash_ids({HASH1: 1, HASH2: 2, HASH3: 3})
+        self.store.add_available([1, 2, 3])
+
+        self.set_pkg1_installed()
+
+        def got_error(error):
+            self.assertEqual([], self.store.get_installed())
+            self.assertEqual([1, 2, 3], self.store.get_available())
+
+        touch_patcher = mock.patch(
+            "landscape.client.package.reporter.touch_file",
+            side_effect=IOError("boom"))
+        touch_patcher.start()
+        self.addCleanup(touch_patcher.stop)
+        result = self.reporter.detect_packages_changes()
+        result = self.assertFailure(result, IOError)
+        return result.addCallback(got_error)
+
     def test_detect_packages_changes_with_installed_already_known(self):
         message_store = self.broker_service.message_store
         message_store.set_accepted_types(["packages"])
@@ -1224,6 +1265,16 @@ class PackageReporterAptTest(LandscapeTest):
         self.assertTrue(self.reporter.request_unknown_hashes.called)
         self.assertTrue(self.reporter.detect_changes.called)
 
+    def test_run_sets_hash_workers(self):
+        """
+        The facade computes the package hashes in as many processes as
+        configured with C{hash_workers}.
+        """
+        self.config.hash_workers = 3
+        self.reporter.run_apt_update = mock.Mock(return_value=Deferred())
+        self.reporter.run()
+        self.assertEqual(3, self.facade.hash_workers)
+
     def test_main(self):
         mocktarget = "landscape.client.package.reporter.run_task_handler"
         with mock.patch(mocktarget) as m:
@@ -31,6 +31,28 @@ class PackageTaskHandlerConfigurationTest(LandscapeTest):
             config.update_stamp_filename,
             "/var/lib/landscape/client/package/update-stamp")
 
+    def test_package_hash_cache_filename(self):
+        """
+        L{PackageReporterConfiguration.package_hash_cache_filename} points
+        to the file caching the hashes of the packages.
+        """
+        config = PackageTaskHandlerConfiguration()
+        self.assertEqual(
+            config.package_hash_cache_filename,
+            "/var/lib/landscape/client/package/hash-cache")
+
+    def test_package_store_wal_option(self):
+        """
+        The L{PackageTaskHandlerConfiguration} supports a
+        '--package-store-wal' command line option.
+        """
+        config = PackageTaskHandlerConfiguration()
+        config.default_config_filenames = (self.makeFile(""), )
+        config.load([])
+        self.assertFalse(config.package_store_wal)
+        config.load(["--package-store-wal"])
+        self.assertTrue(config.package_store_wal)
+
 
 class PackageTaskHandlerTest(LandscapeTest):
 
@@ -83,6 +83,10 @@ def run_landscape_service(configuration_class, service_class, args):
         from landscape.lib.amp import MethodCallSender
         MethodCallSender.timeout = 300
 
+        # Each clone exchanges messages and pings on its own
+        from landscape.lib.workers import set_clients
+        set_clients(configuration.clones + 1)
+
         # Create clones here because LandscapeReactor.__init__ would otherwise
         # cancel all scheduled delayed calls
         clones = []
@@ -1,6 +1,7 @@
 import mock
 
 from landscape.lib.fs import read_text_file, create_text_file
+from landscape.lib.persist import JournaledBPickleBackend
 
 from landscape.client.deployment import (
     BaseConfiguration, Configuration, get_versioned_persist,
@@ -272,3 +273,20 @@ class GetVersionedPersistTest(LandscapeTest):
                              {"monitor": mock_monitor}):
             persist = get_versioned_persist(FakeService())
             mock_monitor.apply.assert_called_with(persist)
+
+    def test_persist_journal(self):
+        """
+        The persist uses a journaled backend if the C{persist_journal}
+        option is set.
+        """
+
+        class FakeService(object):
+            persist_filename = self.makePersistFile(content="")
+            service_name = "monitor"
+            config = Configuration()
+
+        FakeService.config.load(["--persist-journal"])
+        with mock.patch.dict("landscape.client.upgraders.UPGRADE_MANAGERS",
+                             {"monitor": mock.Mock()}):
+            persist = get_versioned_persist(FakeService())
+        self.assertIsInstance(persist._backend, JournaledBPickleBackend)
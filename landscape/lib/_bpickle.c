@@ -0,0 +1,644 @@
+/*
+ * Compiled implementation of the bpickle codec.
+ *
+ * This module is an optional accelerator for landscape.lib.bpickle, which
+ * picks it up automatically when it is available. It implements exactly
+ * the same wire format and semantics as the pure Python code there:
+ *
+ *   dumps(obj) -> bytes
+ *   dump(obj, write)
+ *   decode(buf, pos, as_is) -> (obj, endpos)
+ *   set_serialized_type(type)
+ *
+ * decode() accepts any object supporting the buffer protocol and, like
+ * the Python version, raises IndexError when the data ends before the
+ * object does, so that callers can tell truncated data apart.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+
+/* Encoding */
+
+/* The bytes subclass whose instances are already serialized. */
+static PyObject *serialized_type = NULL;
+
+/* Size of the chunks passed to the write callback of dump(). */
+#define CHUNK_SIZE 65536
+
+typedef struct {
+    char *data;
+    Py_ssize_t len;
+    Py_ssize_t size;
+    PyObject *write;
+} writer_t;
+
+
+/* Pass the buffered data to the write callback, if there's one. */
+static int
+writer_flush(writer_t *writer)
+{
+    PyObject *chunk, *result;
+
+    if (writer->write == NULL || writer->len == 0)
+        return 0;
+    chunk = PyBytes_FromStringAndSize(writer->data, writer->len);
+    if (chunk == NULL)
+        return -1;
+    result = PyObject_CallFunctionObjArgs(writer->write, chunk, NULL);
+    Py_DECREF(chunk);
+    if (result == NULL)
+        return -1;
+    Py_DECREF(result);
+    writer->len = 0;
+    return 0;
+}
+
+
+static int
+writer_reserve(writer_t *writer, Py_ssize_t extra)
+{
+    Py_ssize_t size = writer->size;
+    char *data;
+
+    if (writer->len + extra <= size)
+        return 0;
+    if (writer->write != NULL) {
+        if (writer_flush(writer) < 0)
+            return -1;
+        if (extra <= size)
+            return 0;
+    }
+    while (size < writer->len + extra)
+        size = size * 2;
+    data = PyMem_Realloc(writer->data, size);
+    if (data == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    writer->data = data;
+    writer->size = size;
+    return 0;
+}
+
+
+static int
+writer_write(writer_t *writer, const char *data, Py_ssize_t len)
+{
+    if (writer_reserve(writer, len) < 0)
+        return -1;
+    memcpy(writer->data + writer->len, data, len);
+    writer->len += len;
+    return 0;
+}
+
+
+static int
+writer_write_char(writer_t *writer, char c)
+{
+    if (writer_reserve(writer, 1) < 0)
+        return -1;
+    writer->data[writer->len++] = c;
+    return 0;
+}
+
+
+/* Write a length-prefixed string, like "s3:foo". */
+static int
+writer_write_sized(writer_t *writer, char code, const char *data,
+                   Py_ssize_t len)
+{
+    char header[32];
+    int header_len;
+
+    header_len = PyOS_snprintf(header, sizeof(header), "%c%zd:", code, len);
+    if (writer_write(writer, header, header_len) < 0)
+        return -1;
+    return writer_write(writer, data, len);
+}
+
+
+static int encode(writer_t *writer, PyObject *obj);
+
+
+static int
+encode_int(writer_t *writer, PyObject *obj)
+{
+    char buffer[32];
+    int overflow, len;
+    long long value;
+    PyObject *text;
+    const char *data;
+    Py_ssize_t size;
+
+    value = PyLong_AsLongLongAndOverflow(obj, &overflow);
+    if (value == -1 && PyErr_Occurred())
+        return -1;
+    if (!overflow) {
+        len = PyOS_snprintf(buffer, sizeof(buffer), "i%lld;", value);
+        return writer_write(writer, buffer, len);
+    }
+    text = PyObject_Str(obj);
+    if (text == NULL)
+        return -1;
+    data = PyUnicode_AsUTF8AndSize(text, &size);
+    if (data == NULL || writer_write_char(writer, 'i') < 0 ||
+            writer_write(writer, data, size) < 0 ||
+            writer_write_char(writer, ';') < 0) {
+        Py_DECREF(text);
+        return -1;
+    }
+    Py_DECREF(text);
+    return 0;
+}
+
+
+static int
+encode_float(writer_t *writer, PyObject *obj)
+{
+    char *text;
+    int result;
+
+    /* Same as repr(), which the Python version uses. */
+    text = PyOS_double_to_string(PyFloat_AS_DOUBLE(obj), 'r', 0,
+                                 Py_DTSF_ADD_DOT_0, NULL);
+    if (text == NULL)
+        return -1;
+    result = (writer_write_char(writer, 'f') < 0 ||
+              writer_write(writer, text, strlen(text)) < 0 ||
+              writer_write_char(writer, ';') < 0) ? -1 : 0;
+    PyMem_Free(text);
+    return result;
+}
+
+
+static int
+encode_sequence(writer_t *writer, char code, PyObject *obj)
+{
+    Py_ssize_t i;
+
+    if (writer_write_char(writer, code) < 0)
+        return -1;
+    /* The size is checked at each iteration in case encoding an item
+       ends up changing a list. */
+    for (i = 0; i < PySequence_Fast_GET_SIZE(obj); i++) {
+        if (encode(writer, PySequence_Fast_GET_ITEM(obj, i)) < 0)
+            return -1;
+    }
+    return writer_write_char(writer, ';');
+}
+
+
+static int
+encode_dict(writer_t *writer, PyObject *obj)
+{
+    PyObject *keys, *key, *value;
+    Py_ssize_t i;
+
+    keys = PyDict_Keys(obj);
+    if (keys == NULL)
+        return -1;
+    if (PyList_Sort(keys) < 0 || writer_write_char(writer, 'd') < 0)
+        goto error;
+    for (i = 0; i < PyList_GET_SIZE(keys); i++) {
+        key = PyList_GET_ITEM(keys, i);
+        if (encode(writer, key) < 0)
+            goto error;
+        value = PyObject_GetItem(obj, key);
+        if (value == NULL)
+            goto error;
+        if (encode(writer, value) < 0) {
+            Py_DECREF(value);
+            goto error;
+        }
+        Py_DECREF(value);
+    }
+    Py_DECREF(keys);
+    return writer_write_char(writer, ';');
+
+error:
+    Py_DECREF(keys);
+    return -1;
+}
+
+
+static int
+encode(writer_t *writer, PyObject *obj)
+{
+    PyTypeObject *type = Py_TYPE(obj);
+    const char *data;
+    Py_ssize_t size;
+    int result;
+
+    /* Like the Python version, only exact types are supported. */
+    if (obj == Py_None)
+        return writer_write_char(writer, 'n');
+    if (obj == Py_True)
+        return writer_write(writer, "b1", 2);
+    if (obj == Py_False)
+        return writer_write(writer, "b0", 2);
+    if (type == &PyLong_Type)
+        return encode_int(writer, obj);
+    if (type == &PyFloat_Type)
+        return encode_float(writer, obj);
+    if (type == &PyBytes_Type)
+        return writer_write_sized(writer, 's', PyBytes_AS_STRING(obj),
+                                  PyBytes_GET_SIZE(obj));
+    if (type == &PyUnicode_Type) {
+        data = PyUnicode_AsUTF8AndSize(obj, &size);
+        if (data == NULL)
+            return -1;
+        return writer_write_sized(writer, 'u', data, size);
+    }
+    if ((PyObject *)type == serialized_type)
+        return writer_write(writer, PyBytes_AS_STRING(obj),
+                            PyBytes_GET_SIZE(obj));
+    if (type != &PyList_Type && type != &PyTuple_Type &&
+            type != &PyDict_Type) {
+        PyErr_Format(PyExc_ValueError, "Unsupported type: %R", type);
+        return -1;
+    }
+    if (Py_EnterRecursiveCall(" while encoding a bpickle object"))
+        return -1;
+    if (type == &PyList_Type)
+        result = encode_sequence(writer, 'l', obj);
+    else if (type == &PyTuple_Type)
+        result = encode_sequence(writer, 't', obj);
+    else
+        result = encode_dict(writer, obj);
+    Py_LeaveRecursiveCall();
+    return result;
+}
+
+
+static PyObject *
+bpickle_dumps(PyObject *self, PyObject *obj)
+{
+    writer_t writer;
+    PyObject *result = NULL;
+
+    writer.len = 0;
+    writer.size = 256;
+    writer.write = NULL;
+    writer.data = PyMem_Malloc(writer.size);
+    if (writer.data == NULL)
+        return PyErr_NoMemory();
+    if (encode(&writer, obj) == 0)
+        result = PyBytes_FromStringAndSize(writer.data, writer.len);
+    PyMem_Free(writer.data);
+    return result;
+}
+
+
+static PyObject *
+bpickle_dump(PyObject *self, PyObject *args)
+{
+    writer_t writer;
+    PyObject *obj, *result = NULL;
+
+    if (!PyArg_ParseTuple(args, "OO:dump", &obj, &writer.write))
+        return NULL;
+    writer.len = 0;
+    writer.size = CHUNK_SIZE;
+    writer.data = PyMem_Malloc(writer.size);
+    if (writer.data == NULL)
+        return PyErr_NoMemory();
+    if (encode(&writer, obj) == 0 && writer_flush(&writer) == 0) {
+        result = Py_None;
+        Py_INCREF(result);
+    }
+    PyMem_Free(writer.data);
+    return result;
+}
+
+
+/* Decoding */
+
+typedef struct {
+    char code;
+    PyObject *values;
+} frame_t;
+
+
+static PyObject *
+truncated(Py_ssize_t pos)
+{
+    PyErr_Format(PyExc_IndexError, "bpickle data truncated at %zd", pos);
+    return NULL;
+}
+
+
+/* Return the position of c in data[pos:len], raising ValueError like
+   bytes.index() when it isn't there. */
+static Py_ssize_t
+find(const char *data, Py_ssize_t pos, Py_ssize_t len, char c)
+{
+    const char *found = NULL;
+
+    if (pos < len)
+        found = memchr(data + pos, c, len - pos);
+    if (found == NULL) {
+        PyErr_SetString(PyExc_ValueError, "subsection not found");
+        return -1;
+    }
+    return found - data;
+}
+
+
+/* Parse data[start:end] as int() would. The common case of a plain
+   decimal number is handled directly. */
+static PyObject *
+parse_int(const char *data, Py_ssize_t start, Py_ssize_t end)
+{
+    Py_ssize_t i = start;
+    long long value = 0;
+    int negative = 0;
+    PyObject *text, *result;
+
+    if (i < end && data[i] == '-') {
+        negative = 1;
+        i++;
+    }
+    if (i < end && end - i <= 18) {
+        for (; i < end; i++) {
+            if (data[i] < '0' || data[i] > '9')
+                break;
+            value = value * 10 + (data[i] - '0');
+        }
+        if (i == end)
+            return PyLong_FromLongLong(negative ? -value : value);
+    }
+    text = PyBytes_FromStringAndSize(data + start, end - start);
+    if (text == NULL)
+        return NULL;
+    result = PyObject_CallFunctionObjArgs((PyObject *)&PyLong_Type, text,
+                                          NULL);
+    Py_DECREF(text);
+    return result;
+}
+
+
+/* Build the container for a frame whose ';' has just been found. */
+static PyObject *
+finish_container(frame_t *frame, int as_is)
+{
+    PyObject *values = frame->values, *dict, *key;
+    Py_ssize_t i, size;
+
+    if (frame->code == 'l') {
+        Py_INCREF(values);
+        return values;
+    }
+    if (frame->code == 't')
+        return PyList_AsTuple(values);
+    dict = PyDict_New();
+    if (dict == NULL)
+        return NULL;
+    size = PyList_GET_SIZE(values);
+    for (i = 0; i < size; i += 2) {
+        key = PyList_GET_ITEM(values, i);
+        if (!as_is && PyBytes_CheckExact(key)) {
+            /* Dictionary keys are ASCII bytes on the wire, but the code
+               expects strings. */
+            key = PyUnicode_DecodeASCII(PyBytes_AS_STRING(key),
+                                        PyBytes_GET_SIZE(key), NULL);
+            if (key == NULL)
+                goto error;
+        }
+        else {
+            Py_INCREF(key);
+        }
+        if (i + 1 >= size) {
+            Py_DECREF(key);
+            truncated(i + 1);
+            goto error;
+        }
+        if (PyDict_SetItem(dict, key, PyList_GET_ITEM(values, i + 1)) < 0) {
+            Py_DECREF(key);
+            goto error;
+        }
+        Py_DECREF(key);
+    }
+    return dict;
+
+error:
+    Py_DECREF(dict);
+    return NULL;
+}
+
+
+static PyObject *
+decode(const char *data, Py_ssize_t len, Py_ssize_t *ppos, int as_is)
+{
+    Py_ssize_t pos = *ppos, start, end, depth = 0, stack_size = 0, i;
+    frame_t *stack = NULL, *resized, current = {0, NULL};
+    PyObject *obj, *number, *text;
+    char c;
+    int truth;
+
+    while (1) {
+        if (pos < 0 || pos >= len) {
+            truncated(pos);
+            goto error;
+        }
+        c = data[pos];
+        switch (c) {
+        case 's':
+        case 'u':
+            end = find(data, pos, len, ':');
+            if (end < 0)
+                goto error;
+            start = end + 1;
+            number = parse_int(data, pos + 1, end);
+            if (number == NULL)
+                goto error;
+            end = PyLong_AsSsize_t(number);
+            Py_DECREF(number);
+            if (end == -1 && PyErr_Occurred())
+                goto error;
+            if (end < 0) {
+                PyErr_SetString(PyExc_ValueError, "Invalid length");
+                goto error;
+            }
+            if (end > len - start) {
+                truncated(len);
+                goto error;
+            }
+            end += start;
+            if (c == 'u')
+                obj = PyUnicode_DecodeUTF8(data + start, end - start, NULL);
+            else
+                obj = PyBytes_FromStringAndSize(data + start, end - start);
+            if (obj == NULL)
+                goto error;
+            pos = end;
+            break;
+        case 'i':
+            end = find(data, pos, len, ';');
+            if (end < 0)
+                goto error;
+            obj = parse_int(data, pos + 1, end);
+            if (obj == NULL)
+                goto error;
+            pos = end + 1;
+            break;
+        case 'f':
+            end = find(data, pos, len, ';');
+            if (end < 0)
+                goto error;
+            text = PyBytes_FromStringAndSize(data + pos + 1, end - pos - 1);
+            if (text == NULL)
+                goto error;
+            obj = PyFloat_FromString(text);
+            Py_DECREF(text);
+            if (obj == NULL)
+                goto error;
+            pos = end + 1;
+            break;
+        case 'b':
+            end = pos + 2 < len ? pos + 2 : len;
+            number = parse_int(data, pos + 1, end);
+            if (number == NULL)
+                goto error;
+            truth = PyObject_IsTrue(number);
+            Py_DECREF(number);
+            if (truth < 0)
+                goto error;
+            obj = truth ? Py_True : Py_False;
+            Py_INCREF(obj);
+            pos += 2;
+            break;
+        case 'n':
+            obj = Py_None;
+            Py_INCREF(obj);
+            pos += 1;
+            break;
+        case 'l':
+        case 't':
+        case 'd':
+            if (depth == stack_size) {
+                stack_size = stack_size ? stack_size * 2 : 16;
+                resized = PyMem_Realloc(stack, stack_size * sizeof(frame_t));
+                if (resized == NULL) {
+                    PyErr_NoMemory();
+                    goto error;
+                }
+                stack = resized;
+            }
+            stack[depth++] = current;
+            current.code = c;
+            current.values = PyList_New(0);
+            if (current.values == NULL)
+                goto error;
+            pos += 1;
+            continue;
+        case ';':
+            if (current.values == NULL) {
+                truncated(pos);
+                goto error;
+            }
+            obj = finish_container(&current, as_is);
+            if (obj == NULL)
+                goto error;
+            Py_DECREF(current.values);
+            current = stack[--depth];
+            pos += 1;
+            break;
+        default:
+            text = PyBytes_FromStringAndSize(data + pos, 1);
+            if (text != NULL) {
+                PyErr_Format(PyExc_ValueError,
+                             "Unknown type character: %R", text);
+                Py_DECREF(text);
+            }
+            goto error;
+        }
+        if (current.values == NULL)
+            break;
+        if (PyList_Append(current.values, obj) < 0) {
+            Py_DECREF(obj);
+            goto error;
+        }
+        Py_DECREF(obj);
+    }
+    PyMem_Free(stack);
+    *ppos = pos;
+    return obj;
+
+error:
+    Py_XDECREF(current.values);
+    for (i = 0; i < depth; i++)
+        Py_XDECREF(stack[i].values);
+    PyMem_Free(stack);
+    return NULL;
+}
+
+
+static PyObject *
+bpickle_decode(PyObject *self, PyObject *args)
+{
+    PyObject *buf, *as_is, *obj;
+    Py_ssize_t pos;
+    Py_buffer view;
+    int truth;
+
+    if (!PyArg_ParseTuple(args, "OnO:decode", &buf, &pos, &as_is))
+        return NULL;
+    truth = PyObject_IsTrue(as_is);
+    if (truth < 0)
+        return NULL;
+    if (PyObject_GetBuffer(buf, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    obj = decode(view.buf, view.len, &pos, truth);
+    PyBuffer_Release(&view);
+    if (obj == NULL)
+        return NULL;
+    return Py_BuildValue("(Nn)", obj, pos);
+}
+
+
+static PyObject *
+bpickle_set_serialized_type(PyObject *self, PyObject *type)
+{
+    if (!PyType_Check(type) ||
+            !PyType_IsSubtype((PyTypeObject *)type, &PyBytes_Type)) {
+        PyErr_SetString(PyExc_TypeError, "expected a bytes subclass");
+        return NULL;
+    }
+    Py_INCREF(type);
+    Py_XSETREF(serialized_type, type);
+    Py_RETURN_NONE;
+}
+
+
+static PyMethodDef bpickle_methods[] = {
+    {"dumps", bpickle_dumps, METH_O,
+     "Serialize an object to bpickle bytes."},
+    {"dump", bpickle_dump, METH_VARARGS,
+     "Serialize an object, passing the data to a write callable in "
+     "chunks."},
+    {"decode", bpickle_decode, METH_VARARGS,
+     "Decode the object at a position of a buffer, returning it along "
+     "with the position right after its serialized form."},
+    {"set_serialized_type", bpickle_set_serialized_type, METH_O,
+     "Set the bytes subclass whose instances are written as they are."},
+    {NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef bpickle_module = {
+    PyModuleDef_HEAD_INIT,
+    "_bpickle",
+    "Compiled implementation of landscape.lib.bpickle.",
+    -1,
+    bpickle_methods
+};
+
+
+PyMODINIT_FUNC
+PyInit__bpickle(void)
+{
+    return PyModule_Create(&bpickle_module);
+}
@@ -118,16 +118,54 @@ class MethodCallChunk(Command):
 
     - C{chunk}: A portion of the big BPickle C{arguments} string which is
       being split and buffered.
+
+    - C{total}: Optionally, the size of the whole C{arguments} string, sent
+      along with the first chunk so the receiver can allocate its buffer
+      upfront. Peers which don't know about it just ignore it.
     """
 
     arguments = [(b"sequence", Integer()),
-                 (b"chunk", String())]
+                 (b"chunk", String()),
+                 (b"total", Integer(optional=True))]
 
     response = [(b"result", Integer())]
 
     errors = {MethodCallError: b"METHOD_CALL_ERROR"}
 
 
+class _ArgumentsBuffer(object):
+    """Reassemble the arguments of a L{MethodCall} sent in chunks.
+
+    At most C{max_preallocated_size} bytes are allocated upfront, in case
+    the expected size is wrong. The buffer grows beyond that as chunks are
+    received.
+
+    @param size: The expected size of the arguments, if known.
+    """
+
+    # A few windows worth of chunks, see MethodCallSender._chunk_window.
+    max_preallocated_size = 4 * 16 * MAX_VALUE_LENGTH
+
+    # Sizes above this are rejected, nothing sends arguments that big.
+    max_size = 2 ** 30
+
+    def __init__(self, size=0):
+        if not 0 <= size <= self.max_size:
+            raise MethodCallError("Invalid arguments size %d" % size)
+        self._data = bytearray(min(size, self.max_preallocated_size))
+        self._offset = 0
+
+    def write(self, chunk):
+        end = self._offset + len(chunk)
+        # This grows the buffer if the expected size was wrong.
+        self._data[self._offset:end] = chunk
+        self._offset = end
+
+    def getvalue(self):
+        del self._data[self._offset:]
+        return self._data
+
+
 class MethodCallReceiver(CommandLocator):
     """Expose methods of a local object over AMP.
 
@@ -162,8 +200,8 @@ class MethodCallReceiver(CommandLocator):
         chunks = self._pending_chunks.pop(sequence, None)
         if chunks is not None:
             # We got some L{MethodCallChunk}s before, this is the last.
-            chunks.append(arguments)
-            arguments = b"".join(chunks)
+            chunks.write(arguments)
+            arguments = chunks.getvalue()
 
         # Pass the the arguments as-is without reinterpreting strings.
         args, kwargs = bpickle.loads(arguments, as_is=True)
@@ -188,13 +226,18 @@ class MethodCallReceiver(CommandLocator):
         return deferred
 
     @MethodCallChunk.responder
-    def receive_method_call_chunk(self, sequence, chunk):
+    def receive_method_call_chunk(self, sequence, chunk, total=None):
         """Receive a part of a multi-chunk L{MethodCall}.
 
         Add the received C{chunk} to the buffer of the L{MethodCall} identified
-        by C{sequence}.
+        by C{sequence}, which is allocated with the given C{total} size when
+        the first chunk is received.
         """
-        self._pending_chunks.setdefault(sequence, []).append(chunk)
+        chunks = self._pending_chunks.get(sequence)
+        if chunks is None:
+            chunks = self._pending_chunks[sequence] = _ArgumentsBuffer(
+                total or 0)
+        chunks.write(chunk)
         return {"result": sequence}
 
     def _check_result(self, result):
@@ -208,6 +251,69 @@ class MethodCallReceiver(CommandLocator):
         return result
 
 
+class _ChunkSender(object):
+    """Send the chunks of some L{MethodCall} arguments up to C{end}.
+
+    The chunks are pipelined, that is sent without waiting for the previous
+    ones to be acknowledged, up to C{window} chunks in flight at a time.
+    Since AMP commands are handled in order, the receiver gets them in the
+    right order anyway.
+
+    @ivar deferred: A L{Deferred} firing when all the chunks were
+        acknowledged.
+    """
+
+    def __init__(self, protocol, sequence, arguments, end, chunk_size,
+                 window):
+        self._protocol = protocol
+        self._sequence = sequence
+        self._arguments = arguments
+        self._chunk_size = chunk_size
+        self._window = window
+        self._offsets = iter(xrange(0, end, chunk_size))
+        self._in_flight = 0
+        self._sending = False
+        self._exhausted = False
+        self.deferred = Deferred()
+
+    def send(self):
+        """Send as many chunks as the window allows."""
+        if self._sending or self.deferred.called:
+            # Acknowledgements can come in synchronously, while we're still
+            # in the loop below.
+            return
+        self._sending = True
+        try:
+            while self._in_flight < self._window and not self._exhausted:
+                offset = next(self._offsets, None)
+                if offset is None:
+                    self._exhausted = True
+                    break
+                kwargs = {}
+                if offset == 0:
+                    kwargs["total"] = len(self._arguments)
+                self._in_flight += 1
+                result = self._protocol.callRemote(
+                    MethodCallChunk, sequence=self._sequence,
+                    chunk=self._arguments[offset:offset + self._chunk_size],
+                    **kwargs)
+                result.addCallbacks(self._chunk_sent, self._chunk_failed)
+        finally:
+            self._sending = False
+        if (self._exhausted and not self._in_flight and
+                not self.deferred.called):
+            self.deferred.callback(None)
+
+    def _chunk_sent(self, response):
+        self._in_flight -= 1
+        self.send()
+
+    def _chunk_failed(self, failure):
+        self._in_flight -= 1
+        if not self.deferred.called:
+            self.deferred.errback(failure)
+
+
 class MethodCallSender(object):
     """Call methods on a remote object over L{AMP} and return the result.
 
@@ -220,6 +326,9 @@ class MethodCallSender(object):
 
     _chunk_size = MAX_VALUE_LENGTH
 
+    # How many chunks of big arguments can be waiting to be acknowledged.
+    _chunk_window = 16
+
     def __init__(self, protocol, clock):
         self._protocol = protocol
         self._clock = clock
@@ -270,30 +379,26 @@ class MethodCallSender(object):
         # As we send the method name to remote, we need bytes.
         method = method.encode("utf-8")
 
-        # Split the given arguments in one or more chunks
-        chunks = [arguments[i:i + self._chunk_size]
-                  for i in xrange(0, len(arguments), self._chunk_size)]
-
-        result = Deferred()
-        if len(chunks) > 1:
-            # If we have N chunks, send the first N-1 as MethodCallChunk's
-            for chunk in chunks[:-1]:
-
-                def create_send_chunk(sequence, chunk):
-                    send_chunk = (lambda x: self._protocol.callRemote(
-                        MethodCallChunk, sequence=sequence, chunk=chunk))
-                    return send_chunk
-
-                result.addCallback(create_send_chunk(sequence, chunk))
+        # If the arguments are split in N chunks, the first N-1 are sent as
+        # MethodCallChunk's and the last one along with the MethodCall.
+        last_offset = max(len(arguments) - 1, 0)
+        last_offset -= last_offset % self._chunk_size
+        if last_offset:
+            chunk_sender = _ChunkSender(
+                self._protocol, sequence, arguments, last_offset,
+                self._chunk_size, self._chunk_window)
+            chunk_sender.send()
+            result = chunk_sender.deferred
+        else:
+            result = succeed(None)
 
         def send_last_chunk(ignored):
-            chunk = chunks[-1]
+            chunk = arguments[last_offset:]
             return self._call_remote_with_timeout(
                 MethodCall, sequence=sequence, method=method, arguments=chunk)
 
         result.addCallback(send_last_chunk)
         result.addCallback(lambda response: response["result"])
-        result.callback(None)
         return result
 
 
@@ -23,7 +23,10 @@ from twisted.python.compat import itervalues
 from landscape.lib.compat import StringIO
 from landscape.lib.fs import append_text_file, create_text_file
 from landscape.lib.fs import read_text_file, read_binary_file, touch_file
-from .skeleton import build_skeleton_apt
+from .hashcache import (
+    HASHED_RECORD_FIELDS, PackageHashCache, get_hash_cache_key,
+    get_record_location)
+from .skeleton import build_skeleton_apt, get_record_hashes
 
 
 class TransactionError(Exception):
@@ -125,6 +128,12 @@ class AptFacade(object):
     @ivar refetch_package_index: Whether to refetch the package indexes
         when reloading the channels, or reuse the existing local
         database.
+    @ivar hash_cache_filename: The file in which to keep the hashes of the
+        available packages across runs, or C{None} to compute them all each
+        time the channels are reloaded.
+    @ivar hash_workers: The number of processes in which to compute the
+        hashes of the packages when reloading the channels. If it's lower
+        than 2 they're computed in this process.
     """
 
     max_dpkg_retries = 12  # number of dpkg retries before we give up
@@ -141,6 +150,9 @@ class AptFacade(object):
         # sources.list contains invalid lines (LP: #886208)
         self._cache = apt.cache.Cache(rootdir=root)
         self._channels_loaded = False
+        self.hash_cache_filename = None
+        self.hash_workers = 0
+        self._hash_cache = None
         self._pkg2hash = {}
         self._hash2pkg = {}
         self._version_installs = []
@@ -254,19 +266,102 @@ class AptFacade(object):
 
         self._pkg2hash.clear()
         self._hash2pkg.clear()
-        for package in self._cache:
-            if not self._is_main_architecture(package):
-                continue
-            for version in package.versions:
-                hash = self.get_package_skeleton(
-                    version, with_info=False).get_hash()
-                # Use a tuple including the package, since the Version
-                # objects of two different packages can have the same
-                # hash.
-                self._pkg2hash[(package, version)] = hash
-                self._hash2pkg[hash] = version
+        hash_cache = self._get_hash_cache()
+        versions = [
+            version for package in self._cache
+            if self._is_main_architecture(package)
+            for version in package.versions]
+        hashes = self._get_package_hashes(versions, hash_cache)
+        for version, hash in zip(versions, hashes):
+            # Use a tuple including the package, since the Version
+            # objects of two different packages can have the same
+            # hash.
+            self._pkg2hash[(version.package, version)] = hash
+            self._hash2pkg[hash] = version
+        if hash_cache is not None:
+            logging.debug("Package hashes: %d cached, %d computed.",
+                          hash_cache.hits, hash_cache.misses)
+            hash_cache.save()
         self._channels_loaded = True
 
+    def _get_hash_cache(self):
+        """Return the L{PackageHashCache} to use, if any."""
+        if self.hash_cache_filename is None:
+            return None
+        if self._hash_cache is None:
+            self._hash_cache = PackageHashCache(self.hash_cache_filename)
+            self._hash_cache.load()
+        return self._hash_cache
+
+    def _get_package_hashes(self, versions, hash_cache):
+        """Return the hashes of the skeletons of the given package versions.
+
+        The hashes are looked up in C{hash_cache} first, if it's not
+        C{None}. The missing ones are computed in C{hash_workers}
+        processes, if there are enough of them to make it worth it.
+        """
+        hashes = []
+        missing = []
+        file_stamps = {}
+        for version in versions:
+            key = hash = None
+            if hash_cache is not None:
+                key = self._get_hash_cache_key(version, file_stamps)
+            if key is not None:
+                hash = hash_cache.get(key)
+            if hash is None:
+                missing.append((len(hashes), key, version))
+            hashes.append(hash)
+
+        if self.hash_workers > 1 and len(missing) > self.hash_workers:
+            records = []
+            for _, _, version in missing:
+                # The record gets parsed again each time it's accessed.
+                record = version.record
+                records.append((
+                    version.package.name, version.version,
+                    dict((field, record[field])
+                         for field in HASHED_RECORD_FIELDS
+                         if field in record)))
+            computed = get_record_hashes(records, self.hash_workers)
+        else:
+            computed = [self._get_package_hash(version)
+                        for _, _, version in missing]
+
+        for (index, key, version), hash in zip(missing, computed):
+            hashes[index] = hash
+            if key is not None:
+                hash_cache.set(key, hash)
+        return hashes
+
+    def _get_hash_cache_key(self, version, file_stamps):
+        """Return the key of the given package version in the hash cache.
+
+        The key is built from the location of the package record, so that
+        the record doesn't need to be read. The dpkg status file, which
+        changes with each package operation, is used only for packages
+        which aren't in any other index file.
+
+        @param file_stamps: See L{get_record_location}.
+        @return: The key, or C{None} if the record can't be located.
+        """
+        file_list = version._cand.file_list
+        if not file_list:
+            return None
+        for package_file, offset in file_list:
+            if package_file.index_type != "Debian dpkg status file":
+                break
+        location = get_record_location(
+            package_file.filename, offset, file_stamps)
+        if location is None:
+            return None
+        return get_hash_cache_key(version.package.name, version.version,
+                                  version.architecture, location)
+
+    def _get_package_hash(self, version):
+        """Return the hash of the skeleton of the given package version."""
+        return self.get_package_skeleton(version, with_info=False).get_hash()
+
     def ensure_channels_reloaded(self):
         """Reload the channels if they haven't been reloaded yet."""
         if self._channels_loaded:
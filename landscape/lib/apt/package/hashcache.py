@@ -0,0 +1,145 @@
+"""On-disk cache of package hashes, reused across runs.
+
+Computing the hash of a package skeleton means parsing and sorting all its
+relations, which is the bulk of the time spent reloading the channels on
+systems with many packages available. The hash only depends on the name,
+version and relations of a package though, so we store it keyed by the
+package and the location of its record in the index files, and compute it
+again only for new or changed packages. Reading the records themselves
+would cost about as much as computing the hashes.
+"""
+import binascii
+import logging
+import os
+
+from landscape.lib.hashlib import md5
+
+
+# The record fields the skeleton relations, and so the hash, are built from.
+HASHED_RECORD_FIELDS = (
+    "Provides", "Pre-Depends", "Depends", "Conflicts", "Breaks")
+
+# The version of the cache, written on its first line. It must be bumped
+# whenever the way skeletons or their hashes are built changes, see the
+# skeleton module, or the format of the cache file or its keys does, so
+# that the hashes cached by a previous version are computed again.
+HASH_CACHE_VERSION = 2
+HASH_CACHE_HEADER = "landscape-package-hash-cache %d\n" % HASH_CACHE_VERSION
+
+
+def get_hash_cache_key(name, version, architecture, location):
+    """Return the key of a package in a L{PackageHashCache}.
+
+    @param name: The package name.
+    @param version: The package version string.
+    @param architecture: The package architecture.
+    @param location: The location of the package record, as returned by
+        L{get_record_location}.
+    """
+    fingerprint = md5(location.encode("utf-8"))
+    return "%s %s %s %s" % (name, version, architecture,
+                            fingerprint.hexdigest())
+
+
+def get_record_location(filename, offset, file_stamps):
+    """Return a string locating a package record in an index file.
+
+    The size and modification time of the file are part of it, so that it
+    changes whenever the record could have.
+
+    @param filename: The path to the index file holding the record.
+    @param offset: The offset of the record in the file.
+    @param file_stamps: A C{dict} in which the size and modification time
+        of the files are kept, so that each file is looked up only once.
+    @return: The location, or C{None} if the file can't be found.
+    """
+    stamp = file_stamps.get(filename)
+    if stamp is None:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        stamp = file_stamps[filename] = "%d %r" % (stat.st_size,
+                                                   stat.st_mtime)
+    return "%s %s %d" % (filename, stamp, offset)
+
+
+class PackageHashCache(object):
+    """A file mapping package keys to their hashes.
+
+    The file starts with a header holding the L{HASH_CACHE_VERSION}, and
+    is discarded if it doesn't match. Then it holds a line per package,
+    with its key and hash separated by spaces. Keys are built by
+    L{get_hash_cache_key}.
+
+    @param filename: The path to the cache file.
+    @ivar hits: The number of hashes found in the cache since the last save.
+    @ivar misses: The number of hashes which weren't found.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._hashes = {}
+        self._used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        """Load the hashes saved by a previous run, if any."""
+        self._hashes = {}
+        if not os.path.exists(self._filename):
+            return
+        try:
+            with open(self._filename) as cache_file:
+                if cache_file.readline() != HASH_CACHE_HEADER:
+                    logging.info("Discarding package hash cache %s written "
+                                 "by another version.", self._filename)
+                    return
+                for line in cache_file:
+                    key, hash = line.rsplit(" ", 1)
+                    self._hashes[key] = binascii.unhexlify(hash.rstrip())
+        except (IOError, ValueError, TypeError) as error:
+            logging.warning("Ignoring corrupted package hash cache %s: %s",
+                            self._filename, error)
+            self._hashes = {}
+
+    def get(self, key, compute=None):
+        """Return the hash for the given C{key}.
+
+        @param compute: A function computing the hash, called only if it's
+            not in the cache. If it's C{None}, C{None} is returned for
+            missing hashes instead, and they can be added with L{set}.
+        """
+        hash = self._hashes.get(key)
+        if hash is None:
+            self.misses += 1
+            if compute is None:
+                return None
+            hash = compute()
+        else:
+            self.hits += 1
+        self._used[key] = hash
+        return hash
+
+    def set(self, key, hash):
+        """Add the C{hash} computed for the given C{key}."""
+        self._used[key] = hash
+
+    def save(self):
+        """Save the hashes looked up since the last save.
+
+        Hashes which weren't looked up are dropped, since they belong to
+        packages that aren't available anymore. Nothing is written if the
+        content of the cache didn't change.
+        """
+        if self.misses or len(self._used) != len(self._hashes):
+            temp_filename = self._filename + ".new"
+            with open(temp_filename, "w") as cache_file:
+                cache_file.write(HASH_CACHE_HEADER)
+                for key, hash in self._used.items():
+                    cache_file.write("%s %s\n" % (
+                        key, binascii.hexlify(hash).decode("ascii")))
+            os.rename(temp_filename, self._filename)
+        self._hashes = self._used
+        self._used = {}
+        self.hits = self.misses = 0
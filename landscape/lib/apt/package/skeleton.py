@@ -1,3 +1,5 @@
+import multiprocessing
+
 from landscape.lib.hashlib import sha1
 
 import apt_pkg
@@ -50,6 +52,8 @@ class PackageSkeleton(object):
         """
         if self._hash is not None:
             return self._hash
+        # Hashes are cached across runs, bump HASH_CACHE_VERSION in the
+        # hashcache module when changing how they are computed.
         # We use ascii here as encoding  for backwards compatibility as it was
         # default encoding for conversion from unicode to bytes in Python 2.7.
         package_info = ("[%d %s %s]" % (self.type, self.name, self.version)
@@ -94,7 +98,8 @@ def parse_record_field(record, record_field, relation_type,
                        or_relation_type=None):
     """Parse an apt C{Record} field and return skeleton relations
 
-    @param record: An C{apt.package.Record} instance with package information.
+    @param record: An C{apt.package.Record} instance, or another mapping
+        with the package fields.
     @param record_field: The name of the record field to parse.
     @param relation_type: The deb relation that can be passed to
         C{skeleton.add_relation()}
@@ -113,6 +118,68 @@ def parse_record_field(record, record_field, relation_type,
     return relations
 
 
+def get_record_relations(name, version_string, record):
+    """Return the sorted skeleton relations of a package.
+
+    @param name: The package name.
+    @param version_string: The package version.
+    @param record: A mapping with the fields of the package record.
+    """
+    relations = set()
+    relations.update(parse_record_field(record, "Provides", DEB_PROVIDES))
+    relations.add((DEB_NAME_PROVIDES, "%s = %s" % (name, version_string)))
+    relations.update(parse_record_field(
+        record, "Pre-Depends", DEB_REQUIRES, DEB_OR_REQUIRES))
+    relations.update(parse_record_field(
+        record, "Depends", DEB_REQUIRES, DEB_OR_REQUIRES))
+
+    relations.add((DEB_UPGRADES, "%s < %s" % (name, version_string)))
+
+    relations.update(parse_record_field(record, "Conflicts", DEB_CONFLICTS))
+    relations.update(parse_record_field(record, "Breaks", DEB_CONFLICTS))
+    return sorted(relations)
+
+
+def get_record_hash(name, version_string, record):
+    """Return the hash of the skeleton of a package.
+
+    The hash is the same as the one of the skeleton built by
+    L{build_skeleton_apt}, but only needs the fields of the package record,
+    so that it can be computed in another process.
+
+    @param name: The package name.
+    @param version_string: The package version.
+    @param record: A mapping with the fields of the package record.
+    """
+    skeleton = PackageSkeleton(DEB_PACKAGE, name, version_string)
+    skeleton.relations = get_record_relations(name, version_string, record)
+    return skeleton.get_hash()
+
+
+def _get_record_hash(args):
+    """Call L{get_record_hash} with the given tuple of arguments."""
+    return get_record_hash(*args)
+
+
+def get_record_hashes(records, workers):
+    """Return the hashes of many package skeletons, using many processes.
+
+    @param records: A list of C{(name, version_string, record)} tuples, as
+        taken by L{get_record_hash}.
+    @param workers: The number of processes to compute the hashes in.
+    @return: The list of hashes, in the same order as C{records}.
+    """
+    # Handing each process a few large chunks keeps the cost of passing
+    # the records around low, while still balancing the load.
+    chunk_size = max(1, len(records) // (workers * 4))
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(_get_record_hash, records, chunk_size)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def build_skeleton_apt(version, with_info=False, with_unicode=False):
     """Build a package skeleton from an apt package.
 
@@ -126,25 +193,8 @@ def build_skeleton_apt(version, with_info=False, with_unicode=False):
     if with_unicode:
         name, version_string = unicode(name), unicode(version_string)
     skeleton = PackageSkeleton(DEB_PACKAGE, name, version_string)
-    relations = set()
-    relations.update(parse_record_field(
-        version.record, "Provides", DEB_PROVIDES))
-    relations.add((
-        DEB_NAME_PROVIDES,
-        "%s = %s" % (version.package.name, version.version)))
-    relations.update(parse_record_field(
-        version.record, "Pre-Depends", DEB_REQUIRES, DEB_OR_REQUIRES))
-    relations.update(parse_record_field(
-        version.record, "Depends", DEB_REQUIRES, DEB_OR_REQUIRES))
-
-    relations.add((
-        DEB_UPGRADES, "%s < %s" % (version.package.name, version.version)))
-
-    relations.update(parse_record_field(
-        version.record, "Conflicts", DEB_CONFLICTS))
-    relations.update(parse_record_field(
-        version.record, "Breaks", DEB_CONFLICTS))
-    skeleton.relations = sorted(relations)
+    skeleton.relations = get_record_relations(
+        version.package.name, version.version, version.record)
 
     if with_info:
         skeleton.section = version.section
@@ -1,5 +1,8 @@
 """Provide access to the persistent data used by L{PackageTaskHandler}s."""
+from array import array
+from bisect import bisect_left
 import time
+import zlib
 
 try:
     import sqlite3
@@ -9,9 +12,21 @@ except ImportError:
 from twisted.python.compat import iteritems, long
 
 from landscape.lib import bpickle
+from landscape.lib.sequenceranges import (
+    bitmap_to_bytes, bitmap_to_sequence, bytes_to_bitmap, sequence_to_bitmap)
 from landscape.lib.store import with_cursor
 
 
+# The number of hashes looked up by a single query, which must stay below the
+# maximum number of parameters of a SQLite statement (999 by default).
+HASH_LOOKUP_BATCH_SIZE = 500
+
+# The states of the packages known by a PackageStore, each stored as the
+# bitmap of the ids of the packages in that state.
+PACKAGE_STATES = ("available", "available_upgrade", "autoremovable",
+                  "security", "installed", "locked")
+
+
 class UnknownHashIDRequest(Exception):
     """Raised for unknown hash id requests."""
 
@@ -42,9 +57,10 @@ class HashIdStore(object):
 
         @param hash_ids: a C{dict} of hash=>id mappings.
         """
-        for hash, id in iteritems(hash_ids):
-            cursor.execute("REPLACE INTO hash VALUES (?, ?)",
-                           (id, sqlite3.Binary(hash)))
+        rows = [(id, sqlite3.Binary(hash))
+                for hash, id in iteritems(hash_ids)]
+        if rows:
+            cursor.executemany("REPLACE INTO hash VALUES (?, ?)", rows)
 
     @with_cursor
     def get_hash_id(self, cursor, hash):
@@ -65,6 +81,27 @@ class HashIdStore(object):
         cursor.execute("SELECT hash, id FROM hash")
         return {bytes(row[0]): row[1] for row in cursor.fetchall()}
 
+    @with_cursor
+    def lookup_hash_ids(self, cursor, hashes):
+        """Return a C{dict} mapping the given hashes to their ids.
+
+        The hashes are looked up in batches, in a single transaction.
+        Hashes without an id are left out of the result.
+
+        @param hashes: An iterable of C{bytes} representing hashes.
+        """
+        hashes = list(hashes)
+        hash_ids = {}
+        for start in range(0, len(hashes), HASH_LOOKUP_BATCH_SIZE):
+            batch = hashes[start:start + HASH_LOOKUP_BATCH_SIZE]
+            cursor.execute(
+                "SELECT hash, id FROM hash WHERE hash IN (%s)"
+                % ",".join("?" * len(batch)),
+                [sqlite3.Binary(hash) for hash in batch])
+            hash_ids.update((bytes(row[0]), row[1])
+                            for row in cursor.fetchall())
+        return hash_ids
+
     @with_cursor
     def get_id_hash(self, cursor, id):
         """Return the hash associated to C{id}, or C{None} if not available."""
@@ -75,6 +112,12 @@ class HashIdStore(object):
             return bytes(value[0])
         return None
 
+    @with_cursor
+    def get_sorted_hash_ids(self, cursor):
+        """Return a C{list} of all the C{(hash, id)} pairs, sorted by hash."""
+        cursor.execute("SELECT hash, id FROM hash ORDER BY hash")
+        return [(bytes(row[0]), row[1]) for row in cursor.fetchall()]
+
     @with_cursor
     def clear_hash_ids(self, cursor):
         """Delete all hash=>id mappings."""
@@ -94,6 +137,51 @@ class HashIdStore(object):
             raise InvalidHashIdDb(self._filename)
 
 
+class HashIdIndex(object):
+    """A read-only, in-memory copy of the hash=>id mappings of a store.
+
+    The hashes are kept in a sorted list and the ids in an array of machine
+    integers, which is searched with a binary search. It takes about half
+    the memory of a C{dict}, most of it being the hashes themselves, see
+    C{benchmarks/package_changes.py}.
+
+    It has the same lookup methods as L{HashIdStore}, so it can be used in
+    place of the store it copies. Looking up hashes by id isn't common and
+    is passed on to the store.
+
+    @param store: The L{HashIdStore} to copy.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._hashes = []
+        self._ids = array("l")
+        for hash, id in store.get_sorted_hash_ids():
+            self._hashes.append(hash)
+            self._ids.append(id)
+
+    def get_hash_id(self, hash):
+        """Return the id associated to C{hash}, or C{None} if not available.
+        """
+        index = bisect_left(self._hashes, hash)
+        if index < len(self._hashes) and self._hashes[index] == hash:
+            return self._ids[index]
+        return None
+
+    def lookup_hash_ids(self, hashes):
+        """Return a C{dict} mapping the given hashes to their ids."""
+        hash_ids = {}
+        for hash in hashes:
+            id = self.get_hash_id(hash)
+            if id is not None:
+                hash_ids[hash] = id
+        return hash_ids
+
+    def get_id_hash(self, id):
+        """Return the hash associated to C{id}, or C{None} if not available."""
+        return self._store.get_id_hash(id)
+
+
 class PackageStore(HashIdStore):
     """Persist data about system packages and L{PackageTaskHandler}'s tasks.
 
@@ -104,17 +192,27 @@ class PackageStore(HashIdStore):
     The additional tables and schemas are defined in L{ensure_package_schema}.
 
     @param filename: The file where data is persisted to.
+    @param wal: Whether to switch the database to write-ahead logging, so
+        that the processes reading it don't block the ones writing to it.
+        The database stays in that mode once switched.
     """
 
-    def __init__(self, filename):
+    def __init__(self, filename, wal=False):
         super(PackageStore, self).__init__(filename)
         self._hash_id_stores = []
+        self._wal = wal
 
     def _ensure_schema(self):
+        if self._wal:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # With write-ahead logging, syncing only at checkpoints can't
+            # corrupt the database, it can only lose the last transactions
+            # on power loss, which the next run reports again.
+            self._db.execute("PRAGMA synchronous=NORMAL")
         super(PackageStore, self)._ensure_schema()
         ensure_package_schema(self._db)
 
-    def add_hash_id_db(self, filename):
+    def add_hash_id_db(self, filename, in_memory=False):
         """
         Attach an additional "lookaside" hash=>id database.
 
@@ -128,6 +226,9 @@ class PackageStore(HashIdStore):
 
         @param filename: a secondary SQLite databases to look for pre-canned
                          hash=>id mappings.
+        @param in_memory: Whether to load the mappings in a L{HashIdIndex},
+            rather than querying the database for each lookup. The database
+            must not change while attached.
         """
         hash_id_store = HashIdStore(filename)
 
@@ -137,6 +238,8 @@ class PackageStore(HashIdStore):
             # propagate the error
             raise e
 
+        if in_memory:
+            hash_id_store = HashIdIndex(hash_id_store)
         self._hash_id_stores.append(hash_id_store)
 
     def has_hash_id_db(self):
@@ -161,6 +264,28 @@ class PackageStore(HashIdStore):
         # Fall back to the locally-populated db
         return HashIdStore.get_hash_id(self, hash)
 
+    def lookup_hash_ids(self, hashes):
+        """Return a C{dict} mapping the given hashes to their ids.
+
+        This is the bulk version of L{get_hash_id}: it gives the same ids,
+        but with a single query per batch of hashes and database. Hashes
+        without an id are left out of the result.
+
+        @param hashes: An iterable of C{bytes} representing hashes.
+        """
+        remaining = set(hashes)
+        hash_ids = {}
+        for store in self._hash_id_stores:
+            if not remaining:
+                break
+            found = dict((hash, id) for hash, id
+                         in iteritems(store.lookup_hash_ids(remaining)) if id)
+            hash_ids.update(found)
+            remaining.difference_update(found)
+        if remaining:
+            hash_ids.update(HashIdStore.lookup_hash_ids(self, remaining))
+        return hash_ids
+
     def get_id_hash(self, id):
         """Return the hash associated to C{id}, or C{None} if not available.
 
@@ -174,123 +299,152 @@ class PackageStore(HashIdStore):
                 return hash
         return HashIdStore.get_id_hash(self, id)
 
+    @with_cursor
+    def get_package_states(self, cursor):
+        """Return a C{dict} mapping each of L{PACKAGE_STATES} to a bitmap.
+
+        The bits set in a bitmap are the ids of the packages in that state,
+        see L{sequence_to_bitmap}.
+        """
+        return dict((state, self._get_package_state(cursor, state))
+                    for state in PACKAGE_STATES)
+
+    @with_cursor
+    def set_package_states(self, cursor, bitmaps):
+        """Replace the ids of the packages in the given states.
+
+        @param bitmaps: A C{dict} mapping some of L{PACKAGE_STATES} to the
+            bitmaps of the ids of the packages now in them.
+        """
+        for state, bitmap in iteritems(bitmaps):
+            self._set_package_state(cursor, state, bitmap)
+
+    def _get_package_state(self, cursor, state):
+        cursor.execute("SELECT bitmap FROM package_state WHERE state=?",
+                       (state,))
+        row = cursor.fetchone()
+        if row is None:
+            return 0
+        return decode_bitmap(row[0])
+
+    def _set_package_state(self, cursor, state, bitmap):
+        cursor.execute("REPLACE INTO package_state VALUES (?, ?)",
+                       (state, encode_bitmap(bitmap)))
+
+    def _add_to_package_state(self, cursor, state, ids):
+        bitmap = self._get_package_state(cursor, state)
+        self._set_package_state(
+            cursor, state, bitmap | sequence_to_bitmap(ids))
+
+    def _remove_from_package_state(self, cursor, state, ids):
+        bitmap = self._get_package_state(cursor, state)
+        self._set_package_state(
+            cursor, state, bitmap & ~sequence_to_bitmap(ids))
+
     @with_cursor
     def add_available(self, cursor, ids):
-        for id in ids:
-            cursor.execute("REPLACE INTO available VALUES (?)", (id,))
+        self._add_to_package_state(cursor, "available", ids)
 
     @with_cursor
     def remove_available(self, cursor, ids):
-        id_list = ",".join(str(int(id)) for id in ids)
-        cursor.execute("DELETE FROM available WHERE id IN (%s)" % id_list)
+        self._remove_from_package_state(cursor, "available", ids)
 
     @with_cursor
     def clear_available(self, cursor):
-        cursor.execute("DELETE FROM available")
+        self._set_package_state(cursor, "available", 0)
 
     @with_cursor
     def get_available(self, cursor):
-        cursor.execute("SELECT id FROM available")
-        return [row[0] for row in cursor.fetchall()]
+        return list(bitmap_to_sequence(
+            self._get_package_state(cursor, "available")))
 
     @with_cursor
     def add_available_upgrades(self, cursor, ids):
-        for id in ids:
-            cursor.execute("REPLACE INTO available_upgrade VALUES (?)", (id,))
+        self._add_to_package_state(cursor, "available_upgrade", ids)
 
     @with_cursor
     def remove_available_upgrades(self, cursor, ids):
-        id_list = ",".join(str(int(id)) for id in ids)
-        cursor.execute("DELETE FROM available_upgrade WHERE id IN (%s)"
-                       % id_list)
+        self._remove_from_package_state(cursor, "available_upgrade", ids)
 
     @with_cursor
     def clear_available_upgrades(self, cursor):
-        cursor.execute("DELETE FROM available_upgrade")
+        self._set_package_state(cursor, "available_upgrade", 0)
 
     @with_cursor
     def get_available_upgrades(self, cursor):
-        cursor.execute("SELECT id FROM available_upgrade")
-        return [row[0] for row in cursor.fetchall()]
+        return list(bitmap_to_sequence(
+            self._get_package_state(cursor, "available_upgrade")))
 
     @with_cursor
     def add_autoremovable(self, cursor, ids):
-        for id in ids:
-            cursor.execute("REPLACE INTO autoremovable VALUES (?)", (id,))
+        self._add_to_package_state(cursor, "autoremovable", ids)
 
     @with_cursor
     def remove_autoremovable(self, cursor, ids):
-        id_list = ",".join(str(int(id)) for id in ids)
-        cursor.execute("DELETE FROM autoremovable WHERE id IN (%s)" % id_list)
+        self._remove_from_package_state(cursor, "autoremovable", ids)
 
     @with_cursor
     def clear_autoremovable(self, cursor):
-        cursor.execute("DELETE FROM autoremovable")
+        self._set_package_state(cursor, "autoremovable", 0)
 
     @with_cursor
     def get_autoremovable(self, cursor):
-        cursor.execute("SELECT id FROM autoremovable")
-        return [row[0] for row in cursor.fetchall()]
+        return list(bitmap_to_sequence(
+            self._get_package_state(cursor, "autoremovable")))
 
     @with_cursor
     def add_security(self, cursor, ids):
-        for id in ids:
-            cursor.execute("REPLACE INTO security VALUES (?)", (id,))
+        self._add_to_package_state(cursor, "security", ids)
 
     @with_cursor
     def remove_security(self, cursor, ids):
-        id_list = ",".join(str(int(id)) for id in ids)
-        cursor.execute("DELETE FROM security WHERE id IN (%s)" % id_list)
+        self._remove_from_package_state(cursor, "security", ids)
 
     @with_cursor
     def clear_security(self, cursor):
-        cursor.execute("DELETE FROM security")
+        self._set_package_state(cursor, "security", 0)
 
     @with_cursor
     def get_security(self, cursor):
-        cursor.execute("SELECT id FROM security")
-        return [row[0] for row in cursor.fetchall()]
+        return list(bitmap_to_sequence(
+            self._get_package_state(cursor, "security")))
 
     @with_cursor
     def add_installed(self, cursor, ids):
-        for id in ids:
-            cursor.execute("REPLACE INTO installed VALUES (?)", (id,))
+        self._add_to_package_state(cursor, "installed", ids)
 
     @with_cursor
     def remove_installed(self, cursor, ids):
-        id_list = ",".join(str(int(id)) for id in ids)
-        cursor.execute("DELETE FROM installed WHERE id IN (%s)" % id_list)
+        self._remove_from_package_state(cursor, "installed", ids)
 
     @with_cursor
     def clear_installed(self, cursor):
-        cursor.execute("DELETE FROM installed")
+        self._set_package_state(cursor, "installed", 0)
 
     @with_cursor
     def get_installed(self, cursor):
-        cursor.execute("SELECT id FROM installed")
-        return [row[0] for row in cursor.fetchall()]
-
-    @with_cursor
-    def get_locked(self, cursor):
-        """Get the package ids of all locked packages."""
-        cursor.execute("SELECT id FROM locked")
-        return [row[0] for row in cursor.fetchall()]
+        return list(bitmap_to_sequence(
+            self._get_package_state(cursor, "installed")))
 
     @with_cursor
     def add_locked(self, cursor, ids):
         """Add the given package ids to the list of locked packages."""
-        for id in ids:
-            cursor.execute("REPLACE INTO locked VALUES (?)", (id,))
+        self._add_to_package_state(cursor, "locked", ids)
 
     @with_cursor
     def remove_locked(self, cursor, ids):
-        id_list = ",".join(str(int(id)) for id in ids)
-        cursor.execute("DELETE FROM locked WHERE id IN (%s)" % id_list)
+        self._remove_from_package_state(cursor, "locked", ids)
 
     @with_cursor
     def clear_locked(self, cursor):
-        """Remove all the package ids in the locked table."""
-        cursor.execute("DELETE FROM locked")
+        """Remove all the package ids in the locked state."""
+        self._set_package_state(cursor, "locked", 0)
+
+    @with_cursor
+    def get_locked(self, cursor):
+        """Get the package ids of all locked packages."""
+        return list(bitmap_to_sequence(
+            self._get_package_state(cursor, "locked")))
 
     @with_cursor
     def add_hash_id_request(self, cursor, hashes):
@@ -469,18 +623,6 @@ def ensure_package_schema(db):
     #       try block.
     cursor = db.cursor()
     try:
-        cursor.execute("CREATE TABLE security"
-                       " (id INTEGER PRIMARY KEY)")
-        cursor.execute("CREATE TABLE autoremovable"
-                       " (id INTEGER PRIMARY KEY)")
-        cursor.execute("CREATE TABLE locked"
-                       " (id INTEGER PRIMARY KEY)")
-        cursor.execute("CREATE TABLE available"
-                       " (id INTEGER PRIMARY KEY)")
-        cursor.execute("CREATE TABLE available_upgrade"
-                       " (id INTEGER PRIMARY KEY)")
-        cursor.execute("CREATE TABLE installed"
-                       " (id INTEGER PRIMARY KEY)")
         cursor.execute("CREATE TABLE hash_id_request"
                        " (id INTEGER PRIMARY KEY, timestamp TIMESTAMP,"
                        " message_id INTEGER, hashes BLOB)")
@@ -493,6 +635,74 @@ def ensure_package_schema(db):
     else:
         cursor.close()
         db.commit()
+    ensure_package_state_schema(db)
+
+
+def ensure_package_state_schema(db):
+    """Create the table holding the package states of a L{PackageStore}.
+
+    The states used to be stored in a table each, with a row per package
+    id. The ids in those tables are moved to the new one, and the old
+    tables dropped, in the same transaction.
+
+    @param db: A connection to a SQLite database.
+    """
+    cursor = db.cursor()
+    # Avoid waiting for the write lock if there's nothing to do.
+    cursor.execute("SELECT 1 FROM sqlite_master"
+                   " WHERE type='table' AND name='package_state'")
+    if cursor.fetchone():
+        cursor.close()
+        return
+    # Manage the transaction by hand, since the sqlite3 module of Python 2
+    # implicitly commits before each CREATE and DROP statement.
+    isolation_level = db.isolation_level
+    db.isolation_level = None
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("CREATE TABLE package_state"
+                           " (state TEXT PRIMARY KEY, bitmap BLOB)")
+            for state in PACKAGE_STATES:
+                try:
+                    cursor.execute("SELECT id FROM %s" % state)
+                except sqlite3.OperationalError:
+                    # A new database, or one older than the state.
+                    continue
+                bitmap = sequence_to_bitmap(
+                    row[0] for row in cursor.fetchall())
+                cursor.execute("INSERT INTO package_state VALUES (?, ?)",
+                               (state, encode_bitmap(bitmap)))
+                cursor.execute("DROP TABLE %s" % state)
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+    except sqlite3.OperationalError:
+        # Fine if the table got created by another connection in the
+        # meantime, but not if creating it failed.
+        cursor.execute("SELECT 1 FROM sqlite_master"
+                       " WHERE type='table' AND name='package_state'")
+        if not cursor.fetchone():
+            raise
+    finally:
+        cursor.close()
+        db.isolation_level = isolation_level
+
+
+def encode_bitmap(bitmap):
+    """Return the given bitmap compressed, to be stored in a BLOB column.
+
+    Package ids are allocated by the server for all the packages it knows
+    about, so the bitmaps of a single computer have long runs of zeros,
+    which compress well.
+    """
+    return sqlite3.Binary(zlib.compress(bitmap_to_bytes(bitmap), 1))
+
+
+def decode_bitmap(data):
+    """Return the bitmap encoded by L{encode_bitmap}."""
+    return bytes_to_bitmap(zlib.decompress(bytes(data)))
 
 
 def ensure_fake_package_schema(db):
@@ -784,6 +784,122 @@ class AptFacadeTest(testing.HelperTestCase, testing.FSTestCase,
         hashes = self.facade.get_package_hashes()
         self.assertEqual(sorted(hashes), sorted([HASH1, HASH2, HASH3]))
 
+    def test_get_package_hashes_with_hash_cache(self):
+        """
+        If C{hash_cache_filename} is set, the hashes computed when
+        reloading the channels are saved to it, and reused by the next
+        reloads instead of being computed again.
+        """
+        deb_dir = self.makeDir()
+        create_simple_repository(deb_dir)
+        self.facade.add_channel_deb_dir(deb_dir)
+        self.facade.hash_cache_filename = self.makeFile()
+        self.facade.reload_channels()
+        self.assertEqual(sorted(self.facade.get_package_hashes()),
+                         sorted([HASH1, HASH2, HASH3]))
+
+        new_facade = AptFacade(root=self.apt_root)
+        new_facade.hash_cache_filename = self.facade.hash_cache_filename
+        record = mock.PropertyMock()
+        with mock.patch.object(new_facade, "_get_package_hash") as get_hash, \
+                mock.patch("apt.package.Version.record", record):
+            new_facade.reload_channels()
+        self.assertEqual(0, get_hash.call_count)
+        # The package records aren't read either.
+        self.assertEqual(0, record.call_count)
+        self.assertEqual(sorted(new_facade.get_package_hashes()),
+                         sorted([HASH1, HASH2, HASH3]))
+
+    def test_get_package_hashes_with_hash_cache_changed_index(self):
+        """
+        The hashes cached for the packages of an index file are computed
+        again when the file changes, even if the packages keep the same
+        names and versions.
+        """
+        deb_dir = self.makeDir()
+        self._add_package_to_deb_dir(
+            deb_dir, "foo", control_fields={"Depends": "bar"})
+        self.facade.add_channel_apt_deb(
+            "file://%s" % deb_dir, "./", trusted=True)
+        self.facade.hash_cache_filename = self.makeFile()
+        self.facade.reload_channels()
+        [version] = self.facade.get_packages_by_name("foo")
+        old_hash = self.facade.get_package_hash(version)
+
+        os.unlink(os.path.join(deb_dir, "Packages"))
+        self._add_package_to_deb_dir(
+            deb_dir, "foo", control_fields={"Depends": "baz"})
+        self._touch_packages_file(deb_dir)
+        new_facade = AptFacade(root=self.apt_root)
+        new_facade.hash_cache_filename = self.facade.hash_cache_filename
+        new_facade.refetch_package_index = True
+        new_facade.reload_channels()
+        [version] = new_facade.get_packages_by_name("foo")
+        new_hash = new_facade.get_package_hash(version)
+        self.assertNotEqual(old_hash, new_hash)
+        self.assertEqual(
+            new_facade.get_package_skeleton(version, False).get_hash(),
+            new_hash)
+
+    def test_get_package_hashes_with_hash_workers(self):
+        """
+        If C{hash_workers} is set, the hashes are computed in that many
+        processes, and are the same as the ones computed serially.
+        """
+        deb_dir = self.makeDir()
+        create_simple_repository(deb_dir)
+        self.facade.add_channel_deb_dir(deb_dir)
+        for index in range(20):
+            self._add_package_to_deb_dir(
+                deb_dir, "name%d" % index, version="1.%d" % index,
+                control_fields={"Depends": "name1 (>= 1.0) | name2, name3",
+                                "Breaks": "name%d (<< 1.0)" % index})
+        self.facade.reload_channels()
+        serial_hashes = sorted(self.facade.get_package_hashes())
+
+        new_facade = AptFacade(root=self.apt_root)
+        new_facade.hash_workers = 2
+        new_facade.reload_channels()
+        self.assertEqual(23, len(serial_hashes))
+        self.assertEqual(serial_hashes,
+                         sorted(new_facade.get_package_hashes()))
+        for version in new_facade.get_packages():
+            self.assertEqual(
+                new_facade.get_package_skeleton(version, False).get_hash(),
+                new_facade.get_package_hash(version))
+
+    def test_get_package_hashes_with_hash_cache_and_workers(self):
+        """
+        If both C{hash_cache_filename} and C{hash_workers} are set, the
+        record of each package missing from the cache is read only once.
+        """
+        deb_dir = self.makeDir()
+        create_simple_repository(deb_dir)
+        self.facade.add_channel_deb_dir(deb_dir)
+        for index in range(20):
+            self._add_package_to_deb_dir(
+                deb_dir, "name%d" % index, version="1.%d" % index,
+                control_fields={"Depends": "name1 (>= 1.0) | name2, name3"})
+        self.facade.reload_channels()
+        serial_hashes = sorted(self.facade.get_package_hashes())
+
+        reads = []
+        get_record = apt.package.Version.record.fget
+
+        def record(version):
+            reads.append((version.package.name, version.version))
+            return get_record(version)
+
+        new_facade = AptFacade(root=self.apt_root)
+        new_facade.hash_cache_filename = self.makeFile()
+        new_facade.hash_workers = 2
+        with mock.patch("apt.package.Version.record", property(record)):
+            new_facade.reload_channels()
+        self.assertEqual(23, len(reads))
+        self.assertEqual(len(reads), len(set(reads)))
+        self.assertEqual(serial_hashes,
+                         sorted(new_facade.get_package_hashes()))
+
     def test_get_package_by_hash(self):
         """
         C{get_package_by_hash} returns the package that has the given hash.
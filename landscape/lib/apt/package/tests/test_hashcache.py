@@ -0,0 +1,202 @@
+import os
+import unittest
+
+import mock
+
+from landscape.lib import testing
+from landscape.lib.apt.package.hashcache import (
+    HASH_CACHE_HEADER, PackageHashCache, get_hash_cache_key,
+    get_record_location)
+
+
+class GetHashCacheKeyTest(unittest.TestCase):
+
+    def test_key(self):
+        """
+        The key holds the name, version and architecture of the package,
+        followed by the fingerprint of the location of its record.
+        """
+        key = get_hash_cache_key("name1", "version1", "all", "Packages 1 2 3")
+        name, version, architecture, fingerprint = key.split(" ")
+        self.assertEqual(("name1", "version1", "all"),
+                         (name, version, architecture))
+        self.assertEqual(32, len(fingerprint))
+
+    def test_key_changes_with_location(self):
+        """
+        Moving the record of a package changes its key, even if it keeps
+        the same name and version.
+        """
+        self.assertNotEqual(
+            get_hash_cache_key("name1", "version1", "all", "Packages 1 2 3"),
+            get_hash_cache_key("name1", "version1", "all", "Packages 1 2 4"))
+
+
+class GetRecordLocationTest(testing.FSTestCase, unittest.TestCase):
+
+    def test_location(self):
+        """
+        The location holds the name, size and modification time of the
+        index file, and the offset of the record in it.
+        """
+        filename = self.makeFile("Package: name1\n")
+        os.utime(filename, (1000, 1000))
+        self.assertEqual("%s 15 1000.0 3" % filename,
+                         get_record_location(filename, 3, {}))
+
+    def test_location_changes_with_file(self):
+        """
+        Changing the index file changes the location of its records.
+        """
+        filename = self.makeFile("Package: name1\n")
+        location = get_record_location(filename, 0, {})
+        os.utime(filename, (1000, 1000))
+        self.assertNotEqual(location, get_record_location(filename, 0, {}))
+
+    def test_location_missing_file(self):
+        """
+        No location is returned for records in files which don't exist.
+        """
+        self.assertIs(
+            None, get_record_location(self.makeFile(), 0, {}))
+
+    def test_file_stamps(self):
+        """
+        The size and modification time of each file are looked up once.
+        """
+        filename = self.makeFile("Package: name1\n")
+        file_stamps = {}
+        with mock.patch("os.stat", wraps=os.stat) as stat:
+            location1 = get_record_location(filename, 0, file_stamps)
+            location2 = get_record_location(filename, 10, file_stamps)
+        self.assertEqual(1, stat.call_count)
+        self.assertEqual(location1[:-1] + "10", location2)
+
+
+class PackageHashCacheTest(testing.FSTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(PackageHashCacheTest, self).setUp()
+        self.filename = self.makeFile()
+        self.cache = PackageHashCache(self.filename)
+        self.cache.load()
+
+    def test_get_computes_missing_hashes(self):
+        """
+        L{PackageHashCache.get} computes the hashes it doesn't know about,
+        and counts the misses.
+        """
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return b"\x00hash1"
+
+        self.assertEqual(b"\x00hash1", self.cache.get("key1", compute))
+        self.assertEqual([True], computed)
+        self.assertEqual((0, 1), (self.cache.hits, self.cache.misses))
+
+    def test_get_without_compute(self):
+        """
+        If no function is passed to compute them, L{PackageHashCache.get}
+        returns C{None} for missing hashes, which can be added with
+        L{PackageHashCache.set}.
+        """
+        self.assertIs(None, self.cache.get("key1"))
+        self.cache.set("key1", b"hash1")
+        self.cache.save()
+
+        cache = PackageHashCache(self.filename)
+        cache.load()
+        self.assertEqual(b"hash1", cache.get("key1"))
+
+    def test_save_and_load(self):
+        """
+        Hashes saved by a cache are found by the caches loading the same
+        file afterwards, without being computed again.
+        """
+        self.cache.get("key1", lambda: b"\x00hash1")
+        self.cache.get("key2", lambda: b"hash2\n")
+        self.cache.save()
+
+        cache = PackageHashCache(self.filename)
+        cache.load()
+        self.assertEqual(b"\x00hash1", cache.get("key1", None))
+        self.assertEqual(b"hash2\n", cache.get("key2", None))
+        self.assertEqual((2, 0), (cache.hits, cache.misses))
+
+    def test_save_drops_unused_hashes(self):
+        """
+        Hashes which weren't looked up since the last save aren't saved
+        again, since their packages aren't available anymore.
+        """
+        self.cache.get("key1", lambda: b"hash1")
+        self.cache.get("key2", lambda: b"hash2")
+        self.cache.save()
+        self.cache.get("key1", None)
+        self.cache.save()
+
+        cache = PackageHashCache(self.filename)
+        cache.load()
+        self.assertEqual(b"hash1", cache.get("key1", None))
+        self.assertEqual(b"hash3", cache.get("key2", lambda: b"hash3"))
+
+    def test_save_resets_counters(self):
+        """
+        The hits and misses are counted from the last save.
+        """
+        self.cache.get("key1", lambda: b"hash1")
+        self.cache.save()
+        self.assertEqual((0, 0), (self.cache.hits, self.cache.misses))
+
+    def test_save_without_changes(self):
+        """
+        The cache file isn't written again if its content didn't change.
+        """
+        self.cache.get("key1", lambda: b"hash1")
+        self.cache.save()
+        os.utime(self.filename, (0, 0))
+        self.cache.get("key1", None)
+        self.cache.save()
+        self.assertEqual(0, os.stat(self.filename).st_mtime)
+
+    def test_load_corrupted_file(self):
+        """
+        A corrupted cache file is ignored with a warning, and the hashes
+        are computed again.
+        """
+        self.makeFile(HASH_CACHE_HEADER + "key1 not-hex\n",
+                      path=self.filename)
+        cache = PackageHashCache(self.filename)
+        with mock.patch("logging.warning") as warning:
+            cache.load()
+        warning.assert_called_once_with(
+            "Ignoring corrupted package hash cache %s: %s", self.filename,
+            mock.ANY)
+        self.assertEqual(b"hash1", cache.get("key1", lambda: b"hash1"))
+        self.assertEqual(1, cache.misses)
+
+    def test_load_other_version(self):
+        """
+        A cache file written by another version of the cache, possibly
+        hashing packages differently, is discarded.
+        """
+        self.makeFile("landscape-package-hash-cache 0\nkey1 00\n",
+                      path=self.filename)
+        cache = PackageHashCache(self.filename)
+        with mock.patch("logging.info") as info:
+            cache.load()
+        info.assert_called_once_with(
+            "Discarding package hash cache %s written by another version.",
+            self.filename)
+        self.assertEqual(b"hash1", cache.get("key1", lambda: b"hash1"))
+        self.assertEqual(1, cache.misses)
+
+    def test_save_writes_header(self):
+        """
+        The version of the cache is written on the first line of its file.
+        """
+        self.cache.get("key1", lambda: b"hash1")
+        self.cache.save()
+        with open(self.filename) as cache_file:
+            self.assertEqual(HASH_CACHE_HEADER, cache_file.readline())
@@ -10,9 +10,9 @@ from landscape.lib.apt.package.testing import (
     HASH_MULTIPLE_RELATIONS, PKGNAME_OR_RELATIONS, PKGDEB_OR_RELATIONS,
     HASH_OR_RELATIONS)
 from landscape.lib.apt.package.skeleton import (
-    build_skeleton_apt, DEB_PROVIDES, DEB_PACKAGE,
-    DEB_NAME_PROVIDES, DEB_REQUIRES, DEB_OR_REQUIRES, DEB_UPGRADES,
-    DEB_CONFLICTS, PackageSkeleton)
+    build_skeleton_apt, get_record_hash, get_record_hashes, DEB_PROVIDES,
+    DEB_PACKAGE, DEB_NAME_PROVIDES, DEB_REQUIRES, DEB_OR_REQUIRES,
+    DEB_UPGRADES, DEB_CONFLICTS, PackageSkeleton)
 
 from twisted.python.compat import unicode
 
@@ -276,6 +276,36 @@ class SkeletonAptTest(BaseTestCase):
         self.assertEqual(relations, skeleton.relations)
         self.assertEqual(HASH_OR_RELATIONS, skeleton.get_hash())
 
+    def test_get_record_hash(self):
+        """
+        L{get_record_hash} computes the same hash as the skeleton built by
+        L{build_skeleton_apt}, from the fields of the package record only.
+        """
+        for name in ["name1", "name2", "name3", "minimal", "simple-relations",
+                     "version-relations", "multiple-relations",
+                     "or-relations"]:
+            version = self.get_package(name)
+            self.assertEqual(
+                build_skeleton_apt(version).get_hash(),
+                get_record_hash(name, version.version, version.record))
+
+    def test_get_record_hashes(self):
+        """
+        L{get_record_hashes} computes the same hashes as L{get_record_hash}
+        in many processes, keeping the order of the records.
+        """
+        records = []
+        for name in ["name1", "name2", "name3", "minimal", "simple-relations",
+                     "version-relations", "multiple-relations",
+                     "or-relations"]:
+            version = self.get_package(name)
+            record = dict((field, version.record[field])
+                          for field in version.record)
+            records.append((name, version.version, record))
+        self.assertEqual(
+            [get_record_hash(*record) for record in records],
+            get_record_hashes(records, 3))
+
 
 class SkeletonTest(BaseTestCase):
 
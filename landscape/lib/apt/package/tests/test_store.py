@@ -5,8 +5,10 @@ import time
 import unittest
 
 from landscape.lib import testing
+from landscape.lib.store import transaction
 from landscape.lib.apt.package.store import (
-        HashIdStore, PackageStore, UnknownHashIDRequest, InvalidHashIdDb)
+        HashIdStore, HashIdIndex, PackageStore, UnknownHashIDRequest,
+        InvalidHashIdDb, ensure_package_state_schema)
 
 
 class BaseTestCase(testing.FSTestCase, unittest.TestCase):
@@ -27,6 +29,36 @@ class HashIdStoreTest(BaseTestCase):
         self.assertEqual(self.store1.get_hash_id(b"ha\x00sh1"), 123)
         self.assertEqual(self.store1.get_hash_id(b"ha\x00sh2"), 456)
 
+    def test_lookup_hash_ids(self):
+        """
+        L{HashIdStore.lookup_hash_ids} returns the ids of the given hashes,
+        leaving out the unknown ones.
+        """
+        self.store1.set_hash_ids({b"ha\x00sh1": 123, b"ha\x00sh2": 456})
+        self.assertEqual({b"ha\x00sh1": 123},
+                         self.store2.lookup_hash_ids([b"ha\x00sh1", b"sh3"]))
+
+    def test_lookup_hash_ids_in_batches(self):
+        """
+        L{HashIdStore.lookup_hash_ids} can look up more hashes than a single
+        SQLite statement can have parameters.
+        """
+        hash_ids = dict((("hash%d" % i).encode("ascii"), i)
+                        for i in range(2500))
+        self.store1.set_hash_ids(hash_ids)
+        self.assertEqual(hash_ids,
+                         self.store2.lookup_hash_ids(list(hash_ids)))
+
+    def test_get_sorted_hash_ids(self):
+        """
+        L{HashIdStore.get_sorted_hash_ids} returns all the hash=>id mappings
+        as pairs, sorted by hash.
+        """
+        self.store1.set_hash_ids({b"hash2": 2, b"ha\x00sh3": 3, b"hash1": 1})
+        self.assertEqual(
+            [(b"ha\x00sh3", 3), (b"hash1", 1), (b"hash2", 2)],
+            self.store2.get_sorted_hash_ids())
+
     def test_get_hash_ids(self):
         hash_ids = {b"hash1": 123, b"hash2": 456}
         self.store1.set_hash_ids(hash_ids)
@@ -205,6 +237,65 @@ class PackageStoreTest(BaseTestCase):
         self.assertEqual(self.store1.get_hash_id(b"hash2"), 3)
         self.assertEqual(self.store1.get_hash_id(b"ha\x00sh1"), 5)
 
+    def test_lookup_hash_ids_using_hash_id_dbs(self):
+        """
+        L{PackageStore.lookup_hash_ids} gives the same ids as
+        L{PackageStore.get_hash_id}, looking up the lookaside databases
+        before the main one.
+        """
+        self.store1.set_hash_ids({b"hash1": 1, b"hash4": 6})
+        self.store1.add_hash_id_db(self.hash_id_db_factory({b"hash1": 2,
+                                                            b"hash2": 3}))
+        self.store1.add_hash_id_db(self.hash_id_db_factory({b"hash2": 4,
+                                                            b"ha\x00sh1": 5}))
+        hashes = [b"hash1", b"hash2", b"ha\x00sh1", b"hash4", b"hash5"]
+        self.assertEqual({b"hash1": 2, b"hash2": 3, b"ha\x00sh1": 5,
+                          b"hash4": 6},
+                         self.store1.lookup_hash_ids(hashes))
+        for hash in hashes:
+            self.assertEqual(self.store1.get_hash_id(hash),
+                             self.store1.lookup_hash_ids([hash]).get(hash))
+
+    def test_in_memory_hash_id_db(self):
+        """
+        Lookaside databases can be loaded in memory, giving the same results
+        as when they're queried.
+        """
+        self.store1.set_hash_ids({b"hash1": 1, b"hash4": 6})
+        self.store1.add_hash_id_db(
+            self.hash_id_db_factory({b"hash1": 2, b"hash2": 3}),
+            in_memory=True)
+        self.store1.add_hash_id_db(
+            self.hash_id_db_factory({b"hash2": 4, b"ha\x00sh1": 5}),
+            in_memory=True)
+        self.assertTrue(self.store1.has_hash_id_db())
+        self.assertEqual(2, self.store1.get_hash_id(b"hash1"))
+        self.assertEqual(3, self.store1.get_hash_id(b"hash2"))
+        self.assertEqual(5, self.store1.get_hash_id(b"ha\x00sh1"))
+        self.assertEqual(6, self.store1.get_hash_id(b"hash4"))
+        self.assertIs(None, self.store1.get_hash_id(b"hash5"))
+        self.assertEqual({b"hash1": 2, b"hash2": 3, b"ha\x00sh1": 5,
+                          b"hash4": 6},
+                         self.store1.lookup_hash_ids(
+                             [b"hash1", b"hash2", b"ha\x00sh1", b"hash4",
+                              b"hash5"]))
+        self.assertEqual(b"hash2", self.store1.get_id_hash(3))
+
+    def test_hash_id_index(self):
+        """
+        A L{HashIdIndex} finds the ids of all the hashes of its store, and
+        only those.
+        """
+        hash_ids = dict((("hash%d" % i).encode("ascii"), i)
+                        for i in range(1000))
+        index = HashIdIndex(HashIdStore(self.hash_id_db_factory(hash_ids)))
+        for hash, id in hash_ids.items():
+            self.assertEqual(id, index.get_hash_id(hash))
+        self.assertIs(None, index.get_hash_id(b"hash"))
+        self.assertIs(None, index.get_hash_id(b"hash9999"))
+        self.assertIs(None, index.get_hash_id(b""))
+        self.assertEqual(hash_ids, index.lookup_hash_ids(list(hash_ids)))
+
     def test_get_id_hash_using_hash_id_db(self):
         """
         When lookaside hash->id dbs are used, L{get_id_hash} has
@@ -219,6 +310,59 @@ class PackageStoreTest(BaseTestCase):
         self.assertEqual(self.store1.get_id_hash(456), b"hash2")
         self.assertEqual(self.store1.get_id_hash(789), b"hash3")
 
+    def test_transaction(self):
+        """
+        The changes made by the methods called in a L{transaction} block are
+        committed together when the block ends.
+        """
+        with transaction(self.store1):
+            self.store1.add_available([1, 2])
+            self.store1.add_installed([3])
+            self.assertEqual([], self.store2.get_available())
+        self.assertEqual([1, 2], self.store2.get_available())
+        self.assertEqual([3], self.store2.get_installed())
+
+    def test_transaction_with_error(self):
+        """
+        If a L{transaction} block raises an exception, all its changes are
+        rolled back.
+        """
+        with self.assertRaises(ZeroDivisionError):
+            with transaction(self.store1):
+                self.store1.add_available([1, 2])
+                self.store1.add_installed([3])
+                1 / 0
+        self.assertEqual([], self.store2.get_available())
+        self.assertEqual([], self.store2.get_installed())
+        self.store1.add_available([4])
+        self.assertEqual([4], self.store2.get_available())
+
+    def test_nested_transaction(self):
+        """
+        A L{transaction} block inside another one is part of the outer
+        transaction.
+        """
+        with transaction(self.store1):
+            with transaction(self.store1):
+                self.store1.add_available([1])
+            self.assertEqual([], self.store2.get_available())
+        self.assertEqual([1], self.store2.get_available())
+
+    def test_wal(self):
+        """
+        A L{PackageStore} created with C{wal=True} switches its database to
+        write-ahead logging, which other connections keep using.
+        """
+        store = PackageStore(self.makeFile(), wal=True)
+        store.add_available([1])
+        db = sqlite3.connect(store._filename)
+        self.assertEqual(
+            "wal", db.execute("PRAGMA journal_mode").fetchone()[0])
+        self.assertEqual(
+            [("available",)],
+            db.execute("SELECT state FROM package_state").fetchall())
+        db.close()
+
     def test_add_and_get_available_packages(self):
         self.store1.add_available([1, 2])
         self.assertEqual(self.store2.get_available(), [1, 2])
@@ -355,12 +499,151 @@ class PackageStoreTest(BaseTestCase):
 
         database = sqlite3.connect(filename)
         cursor = database.cursor()
-        cursor.execute("pragma table_info(locked)")
+        cursor.execute("pragma table_info(package_state)")
         result = cursor.fetchall()
         self.assertTrue(len(result) > 0)
-        cursor.execute("pragma table_info(autoremovable)")
+        cursor.execute("pragma table_info(available)")
         result = cursor.fetchall()
-        self.assertTrue(len(result) > 0)
+        self.assertEqual([], result)
+
+    def test_ensure_package_schema_migrates_package_states(self):
+        """
+        The package ids in the tables which used to hold the package states
+        are moved to the package state bitmaps, and the tables dropped.
+        """
+        filename = self.makeFile()
+        database = sqlite3.connect(filename)
+        cursor = database.cursor()
+        for table in ["security", "autoremovable", "locked", "available",
+                      "available_upgrade", "installed"]:
+            cursor.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY)" % table)
+        cursor.executemany("INSERT INTO available VALUES (?)",
+                           [(1,), (2,), (3,), (70000,)])
+        cursor.executemany("INSERT INTO installed VALUES (?)", [(2,)])
+        cursor.executemany("INSERT INTO locked VALUES (?)", [(3,)])
+        cursor.close()
+        database.commit()
+        database.close()
+
+        store = PackageStore(filename)
+        self.assertEqual([1, 2, 3, 70000], store.get_available())
+        self.assertEqual([2], store.get_installed())
+        self.assertEqual([3], store.get_locked())
+        self.assertEqual([], store.get_security())
+
+        database = sqlite3.connect(filename)
+        cursor = database.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        self.assertEqual(
+            ["hash", "hash_id_request", "package_state", "task"],
+            sorted(row[0] for row in cursor.fetchall()))
+        database.close()
+
+    def test_ensure_package_schema_migration_interrupted(self):
+        """
+        If migrating the package states fails midway, none of the changes
+        are kept, and the migration is attempted again later.
+        """
+        filename = self.makeFile()
+        database = sqlite3.connect(filename)
+        cursor = database.cursor()
+        for table in ["security", "autoremovable", "locked", "available",
+                      "available_upgrade", "installed"]:
+            cursor.execute("CREATE TABLE %s (id INTEGER PRIMARY KEY)" % table)
+        cursor.executemany("INSERT INTO available VALUES (?)", [(1,), (2,)])
+        cursor.executemany("INSERT INTO installed VALUES (?)", [(2,)])
+        cursor.close()
+        database.commit()
+
+        encode_bitmap = "landscape.lib.apt.package.store.encode_bitmap"
+        with mock.patch(encode_bitmap, side_effect=[b"", RuntimeError()]):
+            self.assertRaises(RuntimeError,
+                              ensure_package_state_schema, database)
+        cursor = database.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        self.assertEqual(
+            ["autoremovable", "available", "available_upgrade", "installed",
+             "locked", "security"],
+            sorted(row[0] for row in cursor.fetchall()))
+        cursor.execute("SELECT id FROM available")
+        self.assertEqual([(1,), (2,)], cursor.fetchall())
+        cursor.close()
+        database.close()
+
+        store = PackageStore(filename)
+        self.assertEqual([1, 2], store.get_available())
+        self.assertEqual([2], store.get_installed())
+
+    def test_ensure_package_schema_migration_error(self):
+        """
+        Database errors raised while migrating the package states aren't
+        ignored, unless another connection created the new table.
+        """
+        filename = self.makeFile()
+        database = sqlite3.connect(filename)
+        cursor = database.cursor()
+        cursor.execute("CREATE TABLE available (id INTEGER PRIMARY KEY)")
+        cursor.executemany("INSERT INTO available VALUES (?)", [(1,), (2,)])
+        cursor.close()
+        database.commit()
+
+        encode_bitmap = "landscape.lib.apt.package.store.encode_bitmap"
+        error = sqlite3.OperationalError("disk I/O error")
+        with mock.patch(encode_bitmap, side_effect=error):
+            self.assertRaises(sqlite3.OperationalError,
+                              ensure_package_state_schema, database)
+        cursor = database.cursor()
+        cursor.execute("SELECT id FROM available")
+        self.assertEqual([(1,), (2,)], cursor.fetchall())
+        cursor.close()
+        database.close()
+
+    def test_ensure_package_schema_created_meanwhile(self):
+        """
+        If another connection creates the package state table after it was
+        found to be missing, the error creating it again is ignored.
+        """
+        filename = self.makeFile()
+
+        class RacingCursor(sqlite3.Cursor):
+
+            def execute(self, *args):
+                result = sqlite3.Cursor.execute(self, *args)
+                if "sqlite_master" in args[0] and not raced:
+                    raced.append(True)
+                    other = sqlite3.connect(filename)
+                    ensure_package_state_schema(other)
+                    other.close()
+                return result
+
+        class RacingConnection(sqlite3.Connection):
+
+            def cursor(self):
+                return sqlite3.Connection.cursor(self, RacingCursor)
+
+        raced = []
+        database = sqlite3.connect(filename, factory=RacingConnection)
+        ensure_package_state_schema(database)
+        self.assertEqual([True], raced)
+        database.close()
+
+    def test_get_and_set_package_states(self):
+        """
+        L{PackageStore.get_package_states} returns the bitmaps of the ids of
+        the packages in each state, which L{PackageStore.set_package_states}
+        replaces.
+        """
+        self.store1.add_installed([1, 3])
+        self.store1.add_locked([2])
+        self.assertEqual({"available": 0, "available_upgrade": 0,
+                          "autoremovable": 0, "security": 0,
+                          "installed": 0b1010, "locked": 0b100},
+                         self.store2.get_package_states())
+        self.store1.set_package_states({"installed": 0b110000,
+                                        "security": 0b1})
+        self.assertEqual([4, 5], self.store2.get_installed())
+        self.assertEqual([0], self.store2.get_security())
+        self.assertEqual([2], self.store2.get_locked())
 
     def test_add_and_get_locked(self):
         """
@@ -32,10 +32,14 @@ This file is modified from the original to work with python3, but should be
 wire compatible and behave the same way (bugs notwithstanding).
 """
 
+import mmap
+
 from twisted.python.compat import _PY3
 
 dumps_table = {}
-loads_table = {}
+
+# Size of the chunks written out at a time by dump().
+CHUNK_SIZE = 65536
 
 
 def dumps(obj, _dt=dumps_table):
@@ -45,23 +49,226 @@ def dumps(obj, _dt=dumps_table):
         raise ValueError("Unsupported type: %s" % e)
 
 
-def loads(byte_string, _lt=loads_table, as_is=False):
+class Serialized(bytes):
+    """Data already serialized with L{dumps}, which is written out as-is.
+
+    This allows embedding stored objects in bigger ones without decoding
+    and encoding them again.
+    """
+
+
+def dump(obj, fd):
+    """Serialize C{obj} into the binary file-like object C{fd}.
+
+    Unlike L{dumps}, which builds the whole serialized string (joining the
+    serialized items of each container along the way), data is written
+    out in chunks of C{CHUNK_SIZE} bytes as it's produced, so it only ever
+    needs to be held by C{fd}.
+    """
+    try:
+        _dump(obj, fd.write)
+    except KeyError as e:
+        raise ValueError("Unsupported type: %s" % e)
+
+
+def loads(byte_string, as_is=False):
     """Load a serialized byte_string.
 
+    The data is decoded in place, without slicing it token by token, so it
+    can also be a C{bytearray}, an C{mmap} or a C{memoryview} (memory views
+    which don't cover a whole object are copied once).
+
     @param byte_string: the serialized data
-    @param _lt: the conversion map
     @param as_is: don't reinterpret dict keys as str
     """
     if not byte_string:
         raise ValueError("Can't load empty string")
+    if isinstance(byte_string, memoryview):
+        byte_string = _unwrap_memoryview(byte_string)
     try:
-        # To avoid python3 turning byte_string[0] into an int,
-        # we slice the bytestring instead.
-        return _lt[byte_string[0:1]](byte_string, 0, as_is=as_is)[0]
-    except KeyError as e:
-        raise ValueError("Unknown type character: %s" % e)
+        return _decode(byte_string, 0, as_is)[0]
+    except IndexError:
+        raise ValueError("Corrupted data")
+
+
+def peek(byte_string, key, default=None, as_is=False):
+    """Return the value of C{key} in a serialized dict.
+
+    Dict items are serialized sorted by key, so only the items up to
+    C{key} are looked at, and only its value is fully decoded.
+
+    @param byte_string: the serialized dict
+    @param key: the key to look for, its bytes and str versions are
+        considered to be the same on Python 3
+    @param default: what to return if the dict doesn't have C{key}
+    @param as_is: don't reinterpret dict keys as str in the value
+    """
+    if isinstance(byte_string, memoryview):
+        byte_string = _unwrap_memoryview(byte_string)
+    if byte_string[0:1] != b"d":
+        raise ValueError("Not a serialized dict")
+    pos = 1
+    try:
+        while byte_string[pos:pos+1] != b";":
+            item_key, pos = _decode(byte_string, pos, False)
+            if _PY3 and isinstance(item_key, bytes):
+                item_key = item_key.decode("ascii")
+            if item_key == key:
+                return _decode(byte_string, pos, as_is)[0]
+            if type(item_key) is type(key) and item_key > key:
+                break
+            # Skip the value.
+            pos = _decode(byte_string, pos, True)[1]
     except IndexError:
         raise ValueError("Corrupted data")
+    return default
+
+
+def load_stream(fd, as_is=False, chunk_size=65536):
+    """Yield the objects serialized one after the other in a file.
+
+    Data is read from C{fd} in chunks, so only the object being decoded
+    needs to be kept in memory, rather than the whole stream.
+
+    @param fd: a file-like object open in binary mode, for example a file
+        or the result of C{socket.makefile("rb")}.
+    @param as_is: don't reinterpret dict keys as str
+    @param chunk_size: how many bytes to read at a time. Objects bigger
+        than this are read with exponentially growing reads.
+    """
+    buf = b""
+    pos = 0
+    eof = False
+    while True:
+        if pos == len(buf):
+            buf = fd.read(chunk_size)
+            pos = 0
+            if not buf:
+                return
+        try:
+            obj, pos = _decode(buf, pos, as_is)
+        except (IndexError, ValueError) as e:
+            # Most likely, we just don't have the whole object yet.
+            if eof:
+                if isinstance(e, IndexError):
+                    raise ValueError("Corrupted data")
+                raise
+            chunk = fd.read(max(chunk_size, len(buf) - pos))
+            if chunk:
+                buf = buf[pos:] + chunk
+                pos = 0
+            else:
+                eof = True
+        else:
+            yield obj
+
+
+def _unwrap_memoryview(view):
+    """Return the object exported by C{view}, or a copy of its content."""
+    # Memory views don't know what they're exporting in Python 2.
+    obj = getattr(view, "obj", None)
+    if (isinstance(obj, (bytes, bytearray, mmap.mmap)) and
+            view.contiguous and view.nbytes == len(obj)):
+        return obj
+    return view.tobytes()
+
+
+# Codes of the types of serialized values, indexed both by the type
+# characters and by their integer values, since indexing byte strings
+# returns single characters in Python 2 and integers in Python 3, while
+# indexing a bytearray always returns integers.
+_BOOL, _INT, _FLOAT, _BYTES, _UNICODE, _NONE, _LIST, _TUPLE, _DICT, _END = (
+    range(10))
+_codes = {}
+for _char, _code in [(b"b", _BOOL), (b"i", _INT), (b"f", _FLOAT),
+                     (b"s", _BYTES), (b"u", _UNICODE), (b"n", _NONE),
+                     (b"l", _LIST), (b"t", _TUPLE), (b"d", _DICT),
+                     (b";", _END)]:
+    _codes[_char] = _codes[ord(_char)] = _code
+del _char, _code
+
+
+def _decode(buf, pos, as_is, _codes=_codes):
+    """Decode the object serialized at C{pos} in C{buf}.
+
+    Containers are not decoded recursively, instead a stack of the ones
+    being decoded is kept, and C{buf} is only sliced to extract values.
+
+    @return: A tuple with the decoded object and the position right after
+        its serialized form.
+    """
+    if isinstance(buf, mmap.mmap):
+        # Memory maps only have find().
+        def index(sub, start, find=buf.find):
+            found = find(sub, start)
+            if found == -1:
+                raise IndexError(start)
+            return found
+    else:
+        index = buf.index
+    # The (code, values) tuples of the enclosing containers being decoded.
+    stack = []
+    code = values = None
+    while True:
+        try:
+            item_code = _codes[buf[pos]]
+        except KeyError:
+            raise ValueError("Unknown type character: %r" % buf[pos:pos+1])
+        if item_code == _BYTES or item_code == _UNICODE:
+            startpos = index(b":", pos) + 1
+            endpos = startpos + int(buf[pos+1:startpos-1])
+            if endpos < startpos:
+                raise ValueError("Invalid length")
+            if endpos > len(buf):
+                raise IndexError(endpos)
+            obj = buf[startpos:endpos]
+            if item_code == _UNICODE:
+                obj = obj.decode("utf-8")
+            elif type(obj) is not bytes:
+                obj = bytes(obj)
+            pos = endpos
+        elif item_code == _INT:
+            endpos = index(b";", pos)
+            obj = int(buf[pos+1:endpos])
+            pos = endpos + 1
+        elif item_code == _END:
+            if values is None:
+                raise IndexError(pos)
+            if code == _LIST:
+                obj = values
+            elif code == _TUPLE:
+                obj = tuple(values)
+            else:
+                obj = {}
+                for i in range(0, len(values), 2):
+                    key = values[i]
+                    if _PY3 and not as_is and isinstance(key, bytes):
+                        # Although the wire format of dictionary keys is
+                        # ASCII bytes, the code actually expects them to be
+                        # strings, so we convert them here.
+                        key = key.decode("ascii")
+                    obj[key] = values[i + 1]
+            code, values = stack.pop()
+            pos += 1
+        elif item_code == _LIST or item_code == _TUPLE or item_code == _DICT:
+            stack.append((code, values))
+            code = item_code
+            values = []
+            pos += 1
+            continue
+        elif item_code == _NONE:
+            obj = None
+            pos += 1
+        elif item_code == _BOOL:
+            obj = bool(int(buf[pos+1:pos+2]))
+            pos += 2
+        else:
+            endpos = index(b";", pos)
+            obj = float(buf[pos+1:endpos])
+            pos = endpos + 1
+        if values is None:
+            return obj, pos
+        values.append(obj)
 
 
 def dumps_bool(obj):
@@ -113,69 +320,54 @@ def dumps_none(obj):
     return b"n"
 
 
-def loads_bool(bytestring, pos, as_is=False):
-    return bool(int(bytestring[pos+1:pos+2])), pos+2
-
-
-def loads_int(bytestring, pos, as_is=False):
-    endpos = bytestring.index(b";", pos)
-    return int(bytestring[pos+1:endpos]), endpos+1
-
-
-def loads_float(bytestring, pos, as_is=False):
-    endpos = bytestring.index(b";", pos)
-    return float(bytestring[pos+1:endpos]), endpos+1
-
-
-def loads_bytes(bytestring, pos, as_is=False):
-    startpos = bytestring.index(b":", pos)+1
-    endpos = startpos+int(bytestring[pos+1:startpos-1])
-    return bytestring[startpos:endpos], endpos
-
+def dumps_serialized(obj):
+    return bytes(obj)
 
-def loads_unicode(bytestring, pos, as_is=False):
-    startpos = bytestring.index(b":", pos)+1
-    endpos = startpos+int(bytestring[pos+1:startpos-1])
-    return bytestring[startpos:endpos].decode("utf-8"), endpos
 
+def _dump(obj, write):
+    writer = _ChunkWriter(write)
+    _dump_items(obj, writer.write)
+    writer.flush()
 
-def loads_list(bytestring, pos, _lt=loads_table, as_is=False):
-    pos += 1
-    res = []
-    append = res.append
-    while bytestring[pos:pos+1] != b";":
-        obj, pos = _lt[bytestring[pos:pos+1]](bytestring, pos, as_is=as_is)
-        append(obj)
-    return res, pos+1
 
+def _dump_items(obj, write, _dt=dumps_table):
+    obj_type = type(obj)
+    if obj_type is list or obj_type is tuple:
+        write(b"l" if obj_type is list else b"t")
+        for val in obj:
+            _dump_items(val, write)
+        write(b";")
+    elif obj_type is dict:
+        keys = list(obj.keys())
+        keys.sort()
+        write(b"d")
+        for key in keys:
+            _dump_items(key, write)
+            _dump_items(obj[key], write)
+        write(b";")
+    else:
+        write(_dt[obj_type](obj))
 
-def loads_tuple(bytestring, pos, _lt=loads_table, as_is=False):
-    pos += 1
-    res = []
-    append = res.append
-    while bytestring[pos:pos+1] != b";":
-        obj, pos = _lt[bytestring[pos:pos+1]](bytestring, pos, as_is=as_is)
-        append(obj)
-    return tuple(res), pos+1
 
+class _ChunkWriter(object):
+    """Group the small strings written by L{_dump_items} into chunks."""
 
-def loads_dict(bytestring, pos, _lt=loads_table, as_is=False):
-    pos += 1
-    res = {}
-    while bytestring[pos:pos+1] != b";":
-        key, pos = _lt[bytestring[pos:pos+1]](bytestring, pos, as_is=as_is)
-        val, pos = _lt[bytestring[pos:pos+1]](bytestring, pos, as_is=as_is)
-        if _PY3 and not as_is and isinstance(key, bytes):
-            # Although the wire format of dictionary keys is ASCII bytes, the
-            # code actually expects them to be strings, so we convert them
-            # here.
-            key = key.decode("ascii")
-        res[key] = val
-    return res, pos+1
+    def __init__(self, write):
+        self._write = write
+        self._chunk = []
+        self._size = 0
 
+    def write(self, data):
+        self._chunk.append(data)
+        self._size += len(data)
+        if self._size >= CHUNK_SIZE:
+            self.flush()
 
-def loads_none(str, pos, as_is=False):
-    return None, pos+1
+    def flush(self):
+        if self._chunk:
+            self._write(b"".join(self._chunk))
+            self._chunk = []
+            self._size = 0
 
 
 dumps_table.update({
@@ -187,19 +379,7 @@ dumps_table.update({
     dict: dumps_dict,
     type(None): dumps_none,
     bytes: dumps_bytes,
-})
-
-
-loads_table.update({
-    b"b": loads_bool,
-    b"i": loads_int,
-    b"f": loads_float,
-    b"l": loads_list,
-    b"t": loads_tuple,
-    b"d": loads_dict,
-    b"n": loads_none,
-    b"s": loads_bytes,
-    b"u": loads_unicode,
+    Serialized: dumps_serialized,
 })
 
 
@@ -215,3 +395,22 @@ else:
     dumps_table.update({
         str: dumps_unicode,
         })
+
+
+# The pure Python implementation, always available for reference.
+_py_dumps = dumps
+_py_dump = _dump
+_py_decode = _decode
+
+try:
+    # The compiled implementation is optional, and only supports the
+    # types in the table above as they are at import time.
+    from landscape.lib import _bpickle
+except ImportError:
+    _bpickle = None
+else:
+    _bpickle.set_serialized_type(Serialized)
+    dumps = _bpickle.dumps
+    _decode = _bpickle.decode
+
+    _dump = _bpickle.dump
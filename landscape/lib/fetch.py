@@ -4,10 +4,11 @@ import io
 
 from optparse import OptionParser
 
-from twisted.internet.defer import DeferredList
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import Deferred, DeferredList
 from twisted.python.compat import iteritems, networkString
 
+from landscape.lib.workers import get_pool
+
 
 class FetchError(Exception):
     pass
@@ -46,12 +47,15 @@ class PyCurlError(FetchError):
 
 def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
           connect_timeout=30, total_timeout=600, insecure=False, follow=True,
-          user_agent=None, proxy=None):
+          user_agent=None, proxy=None, dns_cache_timeout=0,
+          response_headers=None, decode_content=True):
     """Retrieve a URL and return the content.
 
     @param url: The url to be fetched.
     @param post: If true, the POST method will be used (defaults to GET).
-    @param data: Data to be sent to the server as the POST content.
+    @param data: Data to be sent to the server as the POST content, either
+        as a string or as a seekable binary file-like object, which is read
+        from its current position as the request is sent.
     @param headers: Dictionary of header => value entries to be used on the
         request.
     @param curl: A pycurl.Curl instance to use. If not provided, one will be
@@ -63,11 +67,27 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     @param follow: If True, follow HTTP redirects (default True).
     @param user_agent: The user-agent to set in the request.
     @param proxy: The proxy url to use for the request.
+    @param dns_cache_timeout: How many seconds resolved host names are kept
+        in the cache of C{curl}, by default they aren't cached.
+    @param response_headers: Optionally, a dict which gets the headers of
+        the response, with lowercase names.
+    @param decode_content: If true, gzip and deflate compressed responses
+        are accepted and decompressed by curl. Otherwise the response is
+        returned as it was received, and it's up to the caller to set the
+        C{Accept-Encoding} header and decode the response.
     """
     import pycurl
-    if not isinstance(data, bytes):
-        data = data.encode("utf-8")
-    output = io.BytesIO(data)
+    if hasattr(data, "read"):
+        output = data
+        position = output.tell()
+        output.seek(0, os.SEEK_END)
+        data_size = output.tell() - position
+        output.seek(position)
+    else:
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        output = io.BytesIO(data)
+        data_size = len(data)
     input = io.BytesIO()
 
     if curl is None:
@@ -80,8 +100,8 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     if post:
         curl.setopt(pycurl.POST, True)
 
-        if data:
-            curl.setopt(pycurl.POSTFIELDSIZE, len(data))
+        if data_size:
+            curl.setopt(pycurl.POSTFIELDSIZE, data_size)
             curl.setopt(pycurl.READFUNCTION, output.read)
 
     if cainfo and url.startswith("https:"):
@@ -109,8 +129,12 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     curl.setopt(pycurl.LOW_SPEED_TIME, total_timeout)
     curl.setopt(pycurl.NOSIGNAL, 1)
     curl.setopt(pycurl.WRITEFUNCTION, input.write)
-    curl.setopt(pycurl.DNS_CACHE_TIMEOUT, 0)
-    curl.setopt(pycurl.ENCODING, b"gzip,deflate")
+    if response_headers is not None:
+        curl.setopt(pycurl.HEADERFUNCTION,
+                    lambda line: _parse_header(line, response_headers))
+    curl.setopt(pycurl.DNS_CACHE_TIMEOUT, dns_cache_timeout)
+    # The option is always set, since curl handles can be reused.
+    curl.setopt(pycurl.ENCODING, b"gzip,deflate" if decode_content else None)
 
     try:
         curl.perform()
@@ -126,15 +150,33 @@ def fetch(url, post=False, data="", headers={}, cainfo=None, curl=None,
     return body
 
 
+def _parse_header(line, headers):
+    """Add a header line received by curl to C{headers}."""
+    line = line.decode("iso-8859-1").strip()
+    if line.startswith("HTTP/"):
+        # A new response starts, after a redirect or a "100 Continue".
+        headers.clear()
+    elif ":" in line:
+        name, value = line.split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+
 def fetch_async(*args, **kwargs):
-    """Retrieve a URL asynchronously.
+    """Retrieve a URL asynchronously, in the C{fetch} L{WorkerPool}.
+
+    Apart from C{priority}, the arguments are the ones of L{fetch}.
 
+    @param priority: Optionally, the priority of the download in the pool,
+        see L{WorkerPool.run_with_priority}.
     @return: A C{Deferred} resulting in the URL content.
     """
-    return deferToThread(fetch, *args, **kwargs)
+    priority = kwargs.pop("priority", 0)
+    return get_pool("fetch").run_with_priority(priority, fetch, *args,
+                                               **kwargs)
 
 
-def fetch_many_async(urls, callback=None, errback=None, **kwargs):
+def fetch_many_async(urls, callback=None, errback=None, concurrency=None,
+                     **kwargs):
     """
     Retrieve a list of URLs asynchronously.
 
@@ -142,18 +184,33 @@ def fetch_many_async(urls, callback=None, errback=None, **kwargs):
         each successful URL, and will be passed its content and the URL itself.
     @param errback: Optionally, a function that will be fired one time for each
         failing URL, and will be passed the failure and the URL itself.
+    @param concurrency: Optionally, the maximum number of URLs to retrieve at
+        the same time, leaving room in the C{fetch} pool for other downloads.
     @return: A C{DeferredList} whose callback chain will be fired as soon as
         all downloads have terminated. If an error occurs, the errback chain
         of the C{DeferredList} will be fired immediatly.
     """
-    results = []
-    for url in urls:
-        result = fetch_async(url, **kwargs)
+    urls = list(urls)
+    results = [Deferred() for url in urls]
+    pending = iter(zip(urls, results))
+
+    def fetch_next(ignored=None):
+        for url, result in pending:
+            fetched = fetch_async(url, **kwargs)
+            fetched.chainDeferred(result)
+            fetched.addCallback(fetch_next)
+            break
+
+    if concurrency is None:
+        concurrency = len(urls)
+    for i in range(concurrency):
+        fetch_next()
+
+    for url, result in zip(urls, results):
         if callback:
             result.addCallback(callback, url)
         if errback:
             result.addErrback(errback, url)
-        results.append(result)
     return DeferredList(results, fireOnOneErrback=True, consumeErrors=True)
 
 
@@ -22,13 +22,17 @@ import os
 import sys
 import copy
 import re
+import struct
+import zlib
 
 from twisted.python.compat import StringType  # Py2: basestring, Py3: str
+from twisted.python.compat import long, unicode
 
 
 __all__ = ["Persist", "PickleBackend", "BPickleBackend",
-           "path_string_to_tuple", "path_tuple_to_string", "RootedPersist",
-           "PersistError", "PersistReadOnlyError"]
+           "JournaledBPickleBackend", "path_string_to_tuple",
+           "path_tuple_to_string", "RootedPersist", "PersistError",
+           "PersistReadOnlyError"]
 
 
 NOTHING = object()
@@ -57,6 +61,9 @@ class Persist(object):
 
     @ivar filename: The name of the file where persist data is saved
         or None if no filename is available.
+    @ivar write_counts: How many times each top-level key of the persistent
+        options was written to, which tells what is generating the changes
+        to save.
 
     """
 
@@ -78,6 +85,11 @@ class Persist(object):
         self._readonly = False
         self._modified = False
         self._config = self
+        # The file the hard map was last loaded from or saved to.
+        self._synced_filepath = None
+        # The paths changed since then, if the backend can save just those.
+        self._changes = set() if backend.journaled else None
+        self.write_counts = {}
         self.filename = filename
         if filename is not None and os.path.exists(filename):
             self.load(filename)
@@ -106,8 +118,21 @@ class Persist(object):
         if self._readonly:
             raise PersistReadOnlyError("Configuration is in readonly mode.")
 
+    def _record_change(self, path):
+        """Note that C{path} changed in the hard map."""
+        self._modified = True
+        self.write_counts[path[0]] = self.write_counts.get(path[0], 0) + 1
+        if self._changes is not None:
+            # Items of lists are saved along with the whole list.
+            for index, elem in enumerate(path):
+                if type(elem) is int:
+                    path = path[:index]
+                    break
+            self._changes.add(path)
+
     def load(self, filepath):
         """Load a persisted database."""
+        self._synced_filepath = None
 
         def load_old():
             filepathold = filepath + ".old"
@@ -139,6 +164,14 @@ class Persist(object):
             if load_old():
                 return
             raise PersistError("Broken configuration file at %s" % filepath)
+        self._set_synced(filepath)
+
+    def _set_synced(self, filepath):
+        """Note that the hard map is the same as in C{filepath}."""
+        self._synced_filepath = filepath
+        self._modified = False
+        if self._changes is not None:
+            self._changes = set()
 
     def save(self, filepath=None):
         """Save the persist to the given C{filepath}.
@@ -147,19 +180,44 @@ class Persist(object):
         be used.
 
         If the destination file already exists, it will be renamed
-        to C{<filepath>.old}.
+        to C{<filepath>.old}, unless the backend is journaled and the
+        persist was last loaded from or saved to C{filepath}, in which
+        case only the changes since then are saved.
         """
         if filepath is None:
             if self.filename is None:
                 raise PersistError("Need a filename!")
             filepath = self.filename
         filepath = os.path.expanduser(filepath)
-        if os.path.isfile(filepath):
-            os.rename(filepath, filepath + ".old")
-        dirname = os.path.dirname(filepath)
-        if dirname and not os.path.isdir(dirname):
-            os.makedirs(dirname)
-        self._backend.save(filepath, self._hardmap)
+        if (self._changes is not None and
+                filepath == self._synced_filepath and
+                os.path.isfile(filepath)):
+            self._backend.save_changes(filepath, self._hardmap, self._changes)
+        else:
+            if os.path.isfile(filepath):
+                os.rename(filepath, filepath + ".old")
+            dirname = os.path.dirname(filepath)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._backend.save(filepath, self._hardmap)
+        self._set_synced(filepath)
+
+    def flush(self, filepath=None):
+        """Save the persist to the given C{filepath}, if needed.
+
+        Saving is skipped if the persist was last loaded from or saved to
+        C{filepath} and wasn't modified since.
+
+        @return: Whether the persist was saved.
+        """
+        if filepath is None:
+            filepath = self.filename
+        if (filepath is not None and not self._modified and
+                os.path.expanduser(filepath) == self._synced_filepath and
+                os.path.isfile(self._synced_filepath)):
+            return False
+        self.save(filepath)
+        return True
 
     def _traverse(self, obj, path, default=NOTHING, setvalue=NOTHING):
         if setvalue is not NOTHING:
@@ -259,7 +317,7 @@ class Persist(object):
             map = self._weakmap
         else:
             self.assert_writable()
-            self._modified = True
+            self._record_change(path)
             map = self._hardmap
         self._traverse(map, path, setvalue=value)
 
@@ -273,7 +331,7 @@ class Persist(object):
             map = self._weakmap
         else:
             self.assert_writable()
-            self._modified = True
+            self._record_change(path)
             map = self._hardmap
         if unique:
             current = self._traverse(map, path)
@@ -292,9 +350,10 @@ class Persist(object):
             map = self._weakmap
         else:
             self.assert_writable()
-            self._modified = True
             map = self._hardmap
         marker = NOTHING
+        removed = False
+        changed_path = path
         while path:
             if value is marker:
                 obj = self._traverse(map, path[:-1])
@@ -310,6 +369,7 @@ class Persist(object):
                 if result is NotImplemented:
                     raise PersistError("Can't remove %r from %r" %
                                        (elem, type(obj)))
+                removed = removed or result
             if self._backend.empty(obj):
                 if value is not marker:
                     value = marker
@@ -317,6 +377,8 @@ class Persist(object):
                     path = path[:-1]
             else:
                 break
+        if removed and map is self._hardmap:
+            self._record_change(changed_path)
         return result
 
     def move(self, oldpath, newpath, soft=False, weak=False):
@@ -420,6 +482,11 @@ class RootedPersist(object):
 _splitpath = re.compile(r"(\[-?\d+\])|(?<!\\)\.").split
 
 
+# Parsed path strings, see path_string_to_tuple.
+_path_cache = {}
+_PATH_CACHE_SIZE = 1000
+
+
 def path_string_to_tuple(path):
     """Convert a L{Persist} path string to a path tuple.
 
@@ -435,7 +502,20 @@ def path_string_to_tuple(path):
         ("ab", 0, "cd", 1)
 
     Raises L{PersistError} if the given path string is invalid.
+
+    The paths used by plugins are few and get parsed over and over, so
+    the results are cached.
     """
+    result = _path_cache.get(path)
+    if result is None:
+        result = _parse_path_string(path)
+        if len(_path_cache) >= _PATH_CACHE_SIZE:
+            _path_cache.clear()
+        _path_cache[path] = result
+    return result
+
+
+def _parse_path_string(path):
     if "." not in path and "[" not in path:
         return (path,)
     result = []
@@ -492,8 +572,13 @@ class Backend(object):
         10
         >>> root
         {'foo': 'bar', 'egg': [10, 2, 3]}
+
+    Backends which set C{journaled} can save just the paths which changed
+    since the last save, see L{JournaledBPickleBackend}.
     """
 
+    journaled = False
+
     def new(self):
         raise NotImplementedError
 
@@ -503,6 +588,15 @@ class Backend(object):
     def save(self, filepath, map):
         raise NotImplementedError
 
+    def save_changes(self, filepath, map, paths):
+        """Save the values at the given C{paths} of C{map}.
+
+        @param paths: The paths which changed since C{map} was last loaded
+            from or saved to C{filepath}, as tuples. Items of lists are
+            never part of these paths.
+        """
+        raise NotImplementedError
+
     def get(self, obj, elem, _marker=NOTHING):
         """Lookup a child in the given node object."""
         if type(obj) is dict:
@@ -567,7 +661,7 @@ class Backend(object):
     def copy(self, value):
         """Copy a node or a value."""
         if type(value) in (dict, list):
-            return copy.deepcopy(value)
+            return _copy_value(value)
         return value
 
     def empty(self, obj):
@@ -591,6 +685,41 @@ class Backend(object):
         return NotImplemented
 
 
+# Types of values which never need to be copied.
+_IMMUTABLE_TYPES = frozenset(
+    [type(None), bool, int, long, float, bytes, unicode])
+
+
+def _copy_value(value, _immutable_types=_IMMUTABLE_TYPES):
+    """Deep copy a value, as C{copy.deepcopy} does.
+
+    Values made of dicts, lists and tuples of plain values, like the ones
+    stored in a L{Persist}, are copied by walking them directly, which is
+    much faster than C{copy.deepcopy}. Anything else falls back to it.
+    """
+    value_type = type(value)
+    if value_type in _immutable_types:
+        return value
+    if value_type is dict:
+        result = {}
+        for key, item in value.items():
+            if type(item) not in _immutable_types:
+                item = _copy_value(item)
+            result[key] = item
+        return result
+    if value_type is list:
+        return [item if type(item) in _immutable_types else _copy_value(item)
+                for item in value]
+    if value_type is tuple:
+        items = [_copy_value(item) for item in value]
+        for item, copied_item in zip(value, items):
+            if item is not copied_item:
+                return tuple(items)
+        # Like copy.deepcopy, don't copy tuples of immutable values.
+        return value
+    return copy.deepcopy(value)
+
+
 class PickleBackend(Backend):
 
     def __init__(self):
@@ -626,4 +755,157 @@ class BPickleBackend(Backend):
         with open(filepath, "wb") as fd:
             fd.write(self._bpickle.dumps(map))
 
+
+class JournaledBPickleBackend(BPickleBackend):
+    """A L{BPickleBackend} which can save only what changed.
+
+    Changes are appended to a C{<filepath>.journal} file, as records
+    holding the new value of a changed path, or a marker of its removal.
+    Each record has its length and checksum in front of it, so that a
+    partially written record is ignored when loading. Once the journal
+    outgrows the snapshot in C{<filepath>}, a new snapshot is written
+    and the journal is dropped.
+
+    The journal starts with the size and checksum of the snapshot it
+    extends, and it's ignored when loading any other snapshot, like a
+    new one written right before a crash prevented the journal from
+    being dropped.
+
+    Both the journal records and the snapshots are flushed to disk with
+    C{fsync} before L{Persist.save} returns.
+    """
+
+    journaled = True
+
+    # The journal is compacted into a new snapshot once bigger than both
+    # the snapshot and this size.
+    compact_size = 65536
+
+    _header = struct.Struct(">II")
+
+    def __init__(self):
+        super(JournaledBPickleBackend, self).__init__()
+        # The size of the valid part of the journal of a file, and the
+        # size and stamp of its snapshot, by file path.
+        self._sizes = {}
+
+    def _get_stamp(self, data):
+        """Get the stamp of the journal of the given snapshot C{data}."""
+        return self._header.pack(len(data) & 0xffffffff,
+                                 zlib.crc32(data) & 0xffffffff)
+
+    def _read_stamp(self, filepath):
+        """Read the stamp of the journal of C{filepath}, if any."""
+        try:
+            with open(filepath + ".journal", "rb") as fd:
+                return fd.read(self._header.size)
+        except IOError:
+            return None
+
+    def load(self, filepath):
+        with open(filepath, "rb") as fd:
+            snapshot = fd.read()
+        map = self._bpickle.loads(snapshot)
+        stamp = self._get_stamp(snapshot)
+        journal_size = 0
+        journal = filepath + ".journal"
+        if os.path.isfile(journal):
+            with open(journal, "rb") as fd:
+                data = fd.read()
+            header_size = self._header.size
+            if data[:header_size] == stamp:
+                journal_size = header_size
+            while journal_size and journal_size + header_size <= len(data):
+                length, checksum = self._header.unpack_from(data, journal_size)
+                start = journal_size + header_size
+                record = data[start:start + length]
+                if (len(record) < length or
+                        zlib.crc32(record) & 0xffffffff != checksum):
+                    break
+                self._apply_record(map, self._bpickle.loads(record))
+                journal_size = start + length
+        self._sizes[filepath] = [journal_size, len(snapshot), stamp]
+        return map
+
+    def save(self, filepath, map):
+        data = self._bpickle.dumps(map)
+        stamp = self._get_stamp(data)
+        if self._read_stamp(filepath) == stamp:
+            # The journal would extend the new snapshot if left behind by
+            # a crash, so it must go first. The snapshot already on disk
+            # is the same as the new one in this case anyway.
+            os.unlink(filepath + ".journal")
+        temp_path = filepath + ".tmp"
+        with open(temp_path, "wb") as fd:
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(temp_path, filepath)
+        if os.path.exists(filepath + ".journal"):
+            os.unlink(filepath + ".journal")
+        self._sizes[filepath] = [0, len(data), stamp]
+
+    def save_changes(self, filepath, map, paths):
+        sizes = self._sizes.get(filepath)
+        records = self._make_records(map, paths) if sizes else None
+        if records is None:
+            return self.save(filepath, map)
+        if not records:
+            return
+        data = b"".join(
+            self._header.pack(len(record), zlib.crc32(record) & 0xffffffff) +
+            record for record in records)
+        journal_size, snapshot_size, stamp = sizes
+        if journal_size + len(data) > max(snapshot_size, self.compact_size):
+            return self.save(filepath, map)
+        if not journal_size:
+            data = stamp + data
+        with open(filepath + ".journal", "ab") as fd:
+            # Drop any partially written record left behind.
+            fd.truncate(journal_size)
+            fd.write(data)
+            fd.flush()
+            os.fsync(fd.fileno())
+        sizes[0] = journal_size + len(data)
+
+    def _make_records(self, map, paths):
+        """Make the journal records of the given changed C{paths}.
+
+        @return: A list of serialized records, or C{None} if the changes
+            can't be recorded as such.
+        """
+        records = []
+        changed = set()
+        for path in sorted(paths, key=len):
+            if any(path[:index] in changed for index in range(1, len(path))):
+                # Recorded already, along with a parent.
+                continue
+            changed.add(path)
+            obj = map
+            for index, elem in enumerate(path):
+                if type(obj) is not dict:
+                    return None
+                if elem not in obj:
+                    # The path was removed, possibly along with some
+                    # parents which got empty.
+                    records.append(self._bpickle.dumps([path[:index + 1]]))
+                    break
+                obj = obj[elem]
+            else:
+                records.append(self._bpickle.dumps([path, obj]))
+        return records
+
+    def _apply_record(self, map, record):
+        path = record[0]
+        obj = map
+        for elem in path[:-1]:
+            child = obj.get(elem)
+            if type(child) is not dict:
+                child = obj[elem] = {}
+            obj = child
+        if len(record) > 1:
+            obj[path[-1]] = record[1]
+        else:
+            obj.pop(path[-1], None)
+
 # vim:ts=4:sw=4:et
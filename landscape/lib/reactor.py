@@ -3,12 +3,19 @@ Extend the regular Twisted reactor with event-handling features.
 """
 from __future__ import absolute_import
 
+import bisect
+import heapq
 import logging
+import math
+import random
 import time
+import weakref
+from collections import OrderedDict
 
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import Deferred
 
 from landscape.lib.format import format_object
+from landscape.lib.workers import get_pool
 
 
 class InvalidID(Exception):
@@ -32,6 +39,84 @@ class EventID(object):
         self._pair = pair
 
 
+class EventHandlers(object):
+    """The handlers registered for an event type.
+
+    Handlers are kept in buckets by priority, so registering and cancelling
+    them is cheap. The ordered tuple of handlers used when firing the event
+    is built only when the handlers changed since the last time, and is
+    never modified in place, so it can be iterated safely while handlers
+    register or cancel other handlers.
+    """
+
+    def __init__(self):
+        self._buckets = {}
+        self._priorities = []
+        self._handlers = ()
+
+    def add(self, event_id):
+        """Add the handler identified by the given L{EventID}."""
+        priority = event_id._pair[1]
+        bucket = self._buckets.get(priority)
+        if bucket is None:
+            bucket = self._buckets[priority] = OrderedDict()
+            bisect.insort(self._priorities, priority)
+        bucket[event_id] = event_id._pair
+        self._handlers = None
+
+    def remove(self, event_id):
+        """Remove the handler identified by the given L{EventID}, if any."""
+        priority = event_id._pair[1]
+        bucket = self._buckets.get(priority)
+        if bucket is None or bucket.pop(event_id, None) is None:
+            return
+        if not bucket:
+            del self._buckets[priority]
+            self._priorities.remove(priority)
+        self._handlers = None
+
+    def get_handlers(self):
+        """Return a tuple of C{(handler, priority)} pairs, by priority."""
+        if self._handlers is None:
+            self._handlers = tuple(
+                pair for priority in self._priorities
+                for pair in self._buckets[priority].values())
+        return self._handlers
+
+
+class EventTimings(object):
+    """Histogram of the time taken by the handlers of an event type.
+
+    @cvar bounds: The upper bounds in seconds of the histogram buckets, the
+        last bucket holding the slower runs.
+    @ivar counts: The number of handler runs in each bucket.
+    @ivar total: The total time spent running handlers.
+    @ivar slowest: A C{(seconds, handler)} tuple for the slowest run.
+    """
+
+    bounds = (0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.slowest = None
+
+    def add(self, handler, seconds):
+        """Record a run of C{handler} which took C{seconds}."""
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.total += seconds
+        if self.slowest is None or seconds > self.slowest[0]:
+            self.slowest = (seconds, handler)
+
+    def __repr__(self):
+        slowest = ""
+        if self.slowest is not None:
+            slowest = ", slowest %s (%.3fs)" % (
+                format_object(self.slowest[1]), self.slowest[0])
+        return "<EventTimings runs %d, total %.3fs%s>" % (
+            sum(self.counts), self.total, slowest)
+
+
 class EventHandlingReactorMixin(object):
     """Fire events identified by strings and register handlers for them.
 
@@ -45,6 +130,7 @@ class EventHandlingReactorMixin(object):
     def __init__(self):
         super(EventHandlingReactorMixin, self).__init__()
         self._event_handlers = {}
+        self._event_timings = {}
 
     def call_on(self, event_type, handler, priority=0):
         """Register an event handler.
@@ -59,13 +145,12 @@ class EventHandlingReactorMixin(object):
 
         @return: The L{EventID} of the registered handler.
         """
-        pair = (handler, priority)
-
-        handlers = self._event_handlers.setdefault(event_type, [])
-        handlers.append(pair)
-        handlers.sort(key=lambda pair: pair[1])
-
-        return EventID(event_type, pair)
+        event_id = EventID(event_type, (handler, priority))
+        handlers = self._event_handlers.get(event_type)
+        if handlers is None:
+            handlers = self._event_handlers[event_type] = EventHandlers()
+        handlers.add(event_id)
+        return event_id
 
     def fire(self, event_type, *args, **kwargs):
         """Fire an event of a given type.
@@ -77,16 +162,26 @@ class EventHandlingReactorMixin(object):
         @param args: Positional arguments to pass to the registered handlers.
         @param kwargs: Keyword arguments to pass to the registered handlers.
         """
-        logging.debug("Started firing %s.", event_type)
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            logging.debug("Started firing %s.", event_type)
         results = []
-        # Make a copy of the handlers that are registered at this point in
-        # time, so we have a stable list in case handlers are cancelled
-        # dynamically by executing the handlers themselves.
-        handlers = list(self._event_handlers.get(event_type, ()))
+        handlers = self._event_handlers.get(event_type)
+        if handlers is None:
+            handlers = ()
+        else:
+            # This is a stable tuple, in case handlers are cancelled
+            # dynamically by executing the handlers themselves.
+            handlers = handlers.get_handlers()
+            timings = self._event_timings.get(event_type)
+            if timings is None:
+                timings = self._event_timings[event_type] = EventTimings()
         for handler, priority in handlers:
-            try:
+            if debug:
                 logging.debug("Calling %s for %s with priority %d.",
                               format_object(handler), event_type, priority)
+            started = time.time()
+            try:
                 results.append(handler(*args, **kwargs))
             except KeyboardInterrupt:
                 logging.exception("Keyboard interrupt while running event "
@@ -100,20 +195,223 @@ class EventHandlingReactorMixin(object):
                                   "event type %r with args %r %r.",
                                   format_object(handler), event_type,
                                   args, kwargs)
-        logging.debug("Finished firing %s.", event_type)
+            timings.add(handler, time.time() - started)
+        if debug:
+            logging.debug("Finished firing %s.", event_type)
         return results
 
+    def get_event_timings(self):
+        """Return a C{dict} mapping event types to their L{EventTimings}."""
+        return self._event_timings
+
     def cancel_call(self, id):
         """Unregister an event handler.
 
+        Unregistering a handler more than once has no effect.
+
         @param id: the L{EventID} of the handler to unregister.
         """
         if type(id) is EventID:
-            self._event_handlers[id._event_type].remove(id._pair)
+            handlers = self._event_handlers.get(id._event_type)
+            if handlers is not None:
+                handlers.remove(id)
         else:
             raise InvalidID("EventID instance expected, received %r" % id)
 
 
+class PeriodicCall(object):
+    """A function called repeatedly by a L{PeriodicScheduler}.
+
+    @ivar interval: The number of seconds between two calls.
+    @ivar next_time: The time of the next call.
+    @ivar active: Whether the call is still scheduled.
+    @ivar running: Whether the L{Deferred} returned by the last call is
+        still pending, in which case the call is skipped when due.
+    """
+
+    def __init__(self, scheduler, interval, f, args, kwargs):
+        self._scheduler = scheduler
+        self.interval = interval
+        self._f = f
+        self._args = args
+        self._kwargs = kwargs
+        self.next_time = None
+        self.active = True
+        self.running = False
+
+    def stop(self):
+        """Stop calling the function."""
+        self._scheduler.cancel(self)
+
+    def _run(self):
+        try:
+            result = self._f(*self._args, **self._kwargs)
+        except Exception:
+            logging.exception("Error running periodic call %s, stopping it.",
+                              format_object(self._f))
+            self.stop()
+            return
+        if isinstance(result, Deferred):
+            self.running = True
+            result.addCallbacks(self._finished, self._failed)
+
+    def _finished(self, result):
+        self.running = False
+
+    def _failed(self, failure):
+        self.running = False
+        logging.error("Error running periodic call %s, stopping it: %s",
+                      format_object(self._f), failure.getErrorMessage())
+        self.stop()
+
+
+class PeriodicScheduler(object):
+    """Run periodic calls, coalescing the ones that are due together.
+
+    Time is divided in slots of C{resolution} seconds, and the scheduled
+    calls are kept in a timing wheel hashed by the slot of their next run.
+    A single timer is armed for the earliest busy slot, and all the calls
+    in it are run in the same wake-up.
+
+    The first run of a call is C{interval} seconds after it's scheduled,
+    like with a C{LoopingCall}. Later runs are aligned on multiples of the
+    interval, so calls with the same interval, for instance the ones using
+    L{Monitor.step_size}, end up in the same slot no matter when they were
+    scheduled. This matters when several clients share the same process,
+    see the C{--clones} option.
+
+    The multiples are counted from an origin picked at random for each
+    scheduler, so that the calls of clients running on different machines
+    are spread over their interval instead of all hitting the server at
+    the same time. Calls whose intervals are multiples of each other are
+    still aligned together.
+
+    @param clock: The C{IReactorTime} provider to use.
+    @param resolution: The size of a slot in seconds, which is the maximum
+        delay of a call with respect to its exact due time.
+    @param jitter: The origin of the calls is picked within this many
+        seconds. With C{0}, calls are aligned on multiples of their
+        interval since the epoch.
+    @ivar wakeups: The number of times the scheduler woke up.
+    @ivar runs: The number of calls it performed.
+    """
+
+    def __init__(self, clock, resolution=1.0, jitter=86400.0):
+        self._clock = clock
+        self._resolution = resolution
+        self._origin = random.uniform(0, jitter)
+        self._slots = {}
+        self._heap = []
+        self._timer = None
+        self._timer_slot = None
+        self.wakeups = 0
+        self.runs = 0
+
+    def call_every(self, interval, f, *args, **kwargs):
+        """Call C{f} every C{interval} seconds.
+
+        The first call happens C{interval} seconds from now. The next ones
+        are aligned on multiples of C{interval}, so the second call happens
+        between half an interval and one and a half intervals after the
+        first one.
+
+        @return: The scheduled L{PeriodicCall}.
+        """
+        call = PeriodicCall(self, interval, f, args, kwargs)
+        call.next_time = self._clock.seconds() + interval
+        self._insert(call)
+        self._arm()
+        return call
+
+    def cancel(self, call):
+        """Stop running the given L{PeriodicCall}."""
+        if not call.active:
+            return
+        call.active = False
+        calls = self._slots.get(self._get_slot(call.next_time))
+        if calls is not None and call in calls:
+            calls.remove(call)
+            if not calls:
+                self._arm()
+
+    def clear(self):
+        """Cancel all the scheduled calls."""
+        for calls in self._slots.values():
+            for call in calls:
+                call.active = False
+        self._slots.clear()
+        self._heap = []
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+    def get_stats(self):
+        """Return a C{dict} with statistics about the scheduler."""
+        return {"calls": sum(len(calls) for calls in self._slots.values()),
+                "slots": sum(1 for calls in self._slots.values() if calls),
+                "wakeups": self.wakeups,
+                "runs": self.runs}
+
+    def _get_next_time(self, interval, after):
+        """Return the first multiple of C{interval} later than C{after}."""
+        origin = self._origin
+        count = math.floor((after - origin) / interval) + 1
+        return origin + count * interval
+
+    def _get_slot(self, when):
+        return int(math.ceil(when / self._resolution))
+
+    def _insert(self, call):
+        slot = self._get_slot(call.next_time)
+        calls = self._slots.get(slot)
+        if calls is None:
+            calls = self._slots[slot] = []
+            heapq.heappush(self._heap, slot)
+        calls.append(call)
+
+    def _arm(self):
+        """Make sure the timer fires for the earliest busy slot."""
+        heap = self._heap
+        while heap and not self._slots.get(heap[0]):
+            self._slots.pop(heapq.heappop(heap), None)
+        if not heap:
+            if self._timer is not None and self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+            return
+        slot = heap[0]
+        if self._timer is not None and self._timer.active():
+            if self._timer_slot == slot:
+                return
+            self._timer.cancel()
+        delay = max(0, slot * self._resolution - self._clock.seconds())
+        self._timer = self._clock.callLater(delay, self._wake_up)
+        self._timer_slot = slot
+
+    def _wake_up(self):
+        self._timer = None
+        self.wakeups += 1
+        now = self._clock.seconds()
+        current = self._get_slot(now)
+        while self._heap and self._heap[0] <= current:
+            calls = self._slots.pop(heapq.heappop(self._heap), ())
+            for call in calls:
+                if call.active and not call.running:
+                    self.runs += 1
+                    call._run()
+                if not call.active:
+                    continue
+                # The next multiple of the interval, which is one interval
+                # away for calls that are already aligned.
+                call.next_time = self._get_next_time(
+                    call.interval, call.next_time + call.interval / 2.0)
+                if call.next_time <= now:
+                    # We fell behind, skip the missed runs.
+                    call.next_time = self._get_next_time(call.interval, now)
+                self._insert(call)
+        self._arm()
+
+
 class ReactorID(object):
 
     def __init__(self, timeout):
@@ -128,11 +426,15 @@ class EventHandlingReactor(EventHandlingReactorMixin):
     which are implemented using EventHandlingReactorMixin.
     """
 
+    _scheduler_resolution = 1.0
+    _scheduler_jitter = 86400.0
+
     def __init__(self):
         from twisted.internet import reactor
         from twisted.internet.task import LoopingCall
         self._LoopingCall = LoopingCall
         self._reactor = reactor
+        self._scheduler = _get_scheduler(reactor)
         self._cleanup()
         self.callFromThread = reactor.callFromThread
         super(EventHandlingReactor, self).__init__()
@@ -157,25 +459,36 @@ class EventHandlingReactor(EventHandlingReactorMixin):
     def call_every(self, seconds, f, *args, **kwargs):
         """Call a function repeatedly.
 
-        Create a new L{twisted.internet.task.LoopingCall} object and
-        start it.
+        Calls every C{seconds} are coalesced by a L{PeriodicScheduler}
+        shared by all the reactors of this process. Sub-second intervals get
+        a new L{twisted.internet.task.LoopingCall} object instead.
 
-        @return: the created C{LoopingCall} object.
+        @return: the created L{PeriodicCall} or C{LoopingCall} object.
         """
+        if seconds >= self._scheduler_resolution:
+            return self._scheduler.call_every(seconds, f, *args, **kwargs)
         lc = self._LoopingCall(f, *args, **kwargs)
         lc.start(seconds, now=False)
         return lc
 
+    def get_scheduler_stats(self):
+        """Return statistics about the periodic calls of this process.
+
+        @see: L{PeriodicScheduler.get_stats}.
+        """
+        return self._scheduler.get_stats()
+
     def cancel_call(self, id):
         """Cancel a scheduled function or event handler.
 
         @param id: The function call or handler to remove. It can be an
-            L{EventID}, a L{LoopingCall} or a C{IDelayedCall}, as returned
+            L{EventID}, a L{PeriodicCall}, a L{LoopingCall} or a
+            C{IDelayedCall}, as returned
             by L{call_on}, L{call_every} and L{call_later} respectively.
         """
         if isinstance(id, EventID):
             return EventHandlingReactorMixin.cancel_call(self, id)
-        if isinstance(id, self._LoopingCall):
+        if isinstance(id, (self._LoopingCall, PeriodicCall)):
             return id.stop()
         if id.active():
             id.cancel()
@@ -197,7 +510,18 @@ class EventHandlingReactor(EventHandlingReactorMixin):
 
     def call_in_thread(self, callback, errback, f, *args, **kwargs):
         """
-        Execute a callable object in a new separate thread.
+        Execute a callable object in a separate thread.
+
+        The thread is taken from the C{exchange} L{WorkerPool}, since this
+        is used to talk to the server, see L{call_in_pool}.
+        """
+        self.call_in_pool("exchange", callback, errback, f, *args, **kwargs)
+
+    def call_in_pool(self, name, callback, errback, f, *args, **kwargs):
+        """
+        Execute a callable object in a thread of the given L{WorkerPool}.
+
+        @param name: The name of the pool, see L{get_pool}.
 
         @param callback: A function to call in case C{f} was successful, it
             will be passed the return value of C{f}.
@@ -219,7 +543,7 @@ class EventHandlingReactor(EventHandlingReactorMixin):
             else:
                 logging.error(exc_info[1], exc_info=exc_info)
 
-        deferred = deferToThread(f, *args, **kwargs)
+        deferred = get_pool(name).run(f, *args, **kwargs)
         deferred.addCallback(on_success)
         deferred.addErrback(on_failure)
 
@@ -246,6 +570,20 @@ class EventHandlingReactor(EventHandlingReactorMixin):
     def _cleanup(self):
         # Since the reactor is global, we should clean it up when we
         # initialize one of our wrappers.
+        self._scheduler.clear()
         for call in self._reactor.getDelayedCalls():
             if call.active():
                 call.cancel()
+
+
+_schedulers = weakref.WeakKeyDictionary()
+
+
+def _get_scheduler(clock):
+    """Return the L{PeriodicScheduler} shared by the wrappers of C{clock}."""
+    scheduler = _schedulers.get(clock)
+    if scheduler is None:
+        scheduler = _schedulers[clock] = PeriodicScheduler(
+            clock, resolution=EventHandlingReactor._scheduler_resolution,
+            jitter=EventHandlingReactor._scheduler_jitter)
+    return scheduler
@@ -1,4 +1,10 @@
-"""A schema system. Yes. Another one!"""
+"""A schema system. Yes. Another one!
+
+Besides calling C{coerce} on schemas, L{compile_schema} can turn them into
+faster functions, for when big values need to be coerced often.
+"""
+from itertools import islice
+
 from twisted.python.compat import iteritems, unicode, long
 
 
@@ -17,6 +23,15 @@ class Constant(object):
             raise InvalidError("%r != %r" % (value, self.value))
         return value
 
+    def compile(self):
+        constant = self.value
+
+        def coerce(value):
+            if value != constant:
+                raise InvalidError("Not the constant")
+            return value
+        return coerce
+
 
 class Any(object):
     """Something which must apply to any of a number of different schemas.
@@ -39,38 +54,87 @@ class Any(object):
         raise InvalidError("%r did not match any schema in %s"
                            % (value, self.schemas))
 
+    def compile(self):
+        # Alternatives whose values are of the wrong type are skipped
+        # without trying to coerce them, and values matching the type of
+        # type-only schemas are returned right away.
+        alternatives = []
+        for schema in self.schemas:
+            if getattr(schema, "_type_only", False):
+                alternatives.append((schema._types, None))
+            else:
+                alternatives.append(
+                    (getattr(schema, "_types", None), _compile(schema)))
+
+        def coerce(value):
+            for types, coerce_alternative in alternatives:
+                if types is not None and not isinstance(value, types):
+                    continue
+                if coerce_alternative is None:
+                    return value
+                try:
+                    return coerce_alternative(value)
+                except InvalidError:
+                    pass
+            raise InvalidError("No schema matched")
+        return coerce
+
 
 class Bool(object):
     """Something that must be a C{bool}."""
+    _types = (bool,)
+    _type_only = True
+
     def coerce(self, value):
         if not isinstance(value, bool):
             raise InvalidError("%r is not a bool" % (value,))
         return value
 
+    def compile(self):
+        return _compile_type_check(self._types)
+
 
 class Int(object):
     """Something that must be an C{int} or C{long}."""
+    _types = (int, long)
+    _type_only = True
+
     def coerce(self, value):
         if not isinstance(value, (int, long)):
             raise InvalidError("%r isn't an int or long" % (value,))
         return value
 
+    def compile(self):
+        return _compile_type_check(self._types)
+
 
 class Float(object):
     """Something that must be an C{int}, C{long}, or C{float}."""
+    _types = (int, long, float)
+    _type_only = True
+
     def coerce(self, value):
         if not isinstance(value, (int, long, float)):
             raise InvalidError("%r isn't a float" % (value,))
         return value
 
+    def compile(self):
+        return _compile_type_check(self._types)
+
 
 class Bytes(object):
     """A binary string."""
+    _types = (bytes,)
+    _type_only = True
+
     def coerce(self, value):
         if not isinstance(value, bytes):
             raise InvalidError("%r isn't a bytestring" % (value,))
         return value
 
+    def compile(self):
+        return _compile_type_check(self._types)
+
 
 class Unicode(object):
     """Something that must be a C{unicode}.
@@ -80,6 +144,8 @@ class Unicode(object):
     @param encoding: The encoding to automatically decode C{str}s with.
     """
 
+    _types = (bytes, unicode)
+
     def __init__(self, encoding="utf-8"):
         self.encoding = encoding
 
@@ -93,12 +159,31 @@ class Unicode(object):
             raise InvalidError("%r isn't a unicode" % (value,))
         return value
 
+    def compile(self):
+        encoding = self.encoding
+
+        def coerce(value):
+            if type(value) is unicode:
+                return value
+            if isinstance(value, bytes):
+                try:
+                    value = value.decode(encoding)
+                except UnicodeDecodeError:
+                    raise InvalidError("Can't be decoded")
+            if not isinstance(value, unicode):
+                raise InvalidError("Not a unicode")
+            return value
+        return coerce
+
 
 class List(object):
     """Something which must be a C{list}.
 
     @param schema: The schema that all values of the list must match.
     """
+
+    _types = (list,)
+
     def __init__(self, schema):
         self.schema = schema
 
@@ -115,6 +200,34 @@ class List(object):
                     % (subvalue, self.schema, e))
         return new_list
 
+    def compile(self):
+        if getattr(self.schema, "_type_only", False):
+            types = self.schema._types
+
+            def coerce(value):
+                if not isinstance(value, list):
+                    raise InvalidError("Not a list")
+                for subvalue in value:
+                    if not isinstance(subvalue, types):
+                        raise InvalidError("Wrong item type")
+                return value
+            return coerce
+
+        coerce_item = _compile(self.schema)
+
+        def coerce(value):
+            if not isinstance(value, list):
+                raise InvalidError("Not a list")
+            new_list = None
+            for i, subvalue in enumerate(value):
+                new_subvalue = coerce_item(subvalue)
+                if new_subvalue is not subvalue:
+                    if new_list is None:
+                        new_list = list(value)
+                    new_list[i] = new_subvalue
+            return value if new_list is None else new_list
+        return coerce
+
 
 class Tuple(object):
     """Something which must be a fixed-length tuple.
@@ -123,6 +236,8 @@ class Tuple(object):
         each value in the tuple respectively.
     """
 
+    _types = (tuple,)
+
     def __init__(self, *schema):
         self.schema = schema
 
@@ -137,6 +252,34 @@ class Tuple(object):
             new_value.append(schema.coerce(value))
         return tuple(new_value)
 
+    def compile(self):
+        size = len(self.schema)
+        if all(getattr(schema, "_type_only", False)
+               for schema in self.schema):
+            item_types = [schema._types for schema in self.schema]
+
+            def coerce(value):
+                if not isinstance(value, tuple) or len(value) != size:
+                    raise InvalidError("Not a tuple of %d items" % size)
+                for subvalue, types in zip(value, item_types):
+                    if not isinstance(subvalue, types):
+                        raise InvalidError("Wrong item type")
+                return value
+            return coerce
+
+        coerce_items = [_compile(schema) for schema in self.schema]
+
+        def coerce(value):
+            if not isinstance(value, tuple) or len(value) != size:
+                raise InvalidError("Not a tuple of %d items" % size)
+            new_value = [coerce_item(subvalue) for coerce_item, subvalue
+                         in zip(coerce_items, value)]
+            for subvalue, new_subvalue in zip(value, new_value):
+                if new_subvalue is not subvalue:
+                    return tuple(new_value)
+            return value
+        return coerce
+
 
 class KeyDict(object):
     """Something which must be a C{dict} with defined keys.
@@ -146,6 +289,8 @@ class KeyDict(object):
     @param schema: A dict mapping keys to schemas that the values of those
         keys must match.
     """
+    _types = (dict,)
+
     def __init__(self, schema, optional=None):
         if optional is None:
             optional = []
@@ -173,6 +318,32 @@ class KeyDict(object):
             raise InvalidError("Missing keys %s" % (missing,))
         return new_dict
 
+    def compile(self):
+        coerce_values = dict((key, _compile(schema))
+                             for key, schema in iteritems(self.schema))
+        required_keys = [key for key in self.schema
+                         if key not in self.optional]
+
+        def coerce(value):
+            if not isinstance(value, dict):
+                raise InvalidError("Not a dict")
+            new_dict = None
+            for k, v in iteritems(value):
+                try:
+                    coerce_value = coerce_values[k]
+                except KeyError:
+                    raise InvalidError("Invalid key")
+                new_v = coerce_value(v)
+                if new_v is not v:
+                    if new_dict is None:
+                        new_dict = dict(value)
+                    new_dict[k] = new_v
+            for key in required_keys:
+                if key not in value:
+                    raise InvalidError("Missing key")
+            return value if new_dict is None else new_dict
+        return coerce
+
 
 class Dict(object):
     """Something which must be a C{dict} with arbitrary keys.
@@ -181,6 +352,8 @@ class Dict(object):
     @param value_schema: The schema that values must match.
     """
 
+    _types = (dict,)
+
     def __init__(self, key_schema, value_schema):
         self.key_schema = key_schema
         self.value_schema = value_schema
@@ -192,3 +365,65 @@ class Dict(object):
         for k, v in value.items():
             new_dict[self.key_schema.coerce(k)] = self.value_schema.coerce(v)
         return new_dict
+
+    def compile(self):
+        coerce_key = _compile(self.key_schema)
+        coerce_value = _compile(self.value_schema)
+
+        def coerce(value):
+            if not isinstance(value, dict):
+                raise InvalidError("Not a dict")
+            new_dict = None
+            for i, (k, v) in enumerate(iteritems(value)):
+                new_k = coerce_key(k)
+                new_v = coerce_value(v)
+                if new_dict is None and (new_k is not k or new_v is not v):
+                    # The items so far were left alone.
+                    new_dict = dict(islice(iteritems(value), i))
+                if new_dict is not None:
+                    new_dict[new_k] = new_v
+            return value if new_dict is None else new_dict
+        return coerce
+
+
+def compile_schema(schema):
+    """Return a function coercing values like C{schema.coerce} does.
+
+    The schema is turned into nested functions specialized for it, which
+    don't copy values that need no coercion, rather than returning copies
+    of all lists, tuples and dicts. When a value is invalid, the
+    L{InvalidError} is raised by C{schema.coerce} itself, so it has the
+    same message.
+
+    Schemas without a C{compile} method are used as they are.
+    """
+    compiled = _compile(schema)
+    coerce = schema.coerce
+
+    def coerce_compiled(value):
+        try:
+            return compiled(value)
+        except InvalidError:
+            return coerce(value)
+    return coerce_compiled
+
+
+def _compile(schema):
+    """Return the compiled C{coerce} function of a schema, if it has one."""
+    compile = getattr(schema, "compile", None)
+    if compile is None:
+        # Looking up coerce is deferred, so that errors happen at the same
+        # time as with the schema itself.
+        def coerce(value):
+            return schema.coerce(value)
+        return coerce
+    return compile()
+
+
+def _compile_type_check(types):
+    """Return a function checking that values are instances of C{types}."""
+    def coerce(value):
+        if not isinstance(value, types):
+            raise InvalidError("Wrong type")
+        return value
+    return coerce
@@ -1,4 +1,7 @@
-from twisted.python.compat import xrange
+import binascii
+import re
+
+from twisted.python.compat import xrange, _PY3
 
 
 class SequenceError(Exception):
@@ -106,6 +109,81 @@ def ranges_to_sequence(ranges):
             yield item
 
 
+def sequence_to_bitmap(sequence):
+    """Return an C{int} with the bits at the given positions set.
+
+    Sets of dense non-negative integers, like package ids, take much less
+    memory as such bitmaps than as C{set}s, and the set operations on them
+    (C{&}, C{|} and C{& ~}) run in C.
+
+    @raises ValueError: If an item is negative.
+    """
+    sequence = list(sequence)
+    if not sequence:
+        return 0
+    if min(sequence) < 0:
+        raise ValueError("Negative item %d" % min(sequence))
+    data = bytearray((max(sequence) >> 3) + 1)
+    for item in sequence:
+        data[item >> 3] |= 1 << (item & 7)
+    return bytes_to_bitmap(bytes(data))
+
+
+def bitmap_to_bytes(bitmap):
+    """Return the given bitmap as little-endian C{bytes}."""
+    if not bitmap:
+        return b""
+    if _PY3:
+        return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    digits = "%x" % bitmap
+    return binascii.unhexlify("0" * (len(digits) % 2) + digits)[::-1]
+
+
+def bytes_to_bitmap(data):
+    """Return the bitmap of the given little-endian C{bytes}."""
+    if _PY3:
+        return int.from_bytes(data, "little")
+    if not data:
+        return 0
+    return int(binascii.hexlify(data[::-1]), 16)
+
+
+def bitmap_to_ranges(bitmap):
+    """Iterate over the range items of the bits set in C{bitmap}.
+
+    The items are the same as the ones L{sequence_to_ranges} gives for the
+    sorted positions of the bits, but they're found a byte string at a
+    time instead of an item at a time.
+    """
+    if bitmap == 0:
+        return
+    data = bitmap_to_bytes(bitmap)
+    # Runs of bits can't cross a zero byte, so only the parts between zero
+    # bytes need to be looked into, which keeps sparse bitmaps cheap.
+    for part in re.finditer(b"[^\x00]+", data):
+        offset = part.start() * 8
+        bits = bin(bytes_to_bitmap(part.group()))[:1:-1]
+        for run in re.finditer("1+", bits):
+            start = offset + run.start()
+            stop = offset + run.end() - 1
+            if stop - start >= 2:
+                yield (start, stop)
+            else:
+                yield start
+                if stop != start:
+                    yield stop
+
+
+def bitmap_to_sequence(bitmap):
+    """Iterate over the positions of the bits set in C{bitmap}, in order."""
+    return ranges_to_sequence(bitmap_to_ranges(bitmap))
+
+
+def count_bitmap(bitmap):
+    """Return the number of bits set in C{bitmap}."""
+    return bin(bitmap).count("1")
+
+
 def find_ranges_index(ranges, item):
     """Find the index where an entry *may* be."""
     lo = 0
@@ -1,4 +1,5 @@
 """Functions used by all sqlite-backed stores."""
+from contextlib import contextmanager
 
 try:
     import sqlite3
@@ -14,17 +15,19 @@ def with_cursor(method):
     until the cursor was closed.  With this in mind, instead of using
     the autocommit mode, we explicitly terminate transactions and enforce
     cursor closing with this decorator.
+
+    Inside a L{transaction} block, the method runs in the transaction of
+    the block instead, which is committed or rolled back as a whole.
     """
 
     def inner(self, *args, **kwargs):
-        if not self._db:
-            # Create the database connection only when we start to actually
-            # use it. This is essentially just a workaroud of a sqlite bug
-            # happening when 2 concurrent processes try to create the tables
-            # around the same time, the one which fails having an incorrect
-            # cache and not seeing the tables
-            self._db = sqlite3.connect(self._filename)
-            self._ensure_schema()
+        _connect(self)
+        if getattr(self, "_transaction_depth", 0):
+            cursor = self._db.cursor()
+            try:
+                return method(self, cursor, *args, **kwargs)
+            finally:
+                cursor.close()
         try:
             cursor = self._db.cursor()
             try:
@@ -37,3 +40,39 @@ def with_cursor(method):
             raise
         return result
     return inner
+
+
+def _connect(store):
+    """Make sure that the database connection of C{store} is open."""
+    if not store._db:
+        # Create the database connection only when we start to actually
+        # use it. This is essentially just a workaroud of a sqlite bug
+        # happening when 2 concurrent processes try to create the tables
+        # around the same time, the one which fails having an incorrect
+        # cache and not seeing the tables
+        store._db = sqlite3.connect(store._filename)
+        store._ensure_schema()
+
+
+@contextmanager
+def transaction(store):
+    """Run the methods of C{store} called in the block in one transaction.
+
+    The methods decorated with L{with_cursor} don't commit on their own
+    inside the block. The transaction is committed when the block ends,
+    or rolled back if it raises an exception. Nested blocks are part of
+    the outermost one.
+    """
+    _connect(store)
+    depth = getattr(store, "_transaction_depth", 0)
+    store._transaction_depth = depth + 1
+    try:
+        yield store
+    except BaseException:
+        store._transaction_depth = depth
+        if not depth:
+            store._db.rollback()
+        raise
+    store._transaction_depth = depth
+    if not depth:
+        store._db.commit()
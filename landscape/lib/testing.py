@@ -656,6 +656,13 @@ class FakeReactor(EventHandlingReactorMixin):
         self._in_thread(callback, errback, f, args, kwargs)
         self._run_threaded_callbacks()
 
+    def call_in_pool(self, name, callback, errback, f, *args, **kwargs):
+        """Emulate L{LandscapeReactor.call_in_pool} without spawning threads.
+
+        The C{name} of the pool is ignored, see L{call_in_thread}.
+        """
+        self.call_in_thread(callback, errback, f, *args, **kwargs)
+
     def listen_unix(self, socket_path, factory):
 
         class FakePort(object):
@@ -1,16 +1,19 @@
 import unittest
 
+import mock
+
 from twisted.internet import reactor
 from twisted.internet.error import ConnectError, ConnectionDone
 from twisted.internet.task import Clock
 from twisted.internet.defer import Deferred, inlineCallbacks
 from twisted.python.failure import Failure
+from twisted.protocols.amp import AMP, Command, Integer, String
 
-from landscape.lib import testing
+from landscape.lib import bpickle, testing
 from landscape.lib.amp import (
     MethodCallError, MethodCallServerProtocol, MethodCallClientProtocol,
     MethodCallServerFactory, MethodCallClientFactory, RemoteObject,
-    MethodCallSender)
+    MethodCallSender, MethodCallReceiver, _ArgumentsBuffer)
 
 
 class FakeTransport(object):
@@ -89,6 +92,24 @@ class FakeConnector(object):
         self.connection.lose(self, Failure(ConnectionDone()))
 
 
+class OldMethodCallChunk(Command):
+    """A L{MethodCallChunk} as known by older peers."""
+
+    commandName = b"MethodCallChunk"
+    arguments = [(b"sequence", Integer()),
+                 (b"chunk", String())]
+    response = [(b"result", Integer())]
+
+
+class OldMethodCallReceiver(MethodCallReceiver):
+    """A L{MethodCallReceiver} which only knows older L{MethodCallChunk}s."""
+
+    @OldMethodCallChunk.responder
+    def receive_method_call_chunk(self, sequence, chunk):
+        return MethodCallReceiver.receive_method_call_chunk(
+            self, sequence, chunk)
+
+
 class DummyObject(object):
 
     method = None
@@ -278,6 +299,76 @@ class MethodCallTest(BaseTestCase):
         self.assertEqual(80000, self.successResultOf(deferred1))
         self.assertEqual(90000, self.successResultOf(deferred2))
 
+    def test_with_long_argument_pipelined(self):
+        """
+        The chunks of long arguments are sent without waiting for previous
+        ones to be acknowledged, up to the sender's window.
+        """
+        self.sender._chunk_window = 4
+        self.object.method = lambda word: len(word)
+        deferred = self.sender.send_method_call(method="method",
+                                                args=["!" * 1000000],
+                                                kwargs={})
+        self.assertEqual(4, len(self.connection.client.transport.stream))
+        self.connection.flush()
+        self.assertEqual(1000000, self.successResultOf(deferred))
+
+    def test_with_long_argument_old_receiver(self):
+        """
+        Long arguments can be sent to a receiver which doesn't know about
+        the size sent along with the first chunk.
+        """
+        self.object.method = lambda word: len(word)
+        server = AMP(locator=OldMethodCallReceiver(self.object, self.methods))
+        client = MethodCallClientProtocol()
+        connection = FakeConnection(client, server)
+        connection.make()
+        sender = MethodCallSender(client, self.clock)
+        deferred = sender.send_method_call(method="method",
+                                           args=["!" * 200000],
+                                           kwargs={})
+        connection.flush()
+        self.assertEqual(200000, self.successResultOf(deferred))
+
+    def test_with_long_argument_old_sender(self):
+        """
+        Long arguments sent without their size along with the first chunk
+        are reassembled as well.
+        """
+        self.object.method = lambda word: len(word)
+        arguments = bpickle.dumps((["abc"], {}))
+        receiver = MethodCallReceiver(self.object, self.methods)
+        receiver.receive_method_call_chunk(sequence=1, chunk=arguments[:5])
+        deferred = receiver.receive_method_call(
+            sequence=1, method=b"method", arguments=arguments[5:])
+        self.assertEqual({"result": 3}, self.successResultOf(deferred))
+
+    def test_with_long_argument_big_size(self):
+        """
+        Only part of the buffer of long arguments is allocated upfront if
+        their announced size is big, and it grows as chunks are received.
+        """
+        self.object.method = lambda word: len(word)
+        arguments = bpickle.dumps((["!" * 100], {}))
+        receiver = MethodCallReceiver(self.object, self.methods)
+        with mock.patch.object(_ArgumentsBuffer, "max_preallocated_size", 8):
+            receiver.receive_method_call_chunk(
+                sequence=1, chunk=arguments[:5], total=2 ** 30)
+            self.assertEqual(8, len(receiver._pending_chunks[1]._data))
+        deferred = receiver.receive_method_call(
+            sequence=1, method=b"method", arguments=arguments[5:])
+        self.assertEqual({"result": 100}, self.successResultOf(deferred))
+
+    def test_with_long_argument_invalid_size(self):
+        """
+        Negative or absurdly big sizes of long arguments are rejected.
+        """
+        receiver = MethodCallReceiver(self.object, self.methods)
+        self.assertRaises(MethodCallError, receiver.receive_method_call_chunk,
+                          sequence=1, chunk=b"abc", total=-1)
+        self.assertRaises(MethodCallError, receiver.receive_method_call_chunk,
+                          sequence=1, chunk=b"abc", total=2 ** 40)
+
     def test_with_exception(self):
         """
         If the target object method raises an exception, the remote call fails
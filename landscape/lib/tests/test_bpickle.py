@@ -1,3 +1,6 @@
+import io
+import mmap
+import tempfile
 import unittest
 
 from landscape.lib import bpickle
@@ -61,3 +64,234 @@ class BPickleTest(unittest.TestCase):
     def test_long(self):
         long = 99999999999999999999999999999
         self.assertEqual(bpickle.loads(bpickle.dumps(long)), long)
+
+    def test_dump(self):
+        """C{dump} writes the same data as C{dumps} into a file."""
+        obj = {"messages": [{"type": "test", "data": (1, 2.5, None)}]}
+        fd = io.BytesIO()
+        bpickle.dump(obj, fd)
+        self.assertEqual(bpickle.dumps(obj), fd.getvalue())
+
+    def test_dump_unsupported_type(self):
+        self.assertRaises(ValueError, bpickle.dump, [set()], io.BytesIO())
+
+    def test_peek(self):
+        """C{peek} returns the value of a key of a serialized dict."""
+        data = bpickle.dumps(
+            {"api": b"3.3", "data": [{b"a": 1}], "type": "t"})
+        self.assertEqual(b"3.3", bpickle.peek(data, "api"))
+        self.assertEqual([{"a": 1}], bpickle.peek(data, "data"))
+        self.assertEqual([{b"a": 1}], bpickle.peek(data, "data", as_is=True))
+        self.assertEqual("t", bpickle.peek(data, "type"))
+        self.assertIsNone(bpickle.peek(data, "b"))
+        self.assertEqual(1, bpickle.peek(data, "zzz", default=1))
+
+    def test_peek_bytes_keys(self):
+        """Keys serialized as bytes are found too."""
+        data = bpickle.dumps({b"api": b"3.2", b"type": b"t"})
+        self.assertEqual(b"t", bpickle.peek(data, "type"))
+
+    def test_peek_stops_at_key(self):
+        """Items after the key aren't looked at."""
+        data = bpickle.dumps({"api": b"3.3", "type": "t"})[:-1] + b"s5:"
+        self.assertEqual(b"3.3", bpickle.peek(data, "api"))
+        self.assertRaises(ValueError, bpickle.peek, data, "zzz")
+
+    def test_peek_not_dict(self):
+        self.assertRaises(ValueError, bpickle.peek, bpickle.dumps([]), "a")
+
+    def test_loads_bytearray(self):
+        """Data can be decoded from a C{bytearray}."""
+        data = bytearray(bpickle.dumps({"a": [b"foo", 1, u"\xc0"]}))
+        self.assertEqual(bpickle.loads(data), {"a": [b"foo", 1, u"\xc0"]})
+        self.assertIsInstance(bpickle.loads(data)["a"][0], bytes)
+
+    def test_loads_memoryview(self):
+        """Data can be decoded from a C{memoryview}, even a partial one."""
+        data = bpickle.dumps([b"foo", (1, 2.5), None, True])
+        self.assertEqual(bpickle.loads(memoryview(data)),
+                         [b"foo", (1, 2.5), None, True])
+        self.assertEqual(bpickle.loads(memoryview(b"xx" + data)[2:]),
+                         [b"foo", (1, 2.5), None, True])
+
+    def test_loads_mmap(self):
+        """Data can be decoded straight from a memory mapped file."""
+        data = bpickle.dumps({"messages": [{"type": "test"}] * 3})
+        with tempfile.TemporaryFile() as fd:
+            fd.write(data)
+            fd.flush()
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.assertEqual(bpickle.loads(mapped),
+                                 {"messages": [{"type": "test"}] * 3})
+            finally:
+                mapped.close()
+
+    def test_loads_deeply_nested(self):
+        """Nesting isn't limited by the recursion limit."""
+        data = b"l" * 5000 + b";" * 5000
+        result = bpickle.loads(data)
+        for i in range(4999):
+            [result] = result
+        self.assertEqual([], result)
+
+    def test_loads_corrupted(self):
+        """Truncated or invalid data raises a L{ValueError}."""
+        self.assertRaises(ValueError, bpickle.loads, b"")
+        self.assertRaises(ValueError, bpickle.loads, b";")
+        self.assertRaises(ValueError, bpickle.loads, b"li1;")
+        self.assertRaises(ValueError, bpickle.loads, b"s5:foo")
+        self.assertRaises(ValueError, bpickle.loads, b"x")
+
+    def test_load_stream(self):
+        """
+        C{load_stream} yields the objects serialized one after the other
+        in a file, reading it in chunks.
+        """
+        objects = [{"type": "test", "data": b"x" * 100}, [1, 2], None, 3]
+        fd = io.BytesIO(b"".join(bpickle.dumps(obj) for obj in objects))
+        self.assertEqual(list(bpickle.load_stream(fd, chunk_size=7)), objects)
+
+    def test_load_stream_as_is(self):
+        """C{load_stream} can leave dict keys alone."""
+        fd = io.BytesIO(bpickle.dumps({b"type": b"test"}))
+        self.assertEqual(list(bpickle.load_stream(fd, as_is=True)),
+                         [{b"type": b"test"}])
+
+    def test_load_stream_truncated(self):
+        """A truncated stream raises a L{ValueError}."""
+        fd = io.BytesIO(bpickle.dumps([1, 2]) + bpickle.dumps([1, 2])[:-1])
+        objects = bpickle.load_stream(fd, chunk_size=3)
+        self.assertEqual([1, 2], next(objects))
+        self.assertRaises(ValueError, next, objects)
+
+
+# Objects along with their serialized form.
+VECTORS = [
+    (None, b"n"),
+    (True, b"b1"),
+    (False, b"b0"),
+    (0, b"i0;"),
+    (-42, b"i-42;"),
+    (2 ** 70, b"i1180591620717411303424;"),
+    (-2 ** 70, b"i-1180591620717411303424;"),
+    (1.5, b"f1.5;"),
+    (-0.0, b"f-0.0;"),
+    (1e100, b"f1e+100;"),
+    (float("inf"), b"finf;"),
+    (b"", b"s0:"),
+    (b"a:b;c", b"s5:a:b;c"),
+    (u"", b"u0:"),
+    (u"\xc0ሴ", b"u5:\xc3\x80\xe1\x88\xb4"),
+    ([], b"l;"),
+    ((), b"t;"),
+    ({}, b"d;"),
+    ([1, (b"x", None), [[]]], b"li1;ts1:xn;ll;;;"),
+    ({"b": [1], "a": {2: 3.0}}, b"du1:adi2;f3.0;;u1:bli1;;;"),
+    ({b"type": b"test", b"api": b"3.3"},
+     b"ds3:apis3:3.3s4:types4:test;"),
+]
+
+# Invalid data along with the error raised when decoding it.
+INVALID = [
+    (b"", IndexError),
+    (b";", IndexError),
+    (b"l", IndexError),
+    (b"li1;", IndexError),
+    (b"di1;;", IndexError),
+    (b"s5:foo", IndexError),
+    (b"i1", ValueError),
+    (b"ix;", ValueError),
+    (b"s-1:", ValueError),
+    (b"u2:\xff\xff", ValueError),
+    (b"x", ValueError),
+    (b"ds1:\xffi1;;", ValueError),
+    (b"dli1;;i1;;", TypeError),
+]
+
+
+class BPickleConformanceTestMixin(object):
+    """Checks that a bpickle implementation follows the wire format."""
+
+    dumps = dump = decode = None
+
+    def test_dumps(self):
+        for obj, data in VECTORS:
+            self.assertEqual(data, self.dumps(obj))
+
+    def test_dumps_unsupported_type(self):
+        class Int(int):
+            pass
+        for obj in [set(), object(), Int(1), [1, {"a": object()}]]:
+            self.assertRaises(ValueError, self.dumps, obj)
+
+    def test_dump(self):
+        for obj, data in VECTORS:
+            fd = io.BytesIO()
+            self.dump(obj, fd.write)
+            self.assertEqual(data, fd.getvalue())
+
+    def test_dump_chunks(self):
+        """Big objects are written out in several chunks."""
+        obj = {"messages": [{"data": b"x" * 1000}] * 200}
+        chunks = []
+        self.dump(obj, chunks.append)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(self.dumps(obj), b"".join(chunks))
+
+    def test_dumps_serialized(self):
+        """L{bpickle.Serialized} data is written out unchanged."""
+        data = bpickle.Serialized(b"ds1:ai1;;")
+        self.assertEqual(b"lds1:ai1;;n;", self.dumps([data, None]))
+        chunks = []
+        self.dump([data], chunks.append)
+        self.assertEqual(b"lds1:ai1;;;", b"".join(chunks))
+
+    def test_dumps_nan(self):
+        self.assertEqual(b"fnan;", self.dumps(float("nan")))
+
+    def test_decode(self):
+        for obj, data in VECTORS:
+            result, pos = self.decode(data, 0, True)
+            self.assertEqual(obj, result)
+            self.assertEqual(type(obj), type(result))
+            self.assertEqual(len(data), pos)
+
+    def test_decode_dict_keys(self):
+        """Bytes keys become strings, unless C{as_is} is set."""
+        data = b"ds1:ai1;i2;s1:b;"
+        self.assertEqual(({"a": 1, 2: b"b"}, len(data)),
+                         self.decode(data, 0, False))
+        self.assertEqual(({b"a": 1, 2: b"b"}, len(data)),
+                         self.decode(data, 0, True))
+        [key] = self.decode(b"ds1:an;", 0, False)[0]
+        self.assertIs(str, type(key))
+
+    def test_decode_buffers(self):
+        """Any byte buffer can be decoded, starting at any position."""
+        data = b"nli1;s3:foo;"
+        for buf in [data, bytearray(data)]:
+            self.assertEqual(([1, b"foo"], len(data)),
+                             self.decode(buf, 1, False))
+
+    def test_decode_invalid(self):
+        for data, error in INVALID:
+            self.assertRaises(error, self.decode, data, 0, False)
+
+
+class PythonBPickleConformanceTest(BPickleConformanceTestMixin,
+                                   unittest.TestCase):
+
+    dumps = staticmethod(bpickle._py_dumps)
+    dump = staticmethod(bpickle._py_dump)
+    decode = staticmethod(bpickle._py_decode)
+
+
+@unittest.skipIf(bpickle._bpickle is None, "compiled bpickle not built")
+class CompiledBPickleConformanceTest(BPickleConformanceTestMixin,
+                                     unittest.TestCase):
+
+    def setUp(self):
+        self.dumps = bpickle._bpickle.dumps
+        self.dump = bpickle._bpickle.dump
+        self.decode = bpickle._bpickle.decode
@@ -1,10 +1,12 @@
 import os
+from io import BytesIO
 from threading import local
 import unittest
 
+import mock
 import pycurl
 
-from twisted.internet.defer import FirstError
+from twisted.internet.defer import Deferred, FirstError
 from twisted.python.compat import unicode
 
 from landscape.lib import testing
@@ -148,6 +150,39 @@ class FetchTest(testing.FSTestCase, testing.TwistedTestCase,
                           pycurl.DNS_CACHE_TIMEOUT: 0,
                           pycurl.ENCODING: b"gzip,deflate"})
 
+    def test_post_data_file(self):
+        """
+        The data to post can be read from a file-like object, starting at
+        its current position.
+        """
+        curl = CurlStub(b"result")
+        data = BytesIO(b"skipped:data")
+        data.seek(8)
+        result = fetch("http://example.com", post=True, data=data, curl=curl)
+        self.assertEqual(result, b"result")
+        self.assertEqual(curl.options[pycurl.POSTFIELDSIZE], 4)
+        self.assertEqual(curl.options[pycurl.READFUNCTION](), b"data")
+
+    def test_dns_cache_timeout(self):
+        curl = CurlStub(b"result")
+        fetch("http://example.com", curl=curl, dns_cache_timeout=60)
+        self.assertEqual(60, curl.options[pycurl.DNS_CACHE_TIMEOUT])
+
+    def test_response_headers(self):
+        """
+        If a C{response_headers} dict is passed, it gets the headers of the
+        last response received, by lowercase name.
+        """
+        curl = CurlStub(b"result")
+        headers = {}
+        fetch("http://example.com", curl=curl, response_headers=headers)
+        header_function = curl.options[pycurl.HEADERFUNCTION]
+        for line in [b"HTTP/1.1 302 Found\r\n", b"Location: /there\r\n",
+                     b"\r\n", b"HTTP/1.1 200 OK\r\n",
+                     b"Accept-Encoding: gzip, zstd\r\n", b"\r\n"]:
+            header_function(line)
+        self.assertEqual({"accept-encoding": "gzip, zstd"}, headers)
+
     def test_cainfo(self):
         curl = CurlStub(b"result")
         result = fetch("https://example.com", cainfo="cainfo", curl=curl)
@@ -165,6 +200,17 @@ class FetchTest(testing.FSTestCase, testing.TwistedTestCase,
                           pycurl.DNS_CACHE_TIMEOUT: 0,
                           pycurl.ENCODING: b"gzip,deflate"})
 
+    def test_without_decode_content(self):
+        """
+        With C{decode_content=False}, curl doesn't decompress responses,
+        nor does it set the C{Accept-Encoding} header of the request.
+        """
+        curl = CurlStub(b"result")
+        self.assertEqual(
+            b"result", fetch("http://example.com", curl=curl,
+                             decode_content=False))
+        self.assertIs(None, curl.options[pycurl.ENCODING])
+
     def test_cainfo_on_http(self):
         curl = CurlStub(b"result")
         result = fetch("http://example.com", cainfo="cainfo", curl=curl)
@@ -402,6 +448,40 @@ class FetchTest(testing.FSTestCase, testing.TwistedTestCase,
         self.assertFailure(result, FirstError)
         return result.addCallback(check_failure)
 
+    def test_fetch_many_async_with_concurrency(self):
+        """
+        L{fetch_many_async} retrieves at most C{concurrency} URLs at the same
+        time.
+        """
+        fetches = {}
+
+        def fetch_async(url, **kwargs):
+            fetches[url] = Deferred()
+            return fetches[url]
+
+        urls = ["http://one/", "http://two/", "http://three/"]
+        results = []
+        with mock.patch("landscape.lib.fetch.fetch_async", fetch_async):
+            result = fetch_many_async(
+                urls, callback=lambda data, url: results.append(data),
+                concurrency=2)
+            self.assertEqual(["http://one/", "http://two/"], sorted(fetches))
+            fetches["http://two/"].callback(b"two")
+            self.assertEqual(3, len(fetches))
+            fetches["http://one/"].callback(b"one")
+            fetches["http://three/"].callback(b"three")
+        self.successResultOf(result)
+        self.assertEqual([b"two", b"one", b"three"], results)
+
+    def test_async_fetch_with_priority(self):
+        """
+        L{fetch_async} accepts the priority of the download in the C{fetch}
+        pool.
+        """
+        curl = CurlStub(b"result")
+        d = fetch_async("http://example.com/", curl=curl, priority=1)
+        return d.addCallback(self.assertEqual, b"result")
+
     def test_url_to_filename(self):
         """
         L{url_to_filename} extracts the filename part of an URL, optionally
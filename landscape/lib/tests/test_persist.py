@@ -2,10 +2,13 @@ import os
 import pprint
 import unittest
 
+import mock
+
 from landscape.lib import testing
 from landscape.lib.persist import (
     path_string_to_tuple, path_tuple_to_string, Persist, RootedPersist,
-    PickleBackend, PersistError, PersistReadOnlyError)
+    PickleBackend, JournaledBPickleBackend, PersistError,
+    PersistReadOnlyError)
 
 
 class PersistHelpersTest(unittest.TestCase):
@@ -27,6 +30,12 @@ class PersistHelpersTest(unittest.TestCase):
 
     def test_path_string_to_tuple_error(self):
         self.assertRaises(PersistError, path_string_to_tuple, "ab[0][c]")
+        self.assertRaises(PersistError, path_string_to_tuple, "ab[0][c]")
+
+    def test_path_string_to_tuple_cached(self):
+        """Parsed path strings are cached."""
+        path = path_string_to_tuple("ab[0].cd")
+        self.assertIs(path, path_string_to_tuple("ab[0].cd"))
 
     def test_path_tuple_to_string(self):
         for path_string, path_tuple in self.paths:
@@ -270,6 +279,17 @@ class GeneralPersistTest(BasePersistTest):
         d["c"] = 2
         self.assertEqual(self.persist.get("a"), d_orig)
 
+    def test_copy_nested_values(self):
+        """Values are copied all the way down."""
+        d = {"b": [{"c": [1]}, (2, [3])], "d": (4, "5")}
+        self.persist.set("a", d)
+        d["b"][0]["c"].append(2)
+        d["b"][1][1].append(4)
+        result = self.persist.get("a")
+        self.assertEqual({"b": [{"c": [1]}, (2, [3])], "d": (4, "5")}, result)
+        result["b"][0]["c"].append(2)
+        self.assertEqual([1], self.persist.get("a.b[0].c"))
+
     def test_root_at(self):
         rooted = self.persist.root_at("my-module")
         rooted.set("option", 1)
@@ -338,6 +358,48 @@ class SaveLoadPersistTest(testing.FSTestCase, BasePersistTest):
         self.assertEqual(result, self.set_result,
                          self.format(result, self.set_result))
 
+    def test_save_resets_modified(self):
+        self.persist.set("ab", 1)
+        self.persist.save(self.makePersistFile())
+        self.assertFalse(self.persist.modified)
+
+    def test_flush(self):
+        """
+        L{Persist.flush} saves the persist only if it was modified since it
+        was last saved to or loaded from the same file.
+        """
+        filename = self.makePersistFile()
+        self.assertTrue(self.persist.flush(filename))
+        self.assertTrue(os.path.isfile(filename))
+        self.assertFalse(self.persist.flush(filename))
+        self.persist.set("a", 1)
+        self.assertTrue(self.persist.flush(filename))
+        self.assertFalse(self.persist.flush(filename))
+        self.assertTrue(self.persist.flush(self.makePersistFile()))
+
+        persist = self.build_persist(filename=filename)
+        self.assertFalse(persist.flush())
+        os.unlink(filename)
+        self.assertTrue(persist.flush())
+        self.assertTrue(os.path.isfile(filename))
+
+    def test_remove_missing_is_not_a_change(self):
+        """Removing something which isn't there doesn't modify the persist."""
+        self.persist.set("a.b", 1)
+        self.persist.reset_modified()
+        self.assertFalse(self.persist.remove("a.c"))
+        self.assertFalse(self.persist.modified)
+
+    def test_write_counts(self):
+        """Writes to the persist are counted by top-level key."""
+        self.persist.set("a.b", 1)
+        self.persist.add("a.c", 2)
+        self.persist.remove("a.b")
+        self.persist.remove("a.d")
+        self.persist.set("b", 1)
+        self.persist.set("c", 1, soft=True)
+        self.assertEqual({"a": 3, "b": 1}, self.persist.write_counts)
+
     def test_save_on_unexistent_dir(self):
         dirname = self.makePersistFile()
         filename = os.path.join(dirname, "foobar")
@@ -448,6 +510,141 @@ class PicklePersistTest(GeneralPersistTest, SaveLoadPersistTest):
         return Persist(PickleBackend(), *args, **kwargs)
 
 
+class JournaledPersistTest(GeneralPersistTest, SaveLoadPersistTest):
+
+    def build_persist(self, *args, **kwargs):
+        return Persist(JournaledBPickleBackend(), *args, **kwargs)
+
+    def setUp(self):
+        super(JournaledPersistTest, self).setUp()
+        self.filename = self.makePersistFile()
+        self.journal = self.filename + ".journal"
+        self.journaled = self.build_persist(filename=self.filename)
+        self.journaled.set("a", {"b": 1, "c": [1, 2]})
+        self.journaled.set("d", "e")
+        self.journaled.save()
+
+    def assertLoads(self, expected):
+        persist = self.build_persist(filename=self.filename)
+        self.assertEqual(expected, persist.get((), hard=True))
+
+    def test_save_changes(self):
+        """Once saved, only the changed paths are appended to a journal."""
+        self.assertFalse(os.path.exists(self.journal))
+        self.journaled.set("a.b", 2)
+        self.journaled.add("a.c", 3)
+        self.journaled.save()
+        snapshot_size = os.path.getsize(self.filename)
+        journal_size = os.path.getsize(self.journal)
+        self.journaled.set("d", "f")
+        self.journaled.save()
+        self.assertEqual(snapshot_size, os.path.getsize(self.filename))
+        self.assertTrue(os.path.getsize(self.journal) > journal_size)
+        self.assertLoads({"a": {"b": 2, "c": [1, 2, 3]}, "d": "f"})
+
+    def test_save_changes_remove(self):
+        """
+        Removed paths are recorded, along with parents which got empty.
+        """
+        self.journaled.set("x.y.z", 1)
+        self.journaled.save()
+        self.journaled.remove("x.y.z")
+        self.journaled.remove("a.b")
+        self.journaled.remove("a.c", 1)
+        self.journaled.move("d", "g.h")
+        self.journaled.save()
+        self.assertLoads({"a": {"c": [2]}, "g": {"h": "e"}})
+
+    def test_save_changes_after_load(self):
+        """A loaded persist saves its changes to the journal as well."""
+        self.journaled.set("d", "f")
+        self.journaled.save()
+        persist = self.build_persist(filename=self.filename)
+        persist.set("a.b", 2)
+        persist.save()
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertLoads({"a": {"b": 2, "c": [1, 2]}, "d": "f"})
+
+    def test_save_other_file(self):
+        """Saving to another file writes a full snapshot of it."""
+        filename = self.makePersistFile()
+        self.journaled.set("d", "f")
+        self.journaled.save(filename)
+        self.assertFalse(os.path.exists(filename + ".journal"))
+        self.assertEqual(
+            "f", self.build_persist(filename=filename).get("d"))
+
+    def test_torn_record(self):
+        """
+        A partially written record is ignored when loading, and dropped by
+        the next save.
+        """
+        self.journaled.set("d", "f")
+        self.journaled.save()
+        with open(self.journal, "ab") as fd:
+            fd.write(b"\x00\x00\x01\x00garbage")
+        persist = self.build_persist(filename=self.filename)
+        self.assertEqual("f", persist.get("d"))
+        persist.set("a.b", 2)
+        persist.save()
+        self.assertLoads({"a": {"b": 2, "c": [1, 2]}, "d": "f"})
+
+    def test_compact(self):
+        """
+        Once the journal outgrows the snapshot, a new snapshot is written
+        and the journal is dropped.
+        """
+        self.journaled._backend.compact_size = 0
+        self.journaled.set("d", "x" * 100)
+        self.journaled.save()
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertLoads({"a": {"b": 1, "c": [1, 2]}, "d": "x" * 100})
+
+    def test_compact_interrupted(self):
+        """
+        If writing a new snapshot is interrupted before the journal is
+        dropped, the journal isn't replayed over the new snapshot.
+        """
+        self.journaled.set("d", "f")
+        self.journaled.save()
+        self.journaled._backend.compact_size = 0
+        self.journaled.set("d", "x" * 100)
+        with mock.patch("os.unlink", side_effect=OSError("crash")):
+            self.assertRaises(OSError, self.journaled.save)
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertLoads({"a": {"b": 1, "c": [1, 2]}, "d": "x" * 100})
+
+    def test_compact_interrupted_with_same_snapshot(self):
+        """
+        If the new snapshot is the same as the one extended by the journal,
+        the journal is dropped before the new snapshot gets written.
+        """
+        self.journaled.set("d", "f")
+        self.journaled.save()
+        self.journaled._backend.compact_size = 0
+        self.journaled.set("d", "e")
+        with mock.patch("os.rename", side_effect=OSError("crash")):
+            self.assertRaises(OSError, self.journaled.save)
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertLoads({"a": {"b": 1, "c": [1, 2]}, "d": "e"})
+
+    def test_save_changes_after_interrupted_compact(self):
+        """
+        A journal left behind by an interrupted compaction is replaced by
+        the next changes.
+        """
+        self.journaled.set("d", "f")
+        self.journaled.save()
+        self.journaled._backend.compact_size = 0
+        self.journaled.set("d", "x" * 100)
+        with mock.patch("os.unlink", side_effect=OSError("crash")):
+            self.assertRaises(OSError, self.journaled.save)
+        persist = self.build_persist(filename=self.filename)
+        persist.set("a.b", 2)
+        persist.save()
+        self.assertLoads({"a": {"b": 2, "c": [1, 2]}, "d": "x" * 100})
+
+
 class RootedPersistTest(GeneralPersistTest):
 
     def build_persist(self, *args, **kwargs):
@@ -1,10 +1,19 @@
+import logging
+import random
+import threading
 import time
 import types
 import unittest
 
+import mock
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
 from landscape.lib import testing
 from landscape.lib.compat import thread
-from landscape.lib.reactor import EventHandlingReactor
+from landscape.lib.reactor import (
+    EventHandlingReactor, PeriodicCall, PeriodicScheduler)
 from landscape.lib.testing import FakeReactor
 
 
@@ -236,6 +245,67 @@ class ReactorTestMixin(object):
         reactor.fire("foobar")
         self.assertEqual(called, [])
 
+    def test_cancel_event_twice(self):
+        """
+        Cancelling an event handler more than once has no effect.
+        """
+        reactor = self.get_reactor()
+        called = []
+        id = reactor.call_on("foobar", called.append)
+        reactor.call_on("foobar", called.append, priority=1)
+        reactor.cancel_call(id)
+        reactor.cancel_call(id)
+        reactor.fire("foobar", 1)
+        self.assertEqual(called, [1])
+
+    def test_event_same_priority(self):
+        """
+        Event handlers with the same priority are run in the order they were
+        registered, even after other handlers were cancelled.
+        """
+        reactor = self.get_reactor()
+        called = []
+        reactor.call_on("foobar", lambda: called.append(1))
+        id = reactor.call_on("foobar", lambda: called.append(2))
+        reactor.call_on("foobar", lambda: called.append(3))
+        reactor.call_on("foobar", lambda: called.append(0), priority=-1)
+        reactor.cancel_call(id)
+        reactor.call_on("foobar", lambda: called.append(4))
+        reactor.fire("foobar")
+        self.assertEqual(called, [0, 1, 3, 4])
+
+    def test_event_timings(self):
+        """
+        The time taken by the handlers of each event type is recorded in an
+        histogram, along with the slowest handler.
+        """
+        reactor = self.get_reactor()
+
+        def slow():
+            time.sleep(0.02)
+
+        reactor.call_on("foobar", lambda: None)
+        reactor.call_on("foobar", slow)
+        reactor.fire("foobar")
+        reactor.fire("foobar")
+        timings = reactor.get_event_timings()["foobar"]
+        self.assertEqual(4, sum(timings.counts))
+        self.assertEqual(2, sum(timings.counts[2:]))
+        self.assertIs(slow, timings.slowest[1])
+        self.assertTrue(timings.total >= 0.04)
+        self.assertIn("slow", repr(timings))
+
+    def test_fire_without_debug_logging(self):
+        """
+        Handlers aren't formatted for debug logging if it's disabled.
+        """
+        reactor = self.get_reactor()
+        reactor.call_on("foobar", lambda: None)
+        self.logger.setLevel(logging.INFO)
+        with mock.patch("landscape.lib.reactor.format_object") as format:
+            reactor.fire("foobar")
+        self.assertFalse(format.called)
+
     def test_run_stop_events(self):
         reactor = self.get_reactor()
 
@@ -444,3 +514,219 @@ class EventHandlingReactorTest(testing.HelperTestCase, ReactorTestMixin,
     def test_real_time(self):
         reactor = self.get_reactor()
         self.assertTrue(reactor.time() - time.time() < 3)
+
+    def test_call_every_coalesced(self):
+        """
+        Calls every second or more are handled by a L{PeriodicScheduler}
+        shared by all the reactors.
+        """
+        reactor1 = self.get_reactor()
+        call = reactor1.call_every(60, lambda: None)
+        self.assertTrue(isinstance(call, PeriodicCall))
+        reactor2 = EventHandlingReactor.__new__(EventHandlingReactor)
+        reactor2._scheduler = reactor1._scheduler
+        reactor2.call_every(60, lambda: None)
+        stats = reactor1.get_scheduler_stats()
+        self.assertEqual(2, stats["calls"])
+        self.assertEqual(1, stats["slots"])
+        reactor1.cancel_call(call)
+        self.assertEqual(1, reactor1.get_scheduler_stats()["calls"])
+        reactor1._cleanup()
+        self.assertEqual(0, reactor1.get_scheduler_stats()["calls"])
+
+    def test_call_in_pool(self):
+        """
+        Calls in different pools don't wait for each other, so a blocked
+        ping doesn't delay the exchanges.
+        """
+        reactor = self.get_reactor()
+        event = threading.Event()
+        called = []
+
+        def exchanged(result):
+            called.append(result)
+            event.set()
+
+        reactor.call_in_pool("ping", None, None, event.wait, 5)
+        reactor.call_in_thread(exchanged, None, lambda: "exchanged")
+
+        reactor.call_later(0.7, reactor.stop)
+        reactor.run()
+        event.set()
+
+        self.assertEqual(["exchanged"], called)
+
+
+class PeriodicSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        super(PeriodicSchedulerTest, self).setUp()
+        self.clock = Clock()
+        self.clock.advance(1000.5)
+        self.scheduler = PeriodicScheduler(self.clock, jitter=0)
+
+    def test_call_every(self):
+        """
+        The first call is one interval away, and the next ones are aligned
+        on multiples of the interval. Calls are performed at most one slot
+        later than their due time.
+        """
+        calls = []
+        self.scheduler.call_every(
+            10, lambda: calls.append(self.clock.seconds()))
+        self.clock.advance(10)
+        self.assertEqual([], calls)
+        self.clock.advance(0.5)
+        self.assertEqual([1011], calls)
+        self.clock.advance(9)
+        self.clock.advance(10)
+        self.assertEqual([1011, 1020, 1030], calls)
+
+    def test_call_every_coalesced(self):
+        """
+        After their first run, calls with the same interval are performed in
+        the same wake-up, even if they were scheduled at different times.
+        """
+        calls = []
+        self.scheduler.call_every(10, calls.append, 1)
+        self.clock.advance(3)
+        self.scheduler.call_every(10, calls.append, 2)
+        self.scheduler.call_every(5, calls.append, 3)
+        self.clock.pump([0.5] * 33)
+        self.assertEqual([3, 1, 2, 3, 1, 2, 3], calls)
+        self.assertEqual(5, self.scheduler.wakeups)
+        self.clock.pump([5, 5])
+        self.assertEqual([3, 1, 2, 3, 1, 2, 3, 3, 1, 2, 3], calls)
+        self.assertEqual(7, self.scheduler.wakeups)
+
+    def test_jitter(self):
+        """
+        The multiples of the intervals are counted from an origin picked at
+        random within C{jitter} seconds, and calls with intervals which are
+        multiples of each other are still performed in the same wake-up.
+        """
+        with mock.patch("random.uniform", return_value=1234.5) as uniform:
+            scheduler = PeriodicScheduler(self.clock, jitter=3600)
+        uniform.assert_called_once_with(0, 3600)
+        calls = []
+        scheduler.call_every(
+            10, lambda: calls.append((10, self.clock.seconds())))
+        scheduler.call_every(
+            5, lambda: calls.append((5, self.clock.seconds())))
+        self.clock.pump([0.5] * 39)
+        self.assertEqual(
+            [(5, 1006), (5, 1010), (10, 1011), (5, 1015), (5, 1020)], calls)
+        self.clock.advance(5)
+        self.assertEqual([(10, 1025), (5, 1025)], calls[5:])
+        self.assertEqual(6, scheduler.wakeups)
+
+    def test_cancel(self):
+        """
+        Cancelled calls are not performed anymore, even if they were due in
+        the current wake-up.
+        """
+        calls = []
+        call1 = self.scheduler.call_every(10, calls.append, 1)
+        call2 = self.scheduler.call_every(10, calls.append, 2)
+        self.scheduler.call_every(10, call2.stop)
+        self.clock.advance(10.5)
+        self.assertEqual([1, 2], calls)
+        call1.stop()
+        call1.stop()
+        self.clock.advance(10)
+        self.assertEqual([1, 2], calls)
+        self.assertEqual(1, self.scheduler.get_stats()["calls"])
+
+    def test_cancel_last_call(self):
+        """
+        No timer is left behind once all the calls are cancelled.
+        """
+        call = self.scheduler.call_every(10, lambda: None)
+        self.scheduler.cancel(call)
+        self.clock.advance(10)
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.assertEqual(0, self.scheduler.wakeups)
+
+    def test_clear(self):
+        """
+        L{PeriodicScheduler.clear} cancels all the calls.
+        """
+        calls = []
+        call = self.scheduler.call_every(10, calls.append, 1)
+        self.scheduler.clear()
+        self.clock.advance(10)
+        self.assertEqual([], calls)
+        self.assertFalse(call.active)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_error(self):
+        """
+        A call raising an error is logged and not performed anymore.
+        """
+        calls = []
+
+        def explode():
+            calls.append(True)
+            raise RuntimeError("boom")
+
+        self.scheduler.call_every(10, calls.append, 1)
+        with mock.patch("landscape.lib.reactor.logging") as logging:
+            call = self.scheduler.call_every(10, explode)
+            self.clock.advance(10.5)
+            self.clock.advance(9.5)
+        self.assertEqual([1, True, 1], calls)
+        self.assertFalse(call.active)
+        self.assertEqual(1, logging.exception.call_count)
+
+    def test_deferred(self):
+        """
+        A call returning a L{Deferred} is skipped until the L{Deferred}
+        fires.
+        """
+        deferreds = []
+
+        def call():
+            deferreds.append(Deferred())
+            return deferreds[-1]
+
+        self.scheduler.call_every(10, call)
+        self.clock.advance(20)
+        self.assertEqual(1, len(deferreds))
+        deferreds[0].callback(None)
+        self.clock.advance(10)
+        self.assertEqual(2, len(deferreds))
+
+    def test_fell_behind(self):
+        """
+        If the scheduler couldn't wake up on time, missed runs are skipped.
+        """
+        calls = []
+        self.scheduler.call_every(
+            10, lambda: calls.append(self.clock.seconds()))
+        self.clock.advance(35)
+        self.clock.advance(10)
+        self.assertEqual([1035.5, 1045.5], calls)
+
+    def test_clones_wakeups(self):
+        """
+        Clients sharing the same process wake the reactor up once per
+        distinct due time, instead of once per periodic call.
+        """
+        random.seed(0)
+        intervals = [5, 20, 30, 60, 300]
+        clones = 100
+        for i in range(clones):
+            self.clock.advance(random.random())
+            for interval in intervals:
+                self.scheduler.call_every(interval, lambda: None)
+        self.clock.advance(3600 - (self.clock.seconds() % 3600))
+        wakeups = self.scheduler.wakeups
+        runs = self.scheduler.runs
+        for i in range(60):
+            self.clock.advance(1)
+        per_minute = self.scheduler.wakeups - wakeups
+        # Each of these calls would have its own timer with LoopingCall.
+        looping_calls = clones * sum(60 // i for i in intervals if i <= 60)
+        self.assertEqual(looping_calls, self.scheduler.runs - runs)
+        self.assertEqual(1800, looping_calls)
+        self.assertEqual(12, per_minute)
@@ -2,7 +2,7 @@ import unittest
 
 from landscape.lib.schema import (
     InvalidError, Constant, Bool, Int, Float, Bytes, Unicode, List, KeyDict,
-    Dict, Tuple, Any)
+    Dict, Tuple, Any, compile_schema)
 
 from twisted.python.compat import long
 
@@ -201,3 +201,80 @@ class BasicTypesTest(unittest.TestCase):
 
     def test_dict_wrong_type(self):
         self.assertRaises(InvalidError, Dict(Int(), Int()).coerce, 32)
+
+
+class CompiledSchemaTest(unittest.TestCase):
+
+    def test_type_checks(self):
+        self.assertEqual(3, compile_schema(Int())(3))
+        self.assertEqual(3, compile_schema(Float())(3))
+        self.assertEqual(True, compile_schema(Bool())(True))
+        self.assertEqual(b"foo", compile_schema(Bytes())(b"foo"))
+        self.assertRaises(InvalidError, compile_schema(Bool()), 1)
+        self.assertRaises(InvalidError, compile_schema(Bytes()), u"foo")
+
+    def test_unicode(self):
+        coerce = compile_schema(Unicode())
+        self.assertEqual(u"foo", coerce(u"foo"))
+        self.assertEqual(u"\N{HIRAGANA LETTER A}",
+                         coerce(u"\N{HIRAGANA LETTER A}".encode("utf-8")))
+        self.assertRaises(InvalidError, coerce, b"\xff")
+        self.assertRaises(InvalidError, coerce, 32)
+
+    def test_same_error(self):
+        """
+        Errors are the same as the ones raised by the schema itself.
+        """
+        schema = KeyDict({"foo": List(Tuple(Int(), Unicode()))})
+        value = {"foo": [(1, u"a"), (2, 3)]}
+        with self.assertRaises(InvalidError) as error:
+            schema.coerce(value)
+        with self.assertRaises(InvalidError) as compiled_error:
+            compile_schema(schema)(value)
+        self.assertEqual(str(error.exception), str(compiled_error.exception))
+
+    def test_no_copy(self):
+        """Values which don't need coercion are returned as they are."""
+        schema = KeyDict({"a": List(Any(Tuple(Int(), Int()), Int())),
+                          "b": Dict(Unicode(), Tuple(Float(), Unicode())),
+                          "c": Any(Unicode(), Constant(None))},
+                         optional=["c"])
+        value = {"a": [1, (2, 3), 4], "b": {u"x": (1.5, u"y")}, "c": None}
+        self.assertIs(value, compile_schema(schema)(value))
+
+    def test_copy_on_coercion(self):
+        """
+        Containers with values needing coercion are copied, leaving the
+        original ones alone.
+        """
+        schema = KeyDict({"a": List(Unicode()), "b": Dict(Unicode(), Int()),
+                          "c": Tuple(Int(), Unicode())})
+        value = {"a": [u"x", b"y"], "b": {u"x": 1, b"y": 2},
+                 "c": (1, b"z")}
+        result = compile_schema(schema)(value)
+        self.assertEqual({"a": [u"x", u"y"], "b": {u"x": 1, u"y": 2},
+                          "c": (1, u"z")}, result)
+        self.assertEqual({"a": [u"x", b"y"], "b": {u"x": 1, b"y": 2},
+                          "c": (1, b"z")}, value)
+        self.assertIs(result["a"][0], value["a"][0])
+
+    def test_any(self):
+        """The first alternative which matches is used."""
+        coerce = compile_schema(Any(Constant(None), Tuple(Int()), Unicode()))
+        self.assertEqual(None, coerce(None))
+        self.assertEqual((1,), coerce((1,)))
+        self.assertEqual(u"foo", coerce(b"foo"))
+        self.assertRaises(InvalidError, coerce, (u"foo",))
+
+    def test_key_dict(self):
+        schema = KeyDict({"foo": Int(), "bar": Int()}, optional=["bar"])
+        coerce = compile_schema(schema)
+        self.assertEqual({"foo": 32}, coerce({"foo": 32}))
+        self.assertRaises(InvalidError, coerce, {"bar": 32})
+        self.assertRaises(InvalidError, coerce, {"foo": 1, "baz": 32})
+        self.assertRaises(InvalidError, coerce, [])
+
+    def test_schema_without_compile(self):
+        """Schemas without a C{compile} method are simply called."""
+        coerce = compile_schema(List(Tuple(Int(), DummySchema())))
+        self.assertEqual([(1, "hello!")], coerce([(1, object())]))
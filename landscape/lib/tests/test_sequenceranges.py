@@ -2,7 +2,9 @@ import unittest
 
 from landscape.lib.sequenceranges import (
     SequenceRanges, remove_from_ranges, add_to_ranges, find_ranges_index,
-    ranges_to_sequence, sequence_to_ranges, SequenceError)
+    ranges_to_sequence, sequence_to_ranges, SequenceError,
+    sequence_to_bitmap, bitmap_to_ranges, bitmap_to_sequence,
+    bitmap_to_bytes, bytes_to_bitmap, count_bitmap)
 
 
 class SequenceRangesTest(unittest.TestCase):
@@ -301,3 +303,46 @@ def test_suite():
         unittest.makeSuite(AddToRangesTest),
         unittest.makeSuite(RemoveFromRangesTest),
     ))
+
+
+class BitmapTest(unittest.TestCase):
+
+    def test_sequence_to_bitmap(self):
+        self.assertEqual(0, sequence_to_bitmap([]))
+        self.assertEqual(0b100101, sequence_to_bitmap([0, 2, 5]))
+        self.assertEqual(1 << 100, sequence_to_bitmap([100]))
+
+    def test_sequence_to_bitmap_negative(self):
+        self.assertRaises(ValueError, sequence_to_bitmap, [-1, 3])
+
+    def test_bitmap_to_ranges(self):
+        """
+        L{bitmap_to_ranges} gives the same items as L{sequence_to_ranges}
+        does for the sorted positions of the bits.
+        """
+        sequence = [0, 1, 2, 4, 5, 7, 8, 9, 10, 15, 16, 17, 18, 40, 41,
+                    1000, 1002, 1003, 1004, 100000]
+        self.assertEqual(
+            list(sequence_to_ranges(sequence)),
+            list(bitmap_to_ranges(sequence_to_bitmap(sequence))))
+
+    def test_bitmap_to_ranges_empty(self):
+        self.assertEqual([], list(bitmap_to_ranges(0)))
+
+    def test_bitmap_to_sequence(self):
+        sequence = [3, 7, 8, 9, 64, 65, 66, 67, 5000]
+        bitmap = sequence_to_bitmap(sequence)
+        self.assertEqual(sequence, list(bitmap_to_sequence(bitmap)))
+
+    def test_bitmap_bytes(self):
+        """
+        Bitmaps are converted to and from little-endian bytes.
+        """
+        self.assertEqual(b"\x01\x01", bitmap_to_bytes(257))
+        self.assertEqual(b"", bitmap_to_bytes(0))
+        self.assertEqual(257, bytes_to_bitmap(b"\x01\x01"))
+        self.assertEqual(0, bytes_to_bitmap(b""))
+
+    def test_count_bitmap(self):
+        self.assertEqual(0, count_bitmap(0))
+        self.assertEqual(4, count_bitmap(sequence_to_bitmap([1, 2, 3, 900])))
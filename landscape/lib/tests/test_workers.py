@@ -0,0 +1,108 @@
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.defer import gatherResults
+from twisted.trial.unittest import TestCase
+
+from landscape.lib.workers import (
+    WorkerPool, get_pool, get_pools_stats, set_clients)
+
+
+class WorkerPoolTest(TestCase):
+
+    def setUp(self):
+        super(WorkerPoolTest, self).setUp()
+        self.pool = WorkerPool("test", 1)
+
+    def test_run(self):
+        """
+        L{WorkerPool.run} calls a function in a separate thread and returns
+        a L{Deferred} resulting in its return value.
+        """
+        main_thread = threading.current_thread()
+        result = self.pool.run(
+            lambda value: (threading.current_thread(), value), 123)
+
+        def check(result):
+            thread, value = result
+            self.assertIsNot(main_thread, thread)
+            self.assertEqual(123, value)
+            stats = self.pool.get_stats()
+            self.assertEqual(1, stats["completed"])
+            self.assertEqual(0, stats["running"])
+
+        return result.addCallback(check)
+
+    def test_run_with_error(self):
+        """
+        If the function raises an error, the L{Deferred} returned by
+        L{WorkerPool.run} fails.
+        """
+        result = self.pool.run(lambda: 1 / 0)
+        self.assertFailure(result, ZeroDivisionError)
+        return result.addCallback(
+            lambda ignored: self.assertEqual(
+                1, self.pool.get_stats()["failed"]))
+
+    def test_run_with_priority(self):
+        """
+        Calls are run at most C{size} at a time, and queued calls with a
+        higher priority are run first.
+        """
+        event = threading.Event()
+        calls = []
+        results = [self.pool.run(event.wait, 10)]
+        results.append(self.pool.run(calls.append, "low"))
+        results.append(self.pool.run_with_priority(1, calls.append, "high"))
+        results.append(self.pool.run(calls.append, "low again"))
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats["running"])
+        self.assertEqual(3, stats["queue-depth"])
+        self.assertEqual(3, stats["max-queue-depth"])
+        event.set()
+
+        def check(ignored):
+            self.assertEqual(["high", "low", "low again"], calls)
+            stats = self.pool.get_stats()
+            self.assertEqual(0, stats["queue-depth"])
+            self.assertEqual(4, stats["queued"])
+            self.assertEqual(4, stats["completed"])
+            self.assertTrue(stats["wait-time"] > 0)
+
+        return gatherResults(results).addCallback(check)
+
+    def test_get_pool(self):
+        """
+        L{get_pool} returns the same pool for the same name, and the stats
+        of the pools are available with L{get_pools_stats}.
+        """
+        pool = get_pool("fetch")
+        self.assertIs(pool, get_pool("fetch"))
+        self.assertEqual(4, pool.size)
+        self.assertIn("fetch", get_pools_stats())
+
+    def test_set_clients(self):
+        """
+        L{set_clients} scales the pools used by each client, and the reactor
+        thread pool along with them.
+        """
+        self.addCleanup(set_clients, 1)
+        set_clients(10)
+        self.assertEqual(10, get_pool("exchange").size)
+        self.assertEqual(10, get_pool("ping").size)
+        self.assertEqual(4, get_pool("fetch").size)
+        self.assertEqual(26, reactor.getThreadPool().max)
+        set_clients(1)
+        self.assertEqual(1, get_pool("exchange").size)
+        self.assertEqual(10, reactor.getThreadPool().max)
+
+    def test_resize(self):
+        """
+        Growing a pool runs the calls which were queued.
+        """
+        event = threading.Event()
+        results = [self.pool.run(event.wait, 10), self.pool.run(event.set)]
+        self.assertEqual(1, self.pool.get_stats()["queue-depth"])
+        self.pool.resize(2)
+        self.assertEqual(2, self.pool.get_stats()["running"])
+        return gatherResults(results)
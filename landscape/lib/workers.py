@@ -0,0 +1,166 @@
+"""Named pools of worker threads for running blocking calls.
+
+Each class of workload (message exchanges, pings, URL fetches, process I/O)
+gets its own bounded pool, so that, for instance, a burst of attachment
+downloads or a ping server which doesn't answer can't delay the message
+exchange with the server.
+
+The threads are taken from the Twisted reactor thread pool, whose default
+size is 10, so the sizes of our pools add up to less than that, leaving each
+pool guaranteed room.
+"""
+import heapq
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+
+# The maximum number of threads of the pools, by name.
+POOL_SIZES = {
+    "exchange": 1,
+    "ping": 1,
+    "fetch": 4,
+    "process": 2,
+}
+
+# The pools used by each client, whose sizes above are multiplied by the
+# number of clients running in the process, see L{set_clients}.
+CLIENT_POOLS = ("exchange", "ping")
+
+# The default size of the reactor thread pool.
+REACTOR_POOL_SIZE = 10
+
+
+class WorkerPool(object):
+    """A bounded pool of threads running calls in priority order.
+
+    Calls are queued in the reactor thread and handed to the reactor thread
+    pool only when fewer than C{size} of them are running, so the order of
+    the queue is honored.
+
+    @param name: The name of the pool.
+    @param size: The maximum number of calls running at the same time.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._queue = []
+        self._sequence = 0
+        self._running = 0
+        self._stats = {"queued": 0, "max-queue-depth": 0, "completed": 0,
+                       "failed": 0, "wait-time": 0.0, "run-time": 0.0}
+
+    def run(self, f, *args, **kwargs):
+        """Call C{f} in a thread of the pool.
+
+        @return: A L{Deferred} resulting in the return value of C{f}.
+        """
+        return self.run_with_priority(0, f, *args, **kwargs)
+
+    def run_with_priority(self, priority, f, *args, **kwargs):
+        """Call C{f} in a thread of the pool, with the given C{priority}.
+
+        Calls with a higher priority run first, calls with the same priority
+        run in the order they were queued.
+
+        @return: A L{Deferred} resulting in the return value of C{f}.
+        """
+        deferred = Deferred()
+        self._sequence += 1
+        heapq.heappush(self._queue, (-priority, self._sequence, time.time(),
+                                     deferred, f, args, kwargs))
+        self._stats["queued"] += 1
+        self._stats["max-queue-depth"] = max(
+            self._stats["max-queue-depth"], len(self._queue))
+        self._run_queued()
+        return deferred
+
+    def resize(self, size):
+        """Change the maximum number of calls running at the same time."""
+        self.size = size
+        self._run_queued()
+
+    def get_stats(self):
+        """Return a C{dict} with statistics about the pool.
+
+        It holds the current C{queue-depth} and number of C{running} calls,
+        the C{max-queue-depth} reached, the number of C{queued},
+        C{completed} and C{failed} calls, and the total C{wait-time} spent
+        queued and C{run-time} spent running by the finished calls.
+        """
+        stats = dict(self._stats)
+        stats["queue-depth"] = len(self._queue)
+        stats["running"] = self._running
+        return stats
+
+    def _run_queued(self):
+        while self._queue and self._running < self.size:
+            _, _, queued, deferred, f, args, kwargs = heapq.heappop(
+                self._queue)
+            self._running += 1
+            started = time.time()
+            self._stats["wait-time"] += started - queued
+            result = deferToThread(f, *args, **kwargs)
+            result.addBoth(self._finished, started)
+            result.chainDeferred(deferred)
+
+    def _finished(self, result, started):
+        self._running -= 1
+        self._stats["run-time"] += time.time() - started
+        if isinstance(result, Failure):
+            self._stats["failed"] += 1
+        else:
+            self._stats["completed"] += 1
+        self._run_queued()
+        return result
+
+
+_pools = {}
+_clients = 1
+
+
+def get_pool_size(name):
+    """Return the size of the pool with the given C{name}.
+
+    It's taken from L{POOL_SIZES}, for each client in the process in the
+    case of the L{CLIENT_POOLS}.
+    """
+    size = POOL_SIZES[name]
+    if name in CLIENT_POOLS:
+        size *= _clients
+    return size
+
+
+def get_pool(name):
+    """Return the L{WorkerPool} with the given C{name}, creating it if needed.
+
+    The size of the pool is given by L{get_pool_size}.
+    """
+    pool = _pools.get(name)
+    if pool is None:
+        pool = _pools[name] = WorkerPool(name, get_pool_size(name))
+    return pool
+
+
+def set_clients(count):
+    """Size the pools for C{count} clients running in the process.
+
+    Load tests run clones of a client in the same process, each of them
+    exchanging messages and pinging on its own. The L{CLIENT_POOLS} are
+    scaled accordingly, and the reactor thread pool is grown to fit them.
+    """
+    global _clients
+    _clients = count
+    for name, pool in _pools.items():
+        pool.resize(get_pool_size(name))
+    size = sum(get_pool_size(name) for name in POOL_SIZES)
+    reactor.suggestThreadPoolSize(max(REACTOR_POOL_SIZE, size))
+
+
+def get_pools_stats():
+    """Return a C{dict} mapping the names of the pools to their stats."""
+    return dict((name, pool.get_stats()) for name, pool in _pools.items())
@@ -37,3 +37,14 @@ class Message(KeyDict):
                 # the new field yet.
                 value.pop(k)
         return super(Message, self).coerce(value)
+
+    def compile(self):
+        schema = self.schema
+        coerce = super(Message, self).compile()
+
+        def coerce_message(value):
+            for k in list(value.keys()):
+                if k not in schema:
+                    value.pop(k)
+            return coerce(value)
+        return coerce_message
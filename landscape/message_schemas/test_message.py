@@ -1,7 +1,8 @@
 import unittest
 
-from landscape.lib.schema import Int
+from landscape.lib.schema import InvalidError, Int, compile_schema
 from landscape.message_schemas.message import Message
+from landscape.message_schemas.server_bound import message_schemas
 
 
 class MessageTest(unittest.TestCase):
@@ -51,3 +52,17 @@ class MessageTest(unittest.TestCase):
         schema = Message("foo", {})
         self.assertEqual({"type": "foo"},
                          schema.coerce({"type": "foo", "crap": 123}))
+
+    def test_compile(self):
+        """
+        The compiled L{Message} schema discards unknown fields too.
+        """
+        coerce = compile_schema(Message("foo", {"data": Int()}))
+        self.assertEqual({"type": "foo", "data": 3},
+                         coerce({"type": "foo", "data": 3, "crap": 123}))
+
+    def test_compile_server_bound(self):
+        """All the server bound message schemas can be compiled."""
+        for schema in message_schemas:
+            coerce = compile_schema(schema)
+            self.assertRaises(InvalidError, coerce, {"type": "not-a-type"})
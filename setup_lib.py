@@ -1,5 +1,8 @@
 #!/usr/bin/python
 
+import sys
+
+from distutils.core import Extension
 
 NAME = "landscape-lib",
 DESCRIPTION = "Common code used by Landscape applications"
@@ -14,6 +17,12 @@ MODULES = [
         "landscape.constants",
         ]
 SCRIPTS = []
+EXT_MODULES = []
+if sys.version_info[0] >= 3:
+    # Optional accelerator, landscape.lib.bpickle works without it.
+    EXT_MODULES.append(Extension(
+        "landscape.lib._bpickle", ["landscape/lib/_bpickle.c"],
+        optional=True))
 
 # Dependencies
 
@@ -37,4 +46,5 @@ if __name__ == "__main__":
         packages=PACKAGES,
         modules=MODULES,
         scripts=SCRIPTS,
+        ext_modules=EXT_MODULES,
         )